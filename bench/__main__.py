@@ -0,0 +1,423 @@
+'''
+This file implements the load generator for both chat servers (the `bench` entry point).
+
+A server is launched on localhost (part 1 over the custom wire protocol, part 2 over gRPC)
+and --clients simulated users each create an account, then issue operations drawn from
+--mix for --duration seconds, either back to back or paced to an overall --rate:
+    - create: create a new account (part 1: on a fresh connection)
+    - login:  log into the client's own account (part 1: on a fresh connection)
+    - send:   send a --message-size message to a random other client
+    - list:   list all accounts
+    - delete: delete the client's account (then quietly create a new one to carry on)
+Per-operation and overall p50/p99/p999 latency, operations and messages per second, and the
+server's CPU use and RSS (from /proc) are printed, and written as JSON with --json so runs
+can be compared over time.
+
+Usage: python3 -m bench part1|part2 [--mode MODE] [--clients 50] [--duration 10] [--rate OPS_PER_S]
+                                    [--mix send=70,list=10,login=10,create=5,delete=5] [--json PATH]
+'''
+# Import relevant python packages
+from argparse import ArgumentParser, ArgumentTypeError
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+import platform
+import random
+import resource
+from socket import create_connection, socket, AF_INET, SOCK_STREAM, IPPROTO_TCP, TCP_NODELAY
+import subprocess
+import sys
+from threading import Thread
+import time
+
+import grpc
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(ROOT, 'part_1'))
+sys.path.insert(0, os.path.join(ROOT, 'part_2'))
+from protocol import connect_hello
+from protos import chat_pb2, chat_pb2_grpc
+
+# Constants/configurations
+ENCODING    = 'utf-8' # message encoding
+BUFFER_SIZE = 2048 # fixed 2KB buffer size
+HOST        = '127.0.0.1'
+SERVERS     = {
+    'part1': (os.path.join(ROOT, 'part_1', 'server.py'), ['threaded', 'selectors']),
+    'part2': (os.path.join(ROOT, 'part_2', 'server.py'), ['threaded', 'aio']),
+}
+OPERATIONS  = ['create', 'login', 'send', 'list', 'delete']
+DEFAULT_MIX = 'send=70,list=10,login=10,create=5,delete=5'
+PASSWORD    = 'password'
+MENU        = '5. Groups.' # end of the part 1 menu prompt
+
+# Parse "op=weight,..." into {op: weight}
+def parse_mix(text):
+    mix = {}
+    for item in text.split(','):
+        operation, _, weight = item.partition('=')
+        if operation not in OPERATIONS:
+            raise ArgumentTypeError('unknown operation {!r} (choose from {})'.format(operation, ', '.join(OPERATIONS)))
+        try:
+            mix[operation] = float(weight) if weight else 1.0
+        except ValueError:
+            raise ArgumentTypeError('invalid weight {!r} for {}'.format(weight, operation))
+    if sum(mix.values()) <= 0:
+        raise ArgumentTypeError('mix needs at least one positive weight')
+    return mix
+
+# Read from sock until one of tokens shows up in the received text
+def expect_any(sock, tokens):
+    received = ''
+    while not any(token in received for token in tokens):
+        data = sock.recv(BUFFER_SIZE)
+        if not data:
+            raise ConnectionError('server closed connection while waiting for {!r}'.format(tokens))
+        received += data.decode(encoding=ENCODING)
+    return received
+
+# Read from sock until token shows up in the received text
+def expect(sock, token):
+    return expect_any(sock, [token])
+
+class Part1Client:
+    '''
+    One simulated part 1 user
+        - sock: logged in session, left at the menu between operations
+        - username: the account the session belongs to
+        - name, created: new accounts are named name.1, name.2, ...
+        - framed: speak the length-prefixed framing protocol instead of raw text
+        - peers: every client, to pick message recipients from
+    '''
+    def __init__(self, port, username, framed, peers) -> None:
+        self.port     = port
+        self.username = username
+        self.name     = username
+        self.created  = 0
+        self.framed   = framed
+        self.peers    = peers
+        self.sock     = self.create(username)
+
+    # Open a connection and wait for the welcome prompt
+    def connect(self):
+        sock = create_connection((HOST, self.port))
+        sock.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
+        if self.framed:
+            sock = connect_hello(sock)
+        expect(sock, '2. Login')
+        return sock
+
+    # Create username on a new connection; returns it at the menu
+    def create(self, username):
+        sock = self.connect()
+        sock.send(b'1')
+        expect(sock, 'username: ')
+        sock.send(username.encode(encoding=ENCODING))
+        expect(sock, 'password.')
+        sock.send(PASSWORD.encode(encoding=ENCODING))
+        expect(sock, MENU)
+        return sock
+
+    # Next unused account name of this client
+    def new_username(self):
+        self.created += 1
+        return '{}.{}'.format(self.name, self.created)
+
+    def op_create(self, message):
+        self.create(self.new_username()).close()
+
+    def op_login(self, message):
+        sock = self.connect()
+        sock.send(b'2')
+        expect(sock, 'username.')
+        sock.send(self.username.encode(encoding=ENCODING))
+        expect(sock, 'password.')
+        sock.send(PASSWORD.encode(encoding=ENCODING))
+        expect(sock, MENU)
+        sock.close()
+
+    def op_send(self, message):
+        self.sock.send(b'1')
+        expect(self.sock, 'recipient:')
+        self.sock.send(random.choice(self.peers).username.encode(encoding=ENCODING))
+        # The recipient may have just deleted its account
+        if 'message: ' in expect_any(self.sock, ['message: ', MENU]):
+            self.sock.send(message.encode(encoding=ENCODING))
+            expect(self.sock, MENU)
+
+    def op_list(self, message):
+        self.sock.send(b'2')
+        expect(self.sock, MENU)
+
+    def op_delete(self, message):
+        self.sock.send(b'3')
+        expect(self.sock, 'delete your current account')
+        self.sock.send(b'confirm')
+        # The server closes the connection once the account is gone
+        while self.sock.recv(BUFFER_SIZE):
+            pass
+        self.sock.close()
+        self.reset()
+
+    # Start over with a fresh account (after a delete or a failed operation)
+    def reset(self):
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+        self.username = self.new_username()
+        self.sock = self.create(self.username)
+
+class Part2Client:
+    '''
+    One simulated part 2 user
+        - stub: ChatApp stub on a channel shared with other clients
+        - username: the client's account
+        - name, created: new accounts are named name.1, name.2, ...
+        - peers: every client, to pick message recipients from
+    '''
+    def __init__(self, stub, username, peers) -> None:
+        self.stub     = stub
+        self.username = username
+        self.name     = username
+        self.created  = 0
+        self.peers    = peers
+        self.stub.CreateAccount(chat_pb2.AccountInfo(username=username, password=PASSWORD))
+
+    # Next unused account name of this client
+    def new_username(self):
+        self.created += 1
+        return '{}.{}'.format(self.name, self.created)
+
+    def op_create(self, message):
+        self.stub.CreateAccount(chat_pb2.AccountInfo(username=self.new_username(), password=PASSWORD))
+
+    def op_login(self, message):
+        self.stub.LoginAccount(chat_pb2.AccountInfo(username=self.username, password=PASSWORD))
+
+    def op_send(self, message):
+        dst_username = random.choice(self.peers).username
+        self.stub.SendMessage(chat_pb2.Msg(src_username=self.username, dst_username=dst_username, msg=message))
+
+    def op_list(self, message):
+        self.stub.ListAccounts(chat_pb2.Empty())
+
+    def op_delete(self, message):
+        self.stub.DeleteAccount(chat_pb2.AccountInfo(username=self.username, password=PASSWORD))
+        self.reset()
+
+    def reset(self):
+        self.username = self.new_username()
+        self.stub.CreateAccount(chat_pb2.AccountInfo(username=self.username, password=PASSWORD))
+
+# Launch the server and wait until it accepts connections
+def start_server(args):
+    path, _ = SERVERS[args.server]
+    command = [sys.executable, path, '--mode', args.mode, '--host', HOST, '--port', str(args.port)] + args.server_arg
+    process = subprocess.Popen(command, cwd=os.path.dirname(path), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError('server exited with status {}'.format(process.returncode))
+        try:
+            if args.server == 'part1':
+                probe = socket(AF_INET, SOCK_STREAM)
+                probe.connect((HOST, args.port))
+                # Drain the welcome prompt and leave politely so the threaded accept loop moves on
+                expect(probe, '2. Login')
+                probe.close()
+            else:
+                with grpc.insecure_channel('{}:{}'.format(HOST, args.port)) as channel:
+                    grpc.channel_ready_future(channel).result(timeout=1)
+            return process
+        except (OSError, grpc.FutureTimeoutError):
+            time.sleep(0.05)
+    process.kill()
+    raise RuntimeError('{} server did not start'.format(args.server))
+
+# CPU seconds (user + system) used so far by pid
+def cpu_seconds(pid):
+    with open('/proc/{}/stat'.format(pid)) as stat:
+        fields = stat.read().rsplit(')', 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+# Read a field (e.g. VmRSS, VmHWM) in KiB from /proc/PID/status
+def proc_status(pid, field):
+    with open('/proc/{}/status'.format(pid)) as status:
+        for line in status:
+            if line.startswith(field + ':'):
+                return int(line.split()[1])
+    return None
+
+def percentile(samples, p):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p))]
+
+def summarize(latencies, errors, seconds):
+    summary = {'count': len(latencies), 'errors': errors, 'ops_per_s': len(latencies) / seconds}
+    if latencies:
+        summary.update({
+            'mean_ms': sum(latencies) / len(latencies),
+            'p50_ms':  percentile(latencies, 0.50),
+            'p99_ms':  percentile(latencies, 0.99),
+            'p999_ms': percentile(latencies, 0.999),
+            'max_ms':  max(latencies),
+        })
+    return summary
+
+# Issue operations until stop_at, pacing to interval seconds apart (0: back to back);
+# samples taken before record_at (warmup) are dropped
+def drive(client, mix, message, interval, record_at, stop_at, latencies, errors):
+    operations, weights = list(mix), list(mix.values())
+    next_at = time.perf_counter() + random.uniform(0, interval)
+    while True:
+        if interval:
+            delay = next_at - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            next_at += interval
+        start = time.perf_counter()
+        if start >= stop_at:
+            return
+        operation = random.choices(operations, weights)[0]
+        try:
+            getattr(client, 'op_' + operation)(message)
+        except (OSError, grpc.RpcError):
+            if start >= record_at:
+                errors[operation] += 1
+            try:
+                client.reset()
+            except (OSError, grpc.RpcError):
+                return
+            continue
+        if start >= record_at:
+            latencies[operation].append((time.perf_counter() - start) * 1000)
+
+def run(args):
+    process = start_server(args)
+    channels = []
+    try:
+        # Set up every client (and its account) before the clock starts
+        clients = []
+        if args.server == 'part1':
+            for index in range(args.clients):
+                clients.append(Part1Client(args.port, 'load{}'.format(index), not args.text, clients))
+        else:
+            channels = [grpc.insecure_channel('{}:{}'.format(HOST, args.port)) for _ in range(args.channels)]
+            stubs = [chat_pb2_grpc.ChatAppStub(channel) for channel in channels]
+            with ThreadPoolExecutor(max_workers=32) as pool:
+                clients.extend(pool.map(lambda index: Part2Client(stubs[index % len(stubs)], 'load{}'.format(index),
+                                                                  clients), range(args.clients)))
+
+        message = 'x' * args.message_size
+        interval = args.clients / args.rate if args.rate else 0
+        results = [(defaultdict(list), defaultdict(int)) for _ in clients]
+        start = time.perf_counter()
+        record_at = start + args.warmup
+        stop_at = record_at + args.duration
+        threads = [Thread(target=drive, args=(client, args.mix, message, interval, record_at, stop_at, latencies, errors))
+                   for client, (latencies, errors) in zip(clients, results)]
+        for thread in threads:
+            thread.start()
+
+        # Measure server CPU over the recorded window only
+        time.sleep(max(0.0, record_at - time.perf_counter()))
+        cpu_start = cpu_seconds(process.pid)
+        time.sleep(max(0.0, stop_at - time.perf_counter()))
+        cpu_used = cpu_seconds(process.pid) - cpu_start
+        rss_kib = proc_status(process.pid, 'VmRSS')
+        peak_rss_kib = proc_status(process.pid, 'VmHWM')
+        for thread in threads:
+            thread.join()
+    finally:
+        for channel in channels:
+            channel.close()
+        process.kill()
+        process.wait()
+
+    operations = {}
+    all_latencies = []
+    total_errors = 0
+    for operation in args.mix:
+        latencies = [latency for client_latencies, _ in results for latency in client_latencies[operation]]
+        errors = sum(client_errors[operation] for _, client_errors in results)
+        operations[operation] = summarize(latencies, errors, args.duration)
+        all_latencies += latencies
+        total_errors += errors
+    return {
+        'timestamp':          time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'host':               platform.node(),
+        'python':             platform.python_version(),
+        'server':             args.server,
+        'mode':               args.mode,
+        'protocol':           'grpc' if args.server == 'part2' else 'text' if args.text else 'framed',
+        'clients':            args.clients,
+        'duration_s':         args.duration,
+        'rate':               args.rate,
+        'mix':                args.mix,
+        'message_size':       args.message_size,
+        'server_args':        args.server_arg,
+        'operations':         operations,
+        'total':              summarize(all_latencies, total_errors, args.duration),
+        'msgs_per_s':         operations['send']['ops_per_s'] if 'send' in operations else 0.0,
+        'server_cpu_pct':     cpu_used / args.duration * 100,
+        'server_rss_mb':      rss_kib / 1024,
+        'server_peak_rss_mb': peak_rss_kib / 1024,
+    }
+
+def print_report(report):
+    print('{server} ({mode}, {protocol}): {clients} clients, {duration_s:g}s, server cpu {server_cpu_pct:.1f}%, '
+          'rss {server_rss_mb:.1f} MB (peak {server_peak_rss_mb:.1f} MB), {msgs_per_s:.0f} msgs/s'.format(**report))
+    print('{:<8} {:>8} {:>7} {:>9} {:>9} {:>9} {:>9}'.format('op', 'count', 'errors', 'ops_per_s', 'p50_ms', 'p99_ms',
+                                                           'p999_ms'))
+    rows = list(report['operations'].items()) + [('total', report['total'])]
+    for operation, summary in rows:
+        if summary['count']:
+            print('{:<8} {count:>8} {errors:>7} {ops_per_s:>9.0f} {p50_ms:>9.3f} {p99_ms:>9.3f} {p999_ms:>9.3f}'.format(
+                operation, **summary))
+        else:
+            print('{:<8} {count:>8} {errors:>7}'.format(operation, **summary))
+
+def parse_args():
+    parser = ArgumentParser(prog='python3 -m bench', description='Load generator for the part 1 and part 2 chat servers.')
+    parser.add_argument('server', choices=sorted(SERVERS), help='server to launch and load')
+    parser.add_argument('--mode', help='server mode (part1: threaded|selectors, part2: threaded|aio; default threaded)')
+    parser.add_argument('--clients', type=int, default=50, help='simulated users (one thread each)')
+    parser.add_argument('--duration', type=float, default=10.0, help='seconds to record')
+    parser.add_argument('--warmup', type=float, default=1.0, help='seconds to run before recording')
+    parser.add_argument('--rate', type=float, default=0, help='total operations per second (0: as fast as possible)')
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix(DEFAULT_MIX),
+                        help='operation weights (default: {})'.format(DEFAULT_MIX))
+    parser.add_argument('--message-size', type=int, default=64, help='bytes per sent message')
+    parser.add_argument('--text', action='store_true', help='part1: use the raw text protocol instead of frames')
+    parser.add_argument('--channels', type=int, default=4, help='part2: gRPC channels shared by the clients')
+    parser.add_argument('--server-arg', action='append', default=[],
+                        help='extra server option, repeatable (e.g. --server-arg=--wal=/tmp/chat.wal)')
+    parser.add_argument('--port', type=int, default=12400)
+    parser.add_argument('--json', metavar='PATH', help="write the results as JSON ('-' for stdout)")
+    args = parser.parse_args()
+    args.mode = args.mode or 'threaded'
+    if args.mode not in SERVERS[args.server][1]:
+        parser.error('{} has no mode {!r} (choose from {})'.format(args.server, args.mode, ', '.join(SERVERS[args.server][1])))
+    return args
+
+def main():
+    args = parse_args()
+
+    # Every part 1 client holds a descriptor for its session
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    report = run(args)
+    if args.json == '-':
+        print(json.dumps(report, indent=2))
+        return
+    print_report(report)
+    if args.json:
+        with open(args.json, 'w') as output:
+            json.dump(report, output, indent=2)
+            output.write('\n')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,238 @@
+'''
+This file tests that one abusive client cannot hurt the latency of everyone else once the servers'
+admission control (common/limits.py) is configured.
+
+For each server (part 1 threaded/selectors, part 2 threaded/aio) and scenario, a server is
+launched on localhost with a write-ahead log (so that a send to an offline user waits for the
+log, as in production) and --kdf-cost 4:
+    - alone: --users well-behaved users, each sending --rate messages per second to the next one
+      (paced, through the client libraries, part 1 in command mode), and no abuser
+    - flood: the same, while an abuser process keeps --depth sends outstanding to one offline
+      victim, as fast as the server answers
+    - limited: the flood against a server started with LIMITS (a sender may keep up 20 messages
+      per second, a recipient 100, and 32 requests may be in flight), and for part 2 at most 8
+      open calls per connection
+Reported are the well-behaved users' sends per second, p50 and p99 latency and refused sends,
+the abuser's accepted and refused sends per second, and the messages queued for the victim.
+
+Usage: python3 bench/abusive_client.py [--servers part1-threaded part1-selectors part2-threaded part2-aio]
+                                       [--scenarios alone flood limited] [--users 8] [--rate 10]
+                                       [--depth 256] [--seconds 5]
+'''
+# Import relevant python packages
+from argparse import SUPPRESS, ArgumentParser
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+from threading import Event, Thread
+import time
+from urllib.request import urlopen
+
+# Constants/configurations
+HOST      = '127.0.0.1'
+ROOT      = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+PASSWORD  = 'password'
+VICTIM    = 'victim'
+ABUSER    = 'abuser'
+SERVERS   = {
+    'part1-threaded':  ('part_1', ['--mode', 'threaded']),
+    'part1-selectors': ('part_1', ['--mode', 'selectors']),
+    'part2-threaded':  ('part_2', ['--mode', 'threaded']),
+    'part2-aio':       ('part_2', ['--mode', 'aio']),
+}
+LIMITS    = ['--send-rate', '20', '--send-burst', '40', '--receive-rate', '100', '--receive-burst', '200',
+             '--max-in-flight', '32']
+SCENARIOS = {
+    'alone':   (False, {'part_1': [], 'part_2': []}),
+    'flood':   (True, {'part_1': [], 'part_2': []}),
+    'limited': (True, {'part_1': LIMITS, 'part_2': LIMITS + ['--max-streams', '8']}),
+}
+
+# Client library of part (part_1/sdk.py or part_2/sdk.py; both parts have a heartbeat module, so one
+# process only ever loads one of them)
+def load_sdk(part):
+    sys.path.insert(0, os.path.join(ROOT, part))
+    import sdk
+    return sdk
+
+def connect(sdk, part, port):
+    if part == 'part_1':
+        return sdk.Client(HOST, port, commands=True)
+    return sdk.Client('{}:{}'.format(HOST, port))
+
+# Abuser process: keep depth sends to the victim outstanding for seconds, then print the counts as JSON
+def abuse(part, port, depth, seconds):
+    sdk = load_sdk(part)
+    client = connect(sdk, part, port)
+    client.login(ABUSER, PASSWORD)
+    counts = {'accepted': 0, 'refused': 0}
+    outstanding = []
+    stop_at = time.perf_counter() + seconds
+    while time.perf_counter() < stop_at:
+        while len(outstanding) < depth:
+            outstanding.append(client.send(VICTIM, 'spam', wait=False))
+        future = outstanding.pop(0)
+        try:
+            future.result()
+            counts['accepted'] += 1
+        except Exception: # a rate limit (ChatError) or a busy server (RESOURCE_EXHAUSTED)
+            counts['refused'] += 1
+    for future in outstanding:
+        try:
+            future.result()
+        except Exception:
+            pass
+    client.close()
+    print(json.dumps(counts), flush=True)
+
+# One well-behaved user: rate messages per second to dst_username until stop is set
+def behave(client, dst_username, rate, stop, latencies, refused):
+    next_send = time.perf_counter()
+    while not stop.is_set():
+        next_send += 1 / rate
+        start = time.perf_counter()
+        try:
+            client.send(dst_username, 'hello')
+            latencies.append(time.perf_counter() - start)
+        except Exception:
+            refused.append(1)
+        time.sleep(max(0.0, next_send - time.perf_counter()))
+
+# Well-behaved users' process: create the accounts, print 'ready', and once a line comes in on stdin
+# send for seconds; prints the latencies and refusals as JSON
+def users_process(part, port, users, rate, seconds):
+    sdk = load_sdk(part)
+    for username in (VICTIM, ABUSER):
+        setup = connect(sdk, part, port)
+        setup.create(username, PASSWORD)
+        setup.close()
+    clients = []
+    for index in range(users):
+        client = connect(sdk, part, port)
+        client.create('user{}'.format(index), PASSWORD)
+        clients.append(client)
+    print('ready', flush=True)
+    sys.stdin.readline()
+    stop = Event()
+    latencies = [[] for _ in range(users)]
+    refused = []
+    threads = [Thread(target=behave, args=(clients[index], 'user{}'.format((index + 1) % users), rate, stop,
+                                           latencies[index], refused), daemon=True) for index in range(users)]
+    for thread in threads:
+        thread.start()
+    time.sleep(seconds)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    for client in clients:
+        client.close()
+    print(json.dumps({'latencies': [latency for user in latencies for latency in user], 'refused': len(refused)}),
+          flush=True)
+
+def start_server(name, scenario, port, metrics_port, wal_dir):
+    part, options = SERVERS[name]
+    path = os.path.join(ROOT, part, 'server.py')
+    command = ([sys.executable, path, '--host', HOST, '--port', str(port), '--kdf-cost', '4', '--metrics-port',
+                str(metrics_port), '--wal', os.path.join(wal_dir, 'log')] + options + SCENARIOS[scenario][1][part])
+    process = subprocess.Popen(command, cwd=os.path.dirname(path), stdout=subprocess.DEVNULL,
+                               stderr=subprocess.DEVNULL)
+    deadline = time.time() + 15
+    while time.time() < deadline:
+        try:
+            gauges(metrics_port)
+            socket.create_connection((HOST, port), timeout=5).close() # the chat port may open after the metrics one
+            return process
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError('{} server did not start'.format(name))
+
+def gauges(metrics_port):
+    with urlopen('http://{}:{}/metrics.json'.format(HOST, metrics_port), timeout=5) as response:
+        return json.load(response)['gauges']
+
+def percentile(samples, p):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p))] * 1000 if ordered else float('nan')
+
+def run(name, scenario, port, users, rate, depth, seconds):
+    part, _ = SERVERS[name]
+    metrics_port = port + 1000
+    wal_dir = tempfile.mkdtemp(prefix='abusive-client-')
+    process = start_server(name, scenario, port, metrics_port, wal_dir)
+    children = []
+    try:
+        well_behaved = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--child', part, '--role', 'users',
+                                         '--port', str(port), '--users', str(users), '--rate', str(rate),
+                                         '--seconds', str(seconds)],
+                                        stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
+        children.append(well_behaved)
+        if well_behaved.stdout.readline().strip() != 'ready':
+            raise RuntimeError('well-behaved users failed to connect')
+        flood = SCENARIOS[scenario][0]
+        if flood:
+            abuser = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--child', part, '--role', 'abuser',
+                                       '--port', str(port), '--depth', str(depth), '--seconds', str(seconds + 1)],
+                                      stdout=subprocess.PIPE, text=True)
+            children.append(abuser)
+            time.sleep(1) # let the flood build up
+        well_behaved.stdin.write('go\n')
+        well_behaved.stdin.flush()
+        result = json.loads(well_behaved.stdout.readline())
+        counts = json.loads(abuser.communicate()[0]) if flood else {'accepted': 0, 'refused': 0}
+        samples = result['latencies']
+        return {
+            'server':    name,
+            'scenario':  scenario,
+            'sends':     len(samples) / seconds,
+            'p50':       percentile(samples, 0.50),
+            'p99':       percentile(samples, 0.99),
+            'refused':   result['refused'],
+            'abuse_ok':  counts['accepted'] / (seconds + 1),
+            'abuse_no':  counts['refused'] / (seconds + 1),
+            'queued':    gauges(metrics_port)['chat_mailbox_messages'],
+        }
+    finally:
+        for child_process in children:
+            child_process.kill()
+            child_process.wait()
+        process.kill()
+        process.wait()
+        shutil.rmtree(wal_dir, ignore_errors=True)
+
+def main():
+    parser = ArgumentParser(description='Latency of well-behaved users while one client floods the server.')
+    parser.add_argument('--servers', nargs='+', choices=list(SERVERS), default=list(SERVERS))
+    parser.add_argument('--scenarios', nargs='+', choices=list(SCENARIOS), default=list(SCENARIOS))
+    parser.add_argument('--users', type=int, default=8, help='well-behaved users')
+    parser.add_argument('--rate', type=float, default=10.0, help='messages per second each well-behaved user sends')
+    parser.add_argument('--depth', type=int, default=256, help='sends the abuser keeps outstanding')
+    parser.add_argument('--seconds', type=float, default=5.0, help='duration of each measurement')
+    parser.add_argument('--port', type=int, default=12490)
+    parser.add_argument('--child', choices=['part_1', 'part_2'], help=SUPPRESS)
+    parser.add_argument('--role', choices=['users', 'abuser'], help=SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        if args.role == 'users':
+            users_process(args.child, args.port, args.users, args.rate, args.seconds)
+        else:
+            abuse(args.child, args.port, args.depth, args.seconds)
+        return
+
+    print('{:<16} {:<8} {:>7} {:>7} {:>8} {:>8} {:>13} {:>13} {:>13}'.format(
+        'server', 'scenario', 'sends/s', 'p50_ms', 'p99_ms', 'refused', 'abuse_ok/s', 'abuse_refused/s',
+        'victim_queue'))
+    port = args.port
+    for name in args.servers:
+        for scenario in args.scenarios:
+            result = run(name, scenario, port, args.users, args.rate, args.depth, args.seconds)
+            port += 1
+            print('{server:<16} {scenario:<8} {sends:>7.0f} {p50:>7.2f} {p99:>8.2f} {refused:>8} {abuse_ok:>13.0f} '
+                  '{abuse_no:>13.0f} {queued:>13}'.format(**result))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+'''
+This file benchmarks the part 2 threaded server against the grpc.aio server mode.
+
+For each mode and stream count, a server is launched on localhost with its default
+configuration, S message streams are opened, and then:
+    1. streams_served: how many streams got their initial user listing within --timeout
+       (the threaded server can only run MAX_CLIENTS RPCs at once)
+    2. SendMessage throughput and latency from --callers concurrent callers for --seconds
+
+Usage: python3 bench/aio_vs_threaded.py [--streams 50 500] [--callers 32] [--seconds 5]
+'''
+# Import relevant python packages
+from argparse import ArgumentParser
+import asyncio
+import os
+import subprocess
+import sys
+import time
+
+import grpc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'part_2'))
+from protos import chat_pb2, chat_pb2_grpc
+
+# Constants/configurations
+HOST        = '127.0.0.1'
+SERVER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'part_2', 'server.py')
+NUM_USERS   = 50 # accounts the streams are spread over
+CHANNELS    = 8
+
+def start_server(mode, port):
+    process = subprocess.Popen([sys.executable, SERVER_PATH, '--mode', mode, '--host', HOST, '--port', str(port)],
+                               cwd=os.path.dirname(SERVER_PATH), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    with grpc.insecure_channel('{}:{}'.format(HOST, port)) as channel:
+        grpc.channel_ready_future(channel).result(timeout=10)
+    return process
+
+def percentile(samples, p):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p))]
+
+# Hold a stream open, releasing served once its initial listing has arrived
+async def hold_stream(stub, username, served):
+    received = 0
+    try:
+        async for _ in stub.MessageStream(chat_pb2.AccountInfo(username=username, password='password')):
+            received += 1
+            if received == NUM_USERS + 1:
+                served.release()
+    except grpc.aio.AioRpcError:
+        pass
+
+# Issue SendMessage back to back until stop_at, recording latencies (None marks a failed/timed out call)
+async def caller(stub, index, stop_at, latencies):
+    while time.perf_counter() < stop_at:
+        message = chat_pb2.Msg(src_username='bench', dst_username='user{}'.format(index % NUM_USERS), msg='hello')
+        start = time.perf_counter()
+        try:
+            await stub.SendMessage(message, timeout=1.0)
+            latencies.append((time.perf_counter() - start) * 1000)
+        except grpc.aio.AioRpcError:
+            latencies.append(None)
+
+async def run(mode, port, num_streams, num_callers, seconds, timeout):
+    process = start_server(mode, port)
+    channels = [grpc.aio.insecure_channel('{}:{}'.format(HOST, port)) for _ in range(CHANNELS)]
+    stubs = [chat_pb2_grpc.ChatAppStub(channel) for channel in channels]
+    try:
+        for index in range(NUM_USERS):
+            await stubs[0].CreateAccount(chat_pb2.AccountInfo(username='user{}'.format(index), password='password'))
+
+        # 1. Stream capacity
+        served = asyncio.Semaphore(0)
+        streams = [asyncio.ensure_future(hold_stream(stubs[index % CHANNELS], 'user{}'.format(index % NUM_USERS), served))
+                   for index in range(num_streams)]
+        streams_served = 0
+        deadline = time.perf_counter() + timeout
+        while streams_served < num_streams:
+            try:
+                await asyncio.wait_for(served.acquire(), max(0.0, deadline - time.perf_counter()))
+                streams_served += 1
+            except asyncio.TimeoutError:
+                break
+
+        # 2. Unary throughput while the streams are open
+        latencies = []
+        stop_at = time.perf_counter() + seconds
+        await asyncio.gather(*(caller(stubs[index % CHANNELS], index, stop_at, latencies) for index in range(num_callers)))
+        ok = [latency for latency in latencies if latency is not None]
+
+        for stream in streams:
+            stream.cancel()
+        await asyncio.gather(*streams, return_exceptions=True)
+        return {
+            'mode':           mode,
+            'streams':        num_streams,
+            'streams_served': streams_served,
+            'send_rps':       len(ok) / seconds,
+            'failed':         len(latencies) - len(ok),
+            'p50_ms':         percentile(ok, 0.50) if ok else float('nan'),
+            'p99_ms':         percentile(ok, 0.99) if ok else float('nan'),
+        }
+    finally:
+        for channel in channels:
+            await channel.close()
+        process.kill()
+        process.wait()
+
+def main():
+    parser = ArgumentParser(description='Part 2 threaded vs grpc.aio server.')
+    parser.add_argument('--streams', type=int, nargs='+', default=[50, 500])
+    parser.add_argument('--callers', type=int, default=32, help='concurrent SendMessage callers')
+    parser.add_argument('--seconds', type=float, default=5.0, help='duration of the SendMessage phase')
+    parser.add_argument('--timeout', type=float, default=10.0, help='seconds to wait for streams to be served')
+    parser.add_argument('--modes', nargs='+', default=['threaded', 'aio'])
+    parser.add_argument('--port', type=int, default=12370)
+    args = parser.parse_args()
+
+    # One loop for every run (grpc.aio's poller does not survive asyncio.run tearing loops down)
+    loop = asyncio.new_event_loop()
+    print('{:<9} {:>8} {:>15} {:>9} {:>7} {:>8} {:>8}'.format(
+        'mode', 'streams', 'streams_served', 'send_rps', 'failed', 'p50_ms', 'p99_ms'))
+    port = args.port
+    for num_streams in args.streams:
+        for mode in args.modes:
+            result = loop.run_until_complete(run(mode, port, num_streams, args.callers, args.seconds, args.timeout))
+            port += 1
+            print('{mode:<9} {streams:>8} {streams_served:>15} {send_rps:>9.0f} {failed:>7} {p50_ms:>8.2f} '
+                  '{p99_ms:>8.2f}'.format(**result))
+
+if __name__ == '__main__':
+    main()
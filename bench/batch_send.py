@@ -0,0 +1,111 @@
+'''
+This file benchmarks batched sends against per-message unary SendMessage on the part 2 server.
+
+For each batch size B, --messages messages spread over --recipients accounts are sent three ways
+by --callers concurrent callers:
+    - unary:  one SendMessage RPC per message
+    - batch:  SendMessages RPCs carrying B messages each
+    - stream: SendMessageStream calls streaming B messages each
+and message throughput plus per-call latency (one message for unary, B messages otherwise) are
+reported. With --wal the server logs to a write-ahead log, so each call also waits for an fsync.
+
+Usage: python3 bench/batch_send.py [--batch-sizes 1 10 100 1000] [--messages 20000] [--mode threaded|aio] [--wal]
+'''
+# Import relevant python packages
+from argparse import ArgumentParser
+import os
+import subprocess
+import sys
+import tempfile
+from threading import Thread
+import time
+
+import grpc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'part_2'))
+from protos import chat_pb2, chat_pb2_grpc
+
+# Constants/configurations
+HOST        = '127.0.0.1'
+SERVER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'part_2', 'server.py')
+MESSAGE     = '<bench> ' + 'x' * 56
+
+def start_server(mode, port, wal):
+    command = [sys.executable, SERVER_PATH, '--mode', mode, '--host', HOST, '--port', str(port)]
+    if wal:
+        command += ['--wal', wal]
+    process = subprocess.Popen(command, cwd=os.path.dirname(SERVER_PATH), stdout=subprocess.DEVNULL,
+                               stderr=subprocess.DEVNULL)
+    with grpc.insecure_channel('{}:{}'.format(HOST, port)) as channel:
+        grpc.channel_ready_future(channel).result(timeout=10)
+    return process
+
+def percentile(samples, p):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p))]
+
+# Split num_messages into calls of batch_size messages, spread over callers; returns (msgs/s, latencies ms)
+def drive(stub, method, batch_size, num_messages, num_callers, num_recipients):
+    msgs = [chat_pb2.Msg(src_username='bench', dst_username='user{}'.format(index % num_recipients), msg=MESSAGE)
+            for index in range(batch_size)]
+    calls = max(1, num_messages // batch_size)
+    results = [[] for _ in range(num_callers)]
+    def caller(index, latencies):
+        for _ in range(index, calls, num_callers):
+            start = time.perf_counter()
+            if method == 'unary':
+                for msg in msgs:
+                    stub.SendMessage(msg)
+            elif method == 'batch':
+                response = stub.SendMessages(chat_pb2.MsgBatch(msgs=msgs))
+                assert len(response.statuses) == batch_size
+            else:
+                response = stub.SendMessageStream(iter(msgs))
+                assert len(response.statuses) == batch_size
+            latencies.append((time.perf_counter() - start) * 1000)
+    threads = [Thread(target=caller, args=(index, latencies)) for index, latencies in enumerate(results)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    latencies = [latency for caller_latencies in results for latency in caller_latencies]
+    return calls * batch_size / elapsed, latencies
+
+def main():
+    parser = ArgumentParser(description='Batched/streamed vs unary sends on the part 2 server.')
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 10, 100, 1000])
+    parser.add_argument('--messages', type=int, default=20000, help='messages sent per method and batch size')
+    parser.add_argument('--callers', type=int, default=4, help='concurrent callers')
+    parser.add_argument('--recipients', type=int, default=100)
+    parser.add_argument('--mode', choices=['threaded', 'aio'], default='threaded')
+    parser.add_argument('--wal', action='store_true', help='run the server with a write-ahead log')
+    parser.add_argument('--port', type=int, default=12410)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        process = start_server(args.mode, args.port, os.path.join(directory, 'chat.wal') if args.wal else None)
+        try:
+            with grpc.insecure_channel('{}:{}'.format(HOST, args.port)) as channel:
+                stub = chat_pb2_grpc.ChatAppStub(channel)
+                for index in range(args.recipients):
+                    stub.CreateAccount(chat_pb2.AccountInfo(username='user{}'.format(index), password='password'))
+
+                print('{:>6} {:<7} {:>10} {:>13} {:>13}'.format('batch', 'method', 'msgs_per_s', 'call_p50_ms',
+                                                              'call_p99_ms'))
+                for batch_size in args.batch_sizes:
+                    for method in ['unary', 'batch', 'stream']:
+                        # Unary sends do not depend on the batch size: measure them once
+                        if method == 'unary' and batch_size != args.batch_sizes[0]:
+                            continue
+                        size = 1 if method == 'unary' else batch_size
+                        rate, latencies = drive(stub, method, size, args.messages, args.callers, args.recipients)
+                        print('{:>6} {:<7} {:>10.0f} {:>13.3f} {:>13.3f}'.format(
+                            size, method, rate, percentile(latencies, 0.50), percentile(latencies, 0.99)))
+        finally:
+            process.kill()
+            process.wait()
+
+if __name__ == '__main__':
+    main()
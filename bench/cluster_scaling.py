@@ -0,0 +1,133 @@
+'''
+This file benchmarks how part 2 message throughput scales with the number of cluster workers
+(part_2/cluster.py).
+
+For each --workers count, a cluster is launched on localhost, --accounts accounts are created,
+and --procs load processes (each with --threads client threads on a connection of its own, which
+SO_REUSEPORT spreads over the workers) send SendMessage to random accounts for --duration seconds.
+Messages per second, the speedup over one worker and p50/p99 latency are reported. Most messages
+are for an account another worker owns (all but 1/N of them), so they include a forwarding hop.
+
+The load processes need CPU too: scaling only shows when the machine has cores to spare for both
+(e.g. 16 cores for 8 workers and 8 load processes).
+
+Usage: python3 bench/cluster_scaling.py [--workers 1 2 4 8] [--procs 8] [--threads 4] [--duration 10]
+'''
+# Import relevant python packages
+from argparse import ArgumentParser
+import multiprocessing
+import os
+import random
+import subprocess
+import sys
+from threading import Thread
+import time
+
+import grpc
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(ROOT, 'part_2'))
+from protos import chat_pb2, chat_pb2_grpc
+
+# Constants/configurations
+HOST         = '127.0.0.1'
+CLUSTER_PATH = os.path.join(ROOT, 'part_2', 'cluster.py')
+PASSWORD     = 'password'
+WARMUP       = 1.0 # seconds of load before measuring
+
+def username(index):
+    return 'user{}'.format(index)
+
+# A channel with a connection of its own (channels in one process otherwise share connections)
+def connect(port):
+    channel = grpc.insecure_channel('{}:{}'.format(HOST, port), options=[('grpc.use_local_subchannel_pool', 1)])
+    grpc.channel_ready_future(channel).result(timeout=10)
+    return channel
+
+# Launch a cluster and wait until it accepts connections
+def start_cluster(workers, port):
+    process = subprocess.Popen([sys.executable, CLUSTER_PATH, '--workers', str(workers), '--host', HOST,
+                                '--port', str(port)], stdout=subprocess.DEVNULL)
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            connect(port).close()
+            return process
+        except grpc.FutureTimeoutError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError('cluster of {} workers did not start'.format(workers))
+
+# Body of one load process: --threads senders; puts (messages sent, latencies) on results
+def load(port, accounts, threads, length, start_at, stop_at, results):
+    text = 'x' * length
+    latencies = []
+    def sender(seed):
+        channel = connect(port)
+        stub = chat_pb2_grpc.ChatAppStub(channel)
+        rng = random.Random(seed)
+        while time.time() < stop_at:
+            msg = chat_pb2.Msg(src_username=username(0), dst_username=username(rng.randrange(accounts)), msg=text)
+            start = time.perf_counter()
+            stub.SendMessage(msg)
+            if time.time() >= start_at:
+                latencies.append(time.perf_counter() - start)
+        channel.close()
+    senders = [Thread(target=sender, args=(random.random(),)) for _ in range(threads)]
+    for thread in senders:
+        thread.start()
+    for thread in senders:
+        thread.join()
+    results.put(latencies)
+
+def percentile(samples, p):
+    return samples[min(len(samples) - 1, int(len(samples) * p))] if samples else 0.0
+
+def run(args, workers, port):
+    process = start_cluster(workers, port)
+    try:
+        channel = connect(port)
+        stub = chat_pb2_grpc.ChatAppStub(channel)
+        for index in range(args.accounts):
+            stub.CreateAccount(chat_pb2.AccountInfo(username=username(index), password=PASSWORD))
+        channel.close()
+
+        context = multiprocessing.get_context('spawn')
+        results = context.Queue()
+        start_at = time.time() + 2 + WARMUP # time for the load processes to start, then the warmup
+        stop_at = start_at + args.duration
+        procs = [context.Process(target=load, args=(port, args.accounts, args.threads, args.length, start_at, stop_at, results))
+                 for _ in range(args.procs)]
+        for proc in procs:
+            proc.start()
+        latencies = sorted(sample for _ in procs for sample in results.get())
+        for proc in procs:
+            proc.join()
+        return len(latencies) / args.duration, latencies
+    finally:
+        process.terminate()
+        process.wait()
+
+def main():
+    parser = ArgumentParser(description='Part 2 SendMessage throughput vs number of cluster workers.')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8], help='cluster sizes to measure')
+    parser.add_argument('--procs', type=int, default=8, help='load generator processes')
+    parser.add_argument('--threads', type=int, default=4, help='sending threads per load process')
+    parser.add_argument('--accounts', type=int, default=1000, help='accounts messages are sent to')
+    parser.add_argument('--length', type=int, default=100, help='characters per message')
+    parser.add_argument('--duration', type=float, default=10.0, help='seconds measured per cluster size')
+    parser.add_argument('--port', type=int, default=12750)
+    args = parser.parse_args()
+
+    print('{} CPU cores, {} load processes x {} threads'.format(os.cpu_count(), args.procs, args.threads))
+    print('{:>8} {:>10} {:>8} {:>8} {:>8}'.format('workers', 'msgs_per_s', 'speedup', 'p50_ms', 'p99_ms'))
+    baseline = None
+    for offset, workers in enumerate(args.workers):
+        rate, latencies = run(args, workers, args.port + offset)
+        baseline = baseline or rate
+        print('{:>8} {:>10.0f} {:>8.2f} {:>8.2f} {:>8.2f}'.format(workers, rate, rate / baseline,
+                                                                 percentile(latencies, 0.5) * 1000,
+                                                                 percentile(latencies, 0.99) * 1000))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,172 @@
+'''
+This file benchmarks messages per second over one part 1 connection, prompt flow vs command mode.
+
+For each --modes entry a part 1 server is launched on localhost and a receiver logs in and reads
+everything sent to it. A sender then sends it --messages messages of --message-size bytes:
+    - prompt: the interactive flow over the framed protocol, three answers per message (menu
+      choice, recipient, text), each waiting for the server's next prompt
+    - commands W: command mode with W SEND commands outstanding; the first W go out in one write,
+      then every batch of results read is refilled with as many new commands in one write
+Reported are messages per second, p50/p99 time from writing a message to its confirmation,
+writes per message on the client side and refused sends (a receiver falling behind).
+
+Usage: python3 bench/command_pipeline.py [--modes threaded selectors] [--windows 1 16 128] [--messages 5000]
+'''
+# Import relevant python packages
+from argparse import ArgumentParser
+import os
+from socket import create_connection, IPPROTO_TCP, TCP_NODELAY
+import subprocess
+import sys
+from threading import Thread
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(ROOT, 'part_1'))
+from protocol import (FLAG_COMMANDS, OP_COMMAND, OP_RESULT, OP_TEXT, PROMPTS, RESULT_OK, connect_hello, pack_frame)
+
+# Constants/configurations
+ENCODING = 'utf-8' # message encoding
+HOST     = '127.0.0.1'
+PASSWORD = 'password'
+RECEIVER = 'sink'
+
+def start_server(mode, port):
+    process = subprocess.Popen([sys.executable, os.path.join(ROOT, 'part_1', 'server.py'), '--mode', mode,
+                                '--host', HOST, '--port', str(port)], cwd=os.path.join(ROOT, 'part_1'),
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.time() + 30
+    while True:
+        try:
+            create_connection((HOST, port)).close()
+            return process
+        except OSError:
+            if process.poll() is not None or time.time() > deadline:
+                process.kill()
+                raise RuntimeError('server in {} mode did not start'.format(mode))
+            time.sleep(0.1)
+
+def percentile(samples, p):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * p))] * 1000 if samples else 0.0
+
+# Framed connection (command mode with commands) with Nagle off, as the client library uses it
+def connect(port, commands):
+    sock = create_connection((HOST, port))
+    sock.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
+    return connect_hello(sock, flags=FLAG_COMMANDS if commands else 0)
+
+# Command mode: run one command and wait for its result text (raises if it failed)
+def command(framed, verb, *fields):
+    framed.sock.sendall(pack_frame(OP_COMMAND, 1, '\n'.join((verb,) + fields).encode(encoding=ENCODING)))
+    while True:
+        opcode, _, payload = framed.recv_frame()
+        if opcode == OP_RESULT:
+            if bytes(payload[:1]) != RESULT_OK:
+                raise RuntimeError('{} failed: {}'.format(verb, str(payload[1:], ENCODING)))
+            return
+
+# Prompt flow: answer the prompt the server waits on and return the texts up to its next prompt
+def answer(framed, text, request_id):
+    framed.sock.sendall(pack_frame(OP_TEXT, request_id, text.encode(encoding=ENCODING)))
+    reply = []
+    while True:
+        _, _, payload = framed.recv_frame()
+        reply.append(str(payload, ENCODING, 'replace'))
+        if reply[-1] in PROMPTS:
+            return reply
+
+# Receiver: read (and drop) everything until the connection closes
+def drain(framed):
+    try:
+        while framed.sock.recv(1 << 16):
+            pass
+    except OSError:
+        pass
+
+def run_prompt(port, messages, text):
+    framed = connect(port, False)
+    framed.recv_frame() # welcome prompt
+    answer(framed, '1', 1)
+    answer(framed, 'prompt_sender', 1)
+    answer(framed, PASSWORD, 1)
+    latencies, refused = [], 0
+    start = time.perf_counter()
+    for index in range(messages):
+        begin = time.perf_counter()
+        request_id = index + 2
+        answer(framed, '1', request_id)
+        answer(framed, RECEIVER, request_id)
+        reply = answer(framed, text, request_id)
+        refused += not any('delivered' in line for line in reply)
+        latencies.append(time.perf_counter() - begin)
+    elapsed = time.perf_counter() - start
+    framed.close()
+    return messages / elapsed, latencies, 3.0, refused
+
+def run_commands(port, messages, text, window):
+    framed = connect(port, True)
+    command(framed, 'CREATE', 'sender{}'.format(window), PASSWORD)
+    payload = 'SEND\n{}\n{}'.format(RECEIVER, text).encode(encoding=ENCODING)
+    sent_at, latencies, refused, writes = {}, [], 0, 0
+
+    # Write up to count more commands in one write
+    def write(count):
+        nonlocal writes
+        batch = bytearray()
+        for request_id in range(len(sent_at) + 1, min(messages, len(sent_at) + count) + 1):
+            sent_at[request_id] = time.perf_counter()
+            batch += pack_frame(OP_COMMAND, request_id, payload)
+        if batch:
+            framed.sock.sendall(batch)
+            writes += 1
+
+    start = time.perf_counter()
+    write(window)
+    while len(latencies) < messages:
+        answered = 0
+        frame = framed.recv_frame()
+        while frame is not None:
+            opcode, request_id, result = frame
+            if opcode == OP_RESULT:
+                latencies.append(time.perf_counter() - sent_at[request_id])
+                refused += bytes(result[:1]) != RESULT_OK
+                answered += 1
+            frame = framed.next_frame()
+        write(answered)
+    elapsed = time.perf_counter() - start
+    framed.close()
+    return messages / elapsed, latencies, writes / messages, refused
+
+def main():
+    parser = ArgumentParser(description='Messages per second over one part 1 connection: prompt flow vs command mode.')
+    parser.add_argument('--modes', nargs='+', choices=['threaded', 'selectors'], default=['threaded', 'selectors'])
+    parser.add_argument('--windows', type=int, nargs='+', default=[1, 16, 128], help='commands kept outstanding')
+    parser.add_argument('--messages', type=int, default=5000, help='messages sent per run')
+    parser.add_argument('--message-size', type=int, default=50, help='bytes per message')
+    parser.add_argument('--port', type=int, default=6272)
+    args = parser.parse_args()
+    text = 'x' * args.message_size
+
+    print('{:<10} {:<12} {:>11} {:>8} {:>8} {:>10} {:>8}'.format(
+        'mode', 'client', 'msgs_per_s', 'p50_ms', 'p99_ms', 'writes/msg', 'refused'))
+    for mode in args.modes:
+        process = start_server(mode, args.port)
+        try:
+            receiver = connect(args.port, True)
+            command(receiver, 'CREATE', RECEIVER, PASSWORD)
+            Thread(target=drain, args=(receiver,), daemon=True).start()
+            runs = [('prompt', lambda: run_prompt(args.port, args.messages, text))]
+            runs += [('commands {}'.format(window), lambda window=window: run_commands(args.port, args.messages, text, window))
+                     for window in args.windows]
+            for name, run in runs:
+                rate, latencies, writes, refused = run()
+                print('{:<10} {:<12} {:>11.0f} {:>8.2f} {:>8.2f} {:>10.2f} {:>8}'.format(
+                    mode, name, rate, percentile(latencies, 0.5), percentile(latencies, 0.99), writes, refused))
+            receiver.close()
+        finally:
+            process.kill()
+            process.wait()
+
+if __name__ == '__main__':
+    main()
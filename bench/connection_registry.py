@@ -0,0 +1,122 @@
+'''
+This file benchmarks connection bookkeeping of the threaded part 1 server against the number of
+connected clients: the old list of active sockets vs the ConnectionRegistry (part_1/registry.py).
+
+For each --connections count, that many logged in clients are registered (with stand-in sockets,
+so 50k connections need no file descriptors) and three costs are timed, averaged over --ops
+random clients:
+    - lookup: is this socket connected? ('sock in active_sockets' vs 'sock in registry')
+    - churn: a client disconnecting and another connecting (list.remove + append vs remove + add,
+      the registry also dropping and adding the user's session in the store)
+    - route: handing a message to an online user (deliver(): the store lookup of the user's
+      sessions plus a put into its OutboundQueue); the list version adds the
+      'sock in active_sockets' presence check a list-based router needs
+Costs that do not grow with the number of connections show up as flat columns.
+
+Usage: python3 bench/connection_registry.py [--connections 10 100 1000 10000 50000] [--ops 20000]
+'''
+# Import relevant python packages
+from argparse import ArgumentParser
+import os
+import random
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(ROOT, 'part_1'))
+sys.path.insert(0, ROOT)
+from common.user_store import UserStore
+from outbound import OutboundQueue, OutboundStats, deliver
+from registry import SESSIONS, ConnectionRegistry
+
+# Constants/configurations
+MESSAGE = b'<bench> hello'
+
+class StandInSocket:
+    '''
+    Just enough of a socket for the bookkeeping: a unique fileno (never written to)
+    '''
+    def __init__(self, fd) -> None:
+        self.fd = fd
+
+    def fileno(self):
+        return self.fd
+
+# Microseconds per call of operation(argument) over arguments
+def time_per_op(operation, arguments):
+    start = time.perf_counter()
+    for argument in arguments:
+        operation(argument)
+    return (time.perf_counter() - start) / len(arguments) * 1e6
+
+# Logged in clients: a store with a user per connection, each with an OutboundQueue session
+def setup(count):
+    users = UserStore(**{SESSIONS: ()})
+    stats = OutboundStats()
+    sessions = []
+    for index in range(count):
+        username = 'user{}'.format(index)
+        users.create(username, 'password')
+        sessions.append((username, OutboundQueue(StandInSocket(index + 3), users, stats, max_depth=1 << 30)))
+    return users, sessions
+
+def bench_list(count, ops, rng):
+    users, sessions = setup(count)
+    active_sockets = []
+    for username, queue in sessions:
+        active_sockets.append(queue)
+        users.attach(username, SESSIONS, queue)
+    picks = [rng.choice(sessions) for _ in range(ops)]
+
+    lookup = time_per_op(lambda pick: pick[1] in active_sockets, picks)
+
+    def churn(pick):
+        active_sockets.remove(pick[1])
+        active_sockets.append(pick[1])
+    churned = time_per_op(churn, picks)
+
+    def route(pick):
+        username, queue = pick
+        if queue in active_sockets:
+            deliver(users, username, MESSAGE)
+    routed = time_per_op(route, picks)
+    return lookup, churned, routed
+
+def bench_registry(count, ops, rng):
+    users, sessions = setup(count)
+    registry = ConnectionRegistry(users)
+    for username, queue in sessions:
+        registry.add(queue)
+        registry.login(queue, username)
+    picks = [rng.choice(sessions) for _ in range(ops)]
+
+    lookup = time_per_op(lambda pick: pick[1] in registry, picks)
+
+    def churn(pick):
+        username, queue = pick
+        registry.remove(queue)
+        registry.add(queue)
+        registry.login(queue, username)
+    churned = time_per_op(churn, picks)
+
+    routed = time_per_op(lambda pick: deliver(users, pick[0], MESSAGE), picks)
+    return lookup, churned, routed
+
+def main():
+    parser = ArgumentParser(description='Connection bookkeeping cost vs connected clients (part 1 threaded).')
+    parser.add_argument('--connections', type=int, nargs='+', default=[10, 100, 1000, 10000, 50000])
+    parser.add_argument('--ops', type=int, default=20000, help='operations timed per measurement')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    # Microseconds per operation: list vs registry for each cost
+    print('{:>11} {:>11} {:>11} {:>10} {:>10} {:>10} {:>10}'.format(
+        'connections', 'lookup_list', 'lookup_reg', 'churn_list', 'churn_reg', 'route_list', 'route_reg'))
+    for count in args.connections:
+        old = bench_list(count, args.ops, random.Random(args.seed))
+        new = bench_registry(count, args.ops, random.Random(args.seed))
+        print('{:>11} {:>11.2f} {:>11.2f} {:>10.2f} {:>10.2f} {:>10.2f} {:>10.2f}'.format(
+            count, old[0], new[0], old[1], new[1], old[2], new[2]))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,241 @@
+'''
+This file tests that the servers take back what clients that die without closing their
+connection were holding: sockets, threads, registry entries and message streams.
+
+For each server (part 1 threaded/selectors, part 2 threaded/aio) and configuration, a server is
+launched on localhost with --kdf-cost 4 (hashing is not what is measured here):
+    - on: --heartbeat 1 --idle-timeout 3 (part 1 pings its clients, part 2 sends HTTP/2 PINGs)
+    - off: part 1 without heartbeats or keepalive (--heartbeat 0), part 2 with keepalive
+      settings as long as gRPC's own default (a PING after two hours)
+--procs client processes then open --clients connections between them through the client
+libraries: each part 1 client logs in and idles at the menu, each part 2 client opens its
+MessageStream. A first round of clients leaves cleanly so that the thread pools have grown
+before the baseline is taken. Half of the second round's processes are then killed (SIGKILL: the
+kernel closes their sockets) and the other half stopped (SIGSTOP: their sockets stay open but
+nothing answers). Reported are the server's open fds, threads and connected sockets (part 1)
+or open streams (part 2) at the baseline, with every client connected, and --window seconds
+after the chaos, with the time it took to get back to the baseline ('-' if it never did).
+
+Then, in process, the cost of one heartbeat tick with --connections watched connections that
+are all active (the common case: each only needs rescheduling once per interval), with the timer
+wheel and with a scan over every connection per tick.
+
+Usage: python3 bench/dead_clients.py [--servers part1-threaded part1-selectors part2-threaded part2-aio]
+                                     [--configs on off] [--clients 100] [--procs 4] [--window 10]
+                                     [--connections 10000 100000]
+'''
+# Import relevant python packages
+from argparse import SUPPRESS, ArgumentParser
+import json
+import os
+import signal
+import subprocess
+import sys
+import time
+from urllib.request import urlopen
+
+# Constants/configurations
+HOST      = '127.0.0.1'
+ROOT      = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+PASSWORD  = 'password'
+SERVERS   = {
+    'part1-threaded':  ('part_1', ['--mode', 'threaded'], 'chat_connections'),
+    'part1-selectors': ('part_1', ['--mode', 'selectors'], 'chat_connections'),
+    'part2-threaded':  ('part_2', ['--mode', 'threaded', '--max-clients', '512'], 'chat_streams'),
+    'part2-aio':       ('part_2', ['--mode', 'aio'], 'chat_streams'),
+}
+INTERVAL  = 30.0 # heartbeat interval of the wheel measurement
+CONFIGS   = {
+    'on':  {'part_1': ['--heartbeat', '1', '--idle-timeout', '3'], 'part_2': ['--heartbeat', '1', '--idle-timeout', '3']},
+    'off': {'part_1': ['--heartbeat', '0'], 'part_2': ['--heartbeat', '7200', '--idle-timeout', '7220']},
+}
+
+# Client process: open count connections as users prefix0.., print 'ready' and wait to be signalled
+def child(part, port, count, prefix):
+    signal.pthread_sigmask(signal.SIG_BLOCK, [signal.SIGTERM]) # for sigwait, in every thread
+    sys.path.insert(0, os.path.join(ROOT, part))
+    from sdk import Client
+    clients = []
+    if part == 'part_1':
+        for index in range(count):
+            client = Client(HOST, port, commands=True)
+            client.create('{}{}'.format(prefix, index), PASSWORD)
+            clients.append(client)
+    else:
+        from threading import Thread
+        for index in range(count):
+            client = Client('{}:{}'.format(HOST, port))
+            client.create('{}{}'.format(prefix, index), PASSWORD)
+            Thread(target=lambda client: list(client.subscribe()), args=(client,), daemon=True).start()
+            clients.append(client)
+    print('ready', flush=True)
+    signal.sigwait([signal.SIGTERM])
+    for client in clients:
+        client.close()
+
+def spawn(part, port, count, prefix):
+    process = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--child', part, '--port', str(port),
+                                '--clients', str(count), '--prefix', prefix], stdout=subprocess.PIPE, text=True)
+    return process
+
+def wait_ready(processes):
+    for process in processes:
+        if process.stdout.readline().strip() != 'ready':
+            raise RuntimeError('client process failed to connect')
+
+def start_server(name, config, port, metrics_port):
+    part, options, _ = SERVERS[name]
+    path = os.path.join(ROOT, part, 'server.py')
+    command = ([sys.executable, path, '--host', HOST, '--port', str(port), '--kdf-cost', '4', '--metrics-port',
+                str(metrics_port)] + options + CONFIGS[config][part])
+    process = subprocess.Popen(command, cwd=os.path.dirname(path), stdout=subprocess.DEVNULL,
+                               stderr=subprocess.DEVNULL)
+    deadline = time.time() + 15
+    while time.time() < deadline:
+        try:
+            gauges(metrics_port)
+            return process
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError('{} server did not start'.format(name))
+
+def gauges(metrics_port):
+    with urlopen('http://{}:{}/metrics.json'.format(HOST, metrics_port), timeout=5) as response:
+        return json.load(response)['gauges']
+
+# (open fds, threads, gauge) of the server
+def sample(process, metrics_port, gauge):
+    fds = len(os.listdir('/proc/{}/fd'.format(process.pid)))
+    with open('/proc/{}/status'.format(process.pid)) as status:
+        threads = next(int(line.split()[1]) for line in status if line.startswith('Threads:'))
+    return fds, threads, gauges(metrics_port)[gauge]
+
+# Poll until every resource is back at baseline (or timeout); returns (seconds or None, last sample)
+def settle(process, metrics_port, gauge, baseline, timeout, started=None):
+    started = started or time.perf_counter()
+    while True:
+        current = sample(process, metrics_port, gauge)
+        elapsed = time.perf_counter() - started
+        if all(now <= base for now, base in zip(current, baseline)):
+            return elapsed, current
+        if elapsed >= timeout:
+            return None, current
+        time.sleep(0.1)
+
+def run(name, config, port, clients, procs, window):
+    part, _, gauge = SERVERS[name]
+    metrics_port = port + 1000
+    process = start_server(name, config, port, metrics_port)
+    children = []
+    try:
+        per_process = max(1, clients // procs)
+        # Warm-up round, left cleanly, so thread pools have their size before the baseline
+        warmup = [spawn(part, port, per_process, 'warm{}_'.format(index)) for index in range(procs)]
+        wait_ready(warmup)
+        for child_process in warmup:
+            child_process.send_signal(signal.SIGTERM)
+            child_process.wait()
+        settle(process, metrics_port, gauge, (float('inf'), float('inf'), 0), window)
+        time.sleep(1)
+        baseline = sample(process, metrics_port, gauge)
+
+        children = [spawn(part, port, per_process, 'user{}_'.format(index)) for index in range(procs)]
+        wait_ready(children)
+        # Streams open in the background: wait for all of them
+        deadline = time.perf_counter() + window
+        loaded = sample(process, metrics_port, gauge)
+        while loaded[2] < per_process * procs and time.perf_counter() < deadline:
+            time.sleep(0.1)
+            loaded = sample(process, metrics_port, gauge)
+
+        started = time.perf_counter()
+        for index, child_process in enumerate(children):
+            child_process.send_signal(signal.SIGKILL if index % 2 == 0 else signal.SIGSTOP)
+        recovered, after = settle(process, metrics_port, gauge, baseline, window, started)
+        return {'server': name, 'config': config, 'baseline': baseline, 'loaded': loaded, 'after': after,
+                'recovered': recovered}
+    finally:
+        for child_process in children:
+            child_process.kill()
+            child_process.wait()
+        process.kill()
+        process.wait()
+
+class Watched:
+    '''
+    Stand-in connection for the wheel measurement
+        - last_input: time of its last input
+    '''
+    def __init__(self, last_input) -> None:
+        self.last_input = last_input
+
+# Mean seconds per tick over two heartbeat intervals of connections whose input keeps coming in,
+# with the wheel and with a scan of every connection per tick
+def tick_cost(count):
+    sys.path.insert(0, os.path.join(ROOT, 'part_1'))
+    from heartbeat import Heartbeat
+    heartbeat = Heartbeat(INTERVAL, INTERVAL * 3)
+    now = time.monotonic()
+    connections = [Watched(now) for _ in range(count)]
+    for conn in connections:
+        heartbeat.watch(conn)
+    ticks = int(2 * INTERVAL / heartbeat.tick)
+    alive = lambda conn: True
+    ping = reap = lambda conn: None
+    wheel = 0.0
+    per_interval = int(INTERVAL / heartbeat.tick)
+    for tick in range(ticks):
+        now += heartbeat.tick
+        for conn in connections[tick % per_interval::per_interval]: # every connection sends once per interval
+            conn.last_input = now
+        started = time.perf_counter()
+        heartbeat.run(now, alive, ping, reap)
+        wheel += time.perf_counter() - started
+    scan = 0.0
+    for tick in range(ticks):
+        now += heartbeat.tick
+        started = time.perf_counter()
+        for conn in connections:
+            if now - conn.last_input >= INTERVAL and alive(conn):
+                ping(conn)
+        scan += time.perf_counter() - started
+    return wheel / ticks, scan / ticks, heartbeat.pings
+
+def main():
+    parser = ArgumentParser(description='Server resources after clients die without closing their connections.')
+    parser.add_argument('--servers', nargs='+', choices=list(SERVERS), default=list(SERVERS))
+    parser.add_argument('--configs', nargs='+', choices=list(CONFIGS), default=list(CONFIGS))
+    parser.add_argument('--clients', type=int, default=100, help='connections over all client processes')
+    parser.add_argument('--procs', type=int, default=4, help='client processes (half killed, half stopped)')
+    parser.add_argument('--window', type=float, default=10.0, help='seconds to wait for the resources to come back')
+    parser.add_argument('--connections', nargs='+', type=int, default=[10000, 100000],
+                        help='connections watched in the tick cost measurement')
+    parser.add_argument('--port', type=int, default=12480)
+    parser.add_argument('--child', choices=['part_1', 'part_2'], help=SUPPRESS)
+    parser.add_argument('--prefix', default='user', help=SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        child(args.child, args.port, args.clients, args.prefix)
+        return
+
+    print('{:<16} {:<6} {:>22} {:>22} {:>22} {:>12}'.format(
+        'server', 'config', 'baseline fds/thr/conn', 'loaded fds/thr/conn', 'after fds/thr/conn', 'recovered_s'))
+    port = args.port
+    for name in args.servers:
+        for config in args.configs:
+            result = run(name, config, port, args.clients, args.procs, args.window)
+            port += 1
+            recovered = '-' if result['recovered'] is None else '{:.1f}'.format(result['recovered'])
+            print('{:<16} {:<6} {:>22} {:>22} {:>22} {:>12}'.format(
+                name, config, '/'.join(map(str, result['baseline'])), '/'.join(map(str, result['loaded'])),
+                '/'.join(map(str, result['after'])), recovered))
+
+    print()
+    print('{:>11} {:>13} {:>13} {:>7}'.format('connections', 'wheel_tick_ms', 'scan_tick_ms', 'pings'))
+    for count in args.connections:
+        wheel, scan, pings = tick_cost(count)
+        print('{:>11} {:>13.3f} {:>13.3f} {:>7}'.format(count, wheel * 1000, scan * 1000, pings))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,198 @@
+'''
+This file benchmarks group broadcasts (SendGroupMessage) against sending the same message to every
+member one by one (SendMessage) or as one batch (SendMessages).
+
+Three measurements, for each --members group size:
+    - store: one broadcast queued in the mailboxes of offline members, UserStore.append_group vs
+      append_many of one formatted message per member (what SendMessages does). Reported: time per
+      broadcast, memory the queued broadcast keeps alive (tracemalloc) and bytes it adds to the
+      write-ahead log
+    - rpc: member deliveries per second against an in-process part 2 server, one SendGroupMessage
+      vs one SendMessages batch vs a SendMessage per member
+    - online: --online members hold MessageStreams open; time from the send until every stream
+      received the message, group vs batch
+A group broadcast keeps one message body plus a reference per member; the per-member paths keep a
+body per member, in memory and in the log.
+
+Usage: python3 bench/group_fanout.py [--members 100 1000 5000] [--online 50] [--length 200]
+'''
+# Import relevant python packages
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import redirect_stdout
+import io
+import os
+import sys
+import tempfile
+from threading import Thread
+import time
+import tracemalloc
+
+import grpc
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(ROOT, 'part_2'))
+sys.path.insert(0, ROOT)
+from common.user_store import UserStore
+from common.wal import NullLog, WriteAheadLog, list_segments, segment_path
+from protos import chat_pb2, chat_pb2_grpc
+from server import ChatAppService
+
+# Constants/configurations
+HOST     = '127.0.0.1'
+GROUP    = 'bench'
+SENDER   = 'sender'
+PASSWORD = 'password'
+
+def member(index):
+    return 'user{}'.format(index)
+
+# Store with the sender and count members in GROUP
+def setup_store(count, wal):
+    users = UserStore(wal)
+    users.create(SENDER, PASSWORD)
+    users.create_group(GROUP, SENDER)
+    for index in range(count):
+        users.create(member(index), PASSWORD)
+        users.join_group(GROUP, member(index))
+    return users
+
+def log_size(path):
+    return sum(os.path.getsize(segment_path(path, segment)) for segment in list_segments(path))
+
+# (microseconds, bytes kept alive, bytes logged) of one broadcast with send(users, count)
+def measure_store(count, send, directory):
+    # Time and memory without a log, so neither includes the log's pending buffer
+    users = setup_store(count, NullLog())
+    start = time.perf_counter()
+    send(users, count)
+    elapsed = time.perf_counter() - start
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    send(users, count)
+    kept = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+
+    path = os.path.join(directory, 'wal{}'.format(time.perf_counter_ns()))
+    wal = WriteAheadLog(path, snapshot_interval=0)
+    users = setup_store(count, wal)
+    users.sync(wal.enqueued)
+    size = log_size(path)
+    users.sync(send(users, count))
+    logged = log_size(path) - size
+    wal.close()
+    return elapsed * 1e6, kept, logged
+
+def bench_store(args):
+    text = 'x' * args.length
+    def group(users, count):
+        return users.append_group(GROUP, SENDER, '[{}] <{}> {}'.format(GROUP, SENDER, text).encode())[0]
+    def per_member(users, count):
+        return users.append_many([(member(index), '<{}> {}'.format(SENDER, text).encode()) for index in range(count)])[1]
+
+    print('{:>8} {:<10} {:>12} {:>12} {:>12}'.format('members', 'method', 'us_per_send', 'kept_bytes', 'log_bytes'))
+    with tempfile.TemporaryDirectory() as directory:
+        for count in args.members:
+            for name, send in [('group', group), ('per_member', per_member)]:
+                elapsed, kept, logged = measure_store(count, send, directory)
+                print('{:>8} {:<10} {:>12.0f} {:>12} {:>12}'.format(count, name, elapsed, kept, logged))
+
+def start_server(port, workers):
+    service = ChatAppService(60, NullLog())
+    server = grpc.server(ThreadPoolExecutor(max_workers=workers))
+    chat_pb2_grpc.add_ChatAppServicer_to_server(service, server)
+    server.add_insecure_port('{}:{}'.format(HOST, port))
+    server.start()
+    channel = grpc.insecure_channel('{}:{}'.format(HOST, port))
+    return server, channel, chat_pb2_grpc.ChatAppStub(channel)
+
+# The sender and count members in GROUP (the in-process server's account lines are not printed)
+def setup_accounts(stub, count):
+    with redirect_stdout(io.StringIO()):
+        stub.CreateAccount(chat_pb2.AccountInfo(username=SENDER, password=PASSWORD))
+        stub.CreateGroup(chat_pb2.GroupRequest(group=GROUP, username=SENDER))
+        for index in range(count):
+            stub.CreateAccount(chat_pb2.AccountInfo(username=member(index), password=PASSWORD))
+            stub.JoinGroup(chat_pb2.GroupRequest(group=GROUP, username=member(index)))
+
+# Ways of sending text to the first count members
+def senders(stub, count, text):
+    batch = chat_pb2.MsgBatch(msgs=[chat_pb2.Msg(src_username=SENDER, dst_username=member(index), msg=text)
+                                    for index in range(count)])
+    group = chat_pb2.GroupMsg(group=GROUP, src_username=SENDER, msg=text)
+    def unary():
+        for msg in batch.msgs:
+            stub.SendMessage(msg)
+    return [('group', lambda: stub.SendGroupMessage(group)), ('batch', lambda: stub.SendMessages(batch)),
+            ('unary', unary)]
+
+def bench_rpc(args):
+    text = 'x' * args.length
+    print('{:>8} {:<10} {:>10} {:>16}'.format('members', 'method', 'ms_per_send', 'deliveries_per_s'))
+    for offset, count in enumerate(args.members):
+        server, channel, stub = start_server(args.port + offset, 8)
+        setup_accounts(stub, count)
+        for name, send in senders(stub, count, text):
+            send() # warm up
+            start = time.perf_counter()
+            for _ in range(args.rounds):
+                send()
+            elapsed = (time.perf_counter() - start) / args.rounds
+            print('{:>8} {:<10} {:>10.2f} {:>16.0f}'.format(count, name, elapsed * 1000, count / elapsed))
+        channel.close()
+        server.stop(None)
+
+def bench_online(args):
+    count = args.online
+    server, channel, stub = start_server(args.port + len(args.members), count + 8)
+    setup_accounts(stub, count)
+    # One stream per member; each counts the broadcasts it received
+    received = [0] * count
+    streams = []
+    def listen(index, call):
+        try:
+            for message in call:
+                if message.seq:
+                    received[index] += 1
+        except grpc.RpcError:
+            pass
+    for index in range(count):
+        call = stub.MessageStream(chat_pb2.StreamRequest(username=member(index), password=PASSWORD))
+        streams.append(call)
+        Thread(target=listen, args=(index, call), daemon=True).start()
+    time.sleep(1.0)
+
+    print('{:>8} {:<10} {:>12}'.format('online', 'method', 'ms_to_all'))
+    expected = 0
+    for name, send in senders(stub, count, 'x' * args.length)[:2]:
+        samples = []
+        for _ in range(args.rounds):
+            expected += 1
+            start = time.perf_counter()
+            send()
+            while min(received) < expected:
+                time.sleep(0.0005)
+            samples.append(time.perf_counter() - start)
+        print('{:>8} {:<10} {:>12.2f}'.format(count, name, sorted(samples)[len(samples) // 2] * 1000))
+    for call in streams:
+        call.cancel()
+    channel.close()
+    server.stop(None)
+
+def main():
+    parser = ArgumentParser(description='Group broadcast vs per-member sends (part 2).')
+    parser.add_argument('--members', type=int, nargs='+', default=[100, 1000, 5000], help='group sizes')
+    parser.add_argument('--online', type=int, default=50, help='members with an open MessageStream (online run)')
+    parser.add_argument('--length', type=int, default=200, help='characters per message')
+    parser.add_argument('--rounds', type=int, default=5, help='sends timed per method')
+    parser.add_argument('--port', type=int, default=12650)
+    args = parser.parse_args()
+
+    bench_store(args)
+    print()
+    bench_rpc(args)
+    print()
+    bench_online(args)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+'''
+This file load tests the part 1 threaded server while login handshakes are stalled.
+
+S "slow" clients connect and never answer the welcome prompt (a human who walked away, or
+a malicious client). F fast clients then connect and create accounts; we report how long
+they wait for the welcome prompt and how long a complete account creation takes. Running
+with --handshake-workers 1 reproduces the old behavior of handshaking on the accept thread.
+
+Usage: python3 bench/handshake_load.py [--slow S] [--fast F] [--workers 1 32]
+'''
+# Import relevant python packages
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+import os
+from socket import create_connection, timeout, IPPROTO_TCP, TCP_NODELAY
+import subprocess
+import sys
+import time
+
+# Constants/configurations
+ENCODING    = 'utf-8' # message encoding
+BUFFER_SIZE = 2048 # fixed 2KB buffer size
+HOST        = '127.0.0.1'
+SERVER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'part_1', 'server.py')
+
+# Read from sock until token shows up in the received text
+def expect(sock, token):
+    received = ''
+    while token not in received:
+        data = sock.recv(BUFFER_SIZE)
+        if not data:
+            raise ConnectionError('server closed connection while waiting for {!r}'.format(token))
+        received += data.decode(encoding=ENCODING)
+    return received
+
+# Connect, wait for the welcome prompt and create an account; returns (welcome_s, total_s)
+def fast_client(port, username, deadline):
+    start = time.perf_counter()
+    sock = create_connection((HOST, port))
+    sock.settimeout(deadline)
+    sock.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
+    try:
+        expect(sock, '2. Login')
+        welcome = time.perf_counter() - start
+        sock.send(b'1')
+        expect(sock, 'username: ')
+        sock.send(username.encode(encoding=ENCODING))
+        expect(sock, 'password.')
+        sock.send(b'password')
+        expect(sock, '5. Groups.')
+        return welcome, time.perf_counter() - start
+    except timeout:
+        return None
+    finally:
+        sock.close()
+
+def start_server(port, workers, phase_timeout):
+    process = subprocess.Popen([sys.executable, SERVER_PATH, '--host', HOST, '--port', str(port),
+                                '--handshake-workers', str(workers), '--handshake-timeout', str(phase_timeout)],
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        try:
+            create_connection((HOST, port)).close()
+            return process
+        except OSError:
+            time.sleep(0.05)
+    process.kill()
+    raise RuntimeError('server did not start')
+
+def percentile(samples, p):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p))]
+
+def run(port, workers, num_slow, num_fast, phase_timeout, deadline):
+    process = start_server(port, workers, phase_timeout)
+    slow = []
+    try:
+        # Stalled handshakes: connect and never type anything
+        for _ in range(num_slow):
+            slow.append(create_connection((HOST, port)))
+
+        with ThreadPoolExecutor(max_workers=16) as pool:
+            start = time.perf_counter()
+            results = list(pool.map(lambda index: fast_client(port, 'fast{}'.format(index), deadline),
+                                    range(num_fast)))
+            elapsed = time.perf_counter() - start
+
+        done = [result for result in results if result is not None]
+        welcome = [result[0] * 1000 for result in done] or [float('nan')]
+        total = [result[1] * 1000 for result in done] or [float('nan')]
+        return {
+            'workers':        workers,
+            'slow':           num_slow,
+            'completed':      len(done),
+            'timed_out':      num_fast - len(done),
+            'accounts_per_s': len(done) / elapsed,
+            'welcome_p50_ms': percentile(welcome, 0.50),
+            'welcome_p99_ms': percentile(welcome, 0.99),
+            'create_p99_ms':  percentile(total, 0.99),
+        }
+    finally:
+        for sock in slow:
+            sock.close()
+        process.kill()
+        process.wait()
+
+def main():
+    parser = ArgumentParser(description='Accept throughput of the part 1 threaded server under stalled handshakes.')
+    parser.add_argument('--slow', type=int, default=16, help='clients that connect and never answer')
+    parser.add_argument('--fast', type=int, default=500, help='clients that create an account immediately')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 32], help='handshake worker pool sizes to test')
+    parser.add_argument('--phase-timeout', type=float, default=5.0, help='server per-prompt handshake timeout')
+    parser.add_argument('--deadline', type=float, default=30.0, help='seconds a fast client waits before giving up')
+    parser.add_argument('--port', type=int, default=12350)
+    args = parser.parse_args()
+
+    print('{:>8} {:>6} {:>10} {:>10} {:>15} {:>15} {:>15} {:>14}'.format(
+        'workers', 'slow', 'completed', 'timed_out', 'accounts_per_s', 'welcome_p50_ms', 'welcome_p99_ms',
+        'create_p99_ms'))
+    for offset, workers in enumerate(args.workers):
+        result = run(args.port + offset, workers, args.slow, args.fast, args.phase_timeout, args.deadline)
+        print('{workers:>8} {slow:>6} {completed:>10} {timed_out:>10} {accounts_per_s:>15.1f} '
+              '{welcome_p50_ms:>15.2f} {welcome_p99_ms:>15.2f} {create_p99_ms:>14.2f}'.format(**result))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,173 @@
+'''
+This file benchmarks account listing: full listings vs pages of the sorted username index.
+
+For each account count N, a snapshot holding N accounts is written and the part 2 server
+(--mode) and the part 1 server (--part1-mode) are started on it. Each method is then timed
+--repeat times, and the number of lines/usernames it returned is shown:
+    - part2 full:   ListAccounts, one string holding every username
+    - part2 page:   ListAccountsPage, --page-size usernames after a cursor in the middle of the index
+    - part2 prefix: ListAccountsPage with a prefix matching 10 accounts
+    - part2 glob:   ListAccountsPage with a glob pattern matching 10 accounts
+    - part1 full:   menu option 2 (every username)
+    - part1 page:   menu option 4 with *, first page
+The old ListAccounts string building (one += per username) is also timed in-process, as
+"concat", for reference.
+
+Usage: python3 bench/list_accounts.py [--accounts 1000 10000 100000] [--repeat 20] [--mode threaded|aio]
+'''
+# Import relevant python packages
+from argparse import ArgumentParser
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import grpc
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'part_2'))
+from common.snapshot import write_snapshot
+from common.wal import snapshot_path
+from protos import chat_pb2, chat_pb2_grpc
+
+# Constants/configurations
+HOST        = '127.0.0.1'
+PART1_PATH  = os.path.join(ROOT, 'part_1', 'server.py')
+PART2_PATH  = os.path.join(ROOT, 'part_2', 'server.py')
+MENU        = '5. Groups.' # end of the part 1 menu prompt
+MORE        = 'anything else to return to the menu.' # end of the part 1 next-page prompt
+
+def username(index):
+    return 'user{:07d}'.format(index)
+
+def write_accounts(path, num_accounts):
+    state = {username(index): {'password': 'password', 'mailbox': []} for index in range(num_accounts)}
+    write_snapshot(snapshot_path(path), state, 0)
+
+def start(command, port):
+    process = subprocess.Popen(command + ['--host', HOST, '--port', str(port)], cwd=os.path.dirname(command[1]),
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.time() + 60
+    while True:
+        try:
+            socket.create_connection((HOST, port)).close()
+            return process
+        except OSError:
+            if time.time() > deadline:
+                process.kill()
+                raise
+            time.sleep(0.1)
+
+def stop(process):
+    process.kill()
+    process.wait()
+
+# Read from sock until token arrives; returns the text read
+def expect(sock, token):
+    data = b''
+    encoded = token.encode()
+    while encoded not in data:
+        chunk = sock.recv(1 << 16)
+        if not chunk:
+            raise ConnectionError('server closed the connection')
+        data += chunk
+    return data.decode()
+
+def percentile(samples, p):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p))]
+
+# Time call() repeat times; returns (p50 ms, p99 ms, size of the last result)
+def measure(call, repeat):
+    latencies = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        size = call()
+        latencies.append((time.perf_counter() - start) * 1000)
+    return percentile(latencies, 0.50), percentile(latencies, 0.99), size
+
+# The ListAccounts string building replaced by the paged listing
+def concat(usernames):
+    message = '\nAll users:\n'
+    for index, name in enumerate(usernames):
+        message += '{}. {}\n'.format(index, name)
+    return message.count('\n')
+
+def bench_part2(port, num_accounts, args):
+    stub = chat_pb2_grpc.ChatAppStub(grpc.insecure_channel('{}:{}'.format(HOST, port)))
+    middle = username(num_accounts // 2)
+    prefix = username(num_accounts // 2)[:-1]
+    pattern = prefix[:-1] + '*' + prefix[-1]
+    requests = {
+        'page':   chat_pb2.ListAccountsRequest(page_size=args.page_size, cursor=middle),
+        'prefix': chat_pb2.ListAccountsRequest(prefix=prefix),
+        'glob':   chat_pb2.ListAccountsRequest(pattern=pattern),
+    }
+    results = [('part2', 'full', measure(lambda: stub.ListAccounts(chat_pb2.Empty()).msg.count('\n'), args.repeat))]
+    for method, request in requests.items():
+        results.append(('part2', method, measure(lambda: len(stub.ListAccountsPage(request).usernames), args.repeat)))
+    return results
+
+def bench_part1(port, args):
+    sock = socket.create_connection((HOST, port))
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    expect(sock, '2. Login')
+    for text, token in [('1', 'username'), ('lister', 'password'), ('password', MENU)]:
+        sock.sendall(text.encode())
+        expect(sock, token)
+
+    def full():
+        sock.sendall(b'2')
+        return expect(sock, MENU).count('\n')
+
+    def page():
+        sock.sendall(b'4')
+        expect(sock, 'for all:')
+        sock.sendall(b'*')
+        lines = expect(sock, MORE).count('\n')
+        sock.sendall(b'done')
+        expect(sock, MENU)
+        return lines
+
+    results = [('part1', 'full', measure(full, args.repeat)), ('part1', 'page', measure(page, args.repeat))]
+    sock.close()
+    return results
+
+def main():
+    parser = ArgumentParser(description='Full vs paged account listings on both servers.')
+    parser.add_argument('--accounts', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--repeat', type=int, default=20, help='timed calls per method')
+    parser.add_argument('--page-size', type=int, default=100)
+    parser.add_argument('--mode', choices=['threaded', 'aio'], default='threaded', help='part 2 server mode')
+    parser.add_argument('--part1-mode', choices=['threaded', 'selectors'], default='selectors')
+    parser.add_argument('--port', type=int, default=12420)
+    args = parser.parse_args()
+
+    print('{:>9} {:<6} {:<7} {:>10} {:>10} {:>9}'.format('accounts', 'server', 'method', 'p50_ms', 'p99_ms', 'lines'))
+    for num_accounts in args.accounts:
+        with tempfile.TemporaryDirectory() as directory:
+            wal = os.path.join(directory, 'chat.wal')
+            write_accounts(wal, num_accounts)
+            usernames = [username(index) for index in range(num_accounts)]
+            results = [('-', 'concat', measure(lambda: concat(usernames), args.repeat))]
+
+            process = start([sys.executable, PART2_PATH, '--mode', args.mode, '--wal', wal], args.port)
+            try:
+                results += bench_part2(args.port, num_accounts, args)
+            finally:
+                stop(process)
+
+            process = start([sys.executable, PART1_PATH, '--mode', args.part1_mode, '--wal', wal], args.port + 1)
+            try:
+                results += bench_part1(args.port + 1, args)
+            finally:
+                stop(process)
+
+        for server, method, (p50, p99, size) in results:
+            print('{:>9} {:<6} {:<7} {:>10.3f} {:>10.3f} {:>9}'.format(num_accounts, server, method, p50, p99, size))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,139 @@
+'''
+This file benchmarks part 2 logins (salted scrypt password hashes) and what a login storm does to
+the latency of every other RPC.
+
+For each mode and configuration a server is launched on localhost:
+    - cheap: --kdf-cost 1 --hash-workers 0, a hash costing next to nothing (close to the plain
+      password comparison before hashing)
+    - inline: --hash-workers 0, the full-cost hash on the thread (or event loop) serving the call
+    - pool: the full-cost hash in the server's hashing processes (the default)
+    - tokens: the pool, but the storm logs in with the session token of its first login
+A sender then calls SendMessage back to back for --seconds (the baseline), and again for --seconds
+while --stormers threads call LoginAccount back to back. Reported are logins per second and their
+p99, and SendMessage calls per second, p50 and p99 without and during the storm.
+
+Usage: python3 bench/login_storm.py [--modes threaded aio] [--configs cheap inline pool tokens] [--stormers 16] [--seconds 5]
+'''
+# Import relevant python packages
+from argparse import ArgumentParser
+import os
+import subprocess
+import sys
+from threading import Event, Thread
+import time
+
+import grpc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'part_2'))
+from protos import chat_pb2, chat_pb2_grpc
+
+# Constants/configurations
+HOST        = '127.0.0.1'
+SERVER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'part_2', 'server.py')
+PASSWORD    = 'correct horse battery staple'
+CONFIGS     = {
+    'cheap':  ['--kdf-cost', '1', '--hash-workers', '0'],
+    'inline': ['--hash-workers', '0'],
+    'pool':   [],
+    'tokens': [],
+}
+
+def start_server(mode, port, options):
+    process = subprocess.Popen([sys.executable, SERVER_PATH, '--mode', mode, '--host', HOST, '--port', str(port)] + options,
+                               cwd=os.path.dirname(SERVER_PATH), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    with grpc.insecure_channel('{}:{}'.format(HOST, port)) as channel:
+        grpc.channel_ready_future(channel).result(timeout=30)
+    return process
+
+def percentile(samples, p):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p))] * 1000 if ordered else float('nan')
+
+# Call LoginAccount back to back until stop is set, recording latencies
+def storm(stub, username, token, stop, latencies):
+    request = chat_pb2.AccountInfo(username=username, password='' if token else PASSWORD, token=token)
+    while not stop.is_set():
+        start = time.perf_counter()
+        if not stub.LoginAccount(request).status:
+            raise RuntimeError('login of {} refused'.format(username))
+        latencies.append(time.perf_counter() - start)
+
+# SendMessage back to back for seconds; returns the latencies
+def send_for(stub, token, seconds):
+    message = chat_pb2.Msg(src_username='sender', dst_username='receiver', msg='hello', token=token)
+    latencies = []
+    stop_at = time.perf_counter() + seconds
+    while time.perf_counter() < stop_at:
+        start = time.perf_counter()
+        stub.SendMessage(message)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+def run(mode, config, port, stormers, seconds):
+    process = start_server(mode, port, CONFIGS[config])
+    channels = [grpc.insecure_channel('{}:{}'.format(HOST, port)) for _ in range(stormers + 1)]
+    stubs = [chat_pb2_grpc.ChatAppStub(channel) for channel in channels]
+    try:
+        token = stubs[0].CreateAccount(chat_pb2.AccountInfo(username='sender', password=PASSWORD)).token
+        stubs[0].CreateAccount(chat_pb2.AccountInfo(username='receiver', password=PASSWORD))
+        tokens = []
+        for index in range(stormers):
+            created = stubs[0].CreateAccount(chat_pb2.AccountInfo(username='storm{}'.format(index), password=PASSWORD))
+            tokens.append(created.token if config == 'tokens' else '')
+
+        baseline = send_for(stubs[0], token, seconds)
+
+        stop = Event()
+        logins = [[] for _ in range(stormers)]
+        threads = [Thread(target=storm, args=(stubs[index + 1], 'storm{}'.format(index), tokens[index], stop, logins[index]),
+                          daemon=True) for index in range(stormers)]
+        for thread in threads:
+            thread.start()
+        time.sleep(0.5) # let the storm build up
+        started = time.perf_counter()
+        counted = sum(map(len, logins))
+        during = send_for(stubs[0], token, seconds)
+        login_rate = (sum(map(len, logins)) - counted) / (time.perf_counter() - started)
+        stop.set()
+        for thread in threads:
+            thread.join()
+        login_latencies = [latency for latencies in logins for latency in latencies]
+        return {
+            'mode':         mode,
+            'config':       config,
+            'logins_per_s': login_rate,
+            'login_p99':    percentile(login_latencies, 0.99),
+            'base_rps':     len(baseline) / seconds,
+            'base_p99':     percentile(baseline, 0.99),
+            'storm_rps':    len(during) / seconds,
+            'storm_p50':    percentile(during, 0.50),
+            'storm_p99':    percentile(during, 0.99),
+        }
+    finally:
+        for channel in channels:
+            channel.close()
+        process.kill()
+        process.wait()
+
+def main():
+    parser = ArgumentParser(description='Part 2 login throughput and SendMessage latency during a login storm.')
+    parser.add_argument('--modes', nargs='+', choices=['threaded', 'aio'], default=['threaded', 'aio'])
+    parser.add_argument('--configs', nargs='+', choices=list(CONFIGS), default=list(CONFIGS))
+    parser.add_argument('--stormers', type=int, default=16, help='threads logging in back to back')
+    parser.add_argument('--seconds', type=float, default=5.0, help='duration of each SendMessage phase')
+    parser.add_argument('--port', type=int, default=12470)
+    args = parser.parse_args()
+
+    print('{:<9} {:<7} {:>12} {:>13} {:>9} {:>12} {:>10} {:>13} {:>13}'.format(
+        'mode', 'config', 'logins_per_s', 'login_p99_ms', 'send_rps', 'send_p99_ms', 'storm_rps', 'storm_p50_ms',
+        'storm_p99_ms'))
+    port = args.port
+    for mode in args.modes:
+        for config in args.configs:
+            result = run(mode, config, port, args.stormers, args.seconds)
+            port += 1
+            print('{mode:<9} {config:<7} {logins_per_s:>12.0f} {login_p99:>13.1f} {base_rps:>9.0f} {base_p99:>12.2f} '
+                  '{storm_rps:>10.0f} {storm_p50:>13.2f} {storm_p99:>13.2f}'.format(**result))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,198 @@
+'''
+This file benchmarks replaying a mailbox backlog to a user who logs in.
+
+For each backlog size N a snapshot holding one account ('reader') with N queued messages of
+--message-size characters is written, a server is started on a fresh copy of it, and 'reader'
+logs in through one of these paths:
+    - part1 threaded/selectors: login on the part 1 server (text protocol), backlog sent before the menu
+    - part2 login:  LoginAccount alone (the response carried the whole backlog before FetchMailbox)
+    - part2 fetch:  LoginAccount, then FetchMailbox until the backlog is replayed
+    - part2 stream: LoginAccount, then MessageStream until N messages arrived
+For each path the time to the first message, the time to the whole backlog and the growth of
+the server's peak RSS during the login are reported. --root runs the servers of another
+checkout (e.g. a git worktree of an older commit) for before/after comparisons; paths that
+checkout does not support are reported as errors.
+
+Usage: python3 bench/mailbox_replay.py [--backlogs 1000 10000 50000 200000] [--message-size 64] [--root DIR]
+'''
+# Import relevant python packages
+from argparse import ArgumentParser
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import grpc
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'part_2'))
+from common.snapshot import write_snapshot
+from common.wal import snapshot_path
+from protos import chat_pb2, chat_pb2_grpc
+
+# Constants/configurations
+HOST           = '127.0.0.1'
+USERNAME       = 'reader'
+PASSWORD       = 'password'
+MENU           = '3. Delete your account.' # in the part 1 menu prompt of every version
+STREAM_TIMEOUT = 300 # seconds before the stream path gives up waiting for the backlog
+PATHS          = ['part1 threaded', 'part1 selectors', 'part2 login', 'part2 fetch', 'part2 stream']
+
+def write_backlog(directory, num_messages, message_size):
+    message = b'<bench> ' + b'x' * max(0, message_size - 8)
+    state = {USERNAME: {'password': PASSWORD, 'mailbox': [message] * num_messages}}
+    write_snapshot(snapshot_path(os.path.join(directory, 'chat.wal')), state, 0)
+
+def start(root, part, mode, directory, port):
+    server_path = os.path.join(root, part, 'server.py')
+    command = [sys.executable, server_path, '--mode', mode, '--host', HOST, '--port', str(port),
+               '--wal', os.path.join(directory, 'chat.wal'), '--snapshot-interval', '0']
+    process = subprocess.Popen(command, cwd=os.path.dirname(server_path), stdout=subprocess.DEVNULL,
+                               stderr=subprocess.DEVNULL)
+    deadline = time.time() + 120
+    while True:
+        try:
+            socket.create_connection((HOST, port)).close()
+            return process
+        except OSError:
+            if process.poll() is not None or time.time() > deadline:
+                process.kill()
+                raise RuntimeError('server did not start')
+            time.sleep(0.1)
+
+# Read a field (e.g. VmRSS, VmHWM) in KiB from /proc/PID/status
+def proc_status(pid, field):
+    with open('/proc/{}/status'.format(pid)) as status:
+        for line in status:
+            if line.startswith(field + ':'):
+                return int(line.split()[1])
+    return 0
+
+# Reset the peak RSS of pid to its current RSS
+def reset_peak(pid):
+    with open('/proc/{}/clear_refs'.format(pid), 'w') as clear_refs:
+        clear_refs.write('5')
+
+# Log in on the part 1 server; returns (seconds to first message, seconds to the whole backlog)
+def login_part1(port, num_messages):
+    sock = socket.create_connection((HOST, port))
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    data = b''
+    for text, token in [(None, b'2. Login'), (b'2', b'username'), (USERNAME.encode(), b'password')]:
+        if text:
+            sock.sendall(text)
+        while token not in data:
+            data += sock.recv(1 << 16)
+        data = b''
+
+    start = time.perf_counter()
+    sock.sendall(PASSWORD.encode())
+    first = None
+    received = 0
+    carry = b''
+    tail = b''
+    while True:
+        chunk = sock.recv(1 << 16)
+        if not chunk:
+            raise ConnectionError('server closed the connection')
+        # Prepend the previous read's last 6 bytes (too short to hold a whole marker, so none is
+        # counted twice) so a marker split across two reads is still counted
+        data = carry + chunk
+        received += data.count(b'<bench>')
+        carry = data[-6:]
+        if first is None and received:
+            first = time.perf_counter() - start
+        tail = (tail + chunk)[-64:]
+        if received >= num_messages and MENU.encode() in tail:
+            sock.close()
+            return first, time.perf_counter() - start
+
+def login_part2(stub):
+    response = stub.LoginAccount(chat_pb2.AccountInfo(username=USERNAME, password=PASSWORD))
+    if not response.status:
+        raise RuntimeError(response.msg)
+    return response.msg
+
+# Log in on the part 2 server via method; returns (seconds to first message, seconds to the whole backlog)
+def login_grpc(port, method, num_messages):
+    channel = grpc.insecure_channel('{}:{}'.format(HOST, port))
+    stub = chat_pb2_grpc.ChatAppStub(channel)
+    account = chat_pb2.AccountInfo(username=USERNAME, password=PASSWORD)
+    start = time.perf_counter()
+    try:
+        if method == 'login':
+            received = login_part2(stub).count('<bench>')
+            elapsed = time.perf_counter() - start
+            return (elapsed if received else None), elapsed
+
+        # Servers from before FetchMailbox hand the backlog out with the login response
+        received = login_part2(stub).count('<bench>')
+        first = (time.perf_counter() - start) if received else None
+        if method == 'fetch':
+            for chunk in stub.FetchMailbox(account):
+                received += len(chunk.msgs)
+                if first is None:
+                    first = time.perf_counter() - start
+        elif received < num_messages:
+            stream = stub.MessageStream(account, timeout=STREAM_TIMEOUT)
+            for msg in stream:
+                if msg.msg.startswith('<bench>'):
+                    received += 1
+                    if first is None:
+                        first = time.perf_counter() - start
+                    if received == num_messages:
+                        stream.cancel()
+                        break
+        if received != num_messages:
+            raise RuntimeError('received {} of {} messages'.format(received, num_messages))
+        return first, time.perf_counter() - start
+    finally:
+        channel.close()
+
+def run(args, path, num_messages, port):
+    part, method = path.split()
+    with tempfile.TemporaryDirectory() as directory:
+        write_backlog(directory, num_messages, args.message_size)
+        if part == 'part1':
+            process = start(args.root, 'part_1', method, directory, port)
+        else:
+            process = start(args.root, 'part_2', args.mode, directory, port)
+        try:
+            rss = proc_status(process.pid, 'VmRSS')
+            reset_peak(process.pid)
+            if part == 'part1':
+                first, total = login_part1(port, num_messages)
+            else:
+                first, total = login_grpc(port, method, num_messages)
+            return first, total, (proc_status(process.pid, 'VmHWM') - rss) / 1024
+        finally:
+            process.kill()
+            process.wait()
+
+def main():
+    parser = ArgumentParser(description='Mailbox backlog replay on login.')
+    parser.add_argument('--backlogs', type=int, nargs='+', default=[1000, 10000, 50000, 200000])
+    parser.add_argument('--message-size', type=int, default=64, help='characters per queued message')
+    parser.add_argument('--paths', nargs='+', default=PATHS, help='from: {}'.format(', '.join(PATHS)))
+    parser.add_argument('--mode', choices=['threaded', 'aio'], default='threaded', help='part 2 server mode')
+    parser.add_argument('--root', default=ROOT, help='checkout whose servers are benchmarked')
+    parser.add_argument('--port', type=int, default=12430)
+    args = parser.parse_args()
+
+    print('{:>8} {:<16} {:>9} {:>9} {:>13}'.format('backlog', 'path', 'first_ms', 'total_ms', 'peak_rss_mb'))
+    for num_messages in args.backlogs:
+        for path in args.paths:
+            try:
+                first, total, peak = run(args, path, num_messages, args.port)
+            except (grpc.RpcError, RuntimeError, ConnectionError) as error:
+                reason = error.code().name if isinstance(error, grpc.RpcError) else str(error)
+                print('{:>8} {:<16} error: {}'.format(num_messages, path, reason))
+                continue
+            print('{:>8} {:<16} {:>9} {:>9.1f} {:>13.1f}'.format(
+                num_messages, path, '-' if first is None else '{:.1f}'.format(first * 1000), total * 1000, peak))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+'''
+This file benchmarks the memory of a large offline backlog with and without mailbox spill
+(common/mailbox.py).
+
+For each configuration a fresh interpreter creates --accounts accounts in a UserStore and queues
+--messages messages of --length characters between them, none of them delivered (every user is
+offline). It reports the time taken, the RSS once the backlog is queued and its peak, how many
+messages spilled to disk, and how long one user's login replay (read_mailbox over its whole
+mailbox) takes. The configurations are:
+    1. memory: no spill, every message is a bytes object in a list
+    2. spill:  Spill with the --mailbox-cap / --mailbox-budget limits
+
+Usage: python3 bench/mailbox_spill.py [--accounts 1000] [--messages 10000000] [--length 50]
+                                      [--mailbox-cap BYTES] [--mailbox-budget BYTES]
+'''
+# Import relevant python packages
+from argparse import ArgumentParser
+import json
+import os
+import subprocess
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+from common.mailbox import MEMORY_BUDGET, USER_CAP
+
+# Constants/configurations
+BATCH = 10000 # messages per append_many call
+
+# The backlog is built in a child process so each configuration starts from a cold interpreter
+BACKLOG_SCRIPT = '''
+import json, resource, sys, time
+sys.path.insert(0, {root!r})
+from common.mailbox import Spill
+from common.user_store import UserStore
+
+def rss_mb():
+    with open('/proc/self/status') as status:
+        return next(int(line.split()[1]) for line in status if line.startswith('VmRSS:')) / 1024
+
+users = UserStore(spill=Spill(user_cap={cap}, budget={budget}) if {spill} else None)
+names = ['user{{}}'.format(index) for index in range({accounts})]
+for name in names:
+    users.create(name, 'password')
+base = rss_mb()
+text = b'x' * {length}
+start = time.perf_counter()
+for first in range(0, {messages}, {batch}):
+    users.append_many([(names[index % {accounts}], b'<bench> ' + text) for index in range(first, min(first + {batch}, {messages}))])
+elapsed = time.perf_counter() - start
+rss = rss_mb()
+start = time.perf_counter()
+seq = 0
+while True:
+    _, messages = users.read(names[0], seq)
+    if not messages:
+        break
+    seq += len(messages)
+replay = time.perf_counter() - start
+print(json.dumps({{'seconds': elapsed, 'backlog_mb': rss - base, 'rss_mb': rss,
+                  'peak_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+                  'spilled': users.spilled()[0], 'replayed': seq, 'replay_ms': replay * 1000}}))
+'''
+
+def measure(args, spill):
+    script = BACKLOG_SCRIPT.format(root=ROOT, cap=args.mailbox_cap, budget=args.mailbox_budget, spill=spill,
+                                   accounts=args.accounts, messages=args.messages, length=args.length, batch=BATCH)
+    output = subprocess.run([sys.executable, '-c', script], check=True, capture_output=True, text=True).stdout
+    return json.loads(output)
+
+def main():
+    parser = ArgumentParser(description='RSS of a large offline backlog with and without mailbox spill.')
+    parser.add_argument('--accounts', type=int, default=1000, help='offline accounts the messages are queued for')
+    parser.add_argument('--messages', type=int, default=10000000, help='messages queued in total')
+    parser.add_argument('--length', type=int, default=50, help='characters per message body')
+    parser.add_argument('--mailbox-cap', type=int, default=USER_CAP)
+    parser.add_argument('--mailbox-budget', type=int, default=MEMORY_BUDGET)
+    args = parser.parse_args()
+
+    print('{} messages for {} accounts, cap {} KiB per user, budget {} MiB'.format(
+        args.messages, args.accounts, args.mailbox_cap // 1024, args.mailbox_budget // (1024 * 1024)))
+    print('{:<7} {:>9} {:>11} {:>8} {:>8} {:>10} {:>10}'.format(
+        'store', 'queue_s', 'backlog_mb', 'rss_mb', 'peak_mb', 'spilled', 'replay_ms'))
+    for name, spill in [('memory', False), ('spill', True)]:
+        result = measure(args, spill)
+        print('{:<7} {seconds:>9.1f} {backlog_mb:>11.0f} {rss_mb:>8.0f} {peak_mb:>8.0f} {spilled:>10} {replay_ms:>10.1f}'.format(
+            name, **result))
+
+if __name__ == '__main__':
+    main()
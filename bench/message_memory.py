@@ -0,0 +1,106 @@
+'''
+This file benchmarks the memory and allocations of queued messages along the part 2
+SendMessage -> mailbox -> MessageStream path, for this checkout and (with --root) another one.
+
+In a fresh interpreter per checkout, --accounts accounts are created in a UserStore, then
+--messages Msg requests are formatted with the checkout's own format_message (what SendMessage
+queues) and appended to the recipients' mailboxes. tracemalloc reports the memory each account
+and each queued message keeps, and the number of memory blocks per queued message. Then every
+mailbox is read back in chunks and each message is turned into a chat_pb2.Msg and serialized,
+as MessageStream does; reported are the messages streamed per second (timed without
+tracemalloc) and the peak memory allocated meanwhile.
+
+Usage: python3 bench/message_memory.py [--accounts 10000] [--messages 1000000] [--length 50] [--root OTHER_CHECKOUT]
+'''
+# Import relevant python packages
+from argparse import ArgumentParser
+import json
+import os
+import subprocess
+import sys
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+# Measured in a child process with the checkout's common/ and part_2/ on the path
+MEASURE_SCRIPT = '''
+import json, os, sys, time, tracemalloc
+sys.path[:0] = [{root!r}, os.path.join({root!r}, 'part_2')]
+from protos import chat_pb2
+from batch import format_message
+from common.user_store import UserStore
+
+def blocks():
+    return sum(stat.count for stat in tracemalloc.take_snapshot().statistics('filename'))
+
+def fill(users, names, text):
+    for name in names:
+        users.create(name, 'password')
+    created = tracemalloc.get_traced_memory()[0] if tracemalloc.is_tracing() else 0
+    for index in range({messages}):
+        request = chat_pb2.Msg(src_username=names[(index + 1) % len(names)], dst_username=names[index % len(names)], msg=text)
+        users.append(request.dst_username, format_message(request))
+    return created
+
+def stream(users, names):
+    count = 0
+    for name in names:
+        after = 0
+        while True:
+            first_seq, mailbox = users.read(name, after)
+            if not mailbox:
+                break
+            for offset, message in enumerate(mailbox):
+                chat_pb2.Msg(src_username='', dst_username=name, msg=message, seq=first_seq + offset).SerializeToString()
+            after = first_seq + len(mailbox) - 1
+            count += len(mailbox)
+    return count
+
+names = ['user{{}}'.format(index) for index in range({accounts})]
+text = 'x' * {length}
+
+tracemalloc.start()
+base = tracemalloc.get_traced_memory()[0]
+base_blocks = blocks()
+users = UserStore()
+created = fill(users, names, text)
+queued = tracemalloc.get_traced_memory()[0]
+queued_blocks = blocks()
+tracemalloc.reset_peak()
+stream(users, names)
+stream_peak = tracemalloc.get_traced_memory()[1] - tracemalloc.get_traced_memory()[0]
+tracemalloc.stop()
+del users
+
+users = UserStore()
+fill(users, names, text)
+start = time.perf_counter()
+count = stream(users, names)
+elapsed = time.perf_counter() - start
+print(json.dumps({{'account_bytes': (created - base) / {accounts}, 'message_bytes': (queued - created) / {messages},
+                  'message_blocks': (queued_blocks - base_blocks - {accounts}) / {messages},
+                  'stream_per_s': count / elapsed, 'stream_peak_kb': stream_peak / 1024}}))
+'''
+
+def measure(root, args):
+    script = MEASURE_SCRIPT.format(root=root, accounts=args.accounts, messages=args.messages, length=args.length)
+    output = subprocess.run([sys.executable, '-c', script], check=True, capture_output=True, text=True).stdout
+    return json.loads(output)
+
+def main():
+    parser = ArgumentParser(description='Memory and allocations per queued message, and MessageStream encoding throughput.')
+    parser.add_argument('--accounts', type=int, default=10000, help='accounts messages are queued for')
+    parser.add_argument('--messages', type=int, default=1000000, help='messages queued')
+    parser.add_argument('--length', type=int, default=50, help='characters per message body')
+    parser.add_argument('--root', help='another checkout (e.g. an older commit) to measure next to this one')
+    args = parser.parse_args()
+
+    roots = [('this', ROOT)] + ([('other', os.path.abspath(args.root))] if args.root else [])
+    print('{:<6} {:>14} {:>14} {:>15} {:>13} {:>15}'.format(
+        'tree', 'account_bytes', 'message_bytes', 'message_blocks', 'stream_per_s', 'stream_peak_kb'))
+    for name, root in roots:
+        result = measure(root, args)
+        print('{:<6} {account_bytes:>14.0f} {message_bytes:>14.1f} {message_blocks:>15.2f} {stream_per_s:>13.0f} {stream_peak_kb:>15.0f}'.format(
+            name, **result))
+
+if __name__ == '__main__':
+    main()
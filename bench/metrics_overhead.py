@@ -0,0 +1,147 @@
+'''
+This file measures what the built-in metrics cost, to check they can stay on.
+
+Three measurements:
+    - record: time per call of Series.start/finish and of a Timer context manager (what every
+      RPC and every part 1 input pays), single-threaded and from --threads threads at once
+    - rpc: SendMessage calls per second and p50/p99 latency against an in-process part 2 server,
+      with and without the MetricsInterceptor (same service, --clients client threads)
+    - export: time to render the Prometheus text and the JSON snapshot once the RPC run filled
+      the registry (what one scrape or dump costs the server)
+
+Usage: python3 bench/metrics_overhead.py [--calls 200000] [--threads 4] [--clients 4] [--duration 5]
+'''
+# Import relevant python packages
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+import sys
+from threading import Thread
+import time
+
+import grpc
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(ROOT, 'part_2'))
+sys.path.insert(0, ROOT)
+from common.metrics import Metrics, Series, Timer, store_gauges
+from common.wal import NullLog
+from interceptor import MetricsInterceptor
+from protos import chat_pb2, chat_pb2_grpc
+from server import ChatAppService
+
+# Constants/configurations
+HOST     = '127.0.0.1'
+PASSWORD = 'password'
+
+# Nanoseconds per call of record() over calls calls on each of threads threads
+def time_records(record, calls, threads):
+    def loop():
+        for _ in range(calls):
+            record()
+    workers = [Thread(target=loop) for _ in range(threads)]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return (time.perf_counter() - start) / (calls * threads) * 1e9
+
+def bench_record(args):
+    series = Series()
+    def start_finish():
+        series.finish(series.start())
+    def timer():
+        with Timer(series):
+            pass
+    def baseline():
+        pass
+    print('{:<14} {:>8} {:>12}'.format('record', 'threads', 'ns_per_call'))
+    for threads in [1, args.threads]:
+        empty = time_records(baseline, args.calls, threads)
+        for name, record in [('start/finish', start_finish), ('Timer', timer)]:
+            print('{:<14} {:>8} {:>12.0f}'.format(name, threads, time_records(record, args.calls, threads) - empty))
+
+def percentile(samples, p):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p))]
+
+# Run SendMessage from args.clients threads for args.duration seconds; returns (calls/s, p50 ms, p99 ms)
+def run_sends(args, port, metrics):
+    service = ChatAppService(60, NullLog(), 1 << 16)
+    interceptors = [MetricsInterceptor(metrics)] if metrics else []
+    server = grpc.server(ThreadPoolExecutor(max_workers=args.clients * 2), interceptors=interceptors)
+    chat_pb2_grpc.add_ChatAppServicer_to_server(service, server)
+    server.add_insecure_port('{}:{}'.format(HOST, port))
+    server.start()
+    try:
+        channel = grpc.insecure_channel('{}:{}'.format(HOST, port))
+        stub = chat_pb2_grpc.ChatAppStub(channel)
+        for username in ['sender', 'receiver']:
+            stub.CreateAccount(chat_pb2.AccountInfo(username=username, password=PASSWORD))
+        request = chat_pb2.Msg(src_username='sender', dst_username='receiver', msg='x' * 64)
+        latencies = [[] for _ in range(args.clients)]
+        stop_at = time.perf_counter() + args.duration
+
+        def send(samples):
+            while time.perf_counter() < stop_at:
+                started = time.perf_counter()
+                stub.SendMessage(request)
+                samples.append((time.perf_counter() - started) * 1000)
+
+        # Warm up the channel and the handlers before timing
+        for _ in range(200):
+            stub.SendMessage(request)
+        start = time.perf_counter()
+        threads = [Thread(target=send, args=(samples,)) for samples in latencies]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+        channel.close()
+        samples = [latency for client in latencies for latency in client]
+        if metrics:
+            store_gauges(metrics, service.users)
+        return len(samples) / elapsed, percentile(samples, 0.50), percentile(samples, 0.99)
+    finally:
+        server.stop(None)
+
+def bench_rpc(args, metrics):
+    print('{:<14} {:>10} {:>8} {:>8}'.format('interceptor', 'calls_per_s', 'p50_ms', 'p99_ms'))
+    results = {}
+    # Alternate the two configurations so drift in the machine hits both
+    for index in range(args.rounds):
+        for name, registry in [('off', None), ('on', metrics)]:
+            results.setdefault(name, []).append(run_sends(args, args.port + index * 2 + (name == 'on'), registry))
+    for name, runs in results.items():
+        best = max(runs)
+        print('{:<14} {:>10.0f} {:>8.3f} {:>8.3f}'.format(name, *best))
+
+def bench_export(metrics):
+    for name, export in [('render', metrics.render), ('snapshot', lambda: json.dumps(metrics.snapshot()))]:
+        start = time.perf_counter()
+        for _ in range(100):
+            size = len(export())
+        print('{:<14} {:>8.3f} ms per export, {} bytes'.format(name, (time.perf_counter() - start) * 10, size))
+
+def main():
+    parser = ArgumentParser(description='Cost of the built-in metrics.')
+    parser.add_argument('--calls', type=int, default=200000, help='recorded calls per thread')
+    parser.add_argument('--threads', type=int, default=4, help='threads recording at once')
+    parser.add_argument('--clients', type=int, default=4, help='client threads calling SendMessage')
+    parser.add_argument('--duration', type=float, default=5.0, help='seconds per RPC run')
+    parser.add_argument('--rounds', type=int, default=3, help='RPC runs per configuration (best one is shown)')
+    parser.add_argument('--port', type=int, default=12460)
+    args = parser.parse_args()
+
+    metrics = Metrics()
+    bench_record(args)
+    print()
+    bench_rpc(args, metrics)
+    print()
+    bench_export(metrics)
+
+if __name__ == '__main__':
+    main()
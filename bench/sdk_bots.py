@@ -0,0 +1,197 @@
+'''
+This file benchmarks driving many bot users from one process with the client libraries
+(part_1/sdk.py, part_2/sdk.py).
+
+For each --servers entry a server is launched on localhost and, in a fresh driver process per
+--bots count, that many bots connect and create an account; then every bot sends --messages
+messages to random bots, keeping --depth sends outstanding at a time (depth 1 is what the
+interactive clients do: one request in flight). With --api async each bot is an AsyncClient
+coroutine; with --api sync all bots are blocking Clients driven by the driver's main thread
+through send(wait=False) futures (part 1 bots share one Reactor thread, part 2 bots one
+ChannelPool). --commands has the part 1 bots use command mode instead of the prompt flow.
+Reported are bot setup per second, messages per second, p50/p99 send latency, and the driver's
+peak RSS, threads and sockets.
+
+Usage: python3 bench/sdk_bots.py [--servers part1 part2 part2-aio] [--bots 100 1000] [--messages 20] [--depth 1 16] [--api async] [--commands]
+'''
+# Import relevant python packages
+from argparse import ArgumentParser, SUPPRESS
+import asyncio
+import json
+import os
+import random
+import resource
+from socket import create_connection
+import subprocess
+import sys
+import threading
+import time
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+# Constants/configurations
+HOST     = '127.0.0.1'
+PORT     = 6262
+PASSWORD = 'password'
+SERVERS  = {
+    'part1':     ('part_1', ['--mode', 'selectors']),
+    'part2':     ('part_2', ['--mode', 'threaded']),
+    'part2-aio': ('part_2', ['--mode', 'aio']),
+}
+CHANNELS = 4 # channels of the part 2 pool shared by every bot
+
+def username(index):
+    return 'bot{}'.format(index)
+
+# Launch a server and wait until it accepts connections
+def start_server(server, port):
+    directory, mode = SERVERS[server]
+    process = subprocess.Popen([sys.executable, os.path.join(ROOT, directory, 'server.py'), '--host', HOST,
+                                '--port', str(port)] + mode, cwd=os.path.join(ROOT, directory),
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            create_connection((HOST, port)).close()
+            time.sleep(0.5) # let the gRPC server finish starting
+            return process
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError('{} server did not start'.format(server))
+
+def percentile(samples, p):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * p))] * 1000 if samples else 0.0
+
+# Threads and sockets of the driver process
+def resources():
+    sockets = 0
+    for fd in os.listdir('/proc/self/fd'):
+        try:
+            sockets += os.readlink('/proc/self/fd/' + fd).startswith('socket:')
+        except OSError:
+            pass # the descriptor listdir itself used
+    return threading.active_count(), sockets
+
+# Driver, async API: one coroutine per bot with depth sends outstanding
+async def drive_async(sdk, part, bots, messages, depth, port, commands):
+    start = time.perf_counter()
+    if part == 'part_1':
+        clients = await asyncio.gather(*(sdk.AsyncClient.connect(HOST, port, commands=commands) for _ in range(bots)))
+    else:
+        pool = sdk.AsyncChannelPool('{}:{}'.format(HOST, port), size=CHANNELS)
+        clients = [sdk.AsyncClient(pool=pool) for _ in range(bots)]
+    await asyncio.gather(*(client.create(username(index), PASSWORD) for index, client in enumerate(clients)))
+    setup = time.perf_counter() - start
+
+    latencies = []
+    async def send(client, rng):
+        begin = time.perf_counter()
+        await client.send(username(rng.randrange(bots)), 'x' * 50)
+        latencies.append(time.perf_counter() - begin)
+    async def bot(client, seed):
+        rng = random.Random(seed)
+        for sent in range(0, messages, depth):
+            await asyncio.gather(*(send(client, rng) for _ in range(min(depth, messages - sent))))
+    start = time.perf_counter()
+    await asyncio.gather(*(bot(client, index) for index, client in enumerate(clients)))
+    elapsed = time.perf_counter() - start
+    threads, sockets = resources()
+
+    if part == 'part_1':
+        await asyncio.gather(*(client.close() for client in clients))
+    else:
+        await pool.close()
+    return setup, elapsed, latencies, threads, sockets
+
+# Driver, sync API: the main thread keeps depth sends per bot outstanding as futures
+def drive_sync(sdk, part, bots, messages, depth, port, commands):
+    start = time.perf_counter()
+    if part == 'part_1':
+        clients = [sdk.Client(HOST, port, commands=commands) for _ in range(bots)]
+        creates = [client.request(sdk.create_steps, username(index), PASSWORD) for index, client in enumerate(clients)]
+        for future in creates:
+            future.result()
+    else:
+        pool = sdk.ChannelPool('{}:{}'.format(HOST, port), size=CHANNELS)
+        clients = [sdk.Client(pool=pool) for _ in range(bots)]
+        for index, client in enumerate(clients):
+            client.create(username(index), PASSWORD)
+    setup = time.perf_counter() - start
+
+    latencies = []
+    rng = random.Random(0)
+    def sent(begin):
+        return lambda future: latencies.append(time.perf_counter() - begin)
+    start = time.perf_counter()
+    for done in range(0, messages, depth):
+        futures = []
+        for client in clients:
+            for _ in range(min(depth, messages - done)):
+                future = client.send(username(rng.randrange(bots)), 'x' * 50, wait=False)
+                future.add_done_callback(sent(time.perf_counter()))
+                futures.append(future)
+        for future in futures:
+            future.result()
+    elapsed = time.perf_counter() - start
+    threads, sockets = resources()
+
+    if part == 'part_1':
+        for client in clients:
+            client.close()
+    else:
+        pool.close()
+    return setup, elapsed, latencies, threads, sockets
+
+# Body of the driver process: prints one JSON result
+def driver(args):
+    part = SERVERS[args.driver][0]
+    sys.path.insert(0, os.path.join(ROOT, part))
+    import sdk
+    bots, depth = args.bots[0], args.depth[0]
+    if args.api == 'async':
+        result = asyncio.run(drive_async(sdk, part, bots, args.messages, depth, args.port, args.commands))
+    else:
+        result = drive_sync(sdk, part, bots, args.messages, depth, args.port, args.commands)
+    setup, elapsed, latencies, threads, sockets = result
+    print(json.dumps({'setup_per_s': bots / setup, 'msgs_per_s': len(latencies) / elapsed,
+                      'p50_ms': percentile(latencies, 0.5), 'p99_ms': percentile(latencies, 0.99),
+                      'rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+                      'threads': threads, 'sockets': sockets}))
+
+def main():
+    parser = ArgumentParser(description='Bots driven from one process through the client libraries.')
+    parser.add_argument('--servers', nargs='+', choices=sorted(SERVERS), default=['part1', 'part2', 'part2-aio'])
+    parser.add_argument('--bots', type=int, nargs='+', default=[100, 1000], help='bot users per run')
+    parser.add_argument('--messages', type=int, default=20, help='messages each bot sends')
+    parser.add_argument('--depth', type=int, nargs='+', default=[1, 16], help='sends each bot keeps outstanding')
+    parser.add_argument('--api', choices=['async', 'sync'], default='async', help='client library API the bots use')
+    parser.add_argument('--commands', action='store_true', help='part 1 bots use command mode')
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--driver', choices=sorted(SERVERS), help=SUPPRESS) # run one driver process
+    args = parser.parse_args()
+    if args.driver:
+        driver(args)
+        return
+
+    print('{:<10} {:>6} {:>6} {:>12} {:>11} {:>8} {:>8} {:>8} {:>8} {:>8}'.format(
+        'server', 'bots', 'depth', 'setup_per_s', 'msgs_per_s', 'p50_ms', 'p99_ms', 'rss_mb', 'threads', 'sockets'))
+    for server in args.servers:
+        for bots in args.bots:
+            for depth in args.depth:
+                # A fresh server per run, so every run creates the same accounts
+                process = start_server(server, args.port)
+                try:
+                    command = [sys.executable, os.path.abspath(__file__), '--driver', server, '--bots', str(bots),
+                               '--messages', str(args.messages), '--depth', str(depth), '--api', args.api,
+                               '--port', str(args.port)] + (['--commands'] if args.commands else [])
+                    result = json.loads(subprocess.run(command, check=True, capture_output=True, text=True).stdout)
+                finally:
+                    process.kill()
+                    process.wait()
+                print('{:<10} {:>6} {:>6} {setup_per_s:>12.0f} {msgs_per_s:>11.0f} {p50_ms:>8.2f} {p99_ms:>8.2f} '
+                      '{rss_mb:>8.0f} {threads:>8} {sockets:>8}'.format(server, bots, depth, **result))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,142 @@
+'''
+This file benchmarks the part 1 server modes (thread-per-client vs selectors event loop).
+
+For each mode, a server is launched on localhost, N clients create accounts and then sit
+idle at the menu, and two active clients measure message round-trip latency while the idle
+connections are held open. Server thread count and RSS are read from /proc.
+
+Usage: python3 bench/server_modes.py [--clients N] [--rounds R] [--modes threaded selectors]
+'''
+# Import relevant python packages
+from argparse import ArgumentParser
+import os
+import resource
+from socket import socket, AF_INET, SOCK_STREAM, IPPROTO_TCP, TCP_NODELAY, create_connection
+import subprocess
+import sys
+import time
+
+# Constants/configurations
+ENCODING    = 'utf-8' # message encoding
+BUFFER_SIZE = 2048 # fixed 2KB buffer size
+HOST        = '127.0.0.1'
+SERVER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'part_1', 'server.py')
+
+# Read from sock until token shows up in the received text
+def expect(sock, token):
+    received = ''
+    while token not in received:
+        data = sock.recv(BUFFER_SIZE)
+        if not data:
+            raise ConnectionError('server closed connection while waiting for {!r}'.format(token))
+        received += data.decode(encoding=ENCODING)
+    return received
+
+# Connect and walk through the account creation prompts; leaves the client at the menu
+def create_account(port, username):
+    sock = create_connection((HOST, port))
+    sock.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
+    expect(sock, '2. Login')
+    sock.send(b'1')
+    expect(sock, 'username: ')
+    sock.send(username.encode(encoding=ENCODING))
+    expect(sock, 'password.')
+    sock.send(b'password')
+    expect(sock, '5. Groups.')
+    return sock
+
+# Send one message from sender to receiver and wait for both sides to see it
+def round_trip(sender, receiver, dst_username, text):
+    sender.send(b'1')
+    expect(sender, 'recipient:')
+    sender.send(dst_username.encode(encoding=ENCODING))
+    expect(sender, 'message: ')
+    sender.send(text.encode(encoding=ENCODING))
+    expect(sender, '5. Groups.')
+    expect(receiver, text)
+
+# Launch a server in the given mode and wait until it accepts connections
+def start_server(mode, port):
+    process = subprocess.Popen([sys.executable, SERVER_PATH, '--mode', mode, '--host', HOST, '--port', str(port)],
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        try:
+            probe = socket(AF_INET, SOCK_STREAM)
+            probe.connect((HOST, port))
+            # Drain the welcome prompt and leave politely so the threaded accept loop moves on
+            expect(probe, '2. Login')
+            probe.close()
+            return process
+        except OSError:
+            time.sleep(0.05)
+    process.kill()
+    raise RuntimeError('server in {} mode did not start'.format(mode))
+
+# Read a field (e.g. Threads, VmRSS) from /proc/PID/status
+def proc_status(pid, field):
+    with open('/proc/{}/status'.format(pid)) as status:
+        for line in status:
+            if line.startswith(field + ':'):
+                return int(line.split()[1])
+    return None
+
+def percentile(samples, p):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p))]
+
+def run_mode(mode, port, num_clients, rounds):
+    process = start_server(mode, port)
+    idle = []
+    try:
+        # Establish idle, logged-in connections
+        start = time.perf_counter()
+        for index in range(num_clients):
+            idle.append(create_account(port, 'idle{}'.format(index)))
+        connect_seconds = time.perf_counter() - start
+
+        # Measure round-trip latency of an active pair while idle clients are held open
+        sender = create_account(port, 'sender')
+        receiver = create_account(port, 'receiver')
+        samples = []
+        for index in range(rounds):
+            start = time.perf_counter()
+            round_trip(sender, receiver, 'receiver', 'ping{}'.format(index))
+            samples.append((time.perf_counter() - start) * 1000)
+
+        return {
+            'mode':            mode,
+            'clients':         num_clients,
+            'connect_s':       connect_seconds,
+            'server_threads':  proc_status(process.pid, 'Threads'),
+            'server_rss_mb':   proc_status(process.pid, 'VmRSS') / 1024,
+            'p50_ms':          percentile(samples, 0.50),
+            'p99_ms':          percentile(samples, 0.99),
+        }
+    finally:
+        for sock in idle:
+            sock.close()
+        process.kill()
+        process.wait()
+
+def main():
+    parser = ArgumentParser(description='Compare part 1 thread-per-client and selectors server modes.')
+    parser.add_argument('--clients', type=int, default=1000, help='idle logged-in connections to hold open')
+    parser.add_argument('--rounds', type=int, default=200, help='round trips measured per mode')
+    parser.add_argument('--modes', nargs='+', default=['threaded', 'selectors'])
+    parser.add_argument('--port', type=int, default=12340)
+    args = parser.parse_args()
+
+    # Both this process and the server hold one descriptor per client
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    print('{:<10} {:>8} {:>10} {:>8} {:>9} {:>8} {:>8}'.format(
+        'mode', 'clients', 'connect_s', 'threads', 'rss_mb', 'p50_ms', 'p99_ms'))
+    for offset, mode in enumerate(args.modes):
+        result = run_mode(mode, args.port + offset, args.clients, args.rounds)
+        print('{mode:<10} {clients:>8} {connect_s:>10.2f} {server_threads:>8} {server_rss_mb:>9.1f} '
+              '{p50_ms:>8.3f} {p99_ms:>8.3f}'.format(**result))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,191 @@
+'''
+This file benchmarks how stalled receivers affect other users of the threaded part 1 server.
+
+--senders clients each send --message-size messages, back to back for --duration seconds, to
+their own fast receiver, which reads everything. With --stalled N, N more receivers log in and
+then never read (with a small receive buffer), and every --stall-every-th message of each sender
+goes to one of them instead. The senders' throughput (all sends), their latency sending to the
+fast receivers and the fast receivers' delivery rate are reported for each N, along with the server's outbound
+queue stats (--outbound-policy etc. are passed through). A sender whose send does not finish
+within --block-timeout counts as blocked and stops. --root runs the server of another checkout
+(e.g. a git worktree of an older commit, before outbound queues) for a before/after comparison.
+
+Usage: python3 bench/slow_consumers.py [--senders 4] [--stalled 0 4] [--duration 10] [--outbound-policy spill]
+'''
+# Import relevant python packages
+from argparse import ArgumentParser
+import os
+from socket import create_connection, socket, timeout, AF_INET, SOCK_STREAM, IPPROTO_TCP, SOL_SOCKET, SO_RCVBUF, TCP_NODELAY
+import subprocess
+import sys
+import tempfile
+from threading import Thread
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(ROOT, 'part_1'))
+from outbound import OUTBOUND_QUEUE, POLICIES, POLICY, SEND_TIMEOUT
+from protocol import connect_hello
+
+# Constants/configurations
+ENCODING = 'utf-8' # message encoding
+HOST     = '127.0.0.1'
+PASSWORD = 'password'
+MENU     = '5. Groups.' # end of the part 1 menu prompt
+MARKER   = b'<bench>'
+
+# Read from sock until one of tokens shows up in the received text
+def expect_any(sock, tokens):
+    received = ''
+    while not any(token in received for token in tokens):
+        data = sock.recv()
+        if not data:
+            raise ConnectionError('server closed connection while waiting for {!r}'.format(tokens))
+        received += data.decode(encoding=ENCODING)
+    return received
+
+# Create username on a new framed connection and return it at the menu; rcvbuf shrinks its receive buffer
+def create(port, username, rcvbuf=None):
+    sock = socket(AF_INET, SOCK_STREAM)
+    if rcvbuf:
+        sock.setsockopt(SOL_SOCKET, SO_RCVBUF, rcvbuf)
+    sock.connect((HOST, port))
+    sock.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
+    sock = connect_hello(sock)
+    for text, token in [(None, '2. Login'), ('1', 'username: '), (username, 'password.'), (PASSWORD, MENU)]:
+        if text:
+            sock.send(text.encode(encoding=ENCODING))
+        expect_any(sock, [token])
+    return sock
+
+def start_server(args, port, output):
+    command = [sys.executable, os.path.join(args.root, 'part_1', 'server.py'), '--mode', 'threaded',
+               '--host', HOST, '--port', str(port), '--stats-interval', '1']
+    # Checkouts from before outbound queues do not know these options
+    if os.path.exists(os.path.join(args.root, 'part_1', 'outbound.py')):
+        command += ['--outbound-queue', str(args.outbound_queue), '--outbound-policy', args.outbound_policy,
+                    '--send-timeout', str(args.send_timeout)]
+    process = subprocess.Popen(command, cwd=os.path.join(args.root, 'part_1'), stdout=output,
+                               stderr=subprocess.DEVNULL, env=dict(os.environ, PYTHONUNBUFFERED='1'))
+    deadline = time.time() + 30
+    while True:
+        try:
+            create_connection((HOST, port)).close()
+            return process
+        except OSError:
+            if process.poll() is not None or time.time() > deadline:
+                process.kill()
+                raise RuntimeError('server did not start')
+            time.sleep(0.1)
+
+def percentile(samples, p):
+    if not samples:
+        return float('nan')
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p))]
+
+# Count the messages a fast receiver gets until its connection closes
+def read_messages(sock, counts, index):
+    while True:
+        try:
+            data = sock.recv()
+        except OSError:
+            return
+        if not data:
+            return
+        counts[index] += data.count(MARKER)
+
+# Send messages until stop_at, every stall_every-th one to a stalled receiver; records the sends
+# completed, latencies of sends to the fast receiver, and whether the sender got stuck
+def send_messages(sock, fast, stalled, message, stall_every, stop_at, block_timeout, result):
+    sock.settimeout(block_timeout)
+    sent = 0
+    try:
+        while time.perf_counter() < stop_at:
+            sent += 1
+            target = stalled[sent % len(stalled)] if stalled and sent % stall_every == 0 else fast
+            start = time.perf_counter()
+            sock.send(b'1')
+            expect_any(sock, ['recipient:'])
+            sock.send(target.encode(encoding=ENCODING))
+            expect_any(sock, ['message: '])
+            sock.send(message.encode(encoding=ENCODING))
+            expect_any(sock, [MENU])
+            result['sent'] += 1
+            if target == fast:
+                result['latencies'].append((time.perf_counter() - start) * 1000)
+    except (timeout, OSError):
+        result['blocked'] = True
+
+def run(args, num_stalled, port):
+    with tempfile.TemporaryFile() as output:
+        process = start_server(args, port, output)
+        try:
+            message = '<bench> ' + 'x' * max(0, args.message_size - 8)
+            fast = ['fast{}'.format(index) for index in range(args.senders)]
+            stalled = ['stalled{}'.format(index) for index in range(num_stalled)]
+            receivers = [create(port, username) for username in fast]
+            idle = [create(port, username, rcvbuf=4096) for username in stalled]
+            senders = [create(port, 'sender{}'.format(index)) for index in range(args.senders)]
+
+            counts = [0] * args.senders
+            readers = [Thread(target=read_messages, args=(sock, counts, index), daemon=True)
+                       for index, sock in enumerate(receivers)]
+            for reader in readers:
+                reader.start()
+            results = [{'sent': 0, 'latencies': [], 'blocked': False} for _ in senders]
+            start = time.perf_counter()
+            stop_at = start + args.duration
+            threads = [Thread(target=send_messages, args=(sock, fast[index], stalled, message, args.stall_every,
+                                                          stop_at, args.block_timeout, results[index]))
+                       for index, sock in enumerate(senders)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            elapsed = time.perf_counter() - start
+            time.sleep(1.5) # let in-flight messages and one more stats line arrive
+            delivered = sum(counts)
+            for sock in receivers + idle + senders:
+                sock.close()
+        finally:
+            process.kill()
+            process.wait()
+
+        output.seek(0)
+        lines = [line for line in output.read().decode(encoding=ENCODING, errors='replace').splitlines()
+                 if line.startswith('outbound:')]
+        latencies = [latency for result in results for latency in result['latencies']]
+        blocked = sum(result['blocked'] for result in results)
+        sent = sum(result['sent'] for result in results)
+        return sent / elapsed, latencies, delivered / elapsed, blocked, lines[-1] if lines else '-'
+
+def main():
+    parser = ArgumentParser(description='Throughput of fast users while other receivers stall (part 1 threaded).')
+    parser.add_argument('--senders', type=int, default=4, help='sender/fast receiver pairs')
+    parser.add_argument('--stalled', type=int, nargs='+', default=[0, 4], help='numbers of stalled receivers to run')
+    parser.add_argument('--stall-every', type=int, default=2, help='every n-th message of a sender goes to a stalled receiver')
+    parser.add_argument('--message-size', type=int, default=16384, help='characters per message')
+    parser.add_argument('--duration', type=float, default=10.0, help='seconds of sending per run')
+    parser.add_argument('--block-timeout', type=float, default=10.0,
+                        help='seconds a send may take before the sender counts as blocked')
+    parser.add_argument('--outbound-queue', type=int, default=OUTBOUND_QUEUE)
+    parser.add_argument('--outbound-policy', choices=POLICIES, default=POLICY)
+    parser.add_argument('--send-timeout', type=float, default=SEND_TIMEOUT)
+    parser.add_argument('--root', default=ROOT, help='checkout whose server is benchmarked')
+    parser.add_argument('--port', type=int, default=12450)
+    args = parser.parse_args()
+
+    print('{:>7} {:>11} {:>11} {:>11} {:>15} {:>8}'.format('stalled', 'sends_per_s', 'fast_p50_ms', 'fast_p99_ms',
+                                                        'delivered_per_s', 'blocked'))
+    stats = []
+    for index, num_stalled in enumerate(args.stalled):
+        rate, latencies, delivered, blocked, outbound = run(args, num_stalled, args.port + index)
+        print('{:>7} {:>11.1f} {:>11.2f} {:>11.2f} {:>15.1f} {:>8}'.format(
+            num_stalled, rate, percentile(latencies, 0.50), percentile(latencies, 0.99), delivered, blocked))
+        stats.append((num_stalled, outbound))
+    for num_stalled, outbound in stats:
+        print('stalled={} {}'.format(num_stalled, outbound))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+'''
+This file benchmarks server startup (state recovery) from a full log replay vs a snapshot.
+
+The same state -- --accounts accounts holding --messages undelivered messages between them --
+is written to disk in two layouts:
+    1. log:      one segment holding every CREATE and APPEND record (no compaction)
+    2. snapshot: a snapshot of that state plus a segment of --tail records logged after it
+For each layout a fresh interpreter runs common.wal.load_state() and reports how long the
+recovery took and its peak RSS. With --part2, the part 2 server is also started on each layout
+and timed until it accepts connections.
+
+Usage: python3 bench/snapshot_startup.py [--accounts 1000000] [--messages 10000000] [--tail 10000] [--part2]
+'''
+# Import relevant python packages
+from argparse import ArgumentParser
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import grpc
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+from common.snapshot import write_snapshot
+from common.wal import APPEND, CREATE, encode_record, segment_path, snapshot_path
+
+# Constants/configurations
+HOST        = '127.0.0.1'
+SERVER_PATH = os.path.join(ROOT, 'part_2', 'server.py')
+MESSAGE     = b'<bench> ' + b'x' * 40
+
+# Recovery measured in a child process so each layout starts from a cold interpreter
+LOAD_SCRIPT = '''
+import json, resource, sys, time
+sys.path.insert(0, {root!r})
+from common.wal import load_state
+start = time.perf_counter()
+state, groups, segments, end = load_state({path!r})
+elapsed = time.perf_counter() - start
+print(json.dumps({{'seconds': elapsed, 'accounts': len(state),
+                  'messages': sum(len(record['mailbox']) for record in state.values()),
+                  'rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024}}))
+'''
+
+def username(index):
+    return 'user{}'.format(index)
+
+# Write the records for the whole state into one segment file
+def write_log(path, num_accounts, num_messages):
+    with open(segment_path(path, 1), 'wb') as log:
+        batch = bytearray()
+        for index in range(num_accounts):
+            batch += encode_record(CREATE, username(index), 'password')
+        for index in range(num_messages):
+            batch += encode_record(APPEND, username(index % num_accounts), MESSAGE)
+            if len(batch) >= 1 << 20:
+                log.write(batch)
+                batch = bytearray()
+        log.write(batch)
+
+# Write the same state as a snapshot covering segment 1, plus `tail` appends in segment 2
+def write_snapshot_layout(path, num_accounts, num_messages, tail):
+    per_account, extra = divmod(num_messages, num_accounts)
+    state = {username(index): {'password': 'password', 'mailbox': [MESSAGE] * (per_account + (index < extra))}
+             for index in range(num_accounts)}
+    start = time.perf_counter()
+    write_snapshot(snapshot_path(path), state, 1)
+    elapsed = time.perf_counter() - start
+    del state
+    with open(segment_path(path, 2), 'wb') as log:
+        log.write(b''.join(encode_record(APPEND, username(index % num_accounts), MESSAGE) for index in range(tail)))
+    return elapsed
+
+def measure_load(path):
+    output = subprocess.run([sys.executable, '-c', LOAD_SCRIPT.format(root=ROOT, path=path)],
+                            check=True, capture_output=True, text=True).stdout
+    return json.loads(output)
+
+# Seconds from launching the part 2 server on the log at path until it accepts connections
+def measure_server(path, port):
+    start = time.perf_counter()
+    process = subprocess.Popen([sys.executable, SERVER_PATH, '--host', HOST, '--port', str(port), '--wal', path,
+                                '--snapshot-interval', '0'],
+                               cwd=os.path.dirname(SERVER_PATH), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        with grpc.insecure_channel('{}:{}'.format(HOST, port)) as channel:
+            grpc.channel_ready_future(channel).result(timeout=3600)
+        return time.perf_counter() - start
+    finally:
+        process.kill()
+        process.wait()
+
+def disk_mb(directory):
+    return sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory)) / (1 << 20)
+
+def main():
+    parser = ArgumentParser(description='Startup time: full log replay vs snapshot + log tail.')
+    parser.add_argument('--accounts', type=int, default=1000000)
+    parser.add_argument('--messages', type=int, default=10000000)
+    parser.add_argument('--tail', type=int, default=10000, help='records logged after the snapshot')
+    parser.add_argument('--dir', help='directory for log files (default: a temporary directory)')
+    parser.add_argument('--part2', action='store_true', help='also time part 2 server startup on each layout')
+    parser.add_argument('--port', type=int, default=12390)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(dir=args.dir) as directory:
+        log_dir = os.path.join(directory, 'log')
+        snapshot_dir = os.path.join(directory, 'snapshot')
+        os.mkdir(log_dir)
+        os.mkdir(snapshot_dir)
+        write_log(os.path.join(log_dir, 'chat.wal'), args.accounts, args.messages)
+        snapshot_seconds = write_snapshot_layout(os.path.join(snapshot_dir, 'chat.wal'), args.accounts,
+                                                 args.messages, args.tail)
+        print('{} accounts, {} messages; snapshot written in {:.2f}s\n'.format(args.accounts, args.messages,
+                                                                             snapshot_seconds))
+
+        print('{:<9} {:>8} {:>10} {:>9} {:>11} {:>8} {:>10}'.format(
+            'layout', 'disk_mb', 'accounts', 'messages', 'recovery_s', 'rss_mb', 'server_s'))
+        for offset, (layout, layout_dir) in enumerate([('log', log_dir), ('snapshot', snapshot_dir)]):
+            path = os.path.join(layout_dir, 'chat.wal')
+            result = measure_load(path)
+            server_seconds = measure_server(path, args.port + offset) if args.part2 else float('nan')
+            print('{:<9} {:>8.0f} {accounts:>10} {messages:>9} {seconds:>11.2f} {rss_mb:>8.0f} {:>10.2f}'.format(
+                layout, disk_mb(layout_dir), server_seconds, **result))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,212 @@
+'''
+This file tests that no message is lost when part 2 message streams are killed at random points.
+
+A sender sends --messages numbered messages to each of --receivers accounts while every receiver
+reads its MessageStream and, after each message, kills it with probability --kill-rate, in one of
+three ways, then reopens it:
+    - cancel: cancel the stream, keeping the cursor (sequence number of the last message read)
+    - close:  close the whole channel, keeping the cursor
+    - crash:  cancel the stream and forget everything after the last acknowledged message, so the
+              server has to send those messages again (the receiver drops them by sequence number)
+Receivers acknowledge every --ack-every messages. Each mode runs on a fresh server:
+    - acked:  streams carry a cursor, so the server keeps messages until they are acknowledged
+    - legacy: streams carry no cursor, so the server removes messages as soon as it sends them
+Once nothing new arrives for --settle seconds, each receiver is checked for lost, duplicated
+and out-of-order messages, and for messages still queued on the server.
+
+Usage: python3 bench/stream_chaos.py [--receivers 4] [--messages 500] [--kill-rate 0.05] [--mode threaded|aio]
+'''
+# Import relevant python packages
+from argparse import ArgumentParser
+import os
+import random
+import re
+import subprocess
+import sys
+from threading import Event, Lock, Thread
+import time
+
+import grpc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'part_2'))
+from protos import chat_pb2, chat_pb2_grpc
+
+# Constants/configurations
+HOST        = '127.0.0.1'
+SERVER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'part_2', 'server.py')
+PASSWORD    = 'password'
+SENDER      = 'sender'
+KILLS       = ['cancel', 'close', 'crash']
+
+def start_server(mode, port):
+    command = [sys.executable, SERVER_PATH, '--mode', mode, '--host', HOST, '--port', str(port)]
+    process = subprocess.Popen(command, cwd=os.path.dirname(SERVER_PATH), stdout=subprocess.DEVNULL,
+                               stderr=subprocess.DEVNULL)
+    with grpc.insecure_channel('{}:{}'.format(HOST, port)) as channel:
+        grpc.channel_ready_future(channel).result(timeout=10)
+    return process
+
+class Receiver:
+    '''
+    One receiving account and what it has seen
+        - username: account name
+        - acked: whether its streams carry a cursor
+        - received: message numbers in the order they were accepted
+        - duplicates: messages dropped because their sequence number was already accepted
+        - kills: streams killed so far
+        - cursor: sequence number of the last message read on the current stream (resumed from)
+        - last_seq: sequence number of the last message accepted (survives a crash, like the app's own store)
+        - acked_seq: sequence number of the last acknowledged message
+        - stream: stream currently open (None between streams); guarded by lock
+    '''
+    def __init__(self, username, acked) -> None:
+        self.username   = username
+        self.acked      = acked
+        self.received   = []
+        self.duplicates = 0
+        self.kills      = 0
+        self.cursor     = 0
+        self.last_seq   = 0
+        self.acked_seq  = 0
+        self.stream     = None
+        self.lock       = Lock()
+
+    # Cancel the current stream (when the run is over)
+    def cancel(self):
+        with self.lock:
+            if self.stream is not None:
+                self.stream.cancel()
+
+    def ack(self, stub):
+        if self.cursor > self.acked_seq:
+            stub.Ack(chat_pb2.AckRequest(username=self.username, seq=self.cursor))
+            self.acked_seq = self.cursor
+
+    # Read streams until stop is set, killing them at random
+    def run(self, target, args, rng, stop):
+        while not stop.is_set():
+            channel = grpc.insecure_channel(target)
+            stub = chat_pb2_grpc.ChatAppStub(channel)
+            if self.acked:
+                request = chat_pb2.StreamRequest(username=self.username, password=PASSWORD, cursor=self.cursor)
+            else:
+                request = chat_pb2.StreamRequest(username=self.username, password=PASSWORD)
+            with self.lock:
+                self.stream = stub.MessageStream(request)
+            try:
+                for message in self.stream:
+                    # Skip the welcome listing
+                    if not message.seq:
+                        continue
+                    self.cursor = message.seq
+                    if self.acked and message.seq <= self.last_seq:
+                        self.duplicates += 1
+                    else:
+                        self.last_seq = message.seq
+                        self.received.append(int(message.msg.split()[-1]))
+                    if self.acked and self.cursor - self.acked_seq >= args.ack_every:
+                        self.ack(stub)
+                    if rng.random() < args.kill_rate:
+                        self.kill(rng.choice(KILLS), channel)
+                        break
+            except grpc.RpcError:
+                pass
+            finally:
+                with self.lock:
+                    self.stream = None
+                channel.close()
+
+    def kill(self, how, channel):
+        self.kills += 1
+        if how == 'close':
+            channel.close()
+        else:
+            self.stream.cancel()
+        if how == 'crash':
+            self.cursor = self.acked_seq
+
+# Messages still queued for username on the server (from the login greeting)
+def unread(stub, username):
+    response = stub.LoginAccount(chat_pb2.AccountInfo(username=username, password=PASSWORD))
+    match = re.search(r'You have (\d+) unread', response.msg)
+    return int(match.group(1)) if match else 0
+
+# Run one mode on a fresh server; returns the per-receiver results
+def run(args, acked):
+    target = '{}:{}'.format(HOST, args.port)
+    process = start_server(args.mode, args.port)
+    try:
+        with grpc.insecure_channel(target) as channel:
+            stub = chat_pb2_grpc.ChatAppStub(channel)
+            usernames = ['receiver{}'.format(index) for index in range(args.receivers)]
+            for username in [SENDER] + usernames:
+                stub.CreateAccount(chat_pb2.AccountInfo(username=username, password=PASSWORD))
+
+            rng = random.Random(args.seed)
+            stop = Event()
+            receivers = [Receiver(username, acked) for username in usernames]
+            threads = [Thread(target=receiver.run, args=(target, args, random.Random(rng.random()), stop))
+                       for receiver in receivers]
+            for thread in threads:
+                thread.start()
+
+            start = time.perf_counter()
+            for number in range(args.messages):
+                for username in usernames:
+                    stub.SendMessage(chat_pb2.Msg(src_username=SENDER, dst_username=username, msg=str(number)))
+
+            # Wait until nothing new arrives for args.settle seconds
+            total = -1
+            while total != sum(len(receiver.received) for receiver in receivers):
+                total = sum(len(receiver.received) for receiver in receivers)
+                time.sleep(args.settle)
+            elapsed = time.perf_counter() - start - args.settle
+            stop.set()
+            for receiver in receivers:
+                receiver.cancel()
+            for thread in threads:
+                thread.join()
+
+            results = []
+            for receiver in receivers:
+                if acked:
+                    receiver.ack(stub)
+                lost = len(set(range(args.messages)) - set(receiver.received))
+                duplicated = len(receiver.received) - len(set(receiver.received))
+                ordered = receiver.received == sorted(receiver.received)
+                results.append((receiver, lost, duplicated, ordered, unread(stub, receiver.username)))
+            return results, elapsed
+    finally:
+        process.kill()
+        process.wait()
+
+def main():
+    parser = ArgumentParser(description='Kill part 2 message streams at random points and check for lost messages.')
+    parser.add_argument('--receivers', type=int, default=4)
+    parser.add_argument('--messages', type=int, default=500, help='messages sent to each receiver')
+    parser.add_argument('--kill-rate', type=float, default=0.05, help='chance of killing the stream after each message')
+    parser.add_argument('--ack-every', type=int, default=10, help='messages per acknowledgement')
+    parser.add_argument('--settle', type=float, default=2.0, help='seconds without new messages that end a run')
+    parser.add_argument('--mode', choices=['threaded', 'aio'], default='threaded')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--port', type=int, default=12440)
+    args = parser.parse_args()
+
+    print('{:<7} {:<10} {:>6} {:>9} {:>5} {:>10} {:>11} {:>8} {:>7}'.format(
+        'mode', 'receiver', 'kills', 'received', 'lost', 'duplicated', 'redelivered', 'ordered', 'unread'))
+    failed = False
+    for acked in [True, False]:
+        results, elapsed = run(args, acked)
+        mode = 'acked' if acked else 'legacy'
+        for receiver, lost, duplicated, ordered, pending in results:
+            print('{:<7} {:<10} {:>6} {:>9} {:>5} {:>10} {:>11} {:>8} {:>7}'.format(
+                mode, receiver.username, receiver.kills, len(receiver.received), lost, duplicated,
+                receiver.duplicates, 'yes' if ordered else 'no', pending))
+            if acked and (lost or duplicated or not ordered or pending):
+                failed = True
+        print('{:<7} {} messages in {:.2f}s'.format(mode, args.receivers * args.messages, elapsed))
+    if failed:
+        sys.exit('acked mode lost, duplicated or reordered messages')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,134 @@
+'''
+This file benchmarks idle CPU and delivery latency of part 2 MessageStreams.
+
+For each stream count, a part 2 server is launched on localhost with enough worker threads,
+the streams are opened (spread over --users accounts, since every stream first replays the
+user listing), and then:
+    1. server CPU usage is sampled from /proc while every stream sits idle
+    2. --messages messages are sent to random users and the send-to-stream latency is recorded
+
+Usage: python3 bench/stream_wakeups.py [--streams 100 1000 5000] [--users 100] [--messages 500]
+'''
+# Import relevant python packages
+from argparse import ArgumentParser
+import asyncio
+import os
+import random
+import subprocess
+import sys
+import time
+
+import grpc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'part_2'))
+from protos import chat_pb2, chat_pb2_grpc
+
+# Constants/configurations
+HOST        = '127.0.0.1'
+SERVER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'part_2', 'server.py')
+CHANNELS    = 16 # client channels the streams are spread over
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+
+# Total user+system CPU seconds consumed by pid
+def cpu_seconds(pid):
+    with open('/proc/{}/stat'.format(pid)) as stat:
+        fields = stat.read().rsplit(')', 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+
+def start_server(port, workers, keepalive):
+    process = subprocess.Popen([sys.executable, SERVER_PATH, '--host', HOST, '--port', str(port),
+                                '--max-clients', str(workers), '--keepalive', str(keepalive)],
+                               cwd=os.path.dirname(SERVER_PATH), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    with grpc.insecure_channel('{}:{}'.format(HOST, port)) as channel:
+        grpc.channel_ready_future(channel).result(timeout=10)
+    return process
+
+def percentile(samples, p):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p))]
+
+# Consume one stream, recording latency of every benchmark message (msg body is the send timestamp).
+# ready is released once the initial user listing (banner + one line per user) has been received.
+async def consume(stub, username, listing_size, latencies, ready):
+    stream = stub.MessageStream(chat_pb2.AccountInfo(username=username, password='password'))
+    received = 0
+    try:
+        async for message in stream:
+            received += 1
+            if received == listing_size:
+                ready.release()
+            body = message.msg.split('> ', 1)[-1]
+            if body.startswith('t='):
+                latencies.append((time.perf_counter() - float(body[2:])) * 1000)
+    except grpc.aio.AioRpcError:
+        pass
+
+async def run(port, num_streams, num_users, num_messages, idle_seconds, keepalive):
+    process = start_server(port, num_streams + 32, keepalive)
+    channels = [grpc.aio.insecure_channel('{}:{}'.format(HOST, port)) for _ in range(CHANNELS)]
+    stubs = [chat_pb2_grpc.ChatAppStub(channel) for channel in channels]
+    try:
+        usernames = ['user{}'.format(index) for index in range(num_users)]
+        for username in usernames:
+            await stubs[0].CreateAccount(chat_pb2.AccountInfo(username=username, password='password'))
+
+        # Open every stream and wait until all initial user listings are drained
+        latencies = []
+        ready = asyncio.Semaphore(0)
+        tasks = [asyncio.ensure_future(consume(stubs[index % CHANNELS], usernames[index % num_users], num_users + 1,
+                                               latencies, ready))
+                 for index in range(num_streams)]
+        for _ in range(num_streams):
+            await ready.acquire()
+        await asyncio.sleep(1)
+
+        # 1. Idle CPU
+        before = cpu_seconds(process.pid)
+        await asyncio.sleep(idle_seconds)
+        idle_cpu = (cpu_seconds(process.pid) - before) / idle_seconds * 100
+
+        # 2. Delivery latency
+        for _ in range(num_messages):
+            message = chat_pb2.Msg(src_username='bench', dst_username=random.choice(usernames),
+                                   msg='t={}'.format(time.perf_counter()))
+            await stubs[0].SendMessage(message)
+        deadline = time.time() + 10
+        while len(latencies) < num_messages and time.time() < deadline:
+            await asyncio.sleep(0.05)
+
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        return {
+            'streams':      num_streams,
+            'idle_cpu_pct': idle_cpu,
+            'delivered':    len(latencies),
+            'p50_ms':       percentile(latencies, 0.50) if latencies else float('nan'),
+            'p99_ms':       percentile(latencies, 0.99) if latencies else float('nan'),
+        }
+    finally:
+        for channel in channels:
+            await channel.close()
+        process.kill()
+        process.wait()
+
+def main():
+    parser = ArgumentParser(description='Idle CPU and delivery latency of part 2 MessageStreams.')
+    parser.add_argument('--streams', type=int, nargs='+', default=[100, 1000, 5000])
+    parser.add_argument('--users', type=int, default=100, help='accounts the streams are spread over')
+    parser.add_argument('--messages', type=int, default=500)
+    parser.add_argument('--idle-seconds', type=float, default=5.0)
+    parser.add_argument('--keepalive', type=float, default=5.0, help='server keepalive wake interval')
+    parser.add_argument('--port', type=int, default=12360)
+    args = parser.parse_args()
+
+    # One loop for every run (grpc.aio's poller does not survive asyncio.run tearing loops down)
+    loop = asyncio.new_event_loop()
+    print('{:>8} {:>13} {:>10} {:>9} {:>9}'.format('streams', 'idle_cpu_pct', 'delivered', 'p50_ms', 'p99_ms'))
+    for offset, num_streams in enumerate(args.streams):
+        result = loop.run_until_complete(run(args.port + offset, num_streams, min(args.users, num_streams), args.messages,
+                                 args.idle_seconds, args.keepalive))
+        print('{streams:>8} {idle_cpu_pct:>13.1f} {delivered:>10} {p50_ms:>9.2f} {p99_ms:>9.2f}'.format(**result))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+'''
+This file stress-tests the shared user store with concurrent senders and mailbox drainers.
+
+For each store and thread count T, T sender threads append --messages uniquely tagged messages
+each to --recipients mailboxes while T drainer threads sweep all of those mailboxes
+every --drain-interval seconds, draining each (the way login and MessageStream do, possibly
+for the same user at once). Once the
+senders finish every mailbox is drained one last time and each message is counted: "lost"
+ones were never drained, "duplicated" ones were drained more than once, and the script exits
+with an error if the striped or global store did either. Stores compared:
+    - striped:  common/user_store.py with STRIPES shard locks
+    - global:   the same store with a single shard (one global lock)
+    - unlocked: the pre-store pattern (plain dict, iterate the mailbox sending each message,
+                then reset it to [])
+
+Usage: python3 bench/user_store_stress.py [--threads 1 2 4 8 16] [--messages 20000] [--recipients 64]
+'''
+# Import relevant python packages
+from argparse import ArgumentParser
+from collections import Counter
+import os
+import sys
+from threading import Event, Thread
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.user_store import STRIPES, UserStore
+
+class UnlockedStore:
+    '''
+    Baseline with the servers' original, unsynchronized mailbox handling
+    '''
+    def __init__(self) -> None:
+        self.records = {}
+
+    def create(self, username, password):
+        self.records[username] = {'password': password, 'mailbox': []}
+
+    def append(self, username, message):
+        self.records[username]['mailbox'].append(message)
+        return 0, None
+
+    def drain(self, username):
+        mailbox = []
+        for message in self.records[username]['mailbox']:
+            mailbox.append(message)
+            time.sleep(0) # stands in for sock.send(), which releases the interpreter lock
+        self.records[username]['mailbox'] = []
+        return mailbox
+
+def make_store(kind):
+    if kind == 'unlocked':
+        return UnlockedStore()
+    return UserStore(stripes=STRIPES if kind == 'striped' else 1)
+
+def run(kind, num_threads, num_messages, num_recipients, drain_interval):
+    store = make_store(kind)
+    recipients = ['user{}'.format(index) for index in range(num_recipients)]
+    for username in recipients:
+        store.create(username, 'password')
+
+    def sender(thread_index):
+        for index in range(num_messages):
+            store.append(recipients[(thread_index + index) % num_recipients], '{}:{}'.format(thread_index, index).encode())
+
+    senders_done = Event()
+    drained = [[] for _ in range(num_threads)]
+    def drainer(thread_index):
+        received = drained[thread_index]
+        while not senders_done.wait(drain_interval):
+            for username in recipients[thread_index:] + recipients[:thread_index]:
+                received.extend(store.drain(username))
+
+    senders = [Thread(target=sender, args=(index,)) for index in range(num_threads)]
+    drainers = [Thread(target=drainer, args=(index,)) for index in range(num_threads)]
+    start = time.perf_counter()
+    for thread in senders + drainers:
+        thread.start()
+    for thread in senders:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    senders_done.set()
+    for thread in drainers:
+        thread.join()
+
+    counts = Counter(message for received in drained for message in received)
+    for username in recipients:
+        counts.update(store.drain(username))
+    expected = num_threads * num_messages
+    return {
+        'store':       kind,
+        'threads':     num_threads,
+        'appends_per_s': expected / elapsed,
+        'lost':        expected - len(counts),
+        'duplicated':  sum(count - 1 for count in counts.values() if count > 1),
+    }
+
+def main():
+    parser = ArgumentParser(description='Concurrent append/drain stress test of the user store.')
+    parser.add_argument('--threads', type=int, nargs='+', default=[1, 2, 4, 8, 16],
+                        help='sender threads (and as many drainer threads)')
+    parser.add_argument('--messages', type=int, default=20000, help='messages per sender thread')
+    parser.add_argument('--recipients', type=int, default=64)
+    parser.add_argument('--drain-interval', type=float, default=0.001, help='seconds between drain sweeps')
+    parser.add_argument('--stores', nargs='+', default=['striped', 'global', 'unlocked'])
+    parser.add_argument('--switch-interval', type=float, default=1e-5,
+                        help='interpreter thread switch interval (seconds); small values provoke races')
+    args = parser.parse_args()
+
+    sys.setswitchinterval(args.switch_interval)
+    print('{:<9} {:>8} {:>14} {:>8} {:>11}'.format('store', 'threads', 'appends_per_s', 'lost', 'duplicated'))
+    failed = False
+    for num_threads in args.threads:
+        for kind in args.stores:
+            result = run(kind, num_threads, args.messages, args.recipients, args.drain_interval)
+            print('{store:<9} {threads:>8} {appends_per_s:>14.0f} {lost:>8} {duplicated:>11}'.format(**result))
+            # Only the unlocked baseline is expected to lose or duplicate messages
+            if kind != 'unlocked' and (result['lost'] or result['duplicated']):
+                failed = True
+    if failed:
+        sys.exit('the user store lost or duplicated messages')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,133 @@
+'''
+This file benchmarks write-ahead log throughput against the group commit (fsync) window.
+
+Part A drives common/wal.py directly: T threads each append a mailbox record and wait for it
+to be durable, back to back, for --seconds. A "per-record" row shows the no-group-commit
+baseline (write + fsync for every record under one lock).
+
+Part B (--part2) runs the part 2 server with --wal at each window and measures end-to-end
+SendMessage throughput from --callers concurrent callers.
+
+Usage: python3 bench/wal_group_commit.py [--threads 1 8 32] [--windows 0 0.0005 0.002 0.005] [--part2]
+'''
+# Import relevant python packages
+from argparse import ArgumentParser
+import asyncio
+import os
+import subprocess
+import sys
+import tempfile
+from threading import Lock, Thread
+import time
+
+import grpc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'part_2'))
+from common.wal import APPEND, WriteAheadLog, encode_record
+from protos import chat_pb2, chat_pb2_grpc
+
+# Constants/configurations
+HOST        = '127.0.0.1'
+SERVER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'part_2', 'server.py')
+MESSAGE     = '<bench> ' + 'x' * 100
+
+def percentile(samples, p):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p))]
+
+# Run `worker(latencies)` on num_threads threads for `seconds`; returns (ops, latencies in ms)
+def drive(num_threads, seconds, operation):
+    stop_at = time.perf_counter() + seconds
+    results = [[] for _ in range(num_threads)]
+    def worker(latencies):
+        while time.perf_counter() < stop_at:
+            start = time.perf_counter()
+            operation()
+            latencies.append((time.perf_counter() - start) * 1000)
+    threads = [Thread(target=worker, args=(latencies,)) for latencies in results]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    latencies = [latency for thread_latencies in results for latency in thread_latencies]
+    return len(latencies), latencies
+
+# Baseline: every record written and fsynced on its own
+def bench_per_record(directory, num_threads, seconds):
+    lock = Lock()
+    record = encode_record(APPEND, 'user', MESSAGE)
+    with open(os.path.join(directory, 'per_record.wal'), 'ab') as log:
+        def operation():
+            with lock:
+                log.write(record)
+                log.flush()
+                os.fsync(log.fileno())
+        ops, latencies = drive(num_threads, seconds, operation)
+    return {'window': 'per-record', 'threads': num_threads, 'ops_per_s': ops / seconds, 'fsyncs': ops,
+            'p50_ms': percentile(latencies, 0.50), 'p99_ms': percentile(latencies, 0.99)}
+
+def bench_group_commit(directory, num_threads, window, seconds):
+    wal = WriteAheadLog(os.path.join(directory, 'group_{}_{}.wal'.format(num_threads, window)), window)
+    ops, latencies = drive(num_threads, seconds, lambda: wal.sync(wal.log_append('user', MESSAGE)))
+    wal.close()
+    return {'window': '{:g}ms'.format(window * 1000), 'threads': num_threads, 'ops_per_s': ops / seconds,
+            'fsyncs': wal.fsyncs, 'p50_ms': percentile(latencies, 0.50), 'p99_ms': percentile(latencies, 0.99)}
+
+# Part B: SendMessage throughput of the part 2 server logging to a WAL with the given window
+async def bench_part2(directory, port, window, num_callers, seconds):
+    path = os.path.join(directory, 'part2_{}.wal'.format(window))
+    process = subprocess.Popen([sys.executable, SERVER_PATH, '--host', HOST, '--port', str(port), '--wal', path,
+                                '--fsync-window', str(window)],
+                               cwd=os.path.dirname(SERVER_PATH), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    channel = grpc.aio.insecure_channel('{}:{}'.format(HOST, port))
+    try:
+        await asyncio.wait_for(channel.channel_ready(), 10)
+        stub = chat_pb2_grpc.ChatAppStub(channel)
+        await stub.CreateAccount(chat_pb2.AccountInfo(username='user', password='password'))
+        latencies = []
+        stop_at = time.perf_counter() + seconds
+        async def caller():
+            while time.perf_counter() < stop_at:
+                start = time.perf_counter()
+                await stub.SendMessage(chat_pb2.Msg(src_username='bench', dst_username='user', msg=MESSAGE))
+                latencies.append((time.perf_counter() - start) * 1000)
+        await asyncio.gather(*(caller() for _ in range(num_callers)))
+        return {'window': '{:g}ms'.format(window * 1000), 'callers': num_callers, 'sends_per_s': len(latencies) / seconds,
+                'p50_ms': percentile(latencies, 0.50), 'p99_ms': percentile(latencies, 0.99)}
+    finally:
+        await channel.close()
+        process.kill()
+        process.wait()
+
+def main():
+    parser = ArgumentParser(description='WAL throughput vs group commit window.')
+    parser.add_argument('--threads', type=int, nargs='+', default=[1, 8, 32])
+    parser.add_argument('--windows', type=float, nargs='+', default=[0, 0.0005, 0.002, 0.005],
+                        help='fsync windows in seconds')
+    parser.add_argument('--seconds', type=float, default=3.0)
+    parser.add_argument('--dir', help='directory for log files (default: a temporary directory)')
+    parser.add_argument('--part2', action='store_true', help='also measure part 2 SendMessage end to end')
+    parser.add_argument('--callers', type=int, default=32, help='concurrent SendMessage callers for --part2')
+    parser.add_argument('--port', type=int, default=12380)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(dir=args.dir) as directory:
+        print('{:>11} {:>8} {:>10} {:>8} {:>8} {:>8}'.format('window', 'threads', 'ops_per_s', 'fsyncs', 'p50_ms', 'p99_ms'))
+        row = '{window:>11} {threads:>8} {ops_per_s:>10.0f} {fsyncs:>8} {p50_ms:>8.2f} {p99_ms:>8.2f}'
+        for num_threads in args.threads:
+            print(row.format(**bench_per_record(directory, num_threads, args.seconds)))
+            for window in args.windows:
+                print(row.format(**bench_group_commit(directory, num_threads, window, args.seconds)))
+
+        if args.part2:
+            # One loop for every run (grpc.aio's poller does not survive asyncio.run tearing loops down)
+            loop = asyncio.new_event_loop()
+            print('\n{:>11} {:>8} {:>12} {:>8} {:>8}'.format('window', 'callers', 'sends_per_s', 'p50_ms', 'p99_ms'))
+            for offset, window in enumerate(args.windows):
+                result = loop.run_until_complete(bench_part2(directory, args.port + offset, window, args.callers,
+                                                             args.seconds))
+                print('{window:>11} {callers:>8} {sends_per_s:>12.0f} {p50_ms:>8.2f} {p99_ms:>8.2f}'.format(**result))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,177 @@
+'''
+This file implements the admission control shared by the part 1 and part 2 servers: rate limits
+on the messages each user sends and receives, and a cap on the requests handled at once.
+
+Nothing stopped one client from sending as fast as the server accepted: a runaway bot filled its
+victims' mailboxes and kept the server's threads (the part 2 pool of MAX_CLIENTS workers) busy
+while everyone else waited. With limits configured:
+    - every sender has a token bucket of send_burst messages, refilled at send_rate per second,
+      and every recipient one of receive_burst messages refilled at receive_rate: a message takes
+      a token from both, and is refused when either is empty (one the recipient's bucket
+      refuses gives the sender its token back)
+    - at most max_in_flight requests are handled at once; past that, a new one is refused at
+      once instead of waiting for a thread (part 2 answers RESOURCE_EXHAUSTED, part 1 an error
+      result or reply)
+A refusal costs no more than the check, so a client over its limit mostly spends its own budget.
+A rate or cap of 0 turns that limit off (the default).
+
+The hot path takes no lock. A bucket is a [tokens, last update] list changed in place and found
+with one dict lookup; two threads updating the same bucket at once may both see the same tokens,
+so a sender racing itself can get a message or two past its burst (admission control only needs
+to be about right). Free in-flight slots are the items of a deque, whose pop and append are
+atomic: taking a slot is a pop (IndexError when none is left) and giving it back an append.
+Once there are more than MAX_BUCKETS buckets, the ones that filled up again (no different from a
+missing one) are dropped, so made-up sender names cannot grow the table without bound.
+
+Usage:
+    limits = Limits(send_rate=20, send_burst=100, max_in_flight=64)
+    refusal = limits.admit(sender, recipient) # None: admitted, and holding an in-flight slot
+    if refusal is None:
+        try:
+            ...
+        finally:
+            limits.leave()
+'''
+# Import relevant python packages
+from collections import deque
+import time
+
+# Constants/configurations
+SEND_RATE     = 0.0 # messages per second a sender may keep up (0: unlimited)
+SEND_BURST    = 100 # messages a sender may send at once
+RECEIVE_RATE  = 0.0 # messages per second a recipient may be sent (0: unlimited)
+RECEIVE_BURST = 500 # messages a recipient may be sent at once
+MAX_IN_FLIGHT = 0 # requests handled at once before new ones are refused (0: no cap)
+MAX_BUCKETS   = 100000 # buckets kept before the full ones are dropped
+
+BUSY            = 'Server is busy. Please try again later.'
+SENDER_LIMIT    = 'Too many messages from {}. Please slow down.'
+RECIPIENT_LIMIT = '{} is receiving too many messages. Please try again later.'
+
+class RateLimiter:
+    '''
+    Token buckets by key (a sender or recipient username)
+        - rate: tokens added to a bucket per second (0 or less: every call is allowed)
+        - burst: most tokens a bucket holds
+        - buckets: key -> [tokens, time.monotonic() of the last update]; a missing key is a full bucket
+        - max_buckets, limit: bucket count past which the full buckets are dropped (limit grows
+          with the buckets still in use, so dropping stays amortized O(1) per call)
+    '''
+    def __init__(self, rate, burst, max_buckets=MAX_BUCKETS) -> None:
+        self.rate        = rate
+        self.burst       = float(max(1, burst))
+        self.buckets     = {}
+        self.max_buckets = max_buckets
+        self.limit       = max_buckets
+
+    # Take cost tokens from key's bucket; False (and nothing taken) if it holds fewer
+    def allow(self, key, cost=1):
+        if self.rate <= 0:
+            return True
+        now = time.monotonic()
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets.setdefault(key, [self.burst, now])
+            if len(self.buckets) > self.limit:
+                self.prune(now)
+        tokens = min(self.burst, bucket[0] + max(0.0, now - bucket[1]) * self.rate)
+        bucket[1] = now
+        if tokens < cost:
+            bucket[0] = tokens
+            return False
+        bucket[0] = tokens - cost
+        return True
+
+    # Give back cost tokens allow() took from key's bucket
+    def refund(self, key, cost=1):
+        bucket = self.buckets.get(key)
+        if bucket is not None:
+            bucket[0] = min(self.burst, bucket[0] + cost)
+
+    # Drop the buckets that filled up again (untouched for burst / rate seconds)
+    def prune(self, now):
+        full = now - self.burst / self.rate
+        self.buckets = {key: bucket for key, bucket in list(self.buckets.items()) if bucket[1] > full}
+        self.limit = max(self.max_buckets, 2 * len(self.buckets))
+
+    def __len__(self):
+        return len(self.buckets)
+
+class Limits:
+    '''
+    Admission control of one server
+        - senders: RateLimiter of the messages each user sends
+        - recipients: RateLimiter of the messages each user is sent
+        - max_in_flight: requests handled at once (0 or less: no cap)
+        - slots: free in-flight slots (None without a cap)
+        - busy: requests refused for want of a slot so far
+        - limited: messages refused by a rate limit so far
+    The counters are bumped without a lock, so under threads they may miss a refusal now and then.
+    '''
+    def __init__(self, send_rate=SEND_RATE, send_burst=SEND_BURST, receive_rate=RECEIVE_RATE,
+                 receive_burst=RECEIVE_BURST, max_in_flight=MAX_IN_FLIGHT) -> None:
+        self.senders       = RateLimiter(send_rate, send_burst)
+        self.recipients    = RateLimiter(receive_rate, receive_burst)
+        self.max_in_flight = max_in_flight
+        self.slots         = deque([None] * max_in_flight) if max_in_flight > 0 else None
+        self.busy          = 0
+        self.limited       = 0
+
+    # Whether requests are capped at all
+    @property
+    def capped(self):
+        return self.slots is not None
+
+    # Requests holding a slot now
+    @property
+    def in_flight(self):
+        return self.max_in_flight - len(self.slots) if self.slots is not None else 0
+
+    # Take an in-flight slot; False if none is left
+    def enter(self):
+        if self.slots is None:
+            return True
+        try:
+            self.slots.pop()
+            return True
+        except IndexError:
+            self.busy += 1
+            return False
+
+    # Give back the slot taken by enter()
+    def leave(self):
+        if self.slots is not None:
+            self.slots.append(None)
+
+    # None if sender may send cost messages (to recipient, unless None: a group message only
+    # counts against its sender), otherwise why not
+    def check(self, sender, recipient=None, cost=1):
+        if not self.senders.allow(sender, cost):
+            self.limited += 1
+            return SENDER_LIMIT.format(sender)
+        if recipient is not None and not self.recipients.allow(recipient, cost):
+            # The message is not sent, so it does not count against its sender
+            self.senders.refund(sender, cost)
+            self.limited += 1
+            return RECIPIENT_LIMIT.format(recipient)
+        return None
+
+    # enter() and check() together: None if the message is admitted (the caller then holds a slot
+    # until it calls leave()), otherwise why not
+    def admit(self, sender, recipient=None):
+        if not self.enter():
+            return BUSY
+        refusal = self.check(sender, recipient)
+        if refusal is not None:
+            self.leave()
+        return refusal
+
+# Limits from the servers' command line options
+def limits_from_args(args):
+    return Limits(args.send_rate, args.send_burst, args.receive_rate, args.receive_burst, args.max_in_flight)
+
+# Admission gauges of a server's Limits
+def limit_gauges(metrics, limits):
+    metrics.gauge('chat_requests_in_flight', 'Requests holding an in-flight slot', lambda: limits.in_flight)
+    metrics.gauge('chat_requests_refused_busy', 'Requests refused because too many were in flight', lambda: limits.busy)
+    metrics.gauge('chat_messages_rate_limited', 'Messages refused for exceeding a rate limit', lambda: limits.limited)
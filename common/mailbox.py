@@ -0,0 +1,228 @@
+'''
+This file implements mailboxes whose older messages spill from memory to disk.
+
+A Mailbox holds one user's queued messages, oldest first: runs of spilled messages (extents) on
+disk, followed by the newest ones in a plain list in memory. When a user's in-memory messages
+take more than the per-user cap, or every mailbox together takes more than the memory budget,
+the store spills that user's in-memory messages: they are written to the end of the current
+segment of the Spill, and only their end offsets stay in memory (4 bytes per message instead of
+a bytes object). Messages are utf-8 encoded bytes (see common/user_store.py), so spilling and
+reading back copies them without encoding or decoding. Memory is estimated as their length plus
+MESSAGE_OVERHEAD per message.
+
+Segments are append-only files of SEGMENT_SIZE bytes (sparse until written), written with
+pwrite and memory-mapped read-only once. Reading a spilled message copies it straight out of
+the mapping, without read() copying it into a buffer first. A segment is deleted once every
+message in it was removed (acknowledged, drained, or deleted with its account) and it is no
+longer the one being written; an extent keeps its segment's mapping alive, so a drained mailbox
+can still be iterated after its segments are gone.
+
+Spill files only extend memory: the write-ahead log (if any) stays the durable copy, and
+leftover segments in the spill directory are deleted on start.
+
+Usage:
+    spill = Spill('/tmp/spill', user_cap=1 << 20, budget=256 << 20)
+    mailbox = Mailbox(spill=spill)
+    mailbox.append(b'<bob> hi')
+    size, count = mailbox.spill_out()
+'''
+# Import relevant python packages
+from array import array
+from collections import deque
+import glob
+import mmap
+import os
+from tempfile import TemporaryDirectory
+from threading import Lock
+
+# Constants/configurations
+SEGMENT_SIZE     = 64 * 1024 * 1024 # bytes per spill segment (a longer run gets a segment of its own)
+USER_CAP         = 1024 * 1024 # estimated bytes of one user's in-memory messages before they spill
+MEMORY_BUDGET    = 256 * 1024 * 1024 # estimated bytes of every in-memory message before mailboxes spill
+MIN_SPILL        = 1024 # estimated bytes below which a mailbox is not spilled for the budget
+MESSAGE_OVERHEAD = 41 # bytes an in-memory message costs besides its length (bytes header, list slot)
+
+class Segment:
+    '''
+    One spill file
+        - map, view: read-only mapping of the whole file and a memoryview of it
+        - used: bytes written so far; live: bytes of messages not yet removed
+    '''
+    def __init__(self, path, size) -> None:
+        self.path = path
+        self.size = size
+        self.file = open(path, 'w+b')
+        self.file.truncate(size)
+        self.map  = mmap.mmap(self.file.fileno(), size, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.map)
+        self.used = 0
+        self.live = 0
+
+class Extent:
+    '''
+    Run of consecutive spilled messages in one segment, starting at 'offset'
+        - ends: end of each message, relative to offset
+        - first: messages before it were removed
+    '''
+    def __init__(self, segment, offset, ends) -> None:
+        self.segment = segment
+        self.offset  = offset
+        self.ends    = ends
+        self.first   = 0
+
+    def __len__(self):
+        return len(self.ends) - self.first
+
+    # Offset (relative to self.offset) where message i starts
+    def start(self, i):
+        return self.ends[i - 1] if i else 0
+
+    def message(self, i):
+        return self.segment.view[self.offset + self.start(i):self.offset + self.ends[i]].tobytes()
+
+class Spill:
+    '''
+    Spill segments of every mailbox of a store, and the limits that decide when to spill
+        - directory: where segments are written (a temporary directory, removed at exit, if None)
+        - user_cap, budget: see USER_CAP and MEMORY_BUDGET
+        - lock: guards the current segment and the byte counts (taken after a shard lock, never before)
+    '''
+    def __init__(self, directory=None, user_cap=USER_CAP, budget=MEMORY_BUDGET, segment_size=SEGMENT_SIZE) -> None:
+        if directory is None:
+            self.temporary = TemporaryDirectory(prefix='chat-spill-')
+            directory = self.temporary.name
+        os.makedirs(directory, exist_ok=True)
+        for path in glob.glob(os.path.join(directory, 'spill.*')):
+            os.remove(path)
+        self.directory    = directory
+        self.user_cap     = user_cap
+        self.budget       = budget
+        self.segment_size = segment_size
+        self.lock         = Lock()
+        self.segment      = None
+        self.number       = 0
+        self.bytes        = 0 # bytes of spilled messages not yet removed
+
+    # Append messages to the current segment; returns their Extent
+    def write(self, messages):
+        ends = array('I')
+        end = 0
+        for message in messages:
+            end += len(message)
+            ends.append(end)
+        data = b''.join(messages)
+        with self.lock:
+            segment = self.segment
+            if segment is None or segment.used + len(data) > segment.size:
+                if segment is not None:
+                    self.retire(segment)
+                self.number += 1
+                segment = self.segment = Segment(os.path.join(self.directory, 'spill.{:06d}'.format(self.number)),
+                                                 max(self.segment_size, len(data)))
+            offset = segment.used
+            os.pwrite(segment.file.fileno(), data, offset)
+            segment.used += len(data)
+            segment.live += len(data)
+            self.bytes += len(data)
+        return Extent(segment, offset, ends)
+
+    # size bytes of segment's messages were removed
+    def release(self, segment, size):
+        with self.lock:
+            segment.live -= size
+            self.bytes -= size
+            if segment.live == 0 and segment is not self.segment:
+                os.remove(segment.path)
+
+    # segment is no longer written to (caller holds lock)
+    def retire(self, segment):
+        segment.file.close()
+        if segment.live == 0:
+            os.remove(segment.path)
+
+class Mailbox:
+    '''
+    One user's queued messages, oldest first: 'extents' (spilled, may be empty) then 'messages' (in memory)
+        - size: bytes of the in-memory messages
+        - spilled: number of spilled messages
+        - spill: where messages spill to (None: never spills)
+    Not thread-safe: the store calls it under the owning shard's lock.
+    '''
+    def __init__(self, messages=None, spill=None) -> None:
+        self.messages   = messages if messages is not None else []
+        self.extents    = deque()
+        self.size       = sum(map(len, self.messages))
+        self.spilled    = 0
+        self.spill      = spill
+
+    def __len__(self):
+        return self.spilled + len(self.messages)
+
+    def __iter__(self):
+        return self.iterate(0)
+
+    def append(self, message):
+        self.messages.append(message)
+        self.size += len(message)
+
+    # Estimated bytes of the in-memory messages
+    def memory(self):
+        return self.size + MESSAGE_OVERHEAD * len(self.messages)
+
+    # Messages from index start on, spilled ones read as they are reached
+    def iterate(self, start):
+        for extent in list(self.extents):
+            if start >= len(extent):
+                start -= len(extent)
+                continue
+            for i in range(extent.first + start, len(extent.ends)):
+                yield extent.message(i)
+            start = 0
+        for i in range(start, len(self.messages)):
+            yield self.messages[i]
+
+    # Messages from index start on, up to chunk_size bytes (at least one)
+    def read(self, start, chunk_size):
+        messages = []
+        size = 0
+        for message in self.iterate(start):
+            if messages and size + len(message) > chunk_size:
+                break
+            messages.append(message)
+            size += len(message)
+        return messages
+
+    # Move every in-memory message to a new extent; returns (bytes, messages) moved
+    def spill_out(self):
+        size, count = self.size, len(self.messages)
+        if count:
+            self.extents.append(self.spill.write(self.messages))
+            self.spilled += count
+            self.messages = []
+            self.size = 0
+        return size, count
+
+    # Remove the first count messages; returns (in-memory bytes freed, spilled messages removed)
+    def drop(self, count):
+        removed = 0
+        while count and self.extents:
+            extent = self.extents[0]
+            taken = min(count, len(extent))
+            last = extent.first + taken
+            self.spill.release(extent.segment, extent.start(last) - extent.start(extent.first))
+            extent.first = last
+            if not len(extent):
+                self.extents.popleft()
+            count -= taken
+            removed += taken
+        self.spilled -= removed
+        size = sum(map(len, self.messages[:count]))
+        del self.messages[:count]
+        self.size -= size
+        return size, removed
+
+    # Give every spilled message's disk space back (the mailbox was taken or deleted); the extents
+    # stay readable, so a taken mailbox can still be iterated
+    def release(self):
+        for extent in self.extents:
+            self.spill.release(extent.segment, extent.start(len(extent.ends)) - extent.start(extent.first))
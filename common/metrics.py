@@ -0,0 +1,238 @@
+'''
+This file implements the built-in instrumentation shared by the part 1 and part 2 servers.
+
+A Metrics registry holds two kinds of series:
+    - timers (HistogramFamily): per label value (an RPC method, a part 1 prompt), the number of
+      calls, how many are running right now, how many raised, and a latency histogram over the
+      fixed BUCKETS (50us .. 10s), like a Prometheus histogram
+    - gauges: functions read when the metrics are exported (connected sockets, mailbox depth, ...)
+Recording a call costs two perf_counter reads, a bisect over BUCKETS and one uncontended lock
+per series -- about a microsecond -- so the instrumentation stays on by default; only exporting
+it is optional.
+
+The registry is exported in the Prometheus text format over HTTP (serve_metrics: GET /metrics,
+or /metrics.json for the JSON form), or written as JSON to a file every few seconds (dump_metrics).
+
+Usage:
+    metrics = Metrics()
+    inputs = metrics.timer('chat_part1_input', 'Handling of one client input', 'state')
+    with inputs.time('menu'):
+        ...
+    metrics.gauge('chat_connections', 'Connected client sockets', lambda: len(active_sockets))
+    export_metrics(metrics, port=9100)
+'''
+# Import relevant python packages
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import os
+from threading import Lock, Thread
+import time
+
+# Constants/configurations
+BUCKETS          = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                    0.5, 1.0, 2.5, 5.0, 10.0) # histogram bucket upper bounds (seconds)
+METRICS_HOST     = '127.0.0.1' # metrics are only served locally unless asked otherwise
+METRICS_INTERVAL = 10.0 # seconds between JSON dumps
+
+class Series:
+    '''
+    Calls of one label value of a timer
+        - lock: guards the fields below
+        - counts: calls per bucket (not cumulative); counts[-1] holds those slower than BUCKETS[-1]
+        - total: sum of call durations (seconds)
+        - in_flight: calls currently running
+        - errors: calls that raised
+    '''
+    def __init__(self) -> None:
+        self.lock      = Lock()
+        self.counts    = [0] * (len(BUCKETS) + 1)
+        self.total     = 0.0
+        self.in_flight = 0
+        self.errors    = 0
+
+    def start(self):
+        with self.lock:
+            self.in_flight += 1
+        return time.perf_counter()
+
+    # Record a call that started at perf_counter() value started
+    def finish(self, started, failed=False):
+        seconds = time.perf_counter() - started
+        index = bisect_left(BUCKETS, seconds)
+        with self.lock:
+            self.in_flight -= 1
+            self.counts[index] += 1
+            self.total += seconds
+            if failed:
+                self.errors += 1
+
+    # Consistent copy: (counts, total, in_flight, errors)
+    def read(self):
+        with self.lock:
+            return list(self.counts), self.total, self.in_flight, self.errors
+
+class Timer:
+    '''
+    Context manager timing one call into a Series (a raised exception counts as an error)
+    '''
+    def __init__(self, series) -> None:
+        self.series  = series
+        self.started = 0.0
+
+    def __enter__(self):
+        self.started = self.series.start()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        self.series.finish(self.started, exc_type is not None)
+        return False
+
+class HistogramFamily:
+    '''
+    One timer: a Series per label value, created on first use
+        - name: prefix of the exported series (NAME_duration_seconds, NAME_in_flight, NAME_errors_total)
+        - help: description
+        - label: name of the label that tells series apart (e.g. 'method')
+        - series: key: label value, value: Series; lock guards adding to it
+    '''
+    def __init__(self, name, help, label) -> None:
+        self.name   = name
+        self.help   = help
+        self.label  = label
+        self.series = {}
+        self.lock   = Lock()
+
+    def labels(self, value):
+        series = self.series.get(value)
+        if series is None:
+            with self.lock:
+                series = self.series.setdefault(value, Series())
+        return series
+
+    def time(self, value):
+        return Timer(self.labels(value))
+
+class Metrics:
+    '''
+    Registry of timers and gauges
+        - timers: key: name, value: HistogramFamily
+        - gauges: key: name, value: (help, function returning a number)
+    '''
+    def __init__(self) -> None:
+        self.timers = {}
+        self.gauges = {}
+
+    def timer(self, name, help, label):
+        if name not in self.timers:
+            self.timers[name] = HistogramFamily(name, help, label)
+        return self.timers[name]
+
+    # Register a gauge read through function() at export time (it must be safe to call from another thread)
+    def gauge(self, name, help, function):
+        self.gauges[name] = (help, function)
+
+    # Prometheus text exposition format
+    def render(self):
+        lines = []
+        for family in self.timers.values():
+            rows = [(value, series.read()) for value, series in sorted(family.series.items())]
+            name = family.name + '_duration_seconds'
+            lines.append('# HELP {} {}'.format(name, family.help))
+            lines.append('# TYPE {} histogram'.format(name))
+            for value, (counts, total, _, _) in rows:
+                label = '{}="{}"'.format(family.label, value)
+                cumulative = 0
+                for bound, count in zip(BUCKETS, counts):
+                    cumulative += count
+                    lines.append('{}_bucket{{{},le="{}"}} {}'.format(name, label, bound, cumulative))
+                lines.append('{}_bucket{{{},le="+Inf"}} {}'.format(name, label, sum(counts)))
+                lines.append('{}_sum{{{}}} {}'.format(name, label, total))
+                lines.append('{}_count{{{}}} {}'.format(name, label, sum(counts)))
+            for suffix, kind, field in [('_in_flight', 'gauge', 2), ('_errors_total', 'counter', 3)]:
+                lines.append('# HELP {}{} {} ({})'.format(family.name, suffix, family.help, suffix[1:].replace('_', ' ')))
+                lines.append('# TYPE {}{} {}'.format(family.name, suffix, kind))
+                for value, row in rows:
+                    lines.append('{}{}{{{}="{}"}} {}'.format(family.name, suffix, family.label, value, row[field]))
+        for name, (help, function) in sorted(self.gauges.items()):
+            lines.append('# HELP {} {}'.format(name, help))
+            lines.append('# TYPE {} gauge'.format(name))
+            lines.append('{} {}'.format(name, function()))
+        return '\n'.join(lines) + '\n'
+
+    # JSON-friendly dict, with p50/p99 estimated from the buckets (upper bound of the bucket, in ms)
+    def snapshot(self):
+        timers = {}
+        for family in self.timers.values():
+            rows = {}
+            for value, series in sorted(family.series.items()):
+                counts, total, in_flight, errors = series.read()
+                calls = sum(counts)
+                rows[value] = {'count': calls, 'sum_seconds': total, 'in_flight': in_flight, 'errors': errors,
+                               'p50_ms': bucket_percentile(counts, 0.50), 'p99_ms': bucket_percentile(counts, 0.99)}
+            timers[family.name] = rows
+        gauges = {name: function() for name, (_, function) in sorted(self.gauges.items())}
+        return {'time': time.time(), 'timers': timers, 'gauges': gauges}
+
+# Account and mailbox gauges of a UserStore (shared by every server)
+def store_gauges(metrics, users):
+    metrics.gauge('chat_accounts', 'Accounts', lambda: len(users))
+    metrics.gauge('chat_mailbox_messages', 'Messages queued in mailboxes', lambda: users.queued()[0])
+    metrics.gauge('chat_mailbox_bytes', 'Bytes of queued messages held in memory', lambda: users.queued()[1])
+    metrics.gauge('chat_mailbox_spilled_messages', 'Queued messages spilled to disk', lambda: users.spilled()[0])
+    metrics.gauge('chat_mailbox_spilled_bytes', 'Bytes of queued messages spilled to disk', lambda: users.spilled()[1])
+
+# Upper bound (ms) of the bucket holding the p-th quantile of counts; None without calls
+def bucket_percentile(counts, p):
+    calls = sum(counts)
+    if not calls:
+        return None
+    cumulative = 0
+    for index, count in enumerate(counts):
+        cumulative += count
+        if cumulative >= calls * p:
+            return BUCKETS[index] * 1000 if index < len(BUCKETS) else float('inf')
+
+# Serve GET /metrics (Prometheus text) and /metrics.json on host:port from a daemon thread
+def serve_metrics(metrics, host, port):
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path == '/metrics':
+                body, content_type = metrics.render().encode(), 'text/plain; version=0.0.4'
+            elif self.path == '/metrics.json':
+                body, content_type = json.dumps(metrics.snapshot()).encode(), 'application/json'
+            else:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        # Scrapes are not worth a log line each
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+# Write metrics.snapshot() as JSON to path every interval seconds (atomically, via a rename)
+def dump_metrics(metrics, path, interval=METRICS_INTERVAL):
+    def dump():
+        while True:
+            time.sleep(interval)
+            temporary = path + '.tmp'
+            with open(temporary, 'w') as file:
+                json.dump(metrics.snapshot(), file)
+            os.replace(temporary, path)
+    Thread(target=dump, daemon=True).start()
+
+# Start whichever exports are configured: an HTTP endpoint on port and/or JSON dumps to path
+def export_metrics(metrics, port=None, path=None, interval=METRICS_INTERVAL, host=METRICS_HOST):
+    if port:
+        serve_metrics(metrics, host, port)
+    if path:
+        dump_metrics(metrics, path, interval)
@@ -0,0 +1,102 @@
+'''
+This file implements the password hashing shared by the part 1 and part 2 servers.
+
+Passwords are stored as 'scrypt$LOG_N$R$P$SALT$HASH' (salt and hash in hex, a random SALT_SIZE-byte
+salt per account), so neither the store nor the write-ahead log or a snapshot holds a password.
+scrypt is slow and memory-hard on purpose (about 60 ms and 16 MiB per hash at the default cost),
+and that much CPU on the login path would stall every other request of a server: Passwords runs
+it in a pool of worker processes and hands back concurrent.futures.Future objects instead. A
+server thread waits on one without holding the interpreter lock, the asyncio server awaits it with
+asyncio.wrap_future, and the selectors server is woken when it completes.
+
+Accounts stored before hashing (a plain password in an older log or snapshot) still verify, by
+constant-time comparison.
+
+Usage:
+    passwords = Passwords(workers=2)
+    stored = passwords.hash('secret').result()
+    passwords.verify(stored, 'secret').result() # True
+'''
+# Import relevant python packages
+from concurrent.futures import Future, ProcessPoolExecutor
+import hashlib
+import hmac
+import multiprocessing
+import os
+
+# Constants/configurations
+ENCODING     = 'utf-8'
+SCHEME       = 'scrypt'
+LOG_N        = 14 # scrypt cost: 2**LOG_N iterations, 128 * BLOCK * 2**LOG_N bytes of memory
+BLOCK        = 8 # scrypt block size (r)
+PARALLEL     = 1 # scrypt parallelism (p)
+SALT_SIZE    = 16
+HASH_SIZE    = 32
+HASH_WORKERS = os.cpu_count() or 1 # hashing processes per server
+HASH_NICE    = 10 # niceness of the hashing processes: serving gets the CPU first when both want it
+
+# OpenSSL needs 128 * r * (N + p + 2) bytes; twice that leaves room at any cost
+def derive(password, salt, log_n, block, parallel):
+    return hashlib.scrypt(password.encode(encoding=ENCODING), salt=salt, n=1 << log_n, r=block, p=parallel,
+                          maxmem=256 * block * ((1 << log_n) + parallel + 2), dklen=HASH_SIZE)
+
+# Stored form of a new password (a fresh salt each time)
+def hash_password(password, log_n=LOG_N):
+    salt = os.urandom(SALT_SIZE)
+    digest = derive(password, salt, log_n, BLOCK, PARALLEL)
+    return '$'.join([SCHEME, str(log_n), str(BLOCK), str(PARALLEL), salt.hex(), digest.hex()])
+
+# Whether password matches its stored form (a hash, or a plain password stored before hashing)
+def verify_password(stored, password):
+    if not stored.startswith(SCHEME + '$'):
+        return hmac.compare_digest(stored.encode(encoding=ENCODING), password.encode(encoding=ENCODING))
+    _, log_n, block, parallel, salt, digest = stored.split('$')
+    return hmac.compare_digest(derive(password, bytes.fromhex(salt), int(log_n), int(block), int(parallel)),
+                               bytes.fromhex(digest))
+
+def completed(result):
+    future = Future()
+    future.set_result(result)
+    return future
+
+class Passwords:
+    '''
+    Hashes and verifies passwords in worker processes
+        - pool: ProcessPoolExecutor of 'workers' processes (None for workers=0: the KDF runs on
+          the calling thread, for tools and tests that do not serve clients)
+        - log_n: scrypt cost of new hashes (stored hashes keep the cost they were made with)
+    '''
+    def __init__(self, workers=HASH_WORKERS, log_n=LOG_N) -> None:
+        self.log_n = log_n
+        self.pool  = None
+        if workers:
+            # Spawned, not forked: the servers run gRPC and selector threads by the time this starts
+            self.pool = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn'),
+                                            initializer=os.nice, initargs=(HASH_NICE,))
+            # Start the processes now rather than on the first login
+            for _ in range(workers):
+                self.pool.submit(int)
+
+    def run(self, function, *args):
+        if self.pool is not None:
+            return self.pool.submit(function, *args)
+        try:
+            return completed(function(*args))
+        except Exception as error:
+            future = Future()
+            future.set_exception(error)
+            return future
+
+    # Future of the stored form of password
+    def hash(self, password):
+        return self.run(hash_password, password, self.log_n)
+
+    # Future of whether password matches stored (False at once if stored is None: no such account)
+    def verify(self, stored, password):
+        if stored is None:
+            return completed(False)
+        return self.run(verify_password, stored, password)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait=False, cancel_futures=True)
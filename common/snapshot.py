@@ -0,0 +1,158 @@
+'''
+This file implements compact binary snapshots of the 'users' map for the write-ahead log.
+
+A snapshot holds every account and its undelivered mailbox, and every group, as of the end of
+one log segment:
+
+    magic (4B) | version (1B) | last segment (8B) | number of users (4B)
+    per user:  username | password | sequence number of the first message (8B) |
+               message count (4B) | message lengths (4B each) | messages blob
+    number of groups (4B)
+    per group: name | member count (4B) | members
+    crc32 of everything above (4B)
+
+Strings are length-prefixed utf-8. A mailbox is stored as one length-prefixed blob of its
+(utf-8 bytes) messages plus the length of each message in bytes, so loading slices the blob
+instead of reading every message separately. Version 1 snapshots (without sequence numbers),
+version 2 snapshots (without groups) and version 3 snapshots (message lengths in characters)
+are still read; their mailboxes start at sequence number 1, they have no groups, and their
+blobs are decoded to be sliced by characters, respectively. A message sent to a group is
+written once per member here (it is shared in memory and in the log only).
+
+Snapshots are written to a temporary file, fsynced and renamed over the previous one, so a
+crash leaves either the old or the new snapshot, never a partial one.
+'''
+# Import relevant python packages
+import os
+import struct
+import zlib
+
+# Constants/configurations
+ENCODING = 'utf-8'
+MAGIC    = b'CHSN'
+VERSION  = 4
+VERSIONS = (1, 2, 3, 4) # versions read_snapshot understands
+
+HEADER = struct.Struct('!4sBQI') # magic, version, last segment, number of users
+FIELD  = struct.Struct('!I') # string length / message count
+SEQ    = struct.Struct('!Q') # sequence number
+CRC    = struct.Struct('!I')
+
+class SnapshotError(Exception):
+    pass
+
+# Append one length-prefixed string to chunk
+def pack_string(chunk, text):
+    data = text.encode(ENCODING)
+    chunk += FIELD.pack(len(data))
+    chunk += data
+
+# Write state (username -> {'password', 'mailbox' (list of bytes), 'base'}) and groups (group -> set of usernames)
+# as the snapshot at path covering segments <= last_segment
+def write_snapshot(path, state, last_segment, groups=None):
+    temporary = path + '.tmp'
+    crc = 0
+    with open(temporary, 'wb') as snapshot:
+        header = HEADER.pack(MAGIC, VERSION, last_segment, len(state))
+        snapshot.write(header)
+        crc = zlib.crc32(header, crc)
+        for username, record in state.items():
+            mailbox = record['mailbox']
+            chunk = bytearray()
+            pack_string(chunk, username)
+            pack_string(chunk, record['password'])
+            chunk += SEQ.pack(record.get('base', 1))
+            chunk += FIELD.pack(len(mailbox))
+            chunk += struct.pack('!{}I'.format(len(mailbox)), *map(len, mailbox))
+            blob = b''.join(mailbox)
+            chunk += FIELD.pack(len(blob))
+            chunk += blob
+            snapshot.write(chunk)
+            crc = zlib.crc32(chunk, crc)
+        chunk = bytearray(FIELD.pack(len(groups or {})))
+        for group, members in (groups or {}).items():
+            pack_string(chunk, group)
+            chunk += FIELD.pack(len(members))
+            for username in sorted(members):
+                pack_string(chunk, username)
+        snapshot.write(chunk)
+        crc = zlib.crc32(chunk, crc)
+        snapshot.write(CRC.pack(crc))
+        snapshot.flush()
+        os.fsync(snapshot.fileno())
+    os.replace(temporary, path)
+
+    # Make the rename itself durable
+    directory = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(directory)
+    finally:
+        os.close(directory)
+
+# Read a length-prefixed string at offset of data; returns (string, offset after it)
+def unpack_string(data, view, offset):
+    (length,) = FIELD.unpack_from(data, offset)
+    return str(view[offset + FIELD.size:offset + FIELD.size + length], ENCODING), offset + FIELD.size + length
+
+# Read the snapshot at path: returns (state, groups, last_segment), or ({}, {}, 0) if there is none
+def read_snapshot(path):
+    if not os.path.exists(path):
+        return {}, {}, 0
+    with open(path, 'rb') as snapshot:
+        data = snapshot.read()
+    if len(data) < HEADER.size + CRC.size or zlib.crc32(memoryview(data)[:-CRC.size]) != CRC.unpack_from(data, len(data) - CRC.size)[0]:
+        raise SnapshotError('snapshot {} is corrupt'.format(path))
+    magic, version, last_segment, num_users = HEADER.unpack_from(data, 0)
+    if magic != MAGIC or version not in VERSIONS:
+        raise SnapshotError('snapshot {} has unsupported format'.format(path))
+
+    view = memoryview(data)
+    state = {}
+    offset = HEADER.size
+    for _ in range(num_users):
+        (length,) = FIELD.unpack_from(data, offset)
+        username = str(view[offset + FIELD.size:offset + FIELD.size + length], ENCODING)
+        offset += FIELD.size + length
+        (length,) = FIELD.unpack_from(data, offset)
+        password = str(view[offset + FIELD.size:offset + FIELD.size + length], ENCODING)
+        offset += FIELD.size + length
+        base = 1
+        if version >= 2:
+            (base,) = SEQ.unpack_from(data, offset)
+            offset += SEQ.size
+        (count,) = FIELD.unpack_from(data, offset)
+        offset += FIELD.size
+
+        lengths = struct.unpack_from('!{}I'.format(count), data, offset)
+        offset += FIELD.size * count
+        (length,) = FIELD.unpack_from(data, offset)
+        blob = data[offset + FIELD.size:offset + FIELD.size + length]
+        offset += FIELD.size + length
+
+        mailbox = []
+        start = 0
+        if version < 4:
+            blob = blob.decode(ENCODING)
+            for length in lengths:
+                mailbox.append(blob[start:start + length].encode(ENCODING))
+                start += length
+        else:
+            for length in lengths:
+                mailbox.append(blob[start:start + length])
+                start += length
+        state[username] = {'password': password, 'mailbox': mailbox, 'base': base}
+
+    groups = {}
+    if version >= 3:
+        (num_groups,) = FIELD.unpack_from(data, offset)
+        offset += FIELD.size
+        for _ in range(num_groups):
+            group, offset = unpack_string(data, view, offset)
+            (count,) = FIELD.unpack_from(data, offset)
+            offset += FIELD.size
+            members = set()
+            for _ in range(count):
+                username, offset = unpack_string(data, view, offset)
+                members.add(username)
+            groups[group] = members
+    return state, groups, last_segment
@@ -0,0 +1,616 @@
+'''
+This file implements the concurrent user store shared by the part 1 and part 2 servers.
+
+Accounts are spread over STRIPES shards by the hash of their username. Each shard is a plain
+dict guarded by its own lock, so threads working on different users rarely contend (unlike a
+single global lock), and every compound operation -- check-and-create, append, drain-and-swap,
+delete -- runs inside one critical section. A message appended while a mailbox is being drained
+therefore lands either in the drained batch or in the next one: never lost, never delivered twice.
+
+A sorted list of every username (the index) is kept up to date on create and delete, so listing
+a page of accounts -- optionally only those matching a prefix or glob pattern -- is a binary
+search plus the page, O(log n + page), instead of a walk over every account.
+
+Every queued message has a per-user sequence number: record.base is the number of mailbox[0]
+and the others follow, so numbers cost no memory per message. Messages can be drained (handed
+out and removed at once), or read by sequence number and removed only once the client
+acknowledges them, so a client that disconnects mid-delivery gets them again.
+
+Messages are queued as utf-8 encoded bytes, formatted ('<sender> text') and encoded once by the
+server that takes them in: a bytes object is 16 bytes smaller than the equivalent ASCII str, and
+the bytes go unchanged into the log, spill segments and part 1 sockets, and into part 2 responses
+(protobuf keeps string fields utf-8 encoded), so nothing encodes a message again on its way out.
+
+Named groups map to their members, kept partitioned by shard. A message sent to a group is
+formatted once and the same (immutable) bytes object is appended to every member's mailbox,
+under the locks of every shard holding a member (taken once each, in shard order) and logged as
+one record, so a broadcast to n members costs one message body plus n references, in memory and
+in the log.
+
+Mailboxes are bounded in memory (common/mailbox.py): after an append, a mailbox whose in-memory
+messages exceed the spill's per-user cap, or any mailbox of a shard over its share of the spill's
+memory budget, moves its in-memory messages to disk. Reads, acknowledgements and drains see one
+sequence of messages either way.
+
+Passwords are stored hashed (common/passwords.py). Hashing and checking run in the store's
+Passwords pool and return futures, so callers wait for them outside any shard lock, on their own
+terms (a thread blocks, a coroutine awaits, the selectors server is woken up).
+
+Log records are enqueued while holding the shard lock, so the write-ahead log sees each user's
+changes in the same order as memory; waiting for them to be durable (sync) happens after the
+lock is released, so one slow fsync never holds up the shard.
+
+Usage:
+    users = UserStore(wal)
+    ticket = users.append('alice', b'<bob> hi')
+    users.sync(ticket)
+'''
+# Import relevant python packages
+from bisect import bisect_left, bisect_right, insort
+from collections import defaultdict
+from fnmatch import fnmatchcase
+from sys import intern
+from threading import Condition, Lock
+
+from common.mailbox import MESSAGE_OVERHEAD, MIN_SPILL, Mailbox
+from common.passwords import Passwords
+from common.wal import NullLog
+
+# Constants/configurations
+STRIPES   = 64 # number of shards (independent locks)
+PAGE_SIZE = 100 # usernames per page when the caller does not say
+MAX_PAGE  = 1000 # largest page a caller may ask for
+MAX_SCAN  = 10000 # index entries a glob search may skip per page before returning a short page
+WILDCARDS = '*?[' # characters that make a search string a glob pattern
+
+MAILBOX_CHUNK = 64 * 1024 # bytes of queued messages handed out per chunk when replaying a mailbox
+
+# Split messages into consecutive runs of at most chunk_size bytes (a longer message gets a run of its own)
+def chunk_messages(messages, chunk_size=MAILBOX_CHUNK):
+    chunk = []
+    size = 0
+    for message in messages:
+        if chunk and size + len(message) > chunk_size:
+            yield chunk
+            chunk = []
+            size = 0
+        chunk.append(message)
+        size += len(message)
+    if chunk:
+        yield chunk
+
+class Shard:
+    '''
+    One stripe of the store
+        - lock: guards 'records' and the contents of every record in it
+        - records: key: username, value: record dict
+        - queued: messages in every mailbox of the shard, of which 'spilled' are on disk
+        - size: total length of the in-memory ones
+    '''
+    def __init__(self) -> None:
+        self.lock       = Lock()
+        self.records    = {}
+        self.queued     = 0
+        self.spilled    = 0
+        self.size       = 0
+
+    # Estimated bytes of the shard's in-memory messages (see common.mailbox)
+    def memory(self):
+        return self.size + MESSAGE_OVERHEAD * (self.queued - self.spilled)
+
+class Record:
+    '''
+    One account
+        - password: stored form of the password (see common/passwords.py)
+        - mailbox: Mailbox of queued messages
+        - base: sequence number of mailbox[0]
+        - notify: Condition on the shard lock that wait_read() callers sleep on (None until there is one)
+    Slotted: a record takes 64 bytes (plus 8 per extra field) instead of a 184+ byte dict.
+    '''
+    __slots__ = ('password', 'mailbox', 'base', 'notify')
+    defaults  = {} # extra fields of a subclass and their initial values
+
+    def __init__(self, password, mailbox, base=1) -> None:
+        self.password = password
+        self.mailbox  = mailbox
+        self.base     = base
+        self.notify   = None
+        for field, value in self.defaults.items():
+            setattr(self, field, value)
+
+# Record class with a slot for each extra field (key: name, value: initial value)
+def record_type(fields):
+    if not fields:
+        return Record
+    return type('Record', (Record,), {'__slots__': tuple(fields), 'defaults': dict(fields)})
+
+class UserStore:
+    '''
+    Sharded map of username -> record with atomic mailbox operations
+        - wal: write-ahead log (NullLog if none); the store starts from the state it replays
+        - spill: common.mailbox.Spill that large mailboxes spill to (None: mailboxes stay in memory)
+        - passwords: common.passwords.Passwords hashing and checking passwords (by default on the calling thread)
+        - shards: STRIPES shards; a username always maps to the same one
+        - index: every username, sorted; guarded by index_lock (taken after a shard lock, never before)
+        - groups: key: group name, value: {shard index: set of members in that shard}; guarded by group_lock
+          (taken before a shard lock, never after)
+    A record is a Record, plus any extra fields a server keeps per user (e.g. part 1's 'sessions'),
+    given as keyword arguments with their initial values; they become slots of a Record subclass.
+    Usernames are interned when their account is created (or replayed) and when they join a group,
+    so the shard dicts, the index and the groups share one str per user.
+    '''
+    def __init__(self, wal=None, stripes=STRIPES, spill=None, passwords=None, **fields) -> None:
+        self.wal        = wal or NullLog()
+        self.spill      = spill
+        self.passwords  = passwords or Passwords(workers=0)
+        self.shards     = [Shard() for _ in range(stripes)]
+        self.index_lock = Lock()
+        self.record     = record_type(fields)
+        state = self.wal.load_state()
+        for username, state_record in state.items():
+            username = intern(username)
+            shard = self.shard(username)
+            mailbox = Mailbox(state_record['mailbox'], spill)
+            shard.records[username] = self.record(state_record['password'], mailbox, state_record['base'])
+            shard.queued += len(mailbox)
+            shard.size += mailbox.size
+            if spill is not None and mailbox.memory() > spill.user_cap:
+                self.spill_mailbox(shard, mailbox)
+        self.index = sorted(map(intern, state))
+        # Then the largest mailboxes until the replayed ones fit the memory budget
+        if spill is not None:
+            mailboxes = sorted(((shard, record.mailbox) for shard in self.shards for record in shard.records.values()),
+                               key=lambda pair: pair[1].memory(), reverse=True)
+            for shard, mailbox in mailboxes:
+                if self.memory() <= spill.budget or mailbox.memory() < MIN_SPILL:
+                    break
+                self.spill_mailbox(shard, mailbox)
+        self.group_lock = Lock()
+        self.groups     = {}
+        for group, members in self.wal.load_groups().items():
+            for username in members:
+                self.groups.setdefault(group, {}).setdefault(self.shard_index(username), set()).add(intern(username))
+
+    def shard_index(self, username):
+        return hash(username) % len(self.shards)
+
+    def shard(self, username):
+        return self.shards[self.shard_index(username)]
+
+    def __contains__(self, username):
+        shard = self.shard(username)
+        with shard.lock:
+            return username in shard.records
+
+    def __len__(self):
+        return sum(len(shard.records) for shard in self.shards)
+
+    # (messages, bytes) queued over every mailbox (bytes of the in-memory messages only); read
+    # without locks, so only approximate while mailboxes change, but O(STRIPES) however many messages
+    # there are (for metrics)
+    def queued(self):
+        return sum(shard.queued for shard in self.shards), sum(shard.size for shard in self.shards)
+
+    # (messages, bytes) spilled to disk, approximate like queued()
+    def spilled(self):
+        return sum(shard.spilled for shard in self.shards), self.spill.bytes if self.spill is not None else 0
+
+    # Estimated bytes of every in-memory message (see common.mailbox), approximate like queued()
+    def memory(self):
+        return sum(shard.memory() for shard in self.shards)
+
+    # Spill mailbox if it is over the per-user cap, or its shard is over its share of the memory budget
+    # (usernames hash evenly, so that keeps the store within budget without summing every shard on each
+    # append); caller holds the shard lock
+    def check_spill(self, shard, mailbox):
+        if self.spill is None:
+            return
+        memory = mailbox.memory()
+        if memory > self.spill.user_cap or (memory >= MIN_SPILL and shard.memory() * len(self.shards) > self.spill.budget):
+            self.spill_mailbox(shard, mailbox)
+
+    # Move mailbox's in-memory messages to disk (caller holds the shard lock)
+    def spill_mailbox(self, shard, mailbox):
+        size, count = mailbox.spill_out()
+        shard.size -= size
+        shard.spilled += count
+
+    # All usernames, sorted
+    def usernames(self):
+        with self.index_lock:
+            return list(self.index)
+
+    # One page of usernames in sorted order, starting after cursor (the next_cursor of the previous
+    # page, '' for the first), keeping those that start with prefix and match the glob pattern.
+    # Returns (usernames, next_cursor); next_cursor is '' once there are no more pages.
+    def page(self, prefix='', pattern='', cursor='', limit=PAGE_SIZE):
+        limit = min(max(1, limit or PAGE_SIZE), MAX_PAGE)
+        # Everything before the pattern's first wildcard is a prefix too, and narrows the search
+        if pattern:
+            literal = pattern
+            for wildcard in WILDCARDS:
+                literal = literal.split(wildcard, 1)[0]
+            if literal.startswith(prefix):
+                prefix = literal
+            elif not prefix.startswith(literal):
+                return [], ''
+
+        names = []
+        with self.index_lock:
+            position = bisect_right(self.index, cursor) if cursor > prefix else bisect_left(self.index, prefix)
+            scanned = 0
+            while position < len(self.index) and len(names) < limit and scanned < MAX_SCAN:
+                username = self.index[position]
+                if not username.startswith(prefix):
+                    return names, ''
+                if not pattern or fnmatchcase(username, pattern):
+                    names.append(username)
+                position += 1
+                scanned += 1
+            # More entries with the prefix may follow: resume after the last one looked at
+            if position < len(self.index) and self.index[position].startswith(prefix):
+                return names, self.index[position - 1]
+        return names, ''
+
+    # Wait for a log ticket to become durable (no-op for 0/None)
+    def sync(self, ticket):
+        if ticket:
+            self.wal.sync(ticket)
+
+    # Call callback() once ticket is durable, from the log's flusher (at once if there is nothing to wait for)
+    def on_durable(self, ticket, callback):
+        if ticket:
+            self.wal.on_durable(ticket, callback)
+        else:
+            callback()
+
+    # Add a new account with password in its stored form (hash_password); returns its log ticket,
+    # or None if the username is already taken
+    def create(self, username, password, **fields):
+        username = intern(username)
+        shard = self.shard(username)
+        with shard.lock:
+            if username in shard.records:
+                return None
+            record = shard.records[username] = self.record(password, Mailbox(spill=self.spill))
+            for field, value in fields.items():
+                setattr(record, field, value)
+            with self.index_lock:
+                insort(self.index, username)
+            return self.wal.log_create(username, password)
+
+    # Remove an account (and its mailbox); returns (ticket, connections): ticket is None if it did not
+    # exist, and connections is record[direct] (e.g. part 1's sessions, for the caller to close)
+    def delete(self, username, direct=None):
+        shard = self.shard(username)
+        with shard.lock:
+            record = shard.records.pop(username, None)
+            if record is None:
+                return None, None
+            connections = getattr(record, direct) if direct else None
+            mailbox = record.mailbox
+            shard.queued -= len(mailbox)
+            shard.spilled -= mailbox.spilled
+            shard.size -= mailbox.size
+            mailbox.release()
+            with self.index_lock:
+                del self.index[bisect_left(self.index, username)]
+            ticket = self.wal.log_delete(username)
+            # Wake the user's waiting streams so they notice the deletion
+            if record.notify is not None:
+                record.notify.notify_all()
+        # Leave every group (replaying the delete record does the same, so nothing more is logged)
+        index = self.shard_index(username)
+        with self.group_lock:
+            for group in [group for group, members in self.groups.items() if username in members.get(index, ())]:
+                self.remove_member(group, index, username)
+        return ticket, connections
+
+    # Future of the stored form of a new password (for create)
+    def hash_password(self, password):
+        return self.passwords.hash(password)
+
+    # Future of whether password is username's (False if the user does not exist)
+    def check_password(self, username, password):
+        return self.passwords.verify(self.get(username, 'password'), password)
+
+    # Set extra fields of a record; returns False if the user does not exist
+    def update(self, username, **fields):
+        shard = self.shard(username)
+        with shard.lock:
+            record = shard.records.get(username)
+            if record is None:
+                return False
+            for field, value in fields.items():
+                setattr(record, field, value)
+            return True
+
+    # record[field] of username (None if the user or the field does not exist)
+    def get(self, username, field):
+        shard = self.shard(username)
+        with shard.lock:
+            record = shard.records.get(username)
+            return None if record is None else getattr(record, field, None)
+
+    # Set record[field] to new only if it still holds old (e.g. clear a socket only if it is ours)
+    def replace(self, username, field, old, new):
+        shard = self.shard(username)
+        with shard.lock:
+            record = shard.records.get(username)
+            if record is None or getattr(record, field, None) is not old:
+                return False
+            setattr(record, field, new)
+            return True
+
+    # Queue message in username's mailbox, unless record[direct] holds a connection (or a non-empty
+    # tuple of them) to hand it to instead. Returns (ticket, connection): ticket is None if the user
+    # does not exist, and connection is set (with ticket 0) when the caller should deliver the message itself
+    def append(self, username, message, direct=None):
+        shard = self.shard(username)
+        with shard.lock:
+            record = shard.records.get(username)
+            if record is None:
+                return None, None
+            connection = getattr(record, direct) if direct else None
+            if connection:
+                return 0, connection
+            record.mailbox.append(message)
+            shard.queued += 1
+            shard.size += len(message)
+            self.check_spill(shard, record.mailbox)
+            ticket = self.wal.log_append(username, message)
+            if record.notify is not None:
+                record.notify.notify_all()
+            return ticket, None
+
+    # Queue a batch of (username, message) pairs, taking each shard's lock once for all of its messages.
+    # Returns (statuses, ticket): statuses[i] is False if the i-th recipient does not exist, and
+    # ticket covers every logged append
+    def append_many(self, messages):
+        by_shard = defaultdict(list)
+        for index, (username, _) in enumerate(messages):
+            by_shard[hash(username) % len(self.shards)].append(index)
+        statuses = [False] * len(messages)
+        ticket = 0
+        for shard_index, indexes in by_shard.items():
+            shard = self.shards[shard_index]
+            with shard.lock:
+                appended = []
+                woken = {}
+                for index in indexes:
+                    username, message = messages[index]
+                    record = shard.records.get(username)
+                    if record is None:
+                        continue
+                    record.mailbox.append(message)
+                    shard.queued += 1
+                    shard.size += len(message)
+                    self.check_spill(shard, record.mailbox)
+                    appended.append((username, message))
+                    statuses[index] = True
+                    if record.notify is not None:
+                        woken[username] = record.notify
+                if appended:
+                    ticket = max(ticket, self.wal.log_append_many(appended))
+                for notify in woken.values():
+                    notify.notify_all()
+        return statuses, ticket
+
+    # Create group with username as its first member; returns the log ticket, or None if the group exists
+    def create_group(self, group, username):
+        with self.group_lock:
+            if group in self.groups:
+                return None
+            self.groups[group] = {self.shard_index(username): {intern(username)}}
+            return self.wal.log_group_create(group, username)
+
+    # Add username to group; returns the log ticket (0 if it already was a member), or None if there is no such group
+    def join_group(self, group, username):
+        with self.group_lock:
+            members = self.groups.get(group)
+            if members is None:
+                return None
+            index = self.shard_index(username)
+            if username in members.get(index, ()):
+                return 0
+            members.setdefault(index, set()).add(intern(username))
+            return self.wal.log_group_join(group, username)
+
+    # Remove username from group (and the group once it is empty); returns the log ticket, or None if it was not a member
+    def leave_group(self, group, username):
+        with self.group_lock:
+            index = self.shard_index(username)
+            if username not in self.groups.get(group, {}).get(index, ()):
+                return None
+            self.remove_member(group, index, username)
+            return self.wal.log_group_leave(group, username)
+
+    # Caller holds group_lock
+    def remove_member(self, group, index, username):
+        members = self.groups[group]
+        members[index].discard(username)
+        if not members[index]:
+            del members[index]
+        if not members:
+            del self.groups[group]
+
+    def in_group(self, group, username):
+        with self.group_lock:
+            return username in self.groups.get(group, {}).get(self.shard_index(username), ())
+
+    # Sorted members of group (None if there is no such group)
+    def group_members(self, group):
+        with self.group_lock:
+            members = self.groups.get(group)
+            return None if members is None else sorted(username for usernames in members.values() for username in usernames)
+
+    # Sorted (group, number of members) pairs
+    def group_names(self):
+        with self.group_lock:
+            return sorted((group, sum(map(len, members.values()))) for group, members in self.groups.items())
+
+    # Queue message for every member of group except sender (who must be a member), as append_shared.
+    # Returns (ticket, queued, connections) as append_shared, or None if there is no such group or
+    # sender is not in it
+    def append_group(self, group, sender, message, direct=None):
+        with self.group_lock:
+            members = self.groups.get(group)
+            if members is None or sender not in members.get(self.shard_index(sender), ()):
+                return None
+            by_shard = sorted((index, [username for username in usernames if username != sender])
+                              for index, usernames in members.items())
+        return self.append_by_shard(by_shard, message, direct)
+
+    # Queue message for every user in usernames that exists: the same bytes object goes into each
+    # mailbox and they are logged as one record. The locks of the shards holding them are taken
+    # together, in shard order (the only place more than one shard lock is held), so the record is
+    # enqueued while every mailbox it touches is locked, like any other append. Users whose
+    # record[direct] holds connections (part 1 sessions) are handed back to the caller to deliver to
+    # instead. Returns (ticket, queued, connections): queued lists the users whose mailbox got the
+    # message, connections (username, record[direct]) pairs
+    def append_shared(self, message, usernames, direct=None):
+        by_shard = defaultdict(list)
+        for username in usernames:
+            by_shard[self.shard_index(username)].append(username)
+        return self.append_by_shard(sorted(by_shard.items()), message, direct)
+
+    # by_shard: sorted (shard index, usernames in that shard) pairs
+    def append_by_shard(self, by_shard, message, direct):
+        locks = [self.shards[index].lock for index, _ in by_shard]
+        for lock in locks:
+            lock.acquire()
+        try:
+            queued = []
+            connections = []
+            for index, usernames in by_shard:
+                shard = self.shards[index]
+                for username in usernames:
+                    record = shard.records.get(username)
+                    if record is None:
+                        continue
+                    connection = getattr(record, direct) if direct else None
+                    if connection:
+                        connections.append((username, connection))
+                        continue
+                    record.mailbox.append(message)
+                    shard.queued += 1
+                    shard.size += len(message)
+                    self.check_spill(shard, record.mailbox)
+                    queued.append(username)
+                    if record.notify is not None:
+                        record.notify.notify_all()
+            ticket = self.wal.log_append_shared(message, queued) if queued else 0
+        finally:
+            for lock in reversed(locks):
+                lock.release()
+        return ticket, queued, connections
+
+    # Atomically take every queued message and empty the mailbox (also setting extra fields, e.g.
+    # the socket of a user logging in, in the same step); returns None if the user does not exist
+    def drain(self, username, **fields):
+        shard = self.shard(username)
+        with shard.lock:
+            record = shard.records.get(username)
+            if record is None:
+                return None
+            for field, value in fields.items():
+                setattr(record, field, value)
+            return self.swap_mailbox(shard, username, record)
+
+    # Add connection to the tuple in record[field] (e.g. a user's logged in sessions) and take every
+    # queued message in the same step, like drain; returns None if the user does not exist
+    def attach(self, username, field, connection):
+        shard = self.shard(username)
+        with shard.lock:
+            record = shard.records.get(username)
+            if record is None:
+                return None
+            setattr(record, field, getattr(record, field) + (connection,))
+            return self.swap_mailbox(shard, username, record)
+
+    # Remove connection from the tuple in record[field]; returns False if it was not there
+    def detach(self, username, field, connection):
+        shard = self.shard(username)
+        with shard.lock:
+            record = shard.records.get(username)
+            if record is None or not any(other is connection for other in getattr(record, field)):
+                return False
+            setattr(record, field, tuple(other for other in getattr(record, field) if other is not connection))
+            return True
+
+    # Queued messages numbered after `after`, up to chunk_size bytes (at least one), without
+    # removing them; returns (sequence number of the first, messages), or None if the user does not exist
+    def read(self, username, after=0, chunk_size=MAILBOX_CHUNK):
+        shard = self.shard(username)
+        with shard.lock:
+            record = shard.records.get(username)
+            if record is None:
+                return None
+            return self.read_mailbox(record, after, chunk_size)
+
+    # Remove every queued message numbered up to seq (the client has them); returns False if the user does not exist
+    def ack(self, username, seq):
+        shard = self.shard(username)
+        with shard.lock:
+            record = shard.records.get(username)
+            if record is None:
+                return False
+            count = min(len(record.mailbox), seq + 1 - record.base)
+            if count > 0:
+                size, spilled = record.mailbox.drop(count)
+                shard.queued -= count
+                shard.spilled -= spilled
+                shard.size -= size
+                record.base += count
+                self.wal.log_drain(username, count)
+            return True
+
+    # Wake username's wait_read() callers so they check whether they were cancelled
+    def wake(self, username):
+        shard = self.shard(username)
+        with shard.lock:
+            record = shard.records.get(username)
+            if record is not None and record.notify is not None:
+                record.notify.notify_all()
+
+    # Number of queued messages, or None if the user does not exist
+    def pending(self, username):
+        shard = self.shard(username)
+        with shard.lock:
+            record = shard.records.get(username)
+            return None if record is None else len(record.mailbox)
+
+    # Block until username has a message numbered after `after` (or timeout, or until cancelled()
+    # is true after a wake()), then read() it; returns None once the user is deleted
+    def wait_read(self, username, after, timeout=None, chunk_size=MAILBOX_CHUNK, cancelled=None):
+        shard = self.shard(username)
+        with shard.lock:
+            record = shard.records.get(username)
+            if record is None:
+                return None
+            if record.notify is None:
+                record.notify = Condition(shard.lock)
+            record.notify.wait_for(lambda: record.base + len(record.mailbox) - 1 > after or
+                                      shard.records.get(username) is not record or
+                                      (cancelled is not None and cancelled()), timeout)
+            if shard.records.get(username) is not record:
+                return None
+            return self.read_mailbox(record, after, chunk_size)
+
+    # Messages numbered after `after`, up to chunk_size bytes (caller holds the shard lock)
+    def read_mailbox(self, record, after, chunk_size):
+        start = max(0, after + 1 - record.base)
+        return record.base + start, record.mailbox.read(start, chunk_size)
+
+    # Swap out a mailbox (caller holds the shard lock); the Mailbox returned can still be iterated
+    # (spilled messages are read from disk as it goes) but no longer holds their disk space
+    def swap_mailbox(self, shard, username, record):
+        mailbox, record.mailbox = record.mailbox, Mailbox(spill=self.spill)
+        if mailbox:
+            shard.queued -= len(mailbox)
+            shard.spilled -= mailbox.spilled
+            shard.size -= mailbox.size
+            mailbox.release()
+            record.base += len(mailbox)
+            self.wal.log_drain(username)
+        return mailbox
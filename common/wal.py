@@ -0,0 +1,466 @@
+'''
+This file implements the write-ahead log shared by the part 1 and part 2 servers.
+
+Every change to the 'users' map (account create/delete, mailbox append, mailbox drain) and to
+the groups (create, join, leave) is appended to a log file as one binary record:
+
+    type (1B) | payload length (4B) | crc32 of payload (4B) | payload
+
+where the payload is a sequence of length-prefixed utf-8 strings. Messages are already utf-8
+bytes in memory (see common/user_store.py), so they are copied in as they are and replayed as
+bytes. Writers only copy their
+record into an in-memory batch (cheap enough to do while holding a mailbox lock, which keeps
+log order equal to memory order) and get back a ticket. A background flusher thread waits
+up to `fsync_window` seconds for more writers to join the batch, writes it and fsyncs once;
+sync(ticket) blocks until the ticket's batch is durable, and on_durable(ticket, callback) calls
+back from the flusher once it is (for an event loop, which must not block). Many concurrent
+senders thus share each fsync (group commit) instead of paying one each.
+
+A message sent to a group is logged as one APPEND_SHARED record holding the message once and
+the members it was queued for, so the log (like memory) holds one copy of a broadcast rather
+than one per member.
+
+Servers wait for CREATE, DELETE, APPEND, APPEND_SHARED and group records to be durable before
+acknowledging them.
+DRAIN records are not waited on, so a crash within one fsync window can redeliver (but never
+lose) a message.
+
+The log is split into numbered segment files (PATH.000001, PATH.000002, ...). The flusher
+rolls to a new segment once the current one exceeds `segment_size`, and every
+`snapshot_interval` seconds. A compactor thread then folds the closed segments into the
+snapshot at PATH.snapshot (see common/snapshot.py) and deletes them. It rebuilds the state
+from the previous snapshot plus those segments, never from the live 'users' map, so senders
+are not paused while a snapshot is taken; they keep appending to the new segment.
+
+On restart, load_state() reads the snapshot and replays only the segments after it (stopping
+at the first torn or corrupt record) to rebuild every account and its undelivered mailbox,
+and every group.
+'''
+# Import relevant python packages
+import glob
+import heapq
+from itertools import count
+import os
+import struct
+from threading import Condition, Lock, Thread
+import time
+import zlib
+
+from common.snapshot import read_snapshot, write_snapshot
+
+# Constants/configurations
+ENCODING          = 'utf-8'
+FSYNC_WINDOW      = 0.002 # seconds the flusher waits for more writers before each fsync
+MAX_BATCH         = 1 << 20 # flush early once this many bytes are pending
+SEGMENT_SIZE      = 64 << 20 # roll to a new segment once the current one is this large
+SNAPSHOT_INTERVAL = 60.0 # seconds between snapshots (0 disables compaction)
+
+RECORD = struct.Struct('!BII') # type, payload length, crc32
+FIELD  = struct.Struct('!I') # length of one string field
+
+# Record types
+CREATE = 1 # username, password
+DELETE = 2 # username
+APPEND = 3 # username, message
+DRAIN  = 4 # username[, count] -- mailbox (or its first count messages) delivered/acknowledged and removed
+
+GROUP_CREATE  = 5 # group, username -- new group whose first member is username
+GROUP_JOIN    = 6 # group, username
+GROUP_LEAVE   = 7 # group, username -- the group is removed once its last member leaves
+APPEND_SHARED = 8 # message, username, ... -- the same message queued for each username
+
+MESSAGE_FIELD = {APPEND: 1, APPEND_SHARED: 0} # index of the field (bytes, not str) holding a message
+
+# Encode one record (fields are str, or bytes already encoded)
+def encode_record(record_type, *fields):
+    payload = bytearray()
+    for field in fields:
+        data = field if isinstance(field, bytes) else field.encode(ENCODING)
+        payload += FIELD.pack(len(data))
+        payload += data
+    return RECORD.pack(record_type, len(payload), zlib.crc32(payload)) + payload
+
+# Decode the fields of a record payload: str, except a message field (left as bytes)
+def decode_fields(record_type, payload):
+    fields = []
+    offset = 0
+    message = MESSAGE_FIELD.get(record_type)
+    while offset < len(payload):
+        (length,) = FIELD.unpack_from(payload, offset)
+        offset += FIELD.size
+        data = payload[offset:offset + length].tobytes()
+        fields.append(data if len(fields) == message else data.decode(ENCODING))
+        offset += length
+    return fields
+
+# Yield (record_type, fields, end_offset) for every intact record in the file at path
+def read_records(path, offset=0):
+    if not os.path.exists(path):
+        return
+    with open(path, 'rb') as log:
+        data = log.read()
+    view = memoryview(data)
+    while offset + RECORD.size <= len(data):
+        record_type, length, crc = RECORD.unpack_from(data, offset)
+        start = offset + RECORD.size
+        payload = view[start:start + length]
+        # Torn write at the tail (crash mid-append) or corruption: everything after is unusable
+        if len(payload) < length or zlib.crc32(payload) != crc:
+            return
+        offset = start + length
+        yield record_type, decode_fields(record_type, payload), offset
+
+# Apply one record to a state map (username -> {'password': str, 'mailbox': [bytes], 'base': int}),
+# where base is the sequence number of mailbox[0]: every append takes the next number, and
+# messages leaving the front of the mailbox advance base; and to groups (group -> set of usernames)
+def apply_record(state, groups, record_type, fields):
+    if record_type == CREATE:
+        state[fields[0]] = {'password': fields[1], 'mailbox': [], 'base': 1}
+    elif record_type == DELETE:
+        state.pop(fields[0], None)
+        for group in [group for group, members in groups.items() if fields[0] in members]:
+            leave_group(groups, group, fields[0])
+    elif record_type == APPEND:
+        if fields[0] in state:
+            state[fields[0]]['mailbox'].append(fields[1])
+    elif record_type == APPEND_SHARED:
+        # One bytes object shared by every mailbox, as in the live store
+        message = fields[0]
+        for username in fields[1:]:
+            if username in state:
+                state[username]['mailbox'].append(message)
+    elif record_type == GROUP_CREATE:
+        groups[fields[0]] = {fields[1]}
+    elif record_type == GROUP_JOIN:
+        if fields[0] in groups:
+            groups[fields[0]].add(fields[1])
+    elif record_type == GROUP_LEAVE:
+        leave_group(groups, fields[0], fields[1])
+    elif record_type == DRAIN:
+        if fields[0] in state:
+            record = state[fields[0]]
+            count = int(fields[1]) if len(fields) > 1 else len(record['mailbox'])
+            del record['mailbox'][:count]
+            record['base'] += count
+
+# Remove username from group, and the group once it has no members left
+def leave_group(groups, group, username):
+    members = groups.get(group)
+    if members is not None:
+        members.discard(username)
+        if not members:
+            del groups[group]
+
+# File holding segment number `segment` of the log at path
+def segment_path(path, segment):
+    return '{}.{:06d}'.format(path, segment)
+
+def snapshot_path(path):
+    return path + '.snapshot'
+
+# Numbers of the segment files of the log at path, oldest first
+def list_segments(path):
+    segments = []
+    for name in glob.glob(glob.escape(path) + '.[0-9]*'):
+        suffix = name[len(path) + 1:]
+        if suffix.isdigit():
+            segments.append(int(suffix))
+    return sorted(segments)
+
+# Replay one segment into state and groups; returns the end offset of its last intact record
+def replay_segment(state, groups, path, segment):
+    end = 0
+    for record_type, fields, end in read_records(segment_path(path, segment)):
+        apply_record(state, groups, record_type, fields)
+    return end
+
+# Load the snapshot and replay the segments after it:
+# returns (state, groups, segments replayed, end offset of the last intact record in the newest one)
+def load_state(path):
+    state, groups, last_segment = read_snapshot(snapshot_path(path))
+    segments = [segment for segment in list_segments(path) if segment > last_segment]
+    end = 0
+    for segment in segments:
+        end = replay_segment(state, groups, path, segment)
+    return state, groups, segments, end
+
+class NullLog:
+    '''
+    Log that persists nothing -- used when the server runs without --wal.
+    Same interface as WriteAheadLog so servers can call it unconditionally.
+    '''
+    def load_state(self):
+        return {}
+
+    def load_groups(self):
+        return {}
+
+    def log_create(self, username, password):
+        return 0
+
+    def log_delete(self, username):
+        return 0
+
+    def log_append(self, username, message):
+        return 0
+
+    def log_drain(self, username, count=None):
+        return 0
+
+    def log_append_many(self, appends):
+        return 0
+
+    def log_append_shared(self, message, usernames):
+        return 0
+
+    def log_group_create(self, group, username):
+        return 0
+
+    def log_group_join(self, group, username):
+        return 0
+
+    def log_group_leave(self, group, username):
+        return 0
+
+    def sync(self, ticket):
+        pass
+
+    def on_durable(self, ticket, callback):
+        callback()
+
+    def close(self):
+        pass
+
+class WriteAheadLog(NullLog):
+    '''
+    Segmented append-only log with group commit and background compaction
+        - path: prefix of the segment and snapshot files
+        - fsync_window: seconds the flusher lingers to batch more writers into one fsync
+        - segment_size: bytes after which the flusher rolls to a new segment
+        - snapshot_interval: seconds between rolls forced for compaction (0 disables compaction)
+        - pending: encoded records not yet written
+        - enqueued: ticket of the last record added to pending
+        - durable: ticket of the last record known to be on disk
+        - waiters: heap of (ticket, order, callback) of on_durable() calls waiting for their ticket
+        - fsyncs: number of batches written so far
+        - segment: number of the segment being appended to
+        - closed_segments: full segments waiting to be folded into the snapshot
+        - snapshots: number of snapshots written so far
+        - work/done/compact: conditions on one lock; writers wake the flusher via work,
+          the flusher wakes sync() callers via done and the compactor via compact
+    '''
+    def __init__(self, path, fsync_window=FSYNC_WINDOW, segment_size=SEGMENT_SIZE,
+                 snapshot_interval=SNAPSHOT_INTERVAL) -> None:
+        self.path              = path
+        self.fsync_window      = fsync_window
+        self.segment_size      = segment_size
+        self.snapshot_interval = snapshot_interval
+        self.lock              = Lock()
+        self.work              = Condition(self.lock)
+        self.done              = Condition(self.lock)
+        self.compact           = Condition(self.lock)
+        self.pending           = bytearray()
+        self.enqueued          = 0
+        self.durable           = 0
+        self.waiters           = []
+        self.waiter_order      = count()
+        self.fsyncs            = 0
+        self.snapshots         = 0
+        self.roll_requested    = False
+        self.closed            = False
+
+        # Keep appending to the newest segment, dropping a torn tail left by a crash
+        self.state, self.groups, segments, end = load_state(path)
+        if segments:
+            self.segment = segments[-1]
+            self.closed_segments = segments[:-1]
+        else:
+            self.segment = read_snapshot(snapshot_path(path))[2] + 1
+            self.closed_segments = []
+        self.file = open(segment_path(path, self.segment), 'ab')
+        if self.file.tell() != end:
+            self.file.truncate(end)
+            self.file.seek(end)
+
+        self.flusher = Thread(target=self.flush_loop, name='wal-flusher', daemon=True)
+        self.flusher.start()
+        self.compactor = None
+        if snapshot_interval > 0:
+            self.compactor = Thread(target=self.compact_loop, name='wal-compactor', daemon=True)
+            self.compactor.start()
+
+    # State rebuilt from the snapshot and log when it was opened; handed over once, so the log keeps
+    # no reference to mailboxes the store later trims or spills
+    def load_state(self):
+        state, self.state = self.state, {}
+        return state
+
+    # Groups rebuilt from the snapshot and log when it was opened (group -> set of usernames)
+    def load_groups(self):
+        return self.groups
+    # Add an encoded record to the current batch; returns its ticket
+    def enqueue(self, record):
+        with self.lock:
+            self.pending += record
+            self.enqueued += 1
+            self.work.notify()
+            return self.enqueued
+
+    # Add several encoded records at once; returns the ticket of the last one
+    def enqueue_many(self, records):
+        with self.lock:
+            for record in records:
+                self.pending += record
+            self.enqueued += len(records)
+            self.work.notify()
+            return self.enqueued
+
+    def log_create(self, username, password):
+        return self.enqueue(encode_record(CREATE, username, password))
+
+    def log_delete(self, username):
+        return self.enqueue(encode_record(DELETE, username))
+
+    def log_append(self, username, message):
+        return self.enqueue(encode_record(APPEND, username, message))
+
+    # count: only the first count messages were taken (None: the whole mailbox)
+    def log_drain(self, username, count=None):
+        if count is None:
+            return self.enqueue(encode_record(DRAIN, username))
+        return self.enqueue(encode_record(DRAIN, username, str(count)))
+
+    # Log (username, message) mailbox appends in one go
+    def log_append_many(self, appends):
+        return self.enqueue_many([encode_record(APPEND, username, message) for username, message in appends])
+
+    # Log one message queued for every username in usernames (the message is written once)
+    def log_append_shared(self, message, usernames):
+        return self.enqueue(encode_record(APPEND_SHARED, message, *usernames))
+
+    def log_group_create(self, group, username):
+        return self.enqueue(encode_record(GROUP_CREATE, group, username))
+
+    def log_group_join(self, group, username):
+        return self.enqueue(encode_record(GROUP_JOIN, group, username))
+
+    def log_group_leave(self, group, username):
+        return self.enqueue(encode_record(GROUP_LEAVE, group, username))
+
+    # Block until the record with this ticket is durable
+    def sync(self, ticket):
+        with self.lock:
+            while self.durable < ticket and not self.closed:
+                self.done.wait()
+
+    # Call callback() once the record with this ticket is durable: at once if it already is (or the
+    # log is closed), otherwise on the flusher thread right after its fsync, so it must not block
+    def on_durable(self, ticket, callback):
+        with self.lock:
+            if self.durable < ticket and not self.closed:
+                heapq.heappush(self.waiters, (ticket, next(self.waiter_order), callback))
+                return
+        callback()
+
+    # Take the waiters whose ticket is durable (every one if everything); called with the lock held
+    def ready_waiters(self, everything=False):
+        ready = []
+        while self.waiters and (everything or self.waiters[0][0] <= self.durable):
+            ready.append(heapq.heappop(self.waiters)[2])
+        return ready
+
+    # Background thread: write and fsync pending records in batches, rolling segments as requested
+    def flush_loop(self):
+        while True:
+            with self.lock:
+                while not self.pending and not self.roll_requested and not self.closed:
+                    self.work.wait()
+                if self.closed and not self.pending:
+                    ready = self.ready_waiters(everything=True) # like sync(), they stop waiting
+                    break
+                # Group commit window: let more writers join this batch
+                deadline = time.monotonic() + self.fsync_window
+                while self.pending and len(self.pending) < MAX_BATCH and not self.closed:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.work.wait(remaining)
+                batch, self.pending = self.pending, bytearray()
+                ticket = self.enqueued
+                roll, self.roll_requested = self.roll_requested, False
+
+            if batch:
+                self.file.write(batch)
+                self.file.flush()
+                os.fsync(self.file.fileno())
+            roll = (roll or self.file.tell() >= self.segment_size) and self.file.tell() > 0
+            if roll:
+                self.file.close()
+                self.file = open(segment_path(self.path, self.segment + 1), 'ab')
+
+            with self.lock:
+                self.durable = ticket
+                if batch:
+                    self.fsyncs += 1
+                if roll:
+                    self.closed_segments.append(self.segment)
+                    self.segment += 1
+                    self.compact.notify()
+                self.done.notify_all()
+                ready = self.ready_waiters()
+            for callback in ready:
+                callback()
+        for callback in ready:
+            callback()
+
+    # Ask the flusher to start a new segment, so everything logged so far can be compacted
+    def roll(self):
+        with self.lock:
+            self.roll_requested = True
+            self.work.notify()
+
+    # Fold every closed segment into the snapshot, then delete them
+    def compact_segments(self):
+        with self.lock:
+            segments = list(self.closed_segments)
+        if not segments:
+            return
+        state, groups, last_segment = read_snapshot(snapshot_path(self.path))
+        for segment in segments:
+            if segment > last_segment:
+                replay_segment(state, groups, self.path, segment)
+        write_snapshot(snapshot_path(self.path), state, segments[-1], groups)
+        # The snapshot is durable: the segments it covers are no longer needed
+        for segment in segments:
+            os.remove(segment_path(self.path, segment))
+        with self.lock:
+            self.closed_segments = self.closed_segments[len(segments):]
+            self.snapshots += 1
+
+    # Background thread: snapshot when a segment fills up, and every snapshot_interval seconds
+    def compact_loop(self):
+        deadline = time.monotonic() + self.snapshot_interval
+        while True:
+            with self.lock:
+                while not self.closed_segments and not self.closed:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.compact.wait(remaining)
+                if self.closed:
+                    return
+            if time.monotonic() >= deadline:
+                deadline = time.monotonic() + self.snapshot_interval
+                self.roll()
+            self.compact_segments()
+
+    # Flush everything still pending and stop the background threads
+    def close(self):
+        with self.lock:
+            self.closed = True
+            self.work.notify()
+            self.compact.notify()
+        self.flusher.join()
+        if self.compactor is not None:
+            self.compactor.join()
+        self.file.close()
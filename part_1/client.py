@@ -1,26 +1,37 @@
 '''
 This file implements client functionality of chat application.
 
-Usage: python3 client.py IP_ADDRESS
+Usage: python3 client.py IP_ADDRESS [--text]
+
+By default the client speaks the length-prefixed framed protocol through the client library
+(sdk.py): each line typed answers the prompt the server waits on, and messages from other users
+are printed as they arrive. --text keeps the original free-form text protocol.
 '''
 # Import relevant python packages
+import os
 from select import select
 from socket import socket, AF_INET, SOCK_STREAM
 import sys
+from threading import Thread
+
+from protocol import ProtocolError
+from sdk import Client
 
 # Constants/configurations
 ENCODING    = 'utf-8' # message encoding
 BUFFER_SIZE = 2048 # fixed 2KB buffer size
 PORT        = 1234 # fixed application port
 
-# Main function for client functionality
-def main():
-    # Get IP address and port number of server socket
-    if len(sys.argv) != 2:
-        print('Usage: python3 client.py IP_ADDRESS')
-        sys.exit('client.py exiting')
-    ip_address = str(sys.argv[1])
+# Print messages from other users as they arrive; the connection closing ends the application
+def message_thread(client, ip_address):
+    for message in client.subscribe():
+        print(message)
+    print('Server @ {}:{} disconnected!'.format(ip_address, PORT))
+    print('Closing application.')
+    os._exit(1)
 
+# Original text protocol: relay stdin to the server and print whatever it sends
+def text_client(ip_address):
     # Creates client socket with IPv4 and TCP
     client = socket(family=AF_INET, type=SOCK_STREAM)
     # Connect to server socket
@@ -53,5 +64,39 @@ def main():
                 else:
                     print(message.decode(encoding=ENCODING))
 
+# Main function for client functionality
+def main():
+    # Get IP address and port number of server socket
+    if len(sys.argv) not in (2, 3) or (len(sys.argv) == 3 and sys.argv[2] != '--text'):
+        print('Usage: python3 client.py IP_ADDRESS [--text]')
+        sys.exit('client.py exiting')
+    ip_address = str(sys.argv[1])
+    if len(sys.argv) == 3:
+        text_client(ip_address)
+        return
+
+    # Connect and negotiate the framed protocol (no timeout: the user takes as long as they like)
+    try:
+        client = Client(ip_address, PORT, timeout=None)
+    except ProtocolError as error:
+        print('Could not negotiate framed protocol ({}). Retry with --text.'.format(error))
+        sys.exit('Closing application.')
+    print('Successfully connected to server @ {}:{}'.format(ip_address, PORT))
+    thread = Thread(target=message_thread, args=(client, ip_address), daemon=True)
+    thread.start()
+
+    # Answer one prompt per line; the server's reply and next prompt come back together
+    print(client.prompt)
+    for line in sys.stdin:
+        reply, prompt = client.answer(line.rstrip('\n'))
+        for text in reply:
+            print(text)
+        if prompt is None:
+            break
+        print(prompt)
+    client.close()
+    # The message thread ends the application once the connection is closed
+    thread.join()
+
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
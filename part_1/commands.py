@@ -0,0 +1,97 @@
+'''
+This file implements the command mode of the part 1 framed protocol (see protocol.py).
+
+The prompt flow needs a round trip per prompt: sending one message takes four (menu choice,
+recipient, text, then the confirmation and the next menu). In command mode a client sends
+complete commands instead, each a COMMAND frame holding the command and its fields, one per line
+(the last field may contain newlines):
+
+    CREATE username password    create an account and log in with it
+    LOGIN username password     log in; the backlog comes first, in text frames with the same id
+    SEND dst_username text      send text to dst_username
+    GSEND group text            send text to every other member of group
+    GROUP command               create NAME, join NAME, leave NAME, or list
+    LIST [search]               every username (or those matching a prefix/glob pattern), in text frames
+    DELETE                      delete the account; the server closes the connection
+
+Each one is answered by a RESULT frame carrying its request id, so a client can write many
+commands at once without waiting. Both server modes run every command already received before
+writing any result, then write all of them at once.
+
+Usage:
+    verb, fields = parse_command(b'SEND\\nbob\\nhi there') # ('SEND', ['bob', 'hi there'])
+'''
+# Import relevant python packages
+from common.user_store import MAX_PAGE
+
+# Constants/configurations
+ENCODING = 'utf-8' # message encoding
+
+# Commands
+CREATE = 'CREATE'
+LOGIN  = 'LOGIN'
+SEND   = 'SEND'
+GSEND  = 'GSEND'
+GROUP  = 'GROUP'
+LIST   = 'LIST'
+DELETE = 'DELETE'
+
+FIELDS    = {CREATE: 2, LOGIN: 2, SEND: 2, GSEND: 2, GROUP: 1, LIST: 1, DELETE: 0} # fields of each command
+OPTIONAL  = {LIST} # commands whose fields may be left out
+ANONYMOUS = {CREATE, LOGIN} # the only commands allowed before logging in (and not after)
+
+GROUP_ACTIONS = {'create': 'Created group {}', 'join': 'Joined group {}', 'leave': 'Left group {}'}
+GROUP_ERRORS  = {'create': 'Group {} already exists!', 'join': 'Group {} does not exist!',
+                 'leave': 'You are not in group {}!'}
+
+# A command the server refuses; its message goes back in an error RESULT
+class CommandError(Exception):
+    pass
+
+# Split a COMMAND payload into (command, fields); raises CommandError if it is malformed
+def parse_command(payload):
+    verb, _, rest = str(payload, ENCODING, 'replace').partition('\n')
+    count = FIELDS.get(verb)
+    if count is None:
+        raise CommandError('Unknown command {}'.format(verb))
+    fields = rest.split('\n', count - 1) if count and (rest or verb not in OPTIONAL) else []
+    if len(fields) < count and verb in OPTIONAL:
+        fields += [''] * (count - len(fields))
+    if len(fields) != count:
+        raise CommandError('{} takes {} field(s)'.format(verb, count))
+    return verb, fields
+
+# Refuse commands that need a login before it (or a second login); username is None until then, and
+# session is False once the connection is no longer one of the user's sessions (its account was deleted)
+def check_login(verb, username, session=True):
+    if username is None and verb not in ANONYMOUS:
+        raise CommandError('Not logged in.')
+    if username is not None and not session:
+        raise CommandError('Account {} no longer exists.'.format(username))
+    if username is not None and verb in ANONYMOUS:
+        raise CommandError('Already logged in as {}.'.format(username))
+
+# Usernames starting with prefix and matching pattern, one newline-terminated name per line, a
+# page (one text frame) at a time
+def user_pages(users, prefix, pattern):
+    cursor = ''
+    while True:
+        usernames, cursor = users.page(prefix, pattern, cursor, MAX_PAGE)
+        if usernames:
+            yield ''.join(username + '\n' for username in usernames)
+        if not cursor:
+            return
+
+# Run a GROUP command for username; returns (text, log ticket) or raises CommandError
+def group_request(users, username, command):
+    action, _, group = command.strip().partition(' ')
+    group = group.strip()
+    if action == 'list':
+        return ''.join('{} ({} members)\n'.format(name, count) for name, count in users.group_names()), 0
+    if action not in GROUP_ACTIONS or not group:
+        raise CommandError('{} is not a valid group command.'.format(command.strip()))
+    request = {'create': users.create_group, 'join': users.join_group, 'leave': users.leave_group}[action]
+    ticket = request(group, username)
+    if ticket is None:
+        raise CommandError(GROUP_ERRORS[action].format(group))
+    return GROUP_ACTIONS[action].format(group), ticket
@@ -0,0 +1,147 @@
+'''
+This file implements idle connection detection for both part 1 server modes.
+
+The servers used to notice a dead client only when a recv returned nothing or a send failed, so
+a client that hung (a stopped process, a machine gone off the network) kept its socket, its
+thread and its sessions until the server restarted. Now every socket gets TCP keepalive (the
+kernel probes a silent peer and resets the connection if its host stopped answering), and
+framed clients that set FLAG_HEARTBEAT are watched by the server itself:
+    - after `interval` seconds without input, the server sends a PING (the client's PONG, or any
+      other input, counts as input)
+    - after `idle_timeout` seconds without input, the connection is reaped: the threaded server
+      shuts the socket down so its own thread cleans up, the selector server removes it at once
+A hung process still has a healthy kernel behind it, which answers keepalive probes, so only the
+heartbeat finds it. The selector server also reaps connections that have not logged in after
+`idle_timeout` seconds (the threaded server's handshake timeout does that there).
+
+Deadlines live in a hashed timer wheel: scheduling is an append to one slot, and each tick takes
+the slots of the ticks that passed whole, so the cost per connection is O(1) per interval however
+many are connected (no deadline is ever more than an interval ahead, so the wheel is made one
+interval long and never holds a deadline for a later round). Input does not touch the wheel: it
+just updates the connection's last_input time, and a connection that turns out to have been
+active when its deadline comes is put back for last_input + interval. A connection is reaped at most one tick after its
+idle_timeout ran out.
+
+Usage:
+    heartbeat = Heartbeat(interval=30, idle_timeout=90)
+    heartbeat.watch(conn) # any thread; conn.last_input is a time.monotonic() value
+    heartbeat.run(time.monotonic(), alive, ping, reap) # every heartbeat.tick seconds
+'''
+# Import relevant python packages
+from collections import deque
+from socket import IPPROTO_TCP, SOL_SOCKET, SO_KEEPALIVE
+import socket
+import time
+
+# Constants/configurations
+HEARTBEAT    = 30.0 # seconds without input before a client is pinged
+IDLE_TIMEOUT = 90.0 # seconds without input before a client is dropped
+TICK         = 1.0 # longest resolution of the timer wheel (seconds)
+PROBES       = 3 # unanswered keepalive probes before the kernel resets a connection
+
+class TimerWheel:
+    '''
+    Hashed timer wheel, for deadlines less than size - 1 ticks ahead
+        - tick: seconds covered by one slot
+        - slots: items by deadline; slot i holds those of tick i % size
+        - current: first tick whose slot has not expired yet (never moves backwards)
+        - count: items on the wheel
+    An item expires once the tick of its deadline has passed, so at most one tick late.
+    '''
+    def __init__(self, tick, size, now=None) -> None:
+        self.tick    = tick
+        self.slots   = [[] for _ in range(size)]
+        self.current = int((time.monotonic() if now is None else now) / tick)
+        self.count   = 0
+
+    # Put item on the wheel for deadline (a deadline already past expires with the current tick)
+    def schedule(self, item, deadline):
+        index = max(int(deadline / self.tick), self.current)
+        self.slots[index % len(self.slots)].append(item)
+        self.count += 1
+
+    # Take the items of every tick that ended by now off the wheel, in no particular order
+    def expire(self, now):
+        last = int(now / self.tick)
+        due = []
+        # A late call takes every slot once, never one twice
+        for index in range(self.current, min(last, self.current + len(self.slots))):
+            slot = index % len(self.slots)
+            if self.slots[slot]:
+                due += self.slots[slot]
+                self.slots[slot] = []
+        self.current = max(self.current, last)
+        self.count -= len(due)
+        return due
+
+    def __len__(self):
+        return self.count
+
+class Heartbeat:
+    '''
+    Idle detection of one server's connections
+        - interval: seconds without input before a connection is pinged
+        - idle_timeout: seconds without input before it is reaped
+        - tick: seconds between two runs (the resolution of the wheel)
+        - wheel: TimerWheel of the watched connections, by the time they need looking at
+        - incoming: connections to put on the wheel at the next run (deque appends need no lock,
+          so any thread may watch a connection)
+        - pings, reaped: PINGs sent and connections reaped so far
+    '''
+    def __init__(self, interval=HEARTBEAT, idle_timeout=IDLE_TIMEOUT) -> None:
+        self.interval     = interval
+        self.idle_timeout = max(idle_timeout, interval)
+        self.tick         = min(TICK, interval / 4)
+        self.wheel        = TimerWheel(self.tick, int(interval / self.tick) + 3)
+        self.incoming     = deque()
+        self.pings        = 0
+        self.reaped       = 0
+
+    # Start watching conn (it needs a last_input attribute)
+    def watch(self, conn):
+        self.incoming.append(conn)
+
+    # Connections watched (including those not on the wheel yet)
+    def __len__(self):
+        return len(self.wheel) + len(self.incoming)
+
+    # Look at the connections due by now: alive(conn) says whether it is still connected and
+    # watched (it is forgotten otherwise), ping(conn) sends it a PING, reap(conn) drops it
+    def run(self, now, alive, ping, reap):
+        while self.incoming:
+            conn = self.incoming.popleft()
+            self.wheel.schedule(conn, conn.last_input + self.interval)
+        wheel, interval = self.wheel, self.interval
+        for conn in wheel.expire(now):
+            last_input = conn.last_input
+            idle = now - last_input
+            # Active since it was scheduled (the common case): look again an interval after its last input.
+            # A closed connection stays on the wheel until then
+            if idle < interval:
+                wheel.schedule(conn, last_input + interval)
+                continue
+            if not alive(conn):
+                continue
+            if idle >= self.idle_timeout:
+                self.reaped += 1
+                reap(conn)
+                continue
+            ping(conn)
+            self.pings += 1
+            # Ping again an interval later, unless it is reaped before that
+            self.wheel.schedule(conn, min(conn.last_input + self.idle_timeout, now + self.interval))
+
+# Turn on TCP keepalive for sock: the kernel probes a peer silent for interval seconds and resets
+# the connection once PROBES probes in a row went unanswered (or data stayed unacknowledged for
+# idle_timeout seconds). Options the platform lacks are skipped
+def keepalive(sock, interval=HEARTBEAT, idle_timeout=IDLE_TIMEOUT):
+    sock.setsockopt(SOL_SOCKET, SO_KEEPALIVE, 1)
+    probe = max(1, int(interval / PROBES))
+    for name, value in (('TCP_KEEPIDLE', max(1, int(interval))), ('TCP_KEEPALIVE', max(1, int(interval))),
+                        ('TCP_KEEPINTVL', probe), ('TCP_KEEPCNT', PROBES),
+                        ('TCP_USER_TIMEOUT', int(idle_timeout * 1000))):
+        if hasattr(socket, name):
+            try:
+                sock.setsockopt(IPPROTO_TCP, getattr(socket, name), value)
+            except OSError:
+                pass
@@ -0,0 +1,323 @@
+'''
+This file implements the bounded per-recipient outbound queues of the threaded server mode.
+
+Delivering to an online user used to write to its socket on the sender's thread, so a
+recipient that stopped reading (a full TCP receive window) blocked the sender, and every
+later message the sender tried to send. Now every logged in client has an OutboundQueue:
+senders only enqueue, and one writer thread per recipient moves the queue onto its socket,
+giving up on a write that takes longer than the send timeout. When a queue is full, the
+policy decides what happens to the new message:
+    - drop:       discard it (the sender is told)
+    - spill:      queue it in the recipient's mailbox instead, for its next login
+    - disconnect: close the recipient's connection; the message and everything still queued
+                  go to its mailbox, unless the user has another session (which got them too)
+A recipient whose write times out is disconnected the same way. A user logged in from several
+clients has a queue per session, and deliver() puts each message into all of them;
+deliver_group() does the same for every member of a group, every queue and mailbox holding a
+reference to the one message (utf-8 bytes, written to the socket as they are).
+
+OutboundQueue keeps the socket send/recv interface (like FramedSocket), so the prompt-driven
+handshake and chatroom code run on it unchanged. Their own writes take the same lock as the
+writer, so a delivered message never lands in the middle of a prompt or frame. The heartbeat
+thread (heartbeat.py) pings a silent client through the queue and reaps it with the same
+shutdown as a stalled one.
+'''
+# Import relevant python packages
+from collections import deque
+import select
+from socket import MSG_DONTWAIT, SHUT_RDWR, timeout
+from threading import Condition, Lock, Thread
+import time
+
+from protocol import OP_PING, OP_TEXT, FramedSocket, pack_header
+from registry import SESSIONS
+
+# Constants/configurations
+OUTBOUND_QUEUE = 256 # messages queued per recipient before the policy applies
+SEND_TIMEOUT   = 5.0 # seconds one message may take to write before the recipient counts as stalled
+POLICIES       = ['drop', 'spill', 'disconnect']
+POLICY         = 'spill'
+
+# What OutboundQueue.put did with a message
+QUEUED       = 'queued'
+DROPPED      = 'dropped'
+SPILLED      = 'spilled'
+DISCONNECTED = 'disconnected'
+CLOSED       = 'closed' # the connection is gone: the caller should queue the message in the mailbox
+
+# Hand message to every logged in session of username, or queue it in its mailbox if there is none.
+# Returns (outcome, ticket): outcome is what the sessions did with it -- QUEUED if any session took it,
+# else DISCONNECTED or DROPPED -- or None if it went to the mailbox, with ticket the log ticket of the
+# mailbox append (None if the user does not exist). Messages a disconnected session still had queued
+# go to the mailbox only if the user has no other session left (see OutboundQueue.close)
+def deliver(users, username, message):
+    ticket, sessions = users.append(username, message, direct=SESSIONS)
+    if not sessions:
+        return None, ticket
+    outcomes = [session.put(username, message) for session in sessions]
+    for outcome in (QUEUED, DISCONNECTED, DROPPED):
+        if outcome in outcomes:
+            return outcome, 0
+    # Every queue was full (spill policy) or every session went away: fall back to the mailbox
+    ticket, _ = users.append(username, message)
+    return None, ticket
+
+# Hand message to every other member of group (sender must be a member): the sessions of online
+# members, the mailboxes of the others (see UserStore.append_group). Returns (ticket, queued, mailed):
+# the log ticket to sync, the number of members whose sessions took the message and of those it was
+# queued for in the mailbox (members whose every queue dropped it are in neither); None if there is
+# no such group or sender is not in it
+def deliver_group(users, group, sender, message):
+    result = users.append_group(group, sender, message, direct=SESSIONS)
+    if result is None:
+        return None
+    ticket, mailed, online = result
+    queued = 0
+    for username, sessions in online:
+        outcomes = [session.put(username, message) for session in sessions]
+        if QUEUED in outcomes or DISCONNECTED in outcomes:
+            queued += 1
+            continue
+        if DROPPED in outcomes:
+            continue
+        # Same fallback as deliver(): every queue spilled or went away
+        append_ticket, _ = users.append(username, message)
+        if append_ticket is not None:
+            ticket = max(ticket, append_ticket)
+            mailed.append(username)
+    return ticket, queued, len(mailed)
+
+class OutboundStats:
+    '''
+    Direct delivery metrics for the threaded server
+        - depth: messages currently queued over every outbound queue
+        - max_depth: deepest any one queue has been
+        - delivered: messages written to their recipient
+        - dropped, spilled, disconnected: outcomes of puts into a full queue
+        - timed_out: recipients disconnected because a write took longer than the send timeout
+        - returned: queued messages moved to the mailbox when their connection closed
+    '''
+    def __init__(self) -> None:
+        self.lock         = Lock()
+        self.depth        = 0
+        self.max_depth    = 0
+        self.delivered    = 0
+        self.dropped      = 0
+        self.spilled      = 0
+        self.disconnected = 0
+        self.timed_out    = 0
+        self.returned     = 0
+
+    # A queue grew to depth messages
+    def on_queue(self, depth):
+        with self.lock:
+            self.depth += 1
+            self.max_depth = max(self.max_depth, depth)
+
+    def on_write(self):
+        with self.lock:
+            self.depth -= 1
+            self.delivered += 1
+
+    def on_return(self, count):
+        with self.lock:
+            self.depth -= count
+            self.returned += count
+
+    # outcome is one of DROPPED, SPILLED, DISCONNECTED, or 'timed_out'
+    def on_stall(self, outcome):
+        with self.lock:
+            setattr(self, outcome, getattr(self, outcome) + 1)
+
+    def __str__(self):
+        with self.lock:
+            return ('outbound: depth={} max_depth={} delivered={} dropped={} spilled={} disconnected={} '
+                    'timed_out={} returned={}').format(
+                self.depth, self.max_depth, self.delivered, self.dropped, self.spilled, self.disconnected,
+                self.timed_out, self.returned)
+
+class OutboundQueue:
+    '''
+    Socket wrapper that delivers other users' messages to one client through a bounded queue
+        - sock: client socket (plain or FramedSocket)
+        - raw: the TCP socket underneath it
+        - users: UserStore that still-queued messages go back to when the connection closes (if the
+          user has no other session, which took them as well)
+        - stats: OutboundStats shared by every queue
+        - max_depth, policy, send_timeout: see the module docstring
+        - messages: queued (username, message) pairs, oldest first; guarded by condition
+        - stalled: set once the recipient is being disconnected; puts no longer apply the policy
+        - closed: set once the connection is closed; puts are refused
+        - write_lock: held for every write to the socket, by the writer and by send()/sendall()
+        - writer: thread writing the queue to the socket (None until start())
+    '''
+    def __init__(self, sock, users, stats, max_depth=OUTBOUND_QUEUE, policy=POLICY, send_timeout=SEND_TIMEOUT) -> None:
+        self.sock         = sock
+        self.raw          = sock.sock if isinstance(sock, FramedSocket) else sock
+        self.users        = users
+        self.stats        = stats
+        self.max_depth    = max_depth
+        self.policy       = policy
+        self.send_timeout = send_timeout
+        self.messages     = deque()
+        self.condition    = Condition()
+        self.stalled      = False
+        self.closed       = False
+        self.write_lock   = Lock()
+        self.writer       = None
+
+    # Queue message for username (the client); returns QUEUED, or what the full-queue policy did instead
+    def put(self, username, message):
+        with self.condition:
+            if self.closed:
+                return CLOSED
+            if len(self.messages) >= self.max_depth and not self.stalled:
+                if self.policy == 'drop':
+                    self.stats.on_stall(DROPPED)
+                    return DROPPED
+                if self.policy == 'spill':
+                    self.stats.on_stall(SPILLED)
+                    return SPILLED
+                self.stats.on_stall(DISCONNECTED)
+                self.stall()
+            self.messages.append((username, message))
+            self.stats.on_queue(len(self.messages))
+            self.condition.notify()
+            return DISCONNECTED if self.stalled else QUEUED
+
+    # Start writing queued messages (after the login backlog went out, so nothing overtakes it)
+    def start(self):
+        self.writer = Thread(target=self.write_loop, daemon=True)
+        self.writer.start()
+
+    def write_loop(self):
+        while True:
+            with self.condition:
+                while not self.messages and not self.stalled and not self.closed:
+                    self.condition.wait()
+                if self.stalled or self.closed:
+                    return
+                username, message = self.messages.popleft()
+            data = message
+            if isinstance(self.sock, FramedSocket):
+                data = pack_header(OP_TEXT, 0, len(data)) + data
+            try:
+                with self.write_lock:
+                    self.write(data)
+            except (OSError, ValueError) as error:
+                # Put it back so it goes to the mailbox with the rest
+                with self.condition:
+                    self.messages.appendleft((username, message))
+                    if isinstance(error, timeout) and not self.stalled:
+                        self.stats.on_stall('timed_out')
+                    self.stall()
+                return
+            self.stats.on_write()
+
+    # Write data, waiting at most send_timeout for the client to make room; raises timeout if it does not
+    def write(self, data):
+        view = memoryview(data)
+        deadline = time.monotonic() + self.send_timeout
+        while view:
+            try:
+                view = view[self.raw.send(view, MSG_DONTWAIT):]
+                continue
+            except BlockingIOError:
+                pass
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise timeout('client is not reading')
+            select.select([], [self.raw], [], remaining)
+
+    # Disconnect a client that is not keeping up (caller holds condition): its own thread sees
+    # the connection end and closes it, which returns the queued messages to the mailbox
+    def stall(self):
+        if self.stalled:
+            return
+        self.stalled = True
+        self.condition.notify_all()
+        try:
+            self.raw.shutdown(SHUT_RDWR)
+        except OSError:
+            pass
+
+    # Heartbeat thread: write a PING, unless a write is in progress (the send timeout watches that
+    # one) or the socket has no room for it
+    def ping(self):
+        if not self.write_lock.acquire(blocking=False):
+            return
+        try:
+            frame = pack_header(OP_PING, 0, 0)
+            if 0 < self.raw.send(frame, MSG_DONTWAIT) < len(frame):
+                self.reap() # half a frame went out: the stream can no longer be parsed
+        except OSError:
+            pass
+        finally:
+            self.write_lock.release()
+
+    # Heartbeat thread: disconnect a client that stopped answering, like a stalled one
+    def reap(self):
+        with self.condition:
+            self.stall()
+
+    # Time of the client's last input (framed clients only)
+    @property
+    def last_input(self):
+        return self.sock.last_input
+
+    # Messages currently queued
+    def depth(self):
+        with self.condition:
+            return len(self.messages)
+
+    def send(self, data, *args, **kwargs):
+        with self.write_lock:
+            return self.sock.send(data, *args, **kwargs)
+
+    def sendall(self, data, *args, **kwargs):
+        with self.write_lock:
+            self.sock.sendall(data, *args, **kwargs)
+
+    # Write frames the caller already built (command mode results) between the writer's messages
+    def send_frames(self, data):
+        with self.write_lock:
+            self.raw.sendall(data)
+
+    def recv(self, *args):
+        return self.sock.recv(*args)
+
+    def recv_frame(self):
+        return self.sock.recv_frame()
+
+    def next_frame(self):
+        return self.sock.next_frame()
+
+    def settimeout(self, value):
+        self.sock.settimeout(value)
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    # Close the socket, stop the writer and move whatever is still queued to the mailbox, once it is
+    # durable. Called after the session was logged out: if the user still has other sessions, deliver()
+    # handed them the same messages, so they are dropped here rather than replayed at the next login
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        try:
+            self.raw.shutdown(SHUT_RDWR)
+        except OSError:
+            pass
+        if self.writer is not None:
+            self.writer.join()
+        self.sock.close()
+        with self.condition:
+            messages, self.messages = self.messages, deque()
+        ticket = 0
+        for username, message in messages:
+            append_ticket, _ = self.users.append(username, message, direct=SESSIONS)
+            ticket = max(ticket, append_ticket or 0)
+        self.users.sync(ticket)
+        if messages:
+            self.stats.on_return(len(messages))
@@ -0,0 +1,339 @@
+'''
+This file implements the length-prefixed binary framing protocol of chat application.
+
+Every frame is a fixed 10 byte header followed by the payload:
+
+    version (1B) | opcode (1B) | request id (4B) | payload length (4B) | payload
+
+A client opts in by sending a HELLO frame as its very first input (text clients never send
+a 0x01 byte first); the server answers with HELLO_ACK and both sides speak frames from then
+on. Anything else keeps the connection on the original text protocol.
+
+The server answers a frame with frames carrying the same request id, while messages from other
+users, pushed outside the prompt flow, carry request id 0. A client that numbers its frames
+(sdk.py) can so tell replies from messages, and knows from PROMPTS which input the server waits on.
+
+A client that sets FLAG_COMMANDS in its HELLO gets command mode instead of the prompt flow (the
+server echoes the flag in HELLO_ACK and sends no prompts): every COMMAND frame is a complete
+request -- the command and its fields, one per line, e.g. 'SEND\nbob\nhi there' (commands.py) --
+answered by one RESULT frame with its request id, whose payload is RESULT_OK or RESULT_ERROR
+followed by the text. Text frames with the same id may come before the RESULT (a login's backlog,
+the pages of a listing). A client can so write many commands at once and match the answers later.
+
+A client that sets FLAG_HEARTBEAT promises to answer every PING frame with a PONG carrying the same
+request id. The server pings such a client once it has been silent for a while and drops it if it
+stays silent (heartbeat.py), which finds clients that are hung or gone without closing their socket.
+
+Reads fill one reusable bytearray per connection via recv_into, and parsed payloads are
+memoryview slices of that buffer, so payloads are never copied while parsing. A payload
+view stays valid until the next call that reads into the same FrameReader.
+'''
+# Import relevant python packages
+from socket import MSG_PEEK
+import struct
+import time
+
+# Constants/configurations
+PROTOCOL_VERSION = 1
+MAGIC            = b'CHAT'
+MAX_PAYLOAD      = 1 << 20 # default bound on a single payload (1 MiB), configurable per connection
+INITIAL_BUFFER   = 4096
+
+HEADER = struct.Struct('!BBII') # version, opcode, request id, payload length
+HELLO  = struct.Struct('!4sI') # magic, largest payload the sender accepts
+
+# Opcodes
+OP_HELLO     = 0x01 # client -> server: request framed protocol
+OP_HELLO_ACK = 0x02 # server -> client: framed protocol accepted
+OP_TEXT      = 0x03 # prompt/answer text of the interactive flow
+OP_ERROR     = 0x04 # protocol error; the sender closes the connection afterwards
+OP_COMMAND   = 0x05 # client -> server: one complete command (command mode)
+OP_RESULT    = 0x06 # server -> client: outcome of the command with the same request id
+OP_PING      = 0x07 # server -> client: liveness probe (FLAG_HEARTBEAT clients only)
+OP_PONG      = 0x08 # client -> server: answer to the PING with the same request id
+
+FLAG_COMMANDS  = 0x01 # HELLO/HELLO_ACK flag: command mode instead of the prompt flow
+FLAG_HEARTBEAT = 0x02 # HELLO/HELLO_ACK flag: the client answers PING frames
+FLAGS          = FLAG_COMMANDS | FLAG_HEARTBEAT # flags the server supports
+RESULT_OK     = b'+' # first byte of a RESULT payload
+RESULT_ERROR  = b'-'
+
+HELLO_PREFIX     = bytes([PROTOCOL_VERSION, OP_HELLO])
+HELLO_ACK_PREFIX = bytes([PROTOCOL_VERSION, OP_HELLO_ACK]) + bytes(4) # header up to the payload length (request id 0)
+
+# Prompts of the interactive flow (the server sends each one on its own when it waits for input)
+WELCOME_PROMPT         = '\nPlease enter 1 or 2 :\n1. Create account.\n2. Login'
+CREATE_USERNAME_PROMPT = '\nPlease enter a username: '
+CREATE_PASSWORD_PROMPT = 'Please enter a password.'
+LOGIN_USERNAME_PROMPT  = '\nPlease enter your username.'
+LOGIN_PASSWORD_PROMPT  = 'Please enter your password.'
+MENU_PROMPT            = ('\nPlease enter 1, 2, 3, 4, or 5:\n1. Send message.\n2. List all users.\n3. Delete your account.'
+                          '\n4. Search users.\n5. Groups.')
+RECIPIENT_PROMPT       = '\nEnter username of message recipient:'
+MESSAGE_PROMPT         = 'Enter your message: '
+CONFIRM_PROMPT         = '\nType confirm to delete your current account'
+SEARCH_PROMPT          = '\nEnter a username prefix or pattern (e.g. bo*), or * for all:'
+MORE_PROMPT            = '\nType more for the next page, or anything else to return to the menu.'
+GROUP_PROMPT           = '\nEnter a group command -- create NAME, join NAME, leave NAME, send NAME, or list:'
+PROMPTS = frozenset([WELCOME_PROMPT, CREATE_USERNAME_PROMPT, CREATE_PASSWORD_PROMPT, LOGIN_USERNAME_PROMPT,
+                     LOGIN_PASSWORD_PROMPT, MENU_PROMPT, RECIPIENT_PROMPT, MESSAGE_PROMPT, CONFIRM_PROMPT,
+                     SEARCH_PROMPT, MORE_PROMPT, GROUP_PROMPT])
+
+class ProtocolError(Exception):
+    pass
+
+# Build the header of one frame
+def pack_header(opcode, request_id, length):
+    return HEADER.pack(PROTOCOL_VERSION, opcode, request_id, length)
+
+# Build a complete HELLO/HELLO_ACK frame advertising max_payload (and flags, if any, in one more byte)
+def pack_hello(opcode, max_payload, flags=0):
+    payload = HELLO.pack(MAGIC, max_payload) + (bytes([flags]) if flags else b'')
+    return pack_header(opcode, 0, len(payload)) + payload
+
+# Parse a HELLO/HELLO_ACK payload, returning the peer's max payload
+def unpack_hello(payload):
+    if len(payload) < HELLO.size:
+        raise ProtocolError('handshake of {} bytes is too short'.format(len(payload)))
+    magic, max_payload = HELLO.unpack_from(payload)
+    if magic != MAGIC:
+        raise ProtocolError('bad handshake magic {!r}'.format(magic))
+    return max_payload
+
+# Flags of a HELLO/HELLO_ACK payload (0 if the peer sent none)
+def hello_flags(payload):
+    return payload[HELLO.size] if len(payload) > HELLO.size else 0
+
+# Build a complete frame
+def pack_frame(opcode, request_id, payload):
+    return pack_header(opcode, request_id, len(payload)) + payload
+
+# Build a complete RESULT frame
+def pack_result(request_id, ok, text):
+    return pack_frame(OP_RESULT, request_id, (RESULT_OK if ok else RESULT_ERROR) + text.encode('utf-8'))
+
+# Parse a RESULT payload, returning (ok, text)
+def unpack_result(payload):
+    return bytes(payload[:1]) == RESULT_OK, str(payload[1:], 'utf-8', 'replace')
+
+# True if the first bytes received on a connection are the start of a HELLO frame
+def is_hello(data):
+    return bytes(data[:len(HELLO_PREFIX)]) == HELLO_PREFIX
+
+# Send one frame without concatenating header and payload (gather write)
+def send_frame(sock, opcode, request_id, payload):
+    header = pack_header(opcode, request_id, len(payload))
+    sent = sock.sendmsg([header, payload])
+    total = len(header) + len(payload)
+    # Partial write: fall back to sendall for whatever is left
+    if sent < total:
+        if sent < len(header):
+            sock.sendall(header[sent:])
+            sent = len(header)
+        sock.sendall(memoryview(payload)[sent - len(header):])
+
+class FrameReader:
+    '''
+    Incremental frame parser over a reusable receive buffer
+        - buffer/view: receive buffer and a memoryview over it
+        - start, end: unparsed bytes are buffer[start:end]
+        - max_payload: frames announcing a larger payload are rejected
+    '''
+    def __init__(self, max_payload=MAX_PAYLOAD) -> None:
+        self.max_payload = max_payload
+        self.buffer      = bytearray(INITIAL_BUFFER)
+        self.view        = memoryview(self.buffer)
+        self.start       = 0
+        self.end         = 0
+
+    # Make room for at least `needed` more bytes after end
+    def reserve(self, needed):
+        pending = self.end - self.start
+        if len(self.buffer) - self.end >= needed:
+            return
+        # Grow into a new buffer (views handed out earlier keep pointing at the old one)
+        if pending + needed > len(self.buffer):
+            size = len(self.buffer)
+            while size < pending + needed:
+                size *= 2
+            buffer = bytearray(size)
+            buffer[:pending] = self.view[self.start:self.end]
+            self.buffer = buffer
+            self.view = memoryview(buffer)
+        # Move the partial frame to the front of the existing buffer
+        else:
+            self.buffer[:pending] = bytes(self.view[self.start:self.end])
+        self.start = 0
+        self.end = pending
+
+    # Receive directly into the buffer; returns bytes read (0 on EOF)
+    def recv_into(self, sock):
+        self.reserve(max(INITIAL_BUFFER, self.missing()))
+        count = sock.recv_into(self.view[self.end:])
+        self.end += count
+        return count
+
+    # Append bytes that were already received some other way (e.g. during negotiation)
+    def feed(self, data):
+        self.reserve(len(data))
+        self.view[self.end:self.end + len(data)] = data
+        self.end += len(data)
+
+    # Bytes still needed to complete the frame at start (0 if unknown or complete)
+    def missing(self):
+        pending = self.end - self.start
+        if pending < HEADER.size:
+            return HEADER.size - pending
+        _, _, _, length = HEADER.unpack_from(self.buffer, self.start)
+        if length > self.max_payload:
+            raise ProtocolError('payload of {} bytes exceeds limit of {}'.format(length, self.max_payload))
+        return max(0, HEADER.size + length - pending)
+
+    # Parse the next complete frame: (opcode, request_id, payload memoryview) or None
+    def next_frame(self):
+        if self.end - self.start < HEADER.size:
+            return None
+        version, opcode, request_id, length = HEADER.unpack_from(self.buffer, self.start)
+        if version != PROTOCOL_VERSION:
+            raise ProtocolError('unsupported protocol version {}'.format(version))
+        if length > self.max_payload:
+            raise ProtocolError('payload of {} bytes exceeds limit of {}'.format(length, self.max_payload))
+        frame_end = self.start + HEADER.size + length
+        if self.end < frame_end:
+            return None
+        payload = self.view[self.start + HEADER.size:frame_end]
+        self.start = frame_end
+        # Buffer fully consumed -- rewind so the next read starts at the front
+        if self.start == self.end:
+            self.start = self.end = 0
+        return opcode, request_id, payload
+
+class FramedSocket:
+    '''
+    Socket wrapper that speaks frames but keeps the socket send/recv interface,
+    so the prompt-driven server and client code work unchanged on either protocol
+        - sock: underlying TCP socket
+        - reader: FrameReader for incoming frames
+        - peer_max_payload: largest payload the peer accepts
+        - request_id: id of the last TEXT frame recv() returned, which frames sent in reply carry
+        - flags: HELLO flags both sides agreed on (FLAG_COMMANDS for command mode, FLAG_HEARTBEAT)
+        - last_input: time.monotonic() of the last bytes received (read by the server's heartbeat thread)
+    '''
+    def __init__(self, sock, reader, peer_max_payload, flags=0) -> None:
+        self.sock             = sock
+        self.reader           = reader
+        self.peer_max_payload = peer_max_payload
+        self.request_id       = 0
+        self.flags            = flags
+        self.last_input       = time.monotonic()
+
+    # Send data as one TEXT frame (answering the last frame received unless request_id is given);
+    # returns len(data) like socket.send
+    def send(self, data, opcode=OP_TEXT, request_id=None):
+        if len(data) > self.peer_max_payload:
+            raise ProtocolError('payload of {} bytes exceeds peer limit of {}'.format(len(data), self.peer_max_payload))
+        send_frame(self.sock, opcode, self.request_id if request_id is None else request_id, data)
+        return len(data)
+
+    # A frame is always written whole, so sendall is send
+    def sendall(self, data, opcode=OP_TEXT, request_id=None):
+        self.send(data, opcode, request_id)
+
+    # Receive the next frame: (opcode, request_id, payload memoryview), or None on EOF
+    def recv_frame(self):
+        while True:
+            frame = self.next_frame()
+            if frame is not None:
+                return frame
+            if self.reader.recv_into(self.sock) == 0:
+                return None
+            self.last_input = time.monotonic()
+
+    # The next frame already received, without waiting for more (None if there is none); PONGs
+    # only count as input, so they are skipped here
+    def next_frame(self):
+        frame = self.reader.next_frame()
+        while frame is not None and frame[0] == OP_PONG:
+            frame = self.reader.next_frame()
+        return frame
+
+    # Receive the payload of the next TEXT frame as bytes (b'' on EOF, like socket.recv)
+    def recv(self, bufsize=None):
+        while True:
+            frame = self.recv_frame()
+            if frame is None:
+                return b''
+            opcode, request_id, payload = frame
+            if opcode == OP_TEXT:
+                self.request_id = request_id
+                return bytes(payload)
+            if opcode == OP_ERROR:
+                raise ProtocolError(str(payload, 'utf-8', 'replace'))
+
+    def settimeout(self, value):
+        self.sock.settimeout(value)
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def close(self):
+        self.sock.close()
+
+# Server side: peek at the first client input and upgrade to frames if it is a HELLO.
+# Returns a FramedSocket (its flags set to the HELLO flags the server supports), or sock itself for text clients.
+def accept_hello(sock, max_payload=MAX_PAYLOAD):
+    head = sock.recv(len(HELLO_PREFIX), MSG_PEEK)
+    # A lone first byte equal to the version could still be a split HELLO -- wait for the opcode
+    while head and len(head) < len(HELLO_PREFIX) and HELLO_PREFIX.startswith(head):
+        head = sock.recv(len(HELLO_PREFIX), MSG_PEEK)
+    if not is_hello(head):
+        return sock
+
+    reader = FrameReader(max_payload)
+    frame = None
+    while frame is None:
+        if reader.recv_into(sock) == 0:
+            return sock
+        frame = reader.next_frame()
+    opcode, _, payload = frame
+    if opcode != OP_HELLO:
+        raise ProtocolError('expected HELLO, got opcode {}'.format(opcode))
+    peer_max_payload = unpack_hello(payload)
+    flags = hello_flags(payload) & FLAGS
+    sock.sendall(pack_hello(OP_HELLO_ACK, max_payload, flags))
+    return FramedSocket(sock, reader, peer_max_payload, flags)
+
+# Look for the server's HELLO_ACK in what a client received so far, skipping any text before it; its
+# length comes from its header, since the server acknowledges only the flags it supports (maybe none).
+# Returns (peer max payload, acknowledged flags, bytes received after it), or None if it is not complete yet
+def find_hello_ack(received):
+    index = received.find(HELLO_ACK_PREFIX)
+    if index < 0 or len(received) < index + HEADER.size:
+        return None
+    _, _, _, size = HEADER.unpack_from(received, index)
+    if size > INITIAL_BUFFER:
+        raise ProtocolError('handshake of {} bytes is too long'.format(size))
+    frame_start = index + HEADER.size
+    if len(received) < frame_start + size:
+        return None
+    payload = bytes(received[frame_start:frame_start + size])
+    return unpack_hello(payload), hello_flags(payload), received[frame_start + size:]
+
+# Client side: send HELLO (with flags, e.g. FLAG_COMMANDS) and skip any text the server sent before
+# its HELLO_ACK. Returns a FramedSocket, its flags those the server acknowledged (a subset of flags);
+# raises ProtocolError if the server closes or never acknowledges.
+def connect_hello(sock, max_payload=MAX_PAYLOAD, flags=0):
+    sock.sendall(pack_hello(OP_HELLO, max_payload, flags))
+    received = bytearray()
+    while True:
+        data = sock.recv(INITIAL_BUFFER)
+        if not data:
+            raise ProtocolError('server closed the connection during protocol negotiation')
+        received += data
+        ack = find_hello_ack(received)
+        if ack is not None:
+            break
+    peer_max_payload, acked, rest = ack
+    reader = FrameReader(max_payload)
+    reader.feed(rest)
+    return FramedSocket(sock, reader, peer_max_payload, acked)
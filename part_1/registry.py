@@ -0,0 +1,109 @@
+'''
+This file implements the connection registry of the threaded server mode.
+
+The server used to keep its client sockets in a list, so registering a connection was cheap but
+removing one ('sock in active_sockets' plus list.remove) and every presence check was a scan
+over every connected client. The registry indexes connections two ways:
+    - by socket fd: every connected client, from accept until it disconnects
+    - by username: the logged in sessions of each user, kept in the user's record in the
+      UserStore (the SESSIONS field, a tuple). A user may be logged in from several clients
+      at once; messages for it are handed to every session.
+Both are dict lookups, so registering, removing and routing cost the same with 10 or 50k
+clients. Sessions live in the store rather than here so that logging in (adding a session and
+taking the mailbox) and routing a message (queueing it or finding the sessions) are atomic
+with each other under the user's shard lock: a message is never queued in the mailbox of a
+user who is already online.
+
+Usage:
+    connections = ConnectionRegistry(users)
+    connections.add(sock)
+    mailbox = connections.login(sock, 'alice')
+    ticket, sessions = users.append('alice', message, direct=SESSIONS)
+    connections.remove(sock)
+'''
+# Import relevant python packages
+from threading import Lock
+
+# Constants/configurations
+SESSIONS = 'sessions' # UserStore field holding the tuple of a user's logged in connections
+
+class ConnectionRegistry:
+    '''
+    Connected clients of the threaded server
+        - users: UserStore holding each user's sessions (SESSIONS field)
+        - lock: guards connections
+        - connections: key: socket fd, value: [connection, username] (username is None until login)
+    '''
+    def __init__(self, users) -> None:
+        self.users       = users
+        self.lock        = Lock()
+        self.connections = {}
+
+    def __len__(self):
+        return len(self.connections)
+
+    def __contains__(self, sock):
+        entry = self.connections.get(sock.fileno())
+        return entry is not None and entry[0] is sock
+
+    # Register a newly accepted connection
+    def add(self, sock):
+        with self.lock:
+            self.connections[sock.fileno()] = [sock, None]
+
+    # Swap a registered connection for a wrapper around the same socket (e.g. its OutboundQueue)
+    def replace(self, old, new):
+        with self.lock:
+            entry = self.connections.get(old.fileno())
+            if entry is None or entry[0] is not old:
+                return False
+            entry[0] = new
+            return True
+
+    # Create an account with sock as its first session; returns the log ticket, or None if the username is taken
+    def create(self, sock, username, password):
+        ticket = self.users.create(username, password, **{SESSIONS: (sock,)})
+        if ticket is not None:
+            self.bind(sock, username)
+        return ticket
+
+    # Add sock to username's sessions and take its queued messages in the same step (None if the user does not exist)
+    def login(self, sock, username):
+        mailbox = self.users.attach(username, SESSIONS, sock)
+        if mailbox is not None:
+            self.bind(sock, username)
+        return mailbox
+
+    def bind(self, sock, username):
+        with self.lock:
+            entry = self.connections.get(sock.fileno())
+            if entry is not None and entry[0] is sock:
+                entry[1] = username
+
+    # Stop routing username's messages to sock (later ones go to its other sessions, or the mailbox)
+    def logout(self, sock):
+        with self.lock:
+            entry = self.connections.get(sock.fileno())
+            if entry is None or entry[0] is not sock or entry[1] is None:
+                return
+            username, entry[1] = entry[1], None
+        self.users.detach(username, SESSIONS, sock)
+
+    # Unregister sock (call before closing it, while its fd is still its own); returns False if it was not registered
+    def remove(self, sock):
+        self.logout(sock)
+        with self.lock:
+            fd = sock.fileno()
+            entry = self.connections.get(fd)
+            if entry is None or entry[0] is not sock:
+                return False
+            del self.connections[fd]
+            return True
+
+    # Logged in sessions of username (empty if it is offline or does not exist)
+    def sessions(self, username):
+        return self.users.get(username, SESSIONS) or ()
+
+    # Whether sock is still one of username's sessions (it is not once the account was deleted)
+    def is_session(self, sock, username):
+        return any(session is sock for session in self.sessions(username))
@@ -0,0 +1,788 @@
+'''
+This file implements a client library for the part 1 server, for programs that drive accounts
+without a terminal (bots, load generators, integrations). It speaks the framed protocol.
+
+The server leads every exchange with its prompts (protocol.py), so each request -- create,
+login, send, list, search, group commands, delete -- is a generator of the answers to type: it
+is given the prompt the server waits on, yields one answer at a time and gets back the reply
+frames and the next prompt; its return value is the request's result, and a ChatError it raises
+is the request's failure. Session runs these generators over one connection without doing any
+I/O itself: it numbers the frames of each request, collects the reply frames carrying that
+number and hands frames numbered 0 (messages from other users) to a callback. The prompts branch
+on the answers (an unknown recipient returns to the menu), so a connection runs its requests one
+after the other, but callers can queue as many as they like.
+
+With commands=True the connection uses command mode instead (protocol.py, commands.py):
+CommandSession turns each request into one COMMAND frame, written at once however many are
+outstanding, and matches the RESULT frames to them by request id. The same request functions
+name the requests in both modes (COMMANDS maps them to their commands); answer() needs prompts
+and so only works in the prompt flow. Output is flushed once per reactor loop / event loop
+iteration, so requests made together go out in one write. Both sessions answer the server's
+heartbeat PINGs (FLAG_HEARTBEAT), so an idle connection is not mistaken for a dead one.
+
+Two drivers move the bytes:
+    - Client: blocking calls (send/send_group also return a concurrent.futures.Future with
+      wait=False); every Client of a Reactor shares its one selector thread, so a single thread
+      serves thousands of connections
+    - AsyncClient: coroutines for asyncio, one reader task per connection
+A connection is one logged in user: part 1 ties the login to the socket, so sockets cannot be
+shared between users (part_2/sdk.py pools its channels instead).
+
+Usage:
+    with Client('127.0.0.1') as client:
+        client.login('alice', 'password') # returns the messages queued while alice was away
+        client.send('bob', 'hi')
+        for message in client.subscribe():
+            print(message)
+
+    client = await AsyncClient.connect('127.0.0.1', commands=True)
+    await client.create('bot1', 'password')
+    await asyncio.gather(*(client.send('bob', str(index)) for index in range(100)))
+'''
+# Import relevant python packages
+import asyncio
+from collections import deque
+from concurrent.futures import Future
+import queue
+import re
+import selectors
+from socket import create_connection, socketpair
+from threading import Lock, Thread
+
+from protocol import (CONFIRM_PROMPT, CREATE_PASSWORD_PROMPT, CREATE_USERNAME_PROMPT, FLAG_COMMANDS, FLAG_HEARTBEAT,
+                      GROUP_PROMPT, INITIAL_BUFFER, LOGIN_PASSWORD_PROMPT, LOGIN_USERNAME_PROMPT, MAX_PAYLOAD,
+                      MENU_PROMPT, MESSAGE_PROMPT, MORE_PROMPT, OP_COMMAND, OP_ERROR, OP_HELLO, OP_PING, OP_PONG,
+                      OP_RESULT, OP_TEXT, PROMPTS, RECIPIENT_PROMPT, SEARCH_PROMPT, WELCOME_PROMPT, FrameReader,
+                      ProtocolError, connect_hello, find_hello_ack, pack_frame, pack_header, pack_hello, unpack_result)
+
+# Constants/configurations
+ENCODING        = 'utf-8' # message encoding
+PORT            = 1234 # fixed application port
+REQUEST_TIMEOUT = 30.0 # seconds a blocking Client call waits for its result
+MAX_REQUEST_ID  = 0xFFFFFFFF # request ids are 4 bytes; 0 is reserved for pushed messages
+NO_COMMANDS     = 'server does not support command mode' # its HELLO_ACK left out FLAG_COMMANDS
+
+USER_LINE  = re.compile(r'^\d+\. (.*)$') # one user of a listing ('3. alice')
+GROUP_LINE = re.compile(r'^(.*) \((\d+) members\)$') # one group of a listing ('team (4 members)')
+
+class ChatError(Exception):
+    pass
+
+# Fail unless the server waits on one of prompts (e.g. sending before logging in)
+def expect(prompt, *prompts):
+    if prompt is None:
+        raise ChatError('connection closed')
+    if prompt not in prompts:
+        raise ChatError('not possible at this point (the server is waiting on {!r})'.format(prompt.strip()))
+
+# Text of the reply frames, without the blank lines around it
+def reply_text(reply):
+    return ''.join(reply).strip()
+
+# Create an account and log in with it
+def create_steps(prompt, username, password):
+    if prompt == WELCOME_PROMPT:
+        _, prompt = yield '1'
+    expect(prompt, CREATE_USERNAME_PROMPT)
+    reply, prompt = yield username
+    # Taken usernames send us back to the username prompt
+    if prompt != CREATE_PASSWORD_PROMPT:
+        raise ChatError(reply_text(reply))
+    reply, prompt = yield password
+    if prompt != MENU_PROMPT:
+        raise ChatError(reply_text(reply))
+
+# Log in; returns the messages queued for the user while it was away
+def login_steps(prompt, username, password):
+    if prompt == WELCOME_PROMPT:
+        _, prompt = yield '2'
+    expect(prompt, LOGIN_USERNAME_PROMPT)
+    reply, prompt = yield username
+    if prompt != LOGIN_PASSWORD_PROMPT:
+        raise ChatError(reply_text(reply))
+    reply, prompt = yield password
+    if prompt != MENU_PROMPT:
+        raise ChatError(reply_text(reply))
+    # The backlog comes in chunks of newline-terminated messages between these two frames
+    start = next((index for index, text in enumerate(reply) if text.startswith('\nWelcome back')), None)
+    if start is None:
+        return []
+    end = next(index for index, text in enumerate(reply) if text.startswith('\nWelcome to chatroom!'))
+    return [line for chunk in reply[start + 1:end] for line in chunk.split('\n') if line]
+
+# Send text to dst_username; returns how it was delivered ('Message delivered to mailbox.', ...)
+def send_steps(prompt, dst_username, text):
+    expect(prompt, MENU_PROMPT)
+    _, prompt = yield '1'
+    expect(prompt, RECIPIENT_PROMPT)
+    reply, prompt = yield dst_username
+    if prompt != MESSAGE_PROMPT:
+        raise ChatError(reply_text(reply))
+    reply, prompt = yield text
+    if 'delivered' not in reply_text(reply):
+        raise ChatError(reply_text(reply))
+    return reply_text(reply)
+
+# Every username, in listing order
+def list_steps(prompt):
+    expect(prompt, MENU_PROMPT)
+    reply, prompt = yield '2'
+    lines = ''.join(reply).split('\n')
+    return [match.group(1) for match in map(USER_LINE.match, lines) if match]
+
+# Usernames starting with a prefix, or matching a glob pattern (e.g. bo*), over every page
+def search_steps(prompt, search):
+    expect(prompt, MENU_PROMPT)
+    _, prompt = yield '4'
+    expect(prompt, SEARCH_PROMPT)
+    reply, prompt = yield search
+    usernames = []
+    while True:
+        for text in reply:
+            if text.startswith('\nMatching users:\n'):
+                usernames += [line for line in text.split('\n')[2:] if line]
+        if prompt != MORE_PROMPT:
+            return usernames
+        reply, prompt = yield 'more'
+
+# One group command (create NAME, join NAME, leave NAME); success replies start with done
+def group_steps(prompt, command, done):
+    expect(prompt, MENU_PROMPT)
+    _, prompt = yield '5'
+    expect(prompt, GROUP_PROMPT)
+    reply, prompt = yield command
+    if not reply_text(reply).startswith(done):
+        raise ChatError(reply_text(reply))
+    return reply_text(reply)
+
+# Every group as (name, number of members)
+def list_groups_steps(prompt):
+    expect(prompt, MENU_PROMPT)
+    _, prompt = yield '5'
+    expect(prompt, GROUP_PROMPT)
+    reply, prompt = yield 'list'
+    lines = ''.join(reply).split('\n')
+    return [(match.group(1), int(match.group(2))) for match in map(GROUP_LINE.match, lines) if match]
+
+# Send text to every other member of group; returns how many got it ('Message delivered to ...')
+def send_group_steps(prompt, group, text):
+    expect(prompt, MENU_PROMPT)
+    _, prompt = yield '5'
+    expect(prompt, GROUP_PROMPT)
+    reply, prompt = yield 'send {}'.format(group)
+    if prompt != MESSAGE_PROMPT:
+        raise ChatError(reply_text(reply))
+    reply, prompt = yield text
+    if 'delivered' not in reply_text(reply):
+        raise ChatError(reply_text(reply))
+    return reply_text(reply)
+
+# Delete the logged in account (the server closes the connection)
+def delete_steps(prompt):
+    expect(prompt, MENU_PROMPT)
+    _, prompt = yield '3'
+    expect(prompt, CONFIRM_PROMPT)
+    reply, prompt = yield 'confirm'
+    if prompt is not None:
+        raise ChatError(reply_text(reply) or 'account was not deleted')
+
+# Nothing to answer: done once the server waits on a prompt (connecting waits for the welcome prompt)
+def greeting_steps(prompt):
+    return prompt
+    yield
+
+# Answer whatever the server waits on with text; returns (reply frames, next prompt), the prompt
+# being None if the server closed the connection (what the interactive client runs on)
+def answer_steps(prompt, text):
+    reply, prompt = yield text
+    return reply, prompt
+
+# Lines of the text frames answering a command (a login's backlog, the usernames of a listing)
+def reply_lines(reply, result):
+    return [line for text in reply for line in text.split('\n') if line]
+
+def reply_none(reply, result):
+    return None
+
+def reply_result(reply, result):
+    return result
+
+def reply_groups(reply, result):
+    return [(match.group(1), int(match.group(2))) for match in map(GROUP_LINE.match, result.split('\n')) if match]
+
+# Command mode: request function -> (command and fields for its arguments, result from (text frames, result text))
+COMMANDS = {
+    create_steps:      (lambda username, password: ('CREATE', [username, password]), reply_none),
+    login_steps:       (lambda username, password: ('LOGIN', [username, password]), reply_lines),
+    send_steps:        (lambda dst_username, text: ('SEND', [dst_username, text]), reply_result),
+    list_steps:        (lambda: ('LIST', []), reply_lines),
+    search_steps:      (lambda search: ('LIST', [search]), reply_lines),
+    group_steps:       (lambda command, done: ('GROUP', [command]), reply_result),
+    list_groups_steps: (lambda: ('GROUP', ['list']), reply_groups),
+    send_group_steps:  (lambda group, text: ('GSEND', [group, text]), reply_result),
+    delete_steps:      (lambda: ('DELETE', []), reply_none),
+}
+
+class Session:
+    '''
+    Client side of one framed connection, without I/O: the driver feeds reader and writes output
+        - reader: FrameReader of the bytes received
+        - peer_max_payload: largest payload the server accepts
+        - on_message: called with the text of every message pushed by the server
+        - prompt: prompt the server waits on (None before it greets us and once the connection closed)
+        - requests: queued (function, args, future): function(prompt, *args) makes the request's steps
+        - running: (steps, future) of the request being answered, or None
+        - request_id: id of the running request's frames (never 0)
+        - reply: text frames received for the running request since its last answer
+        - output: encoded frames not yet written
+        - closed: set once the connection is gone; later requests fail at once
+    Futures are concurrent.futures or asyncio ones: only set_result, set_exception and cancelled are used.
+    '''
+    def __init__(self, reader, peer_max_payload, on_message) -> None:
+        self.reader           = reader
+        self.peer_max_payload = peer_max_payload
+        self.on_message       = on_message
+        self.prompt           = None
+        self.requests         = deque()
+        self.running          = None
+        self.request_id       = 0
+        self.reply            = []
+        self.output           = bytearray()
+        self.closed           = False
+
+    # Queue a request; it starts once the ones before it are done
+    def submit(self, function, args, future):
+        if self.closed:
+            future.set_exception(ChatError('connection closed'))
+            return
+        self.requests.append((function, args, future))
+        self.start()
+
+    # Start the next queued request if nothing is running and the server is waiting on a prompt
+    def start(self):
+        while self.running is None and self.requests and self.prompt is not None:
+            function, args, future = self.requests.popleft()
+            if future.cancelled():
+                continue
+            self.running = (function(self.prompt, *args), future)
+            self.request_id = self.request_id % MAX_REQUEST_ID + 1
+            self.advance(None)
+
+    # Send value (None first, then (reply, prompt)) into the running request and write its next answer
+    def advance(self, value):
+        steps, future = self.running
+        try:
+            answer = steps.send(value)
+        except StopIteration as stop:
+            self.running = None
+            future.set_result(stop.value)
+        except ChatError as error:
+            self.running = None
+            future.set_exception(error)
+        else:
+            data = answer.encode(encoding=ENCODING)
+            # The server would drop the connection for it; the prompt is still unanswered
+            if len(data) > self.peer_max_payload:
+                steps.close()
+                self.running = None
+                future.set_exception(ChatError('answer of {} bytes exceeds the server limit of {}'.format(
+                    len(data), self.peer_max_payload)))
+            else:
+                self.reply = []
+                self.output += pack_header(OP_TEXT, self.request_id, len(data))
+                self.output += data
+        if self.running is None:
+            self.start()
+
+    # Handle every complete frame in reader (raises ProtocolError if the server reports one)
+    def process(self):
+        while True:
+            frame = self.reader.next_frame()
+            if frame is None:
+                return
+            opcode, request_id, payload = frame
+            if opcode == OP_ERROR:
+                raise ProtocolError(str(payload, ENCODING, 'replace'))
+            if opcode == OP_PING:
+                self.output += pack_header(OP_PONG, request_id, 0)
+                continue
+            if opcode != OP_TEXT:
+                raise ProtocolError('unexpected opcode {}'.format(opcode))
+            text = str(payload, ENCODING, 'replace')
+            # The welcome prompt sent right after the handshake
+            if self.prompt is None and request_id == 0 and text in PROMPTS:
+                self.prompt = text
+                self.start()
+            elif self.running is not None and request_id == self.request_id:
+                if text in PROMPTS:
+                    self.prompt = text
+                    self.advance((self.reply, text))
+                else:
+                    self.reply.append(text)
+            elif request_id == 0:
+                self.on_message(text)
+
+    # The connection is gone: the running request sees it as a None prompt, queued ones fail
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.prompt = None
+        requests, self.requests = self.requests, deque()
+        if self.running is not None:
+            steps, future = self.running
+            try:
+                steps.send((self.reply, None))
+                steps.close()
+                future.set_exception(ChatError('connection closed'))
+            except StopIteration as stop:
+                future.set_result(stop.value)
+            except ChatError as error:
+                future.set_exception(error)
+            self.running = None
+        for _, _, future in requests:
+            if not future.cancelled():
+                future.set_exception(ChatError('connection closed'))
+
+class CommandSession:
+    '''
+    Client side of one command mode connection, without I/O (same interface as Session)
+        - reader, peer_max_payload, on_message, output, closed: as for Session
+        - prompt: always None (command mode has no prompts)
+        - pending: request id -> (result function, future, text frames received) of the commands not answered yet
+        - request_id: id of the last command written (never 0)
+    '''
+    def __init__(self, reader, peer_max_payload, on_message) -> None:
+        self.reader           = reader
+        self.peer_max_payload = peer_max_payload
+        self.on_message       = on_message
+        self.prompt           = None
+        self.pending          = {}
+        self.request_id       = 0
+        self.output           = bytearray()
+        self.closed           = False
+
+    # Write the request's command right away, however many are outstanding
+    def submit(self, function, args, future):
+        if self.closed:
+            future.set_exception(ChatError('connection closed'))
+            return
+        if function not in COMMANDS:
+            future.set_exception(ChatError('{} needs the prompt flow'.format(function.__name__)))
+            return
+        command, result = COMMANDS[function]
+        verb, fields = command(*args)
+        data = '\n'.join([verb] + fields).encode(encoding=ENCODING)
+        if len(data) > self.peer_max_payload:
+            future.set_exception(ChatError('command of {} bytes exceeds the server limit of {}'.format(
+                len(data), self.peer_max_payload)))
+            return
+        self.request_id = self.request_id % MAX_REQUEST_ID + 1
+        self.pending[self.request_id] = (result, future, [])
+        self.output += pack_frame(OP_COMMAND, self.request_id, data)
+
+    # Handle every complete frame in reader (raises ProtocolError if the server reports one)
+    def process(self):
+        while True:
+            frame = self.reader.next_frame()
+            if frame is None:
+                return
+            opcode, request_id, payload = frame
+            if opcode == OP_ERROR:
+                raise ProtocolError(str(payload, ENCODING, 'replace'))
+            if opcode == OP_PING:
+                self.output += pack_header(OP_PONG, request_id, 0)
+            elif opcode == OP_RESULT:
+                if request_id not in self.pending:
+                    raise ProtocolError('result for unknown request {}'.format(request_id))
+                result, future, reply = self.pending.pop(request_id)
+                ok, text = unpack_result(payload)
+                if future.cancelled():
+                    continue
+                if ok:
+                    future.set_result(result(reply, text))
+                else:
+                    future.set_exception(ChatError(text))
+            elif opcode != OP_TEXT:
+                raise ProtocolError('unexpected opcode {}'.format(opcode))
+            elif request_id in self.pending:
+                self.pending[request_id][2].append(str(payload, ENCODING, 'replace'))
+            elif request_id == 0:
+                self.on_message(str(payload, ENCODING, 'replace'))
+
+    # The connection is gone: every outstanding command fails (a DELETE succeeds once its result came)
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        pending, self.pending = self.pending, {}
+        for _, future, _ in pending.values():
+            if not future.cancelled():
+                future.set_exception(ChatError('connection closed'))
+
+class Reactor:
+    '''
+    Selector thread doing the socket I/O of every Client attached to it
+        - selector: registered client sockets (data: their Client) and the wakeup socket (data: None)
+        - calls: (function, args) queued by other threads, run on the reactor thread
+        - waker, wakeup: socket pair; a byte written to wakeup interrupts select() for new calls
+        - dirty: Clients given requests by this loop iteration's calls, flushed once after them
+    '''
+    def __init__(self) -> None:
+        self.selector = selectors.DefaultSelector()
+        self.calls    = deque()
+        self.dirty    = set()
+        self.waker, self.wakeup = socketpair()
+        self.waker.setblocking(False)
+        self.wakeup.setblocking(False)
+        self.selector.register(self.waker, selectors.EVENT_READ, None)
+        Thread(target=self.run, daemon=True).start()
+
+    # Run function(*args) on the reactor thread
+    def call(self, function, *args):
+        self.calls.append((function, args))
+        try:
+            self.wakeup.send(b'\0')
+        except BlockingIOError:
+            pass # a wakeup is already pending
+
+    def run(self):
+        while True:
+            for key, mask in self.selector.select():
+                if key.data is None:
+                    try:
+                        while self.waker.recv(INITIAL_BUFFER):
+                            pass
+                    except BlockingIOError:
+                        pass
+                    continue
+                if mask & selectors.EVENT_READ:
+                    key.data.on_readable()
+                if mask & selectors.EVENT_WRITE and key.data.sock is not None:
+                    key.data.flush()
+            while self.calls:
+                function, args = self.calls.popleft()
+                function(*args)
+            while self.dirty:
+                self.dirty.pop().flush()
+
+# Reactor shared by the Clients that are not given one
+shared_reactor = None
+shared_reactor_lock = Lock()
+
+def default_reactor():
+    global shared_reactor
+    with shared_reactor_lock:
+        if shared_reactor is None:
+            shared_reactor = Reactor()
+        return shared_reactor
+
+class Client:
+    '''
+    Blocking client for one connection, its I/O done by a Reactor thread
+        - sock: TCP socket (None once closed)
+        - reactor: Reactor the socket is registered with
+        - session: Session of the connection (only touched on the reactor thread)
+        - messages: pushed messages for subscribe() (None marks the end), unless on_message is given
+        - timeout: seconds a blocking call waits for its result
+    on_message, if given, is called with every pushed message on the reactor thread instead.
+    commands selects command mode (CommandSession) instead of the prompt flow.
+    '''
+    def __init__(self, host, port=PORT, reactor=None, on_message=None, timeout=REQUEST_TIMEOUT,
+                 max_payload=MAX_PAYLOAD, commands=False) -> None:
+        framed = connect_hello(create_connection((host, port), timeout), max_payload,
+                               FLAG_HEARTBEAT | (FLAG_COMMANDS if commands else 0))
+        if commands and not framed.flags & FLAG_COMMANDS:
+            framed.close()
+            raise ProtocolError(NO_COMMANDS)
+        self.sock     = framed.sock
+        self.sock.setblocking(False)
+        self.reactor  = reactor or default_reactor()
+        self.messages = queue.Queue()
+        self.timeout  = timeout
+        session       = CommandSession if commands else Session
+        self.session  = session(framed.reader, framed.peer_max_payload, on_message or self.messages.put)
+        self.reactor.call(self.attach)
+        if not commands:
+            self.call(greeting_steps)
+
+    # Reactor thread: start watching the socket; the welcome prompt may already be buffered
+    def attach(self):
+        self.reactor.selector.register(self.sock, selectors.EVENT_READ, self)
+        self.process()
+
+    def on_readable(self):
+        try:
+            count = self.session.reader.recv_into(self.sock)
+        except (BlockingIOError, InterruptedError):
+            return
+        except (OSError, ProtocolError):
+            count = 0
+        if count == 0:
+            self.shutdown()
+            return
+        self.process()
+
+    def process(self):
+        try:
+            self.session.process()
+        except ProtocolError:
+            self.shutdown()
+            return
+        self.flush()
+
+    # Write as much output as the kernel takes; watch for writability while some is left
+    def flush(self):
+        if self.sock is None:
+            return
+        output = self.session.output
+        if output:
+            try:
+                del output[:self.sock.send(output)]
+            except (BlockingIOError, InterruptedError):
+                pass
+            except OSError:
+                self.shutdown()
+                return
+        events = selectors.EVENT_READ | selectors.EVENT_WRITE if output else selectors.EVENT_READ
+        if self.reactor.selector.get_key(self.sock).events != events:
+            self.reactor.selector.modify(self.sock, events, self)
+
+    # Reactor thread: close the socket and end every request and subscription
+    def shutdown(self):
+        if self.sock is not None:
+            self.reactor.selector.unregister(self.sock)
+            self.sock.close()
+            self.sock = None
+        self.session.close()
+        self.messages.put(None)
+
+    # Reactor thread: the request's output is written with the others of this loop iteration
+    def enqueue(self, function, args, future):
+        self.session.submit(function, args, future)
+        self.reactor.dirty.add(self)
+
+    # Queue a request; returns a Future of its result
+    def request(self, function, *args):
+        future = Future()
+        self.reactor.call(self.enqueue, function, args, future)
+        return future
+
+    # Run a request and wait for its result (ChatError if it failed)
+    def call(self, function, *args):
+        return self.request(function, *args).result(self.timeout)
+
+    def create(self, username, password):
+        return self.call(create_steps, username, password)
+
+    def login(self, username, password):
+        return self.call(login_steps, username, password)
+
+    def send(self, dst_username, text, wait=True):
+        future = self.request(send_steps, dst_username, text)
+        return future.result(self.timeout) if wait else future
+
+    def list(self):
+        return self.call(list_steps)
+
+    def search(self, search):
+        return self.call(search_steps, search)
+
+    def create_group(self, group):
+        return self.call(group_steps, 'create {}'.format(group), 'Created group')
+
+    def join_group(self, group):
+        return self.call(group_steps, 'join {}'.format(group), 'Joined group')
+
+    def leave_group(self, group):
+        return self.call(group_steps, 'leave {}'.format(group), 'Left group')
+
+    def list_groups(self):
+        return self.call(list_groups_steps)
+
+    def send_group(self, group, text, wait=True):
+        future = self.request(send_group_steps, group, text)
+        return future.result(self.timeout) if wait else future
+
+    def delete(self):
+        return self.call(delete_steps)
+
+    def answer(self, text):
+        return self.call(answer_steps, text)
+
+    # Prompt the server is waiting on (None once the connection closed)
+    @property
+    def prompt(self):
+        return self.session.prompt
+
+    # Messages pushed by the server, as they arrive, until the connection closes
+    def subscribe(self, timeout=None):
+        while True:
+            try:
+                message = self.messages.get(timeout=timeout)
+            except queue.Empty:
+                return
+            if message is None:
+                self.messages.put(None) # for the next subscriber
+                return
+            yield message
+
+    def close(self):
+        self.reactor.call(self.shutdown)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        self.close()
+        return False
+
+class AsyncClient:
+    '''
+    asyncio client for one connection (create it with AsyncClient.connect)
+        - reader, writer: asyncio streams of the connection
+        - session: Session of the connection
+        - messages: asyncio.Queue of pushed messages for subscribe() (None marks the end)
+        - task: reader task feeding the session
+        - flushing: set while a flush of the session's output is scheduled
+    '''
+    def __init__(self, reader, writer, session) -> None:
+        self.reader   = reader
+        self.writer   = writer
+        self.session  = session
+        self.messages = asyncio.Queue()
+        self.task     = None
+        self.flushing = False
+        if session.on_message is None:
+            session.on_message = self.messages.put_nowait
+
+    # Connect and negotiate the framed protocol (on_message and commands as for Client)
+    @classmethod
+    async def connect(cls, host, port=PORT, on_message=None, max_payload=MAX_PAYLOAD, commands=False):
+        flags = FLAG_HEARTBEAT | (FLAG_COMMANDS if commands else 0)
+        reader, writer = await asyncio.open_connection(host, port)
+        writer.write(pack_hello(OP_HELLO, max_payload, flags))
+        received = bytearray()
+        ack = None
+        while ack is None:
+            data = await reader.read(INITIAL_BUFFER)
+            if not data:
+                writer.close()
+                raise ProtocolError('server closed the connection during protocol negotiation')
+            received += data
+            ack = find_hello_ack(received)
+        peer_max_payload, acked, rest = ack
+        if commands and not acked & FLAG_COMMANDS:
+            writer.close()
+            raise ProtocolError(NO_COMMANDS)
+        frames = FrameReader(max_payload)
+        frames.feed(rest)
+        session = CommandSession if commands else Session
+        client = cls(reader, writer, session(frames, peer_max_payload, on_message))
+        client.process()
+        client.task = asyncio.get_running_loop().create_task(client.read_loop())
+        if not commands:
+            await client.call(greeting_steps)
+        return client
+
+    async def read_loop(self):
+        try:
+            while True:
+                data = await self.reader.read(INITIAL_BUFFER * 16)
+                if not data:
+                    break
+                self.session.reader.feed(data)
+                self.process()
+        except (OSError, ProtocolError):
+            pass
+        finally:
+            self.writer.close()
+            self.session.close()
+            self.messages.put_nowait(None)
+
+    # Handle buffered frames and write out the answers they led to (ProtocolError ends read_loop)
+    def process(self):
+        self.session.process()
+        self.flush()
+
+    def flush(self):
+        self.flushing = False
+        if self.session.output:
+            self.writer.write(bytes(self.session.output))
+            self.session.output.clear()
+
+    # Run a request and wait for its result (ChatError if it failed); the requests made before the
+    # event loop comes back to the flush are written together
+    async def call(self, function, *args):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.session.submit(function, args, future)
+        if not self.flushing:
+            self.flushing = True
+            loop.call_soon(self.flush)
+        try:
+            await self.writer.drain()
+        except OSError:
+            pass # the connection is gone: read_loop fails the request
+        return await future
+
+    async def create(self, username, password):
+        return await self.call(create_steps, username, password)
+
+    async def login(self, username, password):
+        return await self.call(login_steps, username, password)
+
+    async def send(self, dst_username, text):
+        return await self.call(send_steps, dst_username, text)
+
+    async def list(self):
+        return await self.call(list_steps)
+
+    async def search(self, search):
+        return await self.call(search_steps, search)
+
+    async def create_group(self, group):
+        return await self.call(group_steps, 'create {}'.format(group), 'Created group')
+
+    async def join_group(self, group):
+        return await self.call(group_steps, 'join {}'.format(group), 'Joined group')
+
+    async def leave_group(self, group):
+        return await self.call(group_steps, 'leave {}'.format(group), 'Left group')
+
+    async def list_groups(self):
+        return await self.call(list_groups_steps)
+
+    async def send_group(self, group, text):
+        return await self.call(send_group_steps, group, text)
+
+    async def delete(self):
+        return await self.call(delete_steps)
+
+    async def answer(self, text):
+        return await self.call(answer_steps, text)
+
+    @property
+    def prompt(self):
+        return self.session.prompt
+
+    # Messages pushed by the server, as they arrive, until the connection closes
+    async def subscribe(self):
+        while True:
+            message = await self.messages.get()
+            if message is None:
+                self.messages.put_nowait(None)
+                return
+            yield message
+
+    async def close(self):
+        self.writer.close()
+        if self.task is not None:
+            await self.task
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, traceback):
+        await self.close()
+        return False
@@ -0,0 +1,943 @@
+'''
+This file implements the event-driven server mode of chat application.
+
+A single thread multiplexes every client socket through the platform's best selector
+(epoll on Linux, kqueue on macOS). Each connection is an explicit state machine whose
+states mirror the prompts of welcome, create_user, login and client_thread in server.py,
+so no thread is ever parked on a blocking recv. Every input is timed by the state that handled
+it ('chat_part1_input' timer of the server's Metrics registry). Connections in command mode
+(commands.py) skip the state machine: each COMMAND frame is run as it is parsed and answered with
+a RESULT frame, timed as 'command_' plus the command's name.
+
+Passwords are hashed and checked in the store's worker processes (common/passwords.py), never on
+the loop: the connection stops taking input while its future is pending, and a finished future
+wakes the loop through a socket pair to run the rest of the handler.
+
+Changes are confirmed only once the write-ahead log made them durable, without the loop ever
+waiting for the disk: a confirmation whose log record is not on disk yet puts a fence in the
+connection's output, and everything sent to it from there on is held back until the log's flusher
+reports the record durable (through the same socket pair). The loop meanwhile goes on reading and
+running input, so commands pipelined on one connection still share each fsync.
+
+The loop also runs the server's Heartbeat (heartbeat.py) every tick: clients that answer heartbeats
+are pinged when silent and removed when they stay silent, and so are connections that never log in.
+
+Usage: python3 server.py --mode selectors
+'''
+# Import relevant python packages
+from collections import deque
+import resource
+import selectors
+from socket import socketpair, IPPROTO_TCP, TCP_NODELAY
+import time
+
+from commands import (CREATE, DELETE, GROUP, GSEND, LIST, LOGIN, SEND, CommandError, check_login, group_request,
+                      parse_command, user_pages)
+from common.limits import Limits
+from common.metrics import Metrics
+from common.user_store import MAILBOX_CHUNK, MAX_PAGE, PAGE_SIZE, WILDCARDS, chunk_messages
+from heartbeat import keepalive
+from protocol import (CONFIRM_PROMPT, CREATE_PASSWORD_PROMPT, CREATE_USERNAME_PROMPT, FLAG_COMMANDS, FLAG_HEARTBEAT,
+                      FLAGS, GROUP_PROMPT, LOGIN_PASSWORD_PROMPT, LOGIN_USERNAME_PROMPT, MAX_PAYLOAD, MENU_PROMPT,
+                      MESSAGE_PROMPT, MORE_PROMPT, OP_COMMAND, OP_ERROR, OP_HELLO, OP_HELLO_ACK, OP_PING, OP_PONG,
+                      OP_RESULT, OP_TEXT, RECIPIENT_PROMPT, RESULT_ERROR, RESULT_OK, SEARCH_PROMPT, WELCOME_PROMPT,
+                      FrameReader, ProtocolError, hello_flags, is_hello, pack_header, pack_hello, unpack_hello)
+from registry import SESSIONS
+
+# Constants/configurations
+ENCODING       = 'utf-8' # message encoding
+BUFFER_SIZE    = 2048 # fixed 2KB buffer size
+LOGIN_ATTEMPTS = 3
+INPUT_TIMER    = 'chat_part1_input' # per-state timing of client inputs (shared with the threaded mode)
+
+# Connection states -- each one is a prompt the server is waiting on
+WELCOME         = 'welcome'
+CREATE_USERNAME = 'create_username'
+CREATE_PASSWORD = 'create_password'
+LOGIN_USERNAME  = 'login_username'
+LOGIN_PASSWORD  = 'login_password'
+MENU            = 'menu'
+SEND_RECIPIENT  = 'send_recipient'
+SEND_MESSAGE    = 'send_message'
+DELETE_CONFIRM  = 'delete_confirm'
+SEARCH_QUERY    = 'search_query'
+SEARCH_MORE     = 'search_more'
+GROUP_COMMAND   = 'group_command'
+GROUP_MESSAGE   = 'group_message'
+
+# Raise the open file limit to the hard limit so a single process can hold 10k+ sockets
+def raise_fd_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard == resource.RLIM_INFINITY or soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    return resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+
+# Numbered list of all users, one page of the sorted username index at a time (each page is
+# sent as one write/frame: no per-user sends, no single buffer the size of the whole listing)
+def list_pages(users):
+    index, cursor = 0, ''
+    while True:
+        usernames, cursor = users.page(cursor=cursor, limit=MAX_PAGE)
+        if usernames:
+            yield ''.join('{}. {}\n'.format(index + offset, username) for offset, username in enumerate(usernames))
+        index += len(usernames)
+        if not cursor:
+            return
+
+# Search text is a glob pattern if it has wildcards, a prefix otherwise; returns (prefix, pattern)
+def parse_search(text):
+    text = text.strip()
+    if any(wildcard in text for wildcard in WILDCARDS):
+        return '', text
+    return text, ''
+
+# One page of search results; returns (text, next_cursor)
+def search_page(users, prefix, pattern, cursor):
+    usernames, cursor = users.page(prefix, pattern, cursor, PAGE_SIZE)
+    if not usernames and not cursor:
+        return '\nNo matching users.\n', ''
+    return '\nMatching users:\n' + ''.join('{}\n'.format(username) for username in usernames), cursor
+
+# Run a group command typed at GROUP_PROMPT for username; returns (reply, log ticket, group): group
+# is set for 'send NAME' by a member of NAME, whose message is the client's next input
+def group_command(users, username, text):
+    action, _, group = text.strip().partition(' ')
+    group = group.strip()
+    if action == 'list':
+        groups = users.group_names()
+        if not groups:
+            return '\nNo groups.\n', 0, None
+        return '\nAll groups:\n' + ''.join('{} ({} members)\n'.format(name, count) for name, count in groups), 0, None
+    if not group or action not in ('create', 'join', 'leave', 'send'):
+        return '\n{} is not a valid group command.\n'.format(text.strip()), 0, None
+    if action == 'create':
+        ticket = users.create_group(group, username)
+        if ticket is None:
+            return 'Group {} already exists!\n'.format(group), 0, None
+        return '\nCreated group {}\n'.format(group), ticket, None
+    if action == 'join':
+        ticket = users.join_group(group, username)
+        if ticket is None:
+            return 'Group {} does not exist!\n'.format(group), 0, None
+        return '\nJoined group {}\n'.format(group), ticket, None
+    if action == 'leave':
+        ticket = users.leave_group(group, username)
+        if ticket is None:
+            return 'You are not in group {}!\n'.format(group), 0, None
+        return '\nLeft group {}\n'.format(group), ticket, None
+    if not users.in_group(group, username):
+        return 'You are not in group {}!\n'.format(group), 0, None
+    return MESSAGE_PROMPT, 0, group
+
+class Connection:
+    '''
+    Per-client state of the event loop
+        - sock, addr: client socket and address
+        - state: prompt the server is currently waiting on
+        - username: logged in user (None until account creation/login succeeds)
+        - pending: username/recipient/group entered at the previous prompt, or (prefix, pattern, cursor) of a search
+        - attempt_num: current login attempt
+        - outbox: encoded bytes not yet accepted by the kernel
+        - backlog: iterator over the chunks of the mailbox replayed at login that are not yet in the outbox
+          (None once it is exhausted)
+        - deferred: encoded output queued while the backlog is replayed, sent right after it
+        - backlog_id: request id of the login the backlog answers
+        - reader: FrameReader once the client negotiated the framed protocol (None for text clients)
+        - peer_max_payload: largest payload the framed client accepts
+        - request_id: id of the frame being handled, which the frames sent in reply carry
+        - commands: True if the client chose command mode in its HELLO
+        - heartbeat: True if the client answers PINGs (FLAG_HEARTBEAT in its HELLO)
+        - last_input: time.monotonic() of the last bytes received
+        - first_input: True until the client sends anything (protocol negotiation window)
+        - waiting: True while a password is being hashed or checked for the connection; its input
+          waits (in the frame reader, or in 'held' for text clients) until that is done
+        - held: text inputs received while waiting
+        - unsynced: output held back until the log records it confirms are durable
+        - fences: (ticket, offset) of the confirmations in unsynced, oldest first: the output from
+          offset on (counted from the first byte ever held) waits for ticket
+        - released: bytes of unsynced released so far
+        - closing: True once the connection is to be dropped as soon as its held output is out
+    '''
+    def __init__(self, sock, addr) -> None:
+        self.sock        = sock
+        self.addr        = addr
+        self.state       = WELCOME
+        self.username    = None
+        self.pending     = None
+        self.attempt_num = 1
+        self.outbox      = bytearray()
+        self.backlog     = None
+        self.backlog_id  = 0
+        self.deferred    = bytearray()
+
+        self.reader           = None
+        self.peer_max_payload = MAX_PAYLOAD
+        self.first_input      = True
+        self.request_id       = 0
+        self.commands         = False
+        self.heartbeat        = False
+        self.last_input       = time.monotonic()
+        self.waiting          = False
+        self.held             = []
+        self.unsynced         = bytearray()
+        self.fences           = deque()
+        self.released         = 0
+        self.closing          = False
+
+class SelectorServer:
+    '''
+    Single-threaded chat server
+        - users: same UserStore as the threaded server (key: username, values: 'password', 'sessions', 'mailbox');
+          its log records are never synced on the loop, which would stall every connection: the
+          confirmations wait behind a fence instead (see hold)
+        - connections: key: client socket, value: Connection (doubles as the set of active sockets)
+        - dirty: connections with queued output, flushed once per loop iteration so that
+          several prompts produced by one input leave as a single write
+        - completions: (connection, future, handler) of password futures that finished, queued
+          by the pool's threads for the loop; a byte written to 'wakeup' interrupts select() for them
+        - synced: (connection, ticket) of fences whose log record became durable, queued the same
+          way by the log's flusher
+        - mailbox_chunk: bytes of a login backlog copied into the outbox at a time; the next
+          chunk is only encoded once the kernel took the previous one, so replaying a large backlog
+          neither floods the socket with tiny writes nor copies the whole mailbox into the outbox
+        - inputs: timer of the handlers, labelled by connection state (or command)
+        - heartbeat: Heartbeat watching every connection (None if disabled), run once per tick
+        - next_beat: time.monotonic() of its next run
+        - limits: rate limits of the messages sent (common/limits.py); the in-flight cap does not
+          apply, since the loop handles one input at a time
+    '''
+    def __init__(self, server, users, max_payload=MAX_PAYLOAD, mailbox_chunk=MAILBOX_CHUNK, metrics=None,
+                 heartbeat=None, limits=None) -> None:
+        metrics = metrics or Metrics()
+        self.server        = server
+        self.users         = users
+        self.max_payload   = max_payload
+        self.mailbox_chunk = mailbox_chunk
+        self.inputs        = metrics.timer(INPUT_TIMER, 'Client inputs handled by the part 1 server', 'state')
+        self.heartbeat     = heartbeat
+        self.next_beat     = time.monotonic() + (heartbeat.tick if heartbeat is not None else 0)
+        self.limits        = limits or Limits()
+        self.connections = {}
+        self.dirty       = set()
+        self.selector    = selectors.DefaultSelector()
+        self.completions = deque()
+        self.synced      = deque()
+        self.waker, self.wakeup = socketpair()
+        self.waker.setblocking(False)
+        self.wakeup.setblocking(False)
+        self.handlers    = { # prompt flow, by connection state
+            WELCOME:         self.on_welcome,
+            CREATE_USERNAME: self.on_create_username,
+            CREATE_PASSWORD: self.on_create_password,
+            LOGIN_USERNAME:  self.on_login_username,
+            LOGIN_PASSWORD:  self.on_login_password,
+            MENU:            self.on_menu,
+            SEND_RECIPIENT:  self.on_send_recipient,
+            SEND_MESSAGE:    self.on_send_message,
+            DELETE_CONFIRM:  self.on_delete_confirm,
+            SEARCH_QUERY:    self.on_search_query,
+            SEARCH_MORE:     self.on_search_more,
+            GROUP_COMMAND:   self.on_group_command,
+            GROUP_MESSAGE:   self.on_group_message,
+        }
+        self.command_handlers = { # command mode, by command
+            CREATE: self.command_create,
+            LOGIN:  self.command_login,
+            SEND:   self.command_send,
+            GSEND:  self.command_gsend,
+            GROUP:  self.command_group,
+            LIST:   self.command_list,
+            DELETE: self.command_delete,
+        }
+        # Read from the metrics thread: copies of the dict are atomic, iterating it is not
+        metrics.gauge('chat_connections', 'Connected client sockets', lambda: len(self.connections))
+        metrics.gauge('chat_outbox_bytes', 'Encoded output waiting for client sockets',
+                      lambda: sum(len(conn.outbox) + len(conn.deferred) for conn in list(self.connections.values())))
+
+    # Run the event loop until interrupted
+    def serve_forever(self):
+        self.server.setblocking(False)
+        self.selector.register(self.server, selectors.EVENT_READ, None)
+        self.selector.register(self.waker, selectors.EVENT_READ, self)
+        timeout = self.heartbeat.tick if self.heartbeat is not None else None
+        while True:
+            for key, mask in self.selector.select(timeout):
+                # Listening socket is readable -- new connection(s) pending
+                if key.data is None:
+                    self.accept()
+                    continue
+                if key.data is self:
+                    self.run_completions()
+                    continue
+                conn = key.data
+                if mask & selectors.EVENT_READ:
+                    self.read(conn)
+                if mask & selectors.EVENT_WRITE:
+                    self.dirty.add(conn)
+            if self.heartbeat is not None and time.monotonic() >= self.next_beat:
+                self.beat()
+            self.flush_dirty()
+
+    # Ping silent connections and remove the ones that stopped answering (or never logged in)
+    def beat(self):
+        now = time.monotonic()
+        self.next_beat = now + self.heartbeat.tick
+        self.heartbeat.run(now, self.watched, self.ping, self.reap)
+
+    # Whether the heartbeat still watches conn: logged in text clients only have TCP keepalive
+    def watched(self, conn):
+        return conn.sock in self.connections and (conn.heartbeat or conn.username is None)
+
+    def ping(self, conn):
+        if conn.heartbeat:
+            conn.outbox += pack_header(OP_PING, 0, 0)
+            self.dirty.add(conn)
+
+    def reap(self, conn):
+        print('{}:{} idle for {:.0f}s, disconnecting'.format(conn.addr[0], conn.addr[1],
+                                                             time.monotonic() - conn.last_input))
+        self.remove_connection(conn)
+
+    # Accept every pending connection and greet it with the welcome prompt
+    def accept(self):
+        while True:
+            try:
+                sock, addr = self.server.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            sock.setblocking(False)
+            sock.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1) # writes are already coalesced per iteration
+            conn = Connection(sock, addr)
+            self.connections[sock] = conn
+            self.selector.register(sock, selectors.EVENT_READ, conn)
+            if self.heartbeat is not None:
+                keepalive(sock, self.heartbeat.interval, self.heartbeat.idle_timeout)
+                self.heartbeat.watch(conn)
+            print('{}:{} connected'.format(addr[0], addr[1]))
+            self.send(conn, WELCOME_PROMPT)
+
+    # Let future (of the store's password pool) finish off the loop; then handler(conn, result) runs
+    # on the loop, and the connection's input is taken again
+    def offload(self, conn, future, handler):
+        conn.waiting = True
+        future.add_done_callback(lambda future: self.complete(conn, future, handler))
+
+    # Any thread: queue a finished future for the loop and wake it
+    def complete(self, conn, future, handler):
+        self.completions.append((conn, future, handler))
+        self.wake()
+
+    # Any thread: interrupt select() so the loop runs what was queued for it
+    def wake(self):
+        try:
+            self.wakeup.send(b'\0')
+        except BlockingIOError:
+            pass # a wakeup is already pending
+
+    def run_completions(self):
+        try:
+            while self.waker.recv(BUFFER_SIZE):
+                pass
+        except BlockingIOError:
+            pass
+        while self.synced:
+            self.release(*self.synced.popleft())
+        while self.completions:
+            conn, future, handler = self.completions.popleft()
+            conn.waiting = False
+            if conn.sock not in self.connections:
+                continue
+            try:
+                result = future.result()
+            except Exception as error: # the pool broke: the client cannot log in
+                print('{}:{} password check failed: {!r}'.format(conn.addr[0], conn.addr[1], error))
+                self.remove_connection(conn)
+                continue
+            handler(conn, result)
+            # Input that arrived meanwhile
+            if conn.reader is not None:
+                self.process_frames(conn)
+            while conn.held and not conn.waiting and conn.sock in self.connections:
+                self.dispatch(conn, conn.held.pop(0))
+
+    # Hold conn's output back from here on (the confirmation sent next and whatever follows it, so
+    # replies keep their order) until the log record with ticket is durable; 0 or None holds nothing
+    def hold(self, conn, ticket):
+        if not ticket:
+            return
+        conn.fences.append((ticket, conn.released + len(conn.unsynced)))
+        self.users.on_durable(ticket, lambda: self.durable(conn, ticket))
+
+    # Log flusher: the record with ticket is durable
+    def durable(self, conn, ticket):
+        self.synced.append((conn, ticket))
+        self.wake()
+
+    # Let out the output held behind the fences of ticket and older ones (a connection's tickets only
+    # grow, so they are the first ones); a closing connection is dropped once nothing is held
+    def release(self, conn, ticket):
+        if conn.sock not in self.connections:
+            return
+        while conn.fences and conn.fences[0][0] <= ticket:
+            conn.fences.popleft()
+        end = conn.fences[0][1] - conn.released if conn.fences else len(conn.unsynced)
+        if end:
+            if conn.backlog is not None:
+                conn.deferred += conn.unsynced[:end]
+            else:
+                conn.outbox += conn.unsynced[:end]
+            del conn.unsynced[:end]
+            conn.released += end
+            self.dirty.add(conn)
+        if conn.closing and not conn.fences:
+            self.flush(conn)
+            self.remove_connection(conn)
+
+    # Drop conn once its held output is out (at once if nothing is held); it takes no more input
+    def close_when_released(self, conn):
+        conn.closing = True
+        conn.waiting = True
+        if not conn.fences:
+            self.flush(conn)
+            self.remove_connection(conn)
+
+    # Whether conn is still one of its user's sessions (it is not once the account was deleted)
+    def is_session(self, conn):
+        return any(sock is conn.sock for sock in self.users.get(conn.username, SESSIONS) or ())
+
+    # Drop the other sessions of a deleted user
+    def end_sessions(self, sessions, conn):
+        for sock in sessions or ():
+            if sock is not conn.sock and sock in self.connections:
+                self.remove_connection(self.connections[sock])
+
+    # Remove connection from active sockets
+    def remove_connection(self, conn):
+        if conn.sock not in self.connections:
+            return
+        del self.connections[conn.sock]
+        self.dirty.discard(conn)
+        self.selector.unregister(conn.sock)
+        conn.sock.close()
+        print('Removed {}:{} from active sockets'.format(conn.addr[0], conn.addr[1]))
+        if conn.username:
+            self.users.detach(conn.username, SESSIONS, conn.sock) # later messages go to other sessions or the mailbox
+            print('{} logged off.'.format(conn.username))
+
+    # Queue text for conn (one frame for framed clients, answering the frame being handled unless
+    # request_id is given); written out at the end of the loop iteration.
+    # While a login backlog is being replayed, the text waits behind it, and behind a fence
+    # until the log caught up (see hold)
+    def send(self, conn, text, opcode=OP_TEXT, request_id=None):
+        if conn.sock not in self.connections:
+            return
+        request_id = conn.request_id if request_id is None else request_id
+        if conn.fences:
+            self.encode(conn, conn.unsynced, text, opcode, request_id)
+        elif conn.backlog is not None:
+            self.encode(conn, conn.deferred, text, opcode, request_id)
+        else:
+            self.encode(conn, conn.outbox, text, opcode, request_id)
+        self.dirty.add(conn)
+
+    # Append text (str, or a queued message already in bytes) to buffer as the client expects it
+    # (prefixed with a frame header for framed clients)
+    def encode(self, conn, buffer, text, opcode=OP_TEXT, request_id=0):
+        data = text if isinstance(text, bytes) else text.encode(encoding=ENCODING)
+        if conn.reader is not None:
+            buffer += pack_header(opcode, request_id, len(data))
+        buffer += data
+
+    # Top the outbox up to mailbox_chunk from the login backlog; once it runs out, release the deferred output
+    def pump_backlog(self, conn):
+        while conn.backlog is not None and len(conn.outbox) < self.mailbox_chunk:
+            chunk = next(conn.backlog, None)
+            if chunk is None:
+                conn.backlog = None
+                conn.outbox += conn.deferred
+                conn.deferred = bytearray()
+            else:
+                self.encode(conn, conn.outbox, b''.join(message + b'\n' for message in chunk), request_id=conn.backlog_id)
+
+    # Flush every connection that had output queued during this loop iteration
+    def flush_dirty(self):
+        dirty, self.dirty = self.dirty, set()
+        for conn in dirty:
+            if conn.sock in self.connections:
+                self.flush(conn)
+
+    # Write as much of the outbox as the kernel accepts; wait for EVENT_WRITE on the rest
+    def flush(self, conn):
+        self.pump_backlog(conn)
+        try:
+            sent = conn.sock.send(conn.outbox)
+        except (BlockingIOError, InterruptedError):
+            sent = 0
+        except OSError:
+            self.remove_connection(conn)
+            return
+        del conn.outbox[:sent]
+        self.pump_backlog(conn)
+        events = selectors.EVENT_READ | selectors.EVENT_WRITE if conn.outbox else selectors.EVENT_READ
+        if self.selector.get_key(conn.sock).events != events:
+            self.selector.modify(conn.sock, events, conn)
+
+    # Read client input and hand it to the handler of the current state
+    def read(self, conn):
+        if conn.reader is not None:
+            self.read_frames(conn)
+            return
+        try:
+            data = conn.sock.recv(BUFFER_SIZE)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            data = b''
+        if not data:
+            self.remove_connection(conn)
+            return
+        conn.last_input = time.monotonic()
+
+        # A HELLO as the very first input switches the connection to the framed protocol
+        first_input, conn.first_input = conn.first_input, False
+        if first_input and is_hello(data):
+            conn.reader = FrameReader(self.max_payload)
+            conn.reader.feed(data)
+            self.process_frames(conn)
+            return
+        self.dispatch(conn, data.decode(encoding=ENCODING, errors='replace'))
+
+    # Hand one input to the handler of the connection's state, timed under that state (or hold
+    # it while a password is being checked)
+    def dispatch(self, conn, text):
+        if conn.waiting:
+            conn.held.append(text)
+            return
+        with self.inputs.time(conn.state):
+            self.handlers[conn.state](conn, text)
+
+    # Fill the connection's frame buffer and process every complete frame
+    def read_frames(self, conn):
+        try:
+            count = conn.reader.recv_into(conn.sock)
+        except (BlockingIOError, InterruptedError):
+            return
+        except ProtocolError as error:
+            self.protocol_error(conn, error)
+            return
+        except OSError:
+            count = 0
+        if count == 0:
+            self.remove_connection(conn)
+            return
+        conn.last_input = time.monotonic()
+        self.process_frames(conn)
+
+    # Dispatch buffered frames; payloads are decoded straight from the receive buffer
+    def process_frames(self, conn):
+        try:
+            # Stop early if a handler closed the connection (e.g. account deletion) or waits for a password
+            while conn.sock in self.connections and not conn.waiting:
+                frame = conn.reader.next_frame()
+                if frame is None:
+                    return
+                opcode, conn.request_id, payload = frame
+                if opcode == OP_TEXT and not conn.commands:
+                    self.dispatch(conn, str(payload, ENCODING, 'replace'))
+                elif opcode == OP_COMMAND and conn.commands:
+                    self.run_command(conn, payload)
+                elif opcode == OP_PONG:
+                    pass # only counts as input
+                elif opcode == OP_HELLO:
+                    conn.peer_max_payload = unpack_hello(payload)
+                    flags = hello_flags(payload) & FLAGS
+                    conn.commands = bool(flags & FLAG_COMMANDS)
+                    conn.heartbeat = bool(flags & FLAG_HEARTBEAT)
+                    conn.outbox += pack_hello(OP_HELLO_ACK, self.max_payload, flags)
+                    self.dirty.add(conn)
+                    if not conn.commands:
+                        self.send(conn, WELCOME_PROMPT)
+                else:
+                    raise ProtocolError('unexpected opcode {}'.format(opcode))
+        except ProtocolError as error:
+            self.protocol_error(conn, error)
+
+    # Tell a framed client what went wrong, then drop it
+    def protocol_error(self, conn, error):
+        print('{}:{} protocol error: {}'.format(conn.addr[0], conn.addr[1], error))
+        self.send(conn, str(error), opcode=OP_ERROR)
+        self.flush(conn)
+        self.remove_connection(conn)
+
+    # Parse a menu choice, returning None for non-numeric input
+    def parse_choice(self, text):
+        try:
+            return int(text)
+        except ValueError:
+            return None
+
+    # Handles 1) user creation and 2) login for users
+    def on_welcome(self, conn, text):
+        choice = self.parse_choice(text)
+        if choice == 1:
+            conn.state = CREATE_USERNAME
+            self.send(conn, CREATE_USERNAME_PROMPT)
+        elif choice == 2:
+            conn.attempt_num = 1
+            conn.state = LOGIN_USERNAME
+            self.send(conn, LOGIN_USERNAME_PROMPT)
+        else:
+            self.send(conn, '{} is not a valid option. Please enter either 1 or 2!'.format(text.strip()))
+            self.send(conn, WELCOME_PROMPT)
+
+    # Handles user creation for new users (username step)
+    def on_create_username(self, conn, text):
+        username = text.strip()
+        if username not in self.users:
+            conn.pending = username
+            conn.state = CREATE_PASSWORD
+            self.send(conn, CREATE_PASSWORD_PROMPT)
+        # Username has already been taken (re-enter)
+        else:
+            self.send(conn, '{} is already taken. Please enter a unique username.\n'.format(username))
+            self.send(conn, CREATE_USERNAME_PROMPT)
+
+    # Handles user creation for new users (password step): hashed off the loop, then create_account
+    def on_create_password(self, conn, text):
+        self.offload(conn, self.users.hash_password(text.strip()), self.create_account)
+
+    def create_account(self, conn, password):
+        username = conn.pending
+        # Update user information (another client may have taken the username while this one typed its password)
+        ticket = self.users.create(username, password, **{SESSIONS: (conn.sock,)})
+        if ticket is None:
+            self.send(conn, '{} is already taken. Please enter a unique username.\n'.format(username))
+            conn.state = CREATE_USERNAME
+            self.send(conn, CREATE_USERNAME_PROMPT)
+            return
+        self.hold(conn, ticket)
+
+        # Confirm success of account creation
+        print('{}:{} successfully created account with username: {}'.format(conn.addr[0], conn.addr[1], username))
+        self.send(conn, '\nSuccessfully created account with username: {}\n'.format(username))
+        self.enter_chatroom(conn, username)
+
+    # Handles login for existing user (username step)
+    def on_login_username(self, conn, text):
+        username = text.strip()
+        if username in self.users:
+            conn.pending = username
+            conn.state = LOGIN_PASSWORD
+            self.send(conn, LOGIN_PASSWORD_PROMPT)
+        else:
+            self.send(conn, '\n{} is not a valid username.\n'.format(username))
+            self.login_failed(conn, 'Failed to login. You have {} remaining attempt(s).\n')
+
+    # Handles login for existing user (password step): checked off the loop, then finish_login
+    def on_login_password(self, conn, text):
+        self.offload(conn, self.users.check_password(conn.pending, text.strip()), self.finish_login)
+
+    def finish_login(self, conn, correct):
+        username = conn.pending
+        if not correct:
+            self.send(conn, '\nIncorrect password.\n')
+            self.login_failed(conn, 'Failed to login. You have {} remaining attempts.\n')
+            return
+
+        # add this session to the user's sessions and take the mailbox in one step
+        mailbox = self.users.attach(username, SESSIONS, conn.sock) or []
+        print('{} successfully logged via {}:{}'.format(username, conn.addr[0], conn.addr[1]))
+        self.send(conn, '\nSuccessfully logged in\n')
+
+        # No mail to send
+        if len(mailbox) == 0:
+            self.send(conn, '\nYou do not have any queued messages.')
+        # Send mail, a chunk at a time as the socket drains (the chatroom prompts follow it)
+        else:
+            self.send(conn, '\nWelcome back, {}. Unread messages:\n'.format(username))
+            conn.backlog = chunk_messages(mailbox, self.mailbox_chunk)
+            conn.backlog_id = conn.request_id
+        self.enter_chatroom(conn, username)
+
+    # Retry login or fall back to the welcome page once attempts run out
+    def login_failed(self, conn, remaining_message):
+        if conn.attempt_num < LOGIN_ATTEMPTS:
+            self.send(conn, remaining_message.format(LOGIN_ATTEMPTS-conn.attempt_num))
+            conn.attempt_num += 1
+            conn.state = LOGIN_USERNAME
+            self.send(conn, LOGIN_USERNAME_PROMPT)
+        else:
+            self.send(conn, 'Failed to login. Returning to the welcome page.\n')
+            conn.state = WELCOME
+            self.send(conn, WELCOME_PROMPT)
+
+    # Let user know all other users available for messaging, then show the menu
+    def enter_chatroom(self, conn, username):
+        conn.username = username
+        conn.pending = None
+        self.send(conn, '\nWelcome to chatroom!\nAll users:\n')
+        self.list_users(conn)
+        self.show_menu(conn)
+
+    # Queue the numbered list of all users, one page per write
+    def list_users(self, conn):
+        for page in list_pages(self.users):
+            self.send(conn, page)
+
+    def show_menu(self, conn):
+        conn.state = MENU
+        self.send(conn, MENU_PROMPT)
+
+    # Main chat application menu
+    def on_menu(self, conn, text):
+        choice = self.parse_choice(text)
+        if choice == 1:
+            conn.state = SEND_RECIPIENT
+            self.send(conn, RECIPIENT_PROMPT)
+        elif choice == 2:
+            self.send(conn, '\nAll users:\n')
+            self.list_users(conn)
+            self.show_menu(conn)
+        elif choice == 3:
+            conn.state = DELETE_CONFIRM
+            self.send(conn, CONFIRM_PROMPT)
+        elif choice == 4:
+            conn.state = SEARCH_QUERY
+            self.send(conn, SEARCH_PROMPT)
+        elif choice == 5:
+            conn.state = GROUP_COMMAND
+            self.send(conn, GROUP_PROMPT)
+        else:
+            self.send(conn, '\n{} is not a valid option. Please enter either 1, 2, 3, 4, or 5.'.format(text.strip()))
+            self.show_menu(conn)
+
+    # Solicit target user
+    def on_send_recipient(self, conn, text):
+        dst_username = text.strip()
+        # Client specified target user that does not exist - return to menu
+        if dst_username not in self.users:
+            self.send(conn, 'Target user {} does not exist!\n'.format(dst_username))
+            self.show_menu(conn)
+            return
+        conn.pending = dst_username
+        conn.state = SEND_MESSAGE
+        self.send(conn, MESSAGE_PROMPT)
+
+    # Deliver message directly if target is online, otherwise to its mailbox
+    def on_send_message(self, conn, text):
+        dst_username = conn.pending
+        conn.pending = None
+        refusal = self.limits.check(conn.username, dst_username)
+        if refusal is not None:
+            self.send(conn, '\n{}\n'.format(refusal))
+            self.show_menu(conn)
+            return
+        text = '<{}> {}'.format(conn.username, text)
+        message = text.encode(encoding=ENCODING) # queued and sent as bytes
+        ticket, sessions = self.users.append(dst_username, message, direct=SESSIONS)
+        if ticket is None:
+            self.send(conn, 'Target user {} does not exist!\n'.format(dst_username))
+            self.show_menu(conn)
+            return
+        self.hold(conn, ticket)
+
+        # Target user is online so deliver message immediately, to every session it is logged in from
+        if sessions:
+            for sock in sessions:
+                self.send(self.connections[sock], message, request_id=0)
+            self.send(conn, '\nMessage delivered to active user.\n')
+            print('(DELIVERED TO USER) <to {}> {}'.format(dst_username, text))
+        # Target user is currently offline so deliver message to mailbox
+        else:
+            self.send(conn, '\nMessage delivered to mailbox.\n')
+            print('(DELIVERED TO MAILBOX) <to {}> {}'.format(dst_username, text))
+        self.show_menu(conn)
+
+    # Delete account once the user types confirm
+    def on_delete_confirm(self, conn, text):
+        if text.strip() == 'confirm':
+            username = conn.username
+            ticket, sessions = self.users.delete(username, direct=SESSIONS)
+            self.hold(conn, ticket)
+            self.end_sessions(sessions, conn)
+            conn.username = None
+            self.close_when_released(conn)
+            print('{} deleted account.'.format(username))
+        else:
+            self.show_menu(conn)
+
+    # Show the first page of users matching a prefix or pattern
+    def on_search_query(self, conn, text):
+        prefix, pattern = parse_search(text)
+        self.show_search_page(conn, prefix, pattern, '')
+
+    # Show the next page of the current search, or go back to the menu
+    def on_search_more(self, conn, text):
+        prefix, pattern, cursor = conn.pending
+        conn.pending = None
+        if text.strip() == 'more':
+            self.show_search_page(conn, prefix, pattern, cursor)
+        else:
+            self.show_menu(conn)
+
+    def show_search_page(self, conn, prefix, pattern, cursor):
+        page, cursor = search_page(self.users, prefix, pattern, cursor)
+        self.send(conn, page)
+        if cursor:
+            conn.pending = (prefix, pattern, cursor)
+            conn.state = SEARCH_MORE
+            self.send(conn, MORE_PROMPT)
+        else:
+            self.show_menu(conn)
+
+    # Create/join/leave/list groups, or pick the group to send to
+    def on_group_command(self, conn, text):
+        reply, ticket, group = group_command(self.users, conn.username, text)
+        self.hold(conn, ticket)
+        self.send(conn, reply)
+        if group is None:
+            self.show_menu(conn)
+            return
+        conn.pending = group
+        conn.state = GROUP_MESSAGE
+
+    # Hand the message to every online session of the other members in one pass, queue it in the
+    # mailboxes of the offline ones (the same bytes everywhere)
+    def on_group_message(self, conn, text):
+        group = conn.pending
+        conn.pending = None
+        refusal = self.limits.check(conn.username)
+        if refusal is not None:
+            self.send(conn, '\n{}\n'.format(refusal))
+            self.show_menu(conn)
+            return
+        text = '[{}] <{}> {}'.format(group, conn.username, text)
+        message = text.encode(encoding=ENCODING)
+        result = self.users.append_group(group, conn.username, message, direct=SESSIONS)
+        if result is None:
+            self.send(conn, 'You are not in group {}!\n'.format(group))
+        else:
+            ticket, mailed, online = result
+            for _, sessions in online:
+                for sock in sessions:
+                    self.send(self.connections[sock], message, request_id=0)
+            self.hold(conn, ticket)
+            self.send(conn, '\nMessage delivered to {} active and {} offline member(s).\n'.format(len(online), len(mailed)))
+            print('(DELIVERED TO GROUP) <to {}> {}'.format(group, text))
+        self.show_menu(conn)
+
+    # Command mode: run one command and answer it with a RESULT frame (its output, if any, before
+    # it). A handler returning None answers later (CREATE and LOGIN, once the password is done)
+    def run_command(self, conn, payload):
+        try:
+            verb, fields = parse_command(payload)
+            check_login(verb, conn.username, conn.username is None or self.is_session(conn))
+        except CommandError as error:
+            self.send_result(conn, False, str(error))
+            return
+        with self.inputs.time('command_' + verb.lower()):
+            try:
+                text = self.command_handlers[verb](conn, *fields)
+            except CommandError as error:
+                self.send_result(conn, False, str(error))
+                return
+            if text is not None and conn.sock in self.connections:
+                self.send_result(conn, True, text)
+
+    def send_result(self, conn, ok, text):
+        self.send(conn, (RESULT_OK if ok else RESULT_ERROR) + text.encode(encoding=ENCODING), opcode=OP_RESULT)
+
+    def command_create(self, conn, username, password):
+        conn.pending = username.strip()
+        self.offload(conn, self.users.hash_password(password.strip()), self.command_created)
+
+    def command_created(self, conn, password):
+        username = conn.pending
+        ticket = self.users.create(username, password, **{SESSIONS: (conn.sock,)})
+        if ticket is None:
+            self.send_result(conn, False, '{} is already taken. Please enter a unique username.'.format(username))
+            return
+        self.hold(conn, ticket)
+        conn.username = username
+        print('{}:{} successfully created account with username: {}'.format(conn.addr[0], conn.addr[1], username))
+        self.send_result(conn, True, 'Successfully created account with username: {}'.format(username))
+
+    def command_login(self, conn, username, password):
+        conn.pending = username.strip()
+        self.offload(conn, self.users.check_password(conn.pending, password.strip()), self.command_logged_in)
+
+    # The backlog goes out in text frames answering the LOGIN (and the RESULT after them)
+    def command_logged_in(self, conn, correct):
+        username = conn.pending
+        mailbox = self.users.attach(username, SESSIONS, conn.sock) if correct else None
+        if mailbox is None: # wrong password, or deleted in the meantime
+            self.send_result(conn, False, 'Incorrect username or password.')
+            return
+        conn.username = username
+        print('{} successfully logged via {}:{}'.format(username, conn.addr[0], conn.addr[1]))
+        if mailbox:
+            conn.backlog = chunk_messages(mailbox, self.mailbox_chunk)
+            conn.backlog_id = conn.request_id
+        self.send_result(conn, True, 'Successfully logged in. {} queued message(s).'.format(len(mailbox)))
+
+    def command_send(self, conn, dst_username, text):
+        dst_username = dst_username.strip()
+        refusal = self.limits.check(conn.username, dst_username)
+        if refusal is not None:
+            raise CommandError(refusal)
+        text = '<{}> {}'.format(conn.username, text)
+        message = text.encode(encoding=ENCODING)
+        ticket, sessions = self.users.append(dst_username, message, direct=SESSIONS)
+        if ticket is None:
+            raise CommandError('Target user {} does not exist!'.format(dst_username))
+        self.hold(conn, ticket)
+        for sock in sessions or ():
+            self.send(self.connections[sock], message, request_id=0)
+        if sessions:
+            print('(DELIVERED TO USER) <to {}> {}'.format(dst_username, text))
+            return 'Message delivered to active user.'
+        print('(DELIVERED TO MAILBOX) <to {}> {}'.format(dst_username, text))
+        return 'Message delivered to mailbox.'
+
+    def command_gsend(self, conn, group, text):
+        group = group.strip()
+        refusal = self.limits.check(conn.username)
+        if refusal is not None:
+            raise CommandError(refusal)
+        text = '[{}] <{}> {}'.format(group, conn.username, text)
+        message = text.encode(encoding=ENCODING)
+        result = self.users.append_group(group, conn.username, message, direct=SESSIONS)
+        if result is None:
+            raise CommandError('You are not in group {}!'.format(group))
+        ticket, mailed, online = result
+        for _, sessions in online:
+            for sock in sessions:
+                self.send(self.connections[sock], message, request_id=0)
+        self.hold(conn, ticket)
+        print('(DELIVERED TO GROUP) <to {}> {}'.format(group, text))
+        return 'Message delivered to {} active and {} offline member(s).'.format(len(online), len(mailed))
+
+    def command_group(self, conn, command):
+        text, ticket = group_request(self.users, conn.username, command)
+        self.hold(conn, ticket)
+        return text
+
+    # Matching usernames in text frames of at most MAX_PAGE names each; the RESULT counts them
+    def command_list(self, conn, search):
+        prefix, pattern = parse_search(search)
+        count = 0
+        for page in user_pages(self.users, prefix, pattern):
+            self.send(conn, page)
+            count += page.count('\n')
+        return '{} user(s)'.format(count)
+
+    # Answer once the deletion is durable, then drop the connection
+    def command_delete(self, conn):
+        username = conn.username
+        ticket, sessions = self.users.delete(username, direct=SESSIONS)
+        self.hold(conn, ticket)
+        self.end_sessions(sessions, conn)
+        conn.username = None
+        self.send_result(conn, True, 'Account {} deleted.'.format(username))
+        self.close_when_released(conn)
+        print('{} deleted account.'.format(username))
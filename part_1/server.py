@@ -1,12 +1,58 @@
 '''
 This file implements server functionality of chat application.
 
-Usage: python3 server.py
+The server work done for each client input (storing a message, replaying a login backlog,
+listing users, ...) is timed per prompt in the 'chat_part1_input' timer, next to gauges for the
+connected sockets, mailboxes and outbound queues; --metrics-port/--metrics-json export them.
+
+Framed clients may choose command mode (commands.py) in their HELLO instead of the prompt flow;
+their commands are run by serve_commands, on a handshake worker until they log in.
+
+Every socket gets TCP keepalive, and logged in framed clients that answer heartbeats are pinged
+after --heartbeat seconds of silence and dropped after --idle-timeout (heartbeat.py), so a hung or
+vanished client gives back its socket, thread and sessions.
+
+Sends (the send and group prompts, SEND and GSEND commands) count against per-user rate limits
+(common/limits.py); one over a limit is answered with the reason instead of being delivered. In
+threaded mode at most --max-in-flight sends are queued or waiting for the log at once.
+
+Usage: python3 server.py [--mode threaded|selectors] [--host IP_ADDRESS] [--port PORT]
+                         [--spill-dir PATH] [--mailbox-cap BYTES] [--mailbox-budget BYTES]
+                         [--metrics-port PORT] [--metrics-json PATH] [--hash-workers N] [--kdf-cost LOG_N]
+                         [--heartbeat SECONDS] [--idle-timeout SECONDS] [--send-rate N] [--send-burst N]
+                         [--receive-rate N] [--receive-burst N] [--max-in-flight N]
 '''
 # Import relevant python packages
-from collections import defaultdict
-from socket import socket, AF_INET, SOCK_STREAM, SOL_SOCKET, SO_REUSEADDR
-from threading import Thread
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+import os
+from socket import socket, timeout, AF_INET, IPPROTO_TCP, SOCK_STREAM, SOL_SOCKET, SO_REUSEADDR, SOMAXCONN, TCP_NODELAY
+import sys
+from threading import Lock, Thread
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.mailbox import MEMORY_BUDGET, USER_CAP, Spill
+from common.limits import (MAX_IN_FLIGHT, RECEIVE_BURST, RECEIVE_RATE, SEND_BURST, SEND_RATE, Limits, limit_gauges,
+                           limits_from_args)
+from common.metrics import METRICS_INTERVAL, Metrics, export_metrics, store_gauges
+from common.passwords import HASH_WORKERS, LOG_N, Passwords
+from common.user_store import MAILBOX_CHUNK, UserStore, chunk_messages
+from common.wal import FSYNC_WINDOW, SEGMENT_SIZE, SNAPSHOT_INTERVAL, NullLog, WriteAheadLog
+
+from commands import (CREATE, DELETE, GROUP, GSEND, LIST, LOGIN, SEND, CommandError, check_login, group_request,
+                      parse_command, user_pages)
+from heartbeat import HEARTBEAT, IDLE_TIMEOUT, Heartbeat, keepalive
+from outbound import (DISCONNECTED, DROPPED, OUTBOUND_QUEUE, POLICIES, POLICY, QUEUED, SEND_TIMEOUT, OutboundQueue,
+                      OutboundStats, deliver, deliver_group)
+from protocol import (CONFIRM_PROMPT, CREATE_PASSWORD_PROMPT, CREATE_USERNAME_PROMPT, FLAG_COMMANDS, FLAG_HEARTBEAT,
+                      GROUP_PROMPT, LOGIN_PASSWORD_PROMPT, LOGIN_USERNAME_PROMPT, MAX_PAYLOAD, MENU_PROMPT, MESSAGE_PROMPT, MORE_PROMPT,
+                      OP_COMMAND, OP_ERROR, OP_TEXT, RECIPIENT_PROMPT, SEARCH_PROMPT, WELCOME_PROMPT, FramedSocket,
+                      ProtocolError, accept_hello, pack_frame, pack_result)
+from registry import SESSIONS, ConnectionRegistry
+from selector_server import (CREATE_PASSWORD, DELETE_CONFIRM, GROUP_COMMAND, GROUP_MESSAGE, INPUT_TIMER, LOGIN_PASSWORD,
+                             MENU, SEARCH_MORE, SEARCH_QUERY, SEND_MESSAGE, SEND_RECIPIENT, SelectorServer, group_command,
+                             list_pages, parse_search, raise_fd_limit, search_page)
 
 # Constants/configurations
 ENCODING    = 'utf-8' # message encoding
@@ -17,139 +63,430 @@ SERVER_IP      = '100.90.130.16' # REPLACE ME with output of ipconfig getifaddr
 MAX_CLIENTS    = 100
 LOGIN_ATTEMPTS = 3
 
+HANDSHAKE_WORKERS = 32 # concurrent account creation/login handshakes
+HANDSHAKE_BACKLOG = 1024 # accepted connections allowed to wait for a handshake worker
+HANDSHAKE_TIMEOUT = 30.0 # seconds a client may take to answer each handshake prompt
+STATS_INTERVAL    = 0 # seconds between handshake and outbound stats lines (0 disables)
+
+class HandshakeStats:
+    '''
+    Accept backlog metrics for the threaded server
+        - accepted: connections accepted so far
+        - queued: accepted connections waiting for a handshake worker
+        - active: handshakes currently running
+        - completed, failed, timed_out, rejected: finished handshakes by outcome
+        - max_queue_wait: longest time (seconds) a connection waited for a worker
+    '''
+    def __init__(self) -> None:
+        self.lock           = Lock()
+        self.accepted       = 0
+        self.queued         = 0
+        self.active         = 0
+        self.completed      = 0
+        self.failed         = 0
+        self.timed_out      = 0
+        self.rejected       = 0
+        self.max_queue_wait = 0.0
+
+    def on_accept(self):
+        with self.lock:
+            self.accepted += 1
+            self.queued += 1
+
+    def on_reject(self):
+        with self.lock:
+            self.queued -= 1
+            self.rejected += 1
+
+    def on_start(self, queue_wait):
+        with self.lock:
+            self.queued -= 1
+            self.active += 1
+            self.max_queue_wait = max(self.max_queue_wait, queue_wait)
+
+    # outcome is one of 'completed', 'failed', 'timed_out'
+    def on_finish(self, outcome):
+        with self.lock:
+            self.active -= 1
+            setattr(self, outcome, getattr(self, outcome) + 1)
+
+    def __str__(self):
+        with self.lock:
+            return ('handshakes: accepted={} queued={} active={} completed={} failed={} timed_out={} '
+                    'rejected={} max_queue_wait_ms={:.1f}').format(
+                self.accepted, self.queued, self.active, self.completed, self.failed, self.timed_out,
+                self.rejected, self.max_queue_wait * 1000)
+
+# Periodically print handshake and outbound delivery stats
+def stats_thread(stats, outbound_stats, interval):
+    while True:
+        time.sleep(interval)
+        print(stats)
+        print(outbound_stats)
+
+# Ping silent clients and reap the ones that stopped answering, every heartbeat.tick seconds
+def heartbeat_thread(heartbeat, connections):
+    alive = lambda queue: queue in connections and not queue.stalled
+    while True:
+        time.sleep(heartbeat.tick)
+        heartbeat.run(time.monotonic(), alive, OutboundQueue.ping, OutboundQueue.reap)
+
 # Remove sock from active sockets
-def remove_connection(sock, addr, active_sockets):
-    assert sock in active_sockets, 'ERROR: remove_connection encountered corrupted active_sockets'
-    active_sockets.remove(sock)
+def remove_connection(sock, addr, connections):
+    removed = connections.remove(sock)
+    assert removed, 'ERROR: remove_connection encountered corrupted connections'
     sock.close()
     print('Removed {}:{} from active sockets'.format(addr[0], addr[1]))
 
-# Handles user creation for new users
-def create_user(sock, addr, users, active_sockets):
+# Disconnect the other sessions of a deleted user, like stalled ones: each one's own thread sees its
+# connection end and removes it
+def end_sessions(sessions, sock):
+    for session in sessions or ():
+        if session is not sock:
+            session.reap()
+
+# Handles user creation for new users (inputs: timer of the server work done per prompt)
+def create_user(sock, addr, users, connections, inputs):
     # Solicit username
-    sock.send('\nPlease enter a username: '.encode(encoding=ENCODING))
+    sock.send(CREATE_USERNAME_PROMPT.encode(encoding=ENCODING))
     username = sock.recv(BUFFER_SIZE)
     if not username:
-        remove_connection(sock, addr, active_sockets)
+        remove_connection(sock, addr, connections)
         return
     username = username.decode(encoding=ENCODING).strip() # get the username in string without \n
     
     # New username
     if username not in users:
         # Solicit password
-        sock.send('Please enter a password.'.encode(encoding=ENCODING))
+        sock.send(CREATE_PASSWORD_PROMPT.encode(encoding=ENCODING))
         password = sock.recv(BUFFER_SIZE)
         if not password:
-            remove_connection(sock, addr, active_sockets)
+            remove_connection(sock, addr, connections)
             return
         password = password.decode(encoding=ENCODING).strip()
 
-        # Update user information
-        users[username]['socket']   = sock
-        users[username]['password'] = password
-        users[username]['mailbox']  = []
+        with inputs.time(CREATE_PASSWORD):
+            # Update user information (another client may have taken the username while this one typed its password)
+            ticket = connections.create(sock, username, users.hash_password(password).result())
+            if ticket is None:
+                sock.send('{} is already taken. Please enter a unique username.\n'.format(username).encode(encoding=ENCODING))
+            else:
+                users.sync(ticket) # durable before we confirm
+
+                # Confirm success of account creation
+                print('{}:{} successfully created account with username: {}'.format(addr[0], addr[1], username))
+                sock.send('\nSuccessfully created account with username: {}\n'.format(username).encode(encoding=ENCODING))
+        if ticket is None:
+            return create_user(sock, addr, users, connections, inputs)
 
-        # Confirm success of account creation
-        print('{}:{} successfully created account with username: {}'.format(addr[0], addr[1], username))
-        sock.send('\nSuccessfully created account with username: {}\n'.format(username).encode(encoding=ENCODING))
-        
         return username
     # Username has already been taken (re-enter)
     else:
         sock.send('{} is already taken. Please enter a unique username.\n'.format(username).encode(encoding=ENCODING))
-        return create_user(sock, addr, users, active_sockets)
+        return create_user(sock, addr, users, connections, inputs)
     
 # Handles login for existing user
-def login(sock, addr, users, active_sockets, attempt_num):
+def login(sock, addr, users, connections, attempt_num, inputs, mailbox_chunk=MAILBOX_CHUNK):
     # Solicit username
-    sock.send('\nPlease enter your username.'.encode(encoding=ENCODING))
+    sock.send(LOGIN_USERNAME_PROMPT.encode(encoding=ENCODING))
     username = sock.recv(BUFFER_SIZE)
     if not username:
-        remove_connection(sock, addr, active_sockets)
+        remove_connection(sock, addr, connections)
         return
     username = username.decode(encoding=ENCODING).strip() # get the username in string without \n
 
     # Username exists
     if username in users:
         # Solicit password
-        sock.send('Please enter your password.'.encode(encoding=ENCODING))
+        sock.send(LOGIN_PASSWORD_PROMPT.encode(encoding=ENCODING))
         password = sock.recv(BUFFER_SIZE)
         if not password:
-            remove_connection(sock, addr, active_sockets)
+            remove_connection(sock, addr, connections)
             return
         password = password.decode(encoding=ENCODING).strip()
 
-        # Entered correct password
-        if password == users[username]['password']:
-            # update user's active socket
-            users[username]['socket'] = sock
+        with inputs.time(LOGIN_PASSWORD):
+            # Entered correct password
+            correct = users.check_password(username, password).result()
+            if correct:
+                # add this session to the user's sessions and take the mailbox in one step, so no
+                # message slips in between (later ones are sent to the sessions directly)
+                mailbox = connections.login(sock, username) or []
 
-            print('{} successfully logged via {}:{}'.format(username, addr[0], addr[1]))
-            sock.send('\nSuccessfully logged in\n'.encode(encoding=ENCODING))
+                print('{} successfully logged via {}:{}'.format(username, addr[0], addr[1]))
+                sock.send('\nSuccessfully logged in\n'.encode(encoding=ENCODING))
 
-            # No mail to send
-            if len(users[username]['mailbox']) == 0:
-                sock.send('\nYou do not have any queued messages.'.encode(encoding=ENCODING))
-            # Send mail and clear mailbox
-            else:
-                sock.send('\nWelcome back, {}. Unread messages:\n'.format(username).encode(encoding=ENCODING))
-                for message in users[username]['mailbox']:
-                    users[username]['socket'].send(message.encode(encoding=ENCODING))
-                users[username]['mailbox'] = []
-        
+                # No mail to send
+                if len(mailbox) == 0:
+                    sock.send('\nYou do not have any queued messages.'.encode(encoding=ENCODING))
+                # Send mail, coalesced into a few large writes (one frame each) instead of one send per message
+                else:
+                    sock.send('\nWelcome back, {}. Unread messages:\n'.format(username).encode(encoding=ENCODING))
+                    for chunk in chunk_messages(mailbox, mailbox_chunk):
+                        sock.sendall(b''.join(message + b'\n' for message in chunk))
+
+        if correct:
             return username
         # Entered incorrect password
         else:
             sock.send('\nIncorrect password.\n'.encode(encoding=ENCODING))
             if attempt_num < LOGIN_ATTEMPTS:
                 sock.send('Failed to login. You have {} remaining attempts.\n'.format(LOGIN_ATTEMPTS-attempt_num).encode(encoding=ENCODING))
-                return login(sock, addr, users, active_sockets, attempt_num+1)
+                return login(sock, addr, users, connections, attempt_num+1, inputs, mailbox_chunk)
             else:
                 sock.send('Failed to login. Returning to the welcome page.\n'.encode(encoding=ENCODING))
-                return welcome(sock, addr, users, active_sockets)
+                return welcome(sock, addr, users, connections, inputs, mailbox_chunk=mailbox_chunk)
     
     # Username does not exist
     else:
         sock.send('\n{} is not a valid username.\n'.format(username.strip()).encode(encoding=ENCODING))
         if attempt_num < LOGIN_ATTEMPTS:
             sock.send('Failed to login. You have {} remaining attempt(s).\n'.format(LOGIN_ATTEMPTS-attempt_num).encode(encoding=ENCODING))
-            return login(sock, addr, users, active_sockets, attempt_num+1)
+            return login(sock, addr, users, connections, attempt_num+1, inputs, mailbox_chunk)
         else:
             sock.send('Failed to login. Returning to the welcome page.\n'.encode(encoding=ENCODING))
-            return welcome(sock, addr, users, active_sockets)
+            return welcome(sock, addr, users, connections, inputs, mailbox_chunk=mailbox_chunk)
 
 # Handles 1) user creation and 2) login for users
-def welcome(sock, addr, users, active_sockets):
-    sock.send('\nPlease enter 1 or 2 :\n1. Create account.\n2. Login'.encode(encoding=ENCODING))
+def welcome(sock, addr, users, connections, inputs, prompt=True, mailbox_chunk=MAILBOX_CHUNK):
+    if prompt:
+        sock.send(WELCOME_PROMPT.encode(encoding=ENCODING))
     choice = sock.recv(BUFFER_SIZE)
     if not choice:
-        remove_connection(sock, addr, active_sockets)
+        remove_connection(sock, addr, connections)
         return
     choice = int(choice.decode(encoding=ENCODING))
 
     if choice == 1:
-        username = create_user(sock, addr, users, active_sockets)
+        username = create_user(sock, addr, users, connections, inputs)
     elif choice == 2:
-        username = login(sock, addr, users, active_sockets, attempt_num=1)
+        username = login(sock, addr, users, connections, 1, inputs, mailbox_chunk=mailbox_chunk)
     else:
         sock.send('{} is not a valid option. Please enter either 1 or 2!'.format(choice).encode(encoding=ENCODING))
-        welcome(sock, addr, users, active_sockets)
+        username = welcome(sock, addr, users, connections, inputs, mailbox_chunk=mailbox_chunk)
 
     return username
 
+# Runs welcome() on a handshake worker, then hands the logged in client to its own thread.
+# outbound is (OutboundStats, queue size, policy, send timeout) for the client's OutboundQueue;
+# heartbeat (None if disabled) watches logged in clients that answer PINGs; limits admits their sends
+def handshake(sock, addr, users, connections, stats, accepted_at, phase_timeout, max_payload, mailbox_chunk,
+              outbound, inputs, heartbeat=None, limits=None):
+    stats.on_start(time.monotonic() - accepted_at)
+    outcome = 'failed'
+    try:
+        # Every recv during the handshake (choice, username, password) is bounded by phase_timeout
+        sock.settimeout(phase_timeout)
+
+        # Show the welcome prompt, then pick the wire protocol from the client's first input:
+        # framed clients answer with HELLO and get the prompt again as a frame
+        sock.send(WELCOME_PROMPT.encode(encoding=ENCODING))
+        framed = accept_hello(sock, max_payload)
+        upgraded = framed is not sock
+        # Messages from other users reach this client through a bounded queue (one of its user's
+        # sessions once it logs in), so a client that stops reading never blocks their senders
+        queue = OutboundQueue(framed, users, *outbound)
+        connections.replace(sock, queue)
+        sock = queue
+        # Command mode: answers are written once per batch of commands, so Nagle would only delay them
+        if upgraded and framed.flags & FLAG_COMMANDS:
+            queue.raw.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
+            username = serve_commands(sock, addr, None, users, connections, inputs, mailbox_chunk, limits)
+            target = command_thread
+        else:
+            username = welcome(sock, addr, users, connections, inputs, prompt=upgraded, mailbox_chunk=mailbox_chunk)
+            target = client_thread
+        if username:
+            sock.settimeout(None)
+            queue.start()
+            if heartbeat is not None and upgraded and framed.flags & FLAG_HEARTBEAT:
+                heartbeat.watch(queue)
+            outcome = 'completed'
+            # Start new thread for each client user
+            Thread(target=target, args=(sock, addr, username, users, connections, inputs, limits or Limits())).start()
+    except timeout:
+        outcome = 'timed_out'
+        print('{}:{} timed out during login'.format(addr[0], addr[1]))
+        try:
+            sock.send('\nTimed out waiting for input. Disconnecting.\n'.encode(encoding=ENCODING))
+        except OSError:
+            pass
+    except ProtocolError as error:
+        print('{}:{} protocol error: {}'.format(addr[0], addr[1], error))
+        framed = sock.sock if isinstance(sock, OutboundQueue) else sock
+        if isinstance(framed, FramedSocket):
+            try:
+                sock.send(str(error).encode(encoding=ENCODING), opcode=OP_ERROR)
+            except (OSError, ProtocolError):
+                pass
+    except (OSError, ValueError):
+        pass
+    finally:
+        # Close connections that did not make it to the chatroom
+        if outcome != 'completed' and sock in connections:
+            remove_connection(sock, addr, connections)
+        stats.on_finish(outcome)
+
 # Thread for server socket to interact with each client user in chat application
-def client_thread(sock, addr, src_username, users, active_sockets):
+def client_thread(sock, addr, src_username, users, connections, inputs, limits):
+    try:
+        chatroom(sock, addr, src_username, users, connections, inputs, limits)
+    finally:
+        # Messages for a logged off session go to the user's other sessions, or its mailbox again
+        connections.logout(sock)
+
+# Thread running the commands of a logged in command mode client
+def command_thread(sock, addr, username, users, connections, inputs, limits):
+    try:
+        serve_commands(sock, addr, username, users, connections, inputs, limits=limits)
+    except ProtocolError as error:
+        print('{}:{} protocol error: {}'.format(addr[0], addr[1], error))
+        try:
+            sock.send(str(error).encode(encoding=ENCODING), opcode=OP_ERROR)
+        except (OSError, ProtocolError):
+            pass
+    except (OSError, ValueError):
+        pass
+    finally:
+        if sock in connections:
+            remove_connection(sock, addr, connections)
+            print('{} logged off.'.format(username))
+
+# Command mode: run every COMMAND frame already received, wait once for the log to hold what they
+# changed, then write all their results at once. Before login (username None) this runs on a
+# handshake worker and returns the username as soon as a CREATE/LOGIN succeeds (commands received
+# after it stay buffered for command_thread); afterwards it runs until the connection closes or the
+# account is deleted, and returns None. SEND and GSEND go through limits (no limits if None)
+def serve_commands(sock, addr, username, users, connections, inputs, mailbox_chunk=MAILBOX_CHUNK, limits=None):
+    limits = limits or Limits()
+    logging_in = username is None
+    frame = sock.recv_frame()
+    while frame is not None:
+        output, ticket, deleted = bytearray(), 0, False
+        while frame is not None:
+            opcode, request_id, payload = frame
+            if opcode != OP_COMMAND:
+                raise ProtocolError('expected a command, got opcode {}'.format(opcode))
+            try:
+                verb, fields = parse_command(payload)
+                check_login(verb, username, username is None or connections.is_session(sock, username))
+                with inputs.time('command_' + verb.lower()):
+                    text, username, command_ticket = run_command(verb, fields, sock, addr, username, users, connections,
+                                                                 output, request_id, mailbox_chunk, limits)
+                ticket = max(ticket, command_ticket)
+                output += pack_result(request_id, True, text)
+                deleted = verb == DELETE
+            except CommandError as error:
+                output += pack_result(request_id, False, str(error))
+            if deleted or (logging_in and username is not None):
+                break
+            frame = sock.next_frame()
+
+        users.sync(ticket) # durable before we confirm
+        sock.send_frames(output)
+        if deleted:
+            remove_connection(sock, addr, connections)
+            return None
+        if logging_in and username is not None:
+            return username
+        frame = sock.recv_frame()
+    return None
+
+# Run one command for username (None before login), appending the text frames it answers with
+# (a login's backlog, a listing) to output. Returns (result text, username afterwards, log ticket
+# to sync before answering); raises CommandError if the server refuses it (a send over a rate
+# limit, or while too many are in flight, included)
+def run_command(verb, fields, sock, addr, username, users, connections, output, request_id, mailbox_chunk, limits):
+    if verb == CREATE:
+        username, password = fields[0].strip(), fields[1].strip()
+        ticket = connections.create(sock, username, users.hash_password(password).result())
+        if ticket is None:
+            raise CommandError('{} is already taken. Please enter a unique username.'.format(username))
+        print('{}:{} successfully created account with username: {}'.format(addr[0], addr[1], username))
+        return 'Successfully created account with username: {}'.format(username), username, ticket
+
+    if verb == LOGIN:
+        username, password = fields[0].strip(), fields[1].strip()
+        mailbox = connections.login(sock, username) if users.check_password(username, password).result() else None
+        if mailbox is None:
+            raise CommandError('Incorrect username or password.')
+        print('{} successfully logged via {}:{}'.format(username, addr[0], addr[1]))
+        for chunk in chunk_messages(mailbox, mailbox_chunk):
+            output += pack_frame(OP_TEXT, request_id, b''.join(message + b'\n' for message in chunk))
+        return 'Successfully logged in. {} queued message(s).'.format(len(mailbox)), username, 0
+
+    if verb == SEND:
+        dst_username = fields[0].strip()
+        text = '<{}> {}'.format(username, fields[1])
+        refusal = limits.admit(username, dst_username)
+        if refusal is not None:
+            raise CommandError(refusal)
+        try:
+            outcome, ticket = deliver(users, dst_username, text.encode(encoding=ENCODING))
+        finally:
+            limits.leave()
+        if outcome == QUEUED:
+            print('(DELIVERED TO USER) <to {}> {}'.format(dst_username, text))
+            return 'Message delivered to active user.', username, 0
+        if outcome == DROPPED:
+            print('(DROPPED) <to {}> {}'.format(dst_username, text))
+            raise CommandError('{} is not keeping up with messages. Message dropped.'.format(dst_username))
+        if outcome == DISCONNECTED:
+            print('(DISCONNECTED USER) <to {}> {}'.format(dst_username, text))
+            return ('{} is not keeping up with messages and was disconnected. Message delivered to mailbox.'.format(
+                dst_username), username, 0)
+        if ticket is None:
+            raise CommandError('Target user {} does not exist!'.format(dst_username))
+        print('(DELIVERED TO MAILBOX) <to {}> {}'.format(dst_username, text))
+        return 'Message delivered to mailbox.', username, ticket
+
+    if verb == GSEND:
+        group = fields[0].strip()
+        text = '[{}] <{}> {}'.format(group, username, fields[1])
+        refusal = limits.admit(username)
+        if refusal is not None:
+            raise CommandError(refusal)
+        try:
+            result = deliver_group(users, group, username, text.encode(encoding=ENCODING))
+        finally:
+            limits.leave()
+        if result is None:
+            raise CommandError('You are not in group {}!'.format(group))
+        ticket, queued, mailed = result
+        print('(DELIVERED TO GROUP) <to {}> {}'.format(group, text))
+        return 'Message delivered to {} active and {} offline member(s).'.format(queued, mailed), username, ticket
+
+    if verb == GROUP:
+        text, ticket = group_request(users, username, fields[0])
+        return text, username, ticket
+
+    if verb == LIST:
+        prefix, pattern = parse_search(fields[0])
+        count = 0
+        for page in user_pages(users, prefix, pattern):
+            output += pack_frame(OP_TEXT, request_id, page.encode(encoding=ENCODING))
+            count += page.count('\n')
+        return '{} user(s)'.format(count), username, 0
+
+    # DELETE: the caller closes the connection once the result is written
+    ticket, sessions = users.delete(username, direct=SESSIONS)
+    end_sessions(sessions, sock)
+    print('{} deleted account.'.format(username))
+    return 'Account {} deleted.'.format(username), None, ticket
+
+# Main chat application menu for a logged in user
+def chatroom(sock, addr, src_username, users, connections, inputs, limits):
     # Let user know all other users available for messaging
     sock.send('\nWelcome to chatroom!\nAll users:\n'.encode(encoding=ENCODING))
-    for index, username in enumerate(users):
-        sock.send('{}. {}\n'.format(index, username).encode(encoding=ENCODING))
+    for page in list_pages(users):
+        sock.send(page.encode(encoding=ENCODING))
 
     while True:
         try:
-            sock.send('\nPlease enter 1, 2, or 3:\n1. Send message.\n2. List all users.\n3. Delete your account.'.encode(encoding=ENCODING))
+            sock.send(MENU_PROMPT.encode(encoding=ENCODING))
             choice = sock.recv(BUFFER_SIZE)
             if not choice:
-                remove_connection(sock, addr, active_sockets)
+                remove_connection(sock, addr, connections)
                 print('{} logged off.'.format(src_username))
                 return
             choice = int(choice.decode(encoding=ENCODING))
@@ -157,96 +494,319 @@ def client_thread(sock, addr, src_username, users, active_sockets):
             # Send message to another user
             if choice == 1:
                 # Solicit target user
-                sock.send('\nEnter username of message recipient:'.encode(encoding=ENCODING))
+                sock.send(RECIPIENT_PROMPT.encode(encoding=ENCODING))
                 dst_username = sock.recv(BUFFER_SIZE)
                 if not dst_username:
-                    remove_connection(sock, addr, active_sockets)
+                    remove_connection(sock, addr, connections)
                     print('{} logged off.'.format(src_username))
                     return
                 dst_username = dst_username.decode(encoding=ENCODING).strip()
-                
-                # Client specified target user that does not exist - return to general chat application loop
-                if dst_username not in users:
-                    sock.send('Target user {} does not exist!\n'.format(dst_username).encode(encoding=ENCODING))
-                    continue
-                
-                # Solicit message
-                sock.send('Enter your message: '.encode(encoding=ENCODING))
+
+                with inputs.time(SEND_RECIPIENT):
+                    # Client specified target user that does not exist - return to general chat application loop
+                    if dst_username not in users:
+                        sock.send('Target user {} does not exist!\n'.format(dst_username).encode(encoding=ENCODING))
+                        continue
+
+                    # Solicit message
+                    sock.send(MESSAGE_PROMPT.encode(encoding=ENCODING))
                 message = sock.recv(BUFFER_SIZE)
                 if not message:
-                    remove_connection(sock, addr, active_sockets)
+                    remove_connection(sock, addr, connections)
                     print('{} logged off.'.format(src_username))
                     return
-                message = '<{}> {}'.format(src_username, message.decode(encoding=ENCODING))
+                with inputs.time(SEND_MESSAGE):
+                    text = '<{}> {}'.format(src_username, message.decode(encoding=ENCODING))
+                    message = text.encode(encoding=ENCODING) # queued and sent as bytes
 
-                # Target user is online so deliver message immediately
-                if users[dst_username]['socket'] in active_sockets:
-                    users[dst_username]['socket'].send(message.encode(encoding=ENCODING))
-                    sock.send('\nMessage delivered to active user.\n'.encode(encoding=ENCODING))
-                    print('(DELIVERED TO USER) <to {}> {}'.format(dst_username, message))
+                    # Over the sender's or recipient's rate limit, or too many sends in flight: refused at once
+                    refusal = limits.admit(src_username, dst_username)
+                    if refusal is not None:
+                        sock.send('\n{}\n'.format(refusal).encode(encoding=ENCODING))
+                        continue
+                    # Target user is online: hand the message to the outbound queue of each of its
+                    # sessions (never waits on their sockets); otherwise queue it in the mailbox.
+                    # The in-flight slot is given back before answering, so a sender that stops
+                    # reading cannot keep it
+                    try:
+                        outcome, ticket = deliver(users, dst_username, message)
+                        if outcome not in (QUEUED, DROPPED, DISCONNECTED) and ticket is not None:
+                            users.sync(ticket) # durable before we confirm
+                    finally:
+                        limits.leave()
+                    if outcome == QUEUED:
+                        sock.send('\nMessage delivered to active user.\n'.encode(encoding=ENCODING))
+                        print('(DELIVERED TO USER) <to {}> {}'.format(dst_username, text))
+                        continue
+                    if outcome == DROPPED:
+                        sock.send('\n{} is not keeping up with messages. Message dropped.\n'.format(dst_username).encode(encoding=ENCODING))
+                        print('(DROPPED) <to {}> {}'.format(dst_username, text))
+                        continue
+                    # The queue hands the message to the mailbox once the connection is closed
+                    if outcome == DISCONNECTED:
+                        sock.send('\n{} is not keeping up with messages and was disconnected. Message delivered to mailbox.\n'.format(dst_username).encode(encoding=ENCODING))
+                        print('(DISCONNECTED USER) <to {}> {}'.format(dst_username, text))
+                        continue
 
-                # Target user is currently offline so deliver message to mailbox
-                else:
-                    users[dst_username]['mailbox'].append(message)
-                    sock.send('\nMessage delivered to mailbox.\n'.encode(encoding=ENCODING))
-                    print('(DELIVERED TO MAILBOX) <to {}> {}'.format(dst_username, message))
+                    # Target user was deleted in the meantime
+                    if ticket is None:
+                        sock.send('Target user {} does not exist!\n'.format(dst_username).encode(encoding=ENCODING))
+
+                    # Target user is currently offline so deliver message to mailbox
+                    else:
+                        sock.send('\nMessage delivered to mailbox.\n'.encode(encoding=ENCODING))
+                        print('(DELIVERED TO MAILBOX) <to {}> {}'.format(dst_username, text))
 
             elif choice == 2:
-                sock.send('\nAll users:\n'.encode(encoding=ENCODING))
-                for index, username in enumerate(users):
-                    sock.send('{}. {}\n'.format(index, username).encode(encoding=ENCODING))
+                with inputs.time(MENU):
+                    sock.send('\nAll users:\n'.encode(encoding=ENCODING))
+                    for page in list_pages(users):
+                        sock.send(page.encode(encoding=ENCODING))
 
             elif choice == 3:
-                sock.send('\nType confirm to delete your current account'.encode(encoding=ENCODING))
+                sock.send(CONFIRM_PROMPT.encode(encoding=ENCODING))
                 confirm = sock.recv(BUFFER_SIZE)
                 if not confirm:
-                    remove_connection(sock, addr, active_sockets)
+                    remove_connection(sock, addr, connections)
                     print('{} logged off.'.format(src_username))
                     return
-                confirm = confirm.decode(encoding=ENCODING).strip()
-                if confirm == 'confirm':
-                    del users[src_username]
-                    remove_connection(sock, addr, active_sockets)
-                    print('{} deleted account.'.format(src_username))
+                with inputs.time(DELETE_CONFIRM):
+                    confirm = confirm.decode(encoding=ENCODING).strip()
+                    if confirm == 'confirm':
+                        ticket, sessions = users.delete(src_username, direct=SESSIONS)
+                        end_sessions(sessions, sock)
+                        users.sync(ticket)
+                        remove_connection(sock, addr, connections)
+                        print('{} deleted account.'.format(src_username))
+                        return
+
+            # Search users by prefix or pattern, one page at a time
+            elif choice == 4:
+                sock.send(SEARCH_PROMPT.encode(encoding=ENCODING))
+                search = sock.recv(BUFFER_SIZE)
+                if not search:
+                    remove_connection(sock, addr, connections)
+                    print('{} logged off.'.format(src_username))
                     return
+                prefix, pattern = parse_search(search.decode(encoding=ENCODING))
+                cursor = ''
+                state = SEARCH_QUERY
+                while True:
+                    with inputs.time(state):
+                        page, cursor = search_page(users, prefix, pattern, cursor)
+                        sock.send(page.encode(encoding=ENCODING))
+                        if cursor:
+                            sock.send(MORE_PROMPT.encode(encoding=ENCODING))
+                    if not cursor:
+                        break
+                    state = SEARCH_MORE
+                    more = sock.recv(BUFFER_SIZE)
+                    if not more:
+                        remove_connection(sock, addr, connections)
+                        print('{} logged off.'.format(src_username))
+                        return
+                    if more.decode(encoding=ENCODING).strip() != 'more':
+                        break
+
+            # Create/join/leave/list groups, or send a message to every other member of one
+            elif choice == 5:
+                sock.send(GROUP_PROMPT.encode(encoding=ENCODING))
+                command = sock.recv(BUFFER_SIZE)
+                if not command:
+                    remove_connection(sock, addr, connections)
+                    print('{} logged off.'.format(src_username))
+                    return
+                with inputs.time(GROUP_COMMAND):
+                    reply, ticket, group = group_command(users, src_username, command.decode(encoding=ENCODING))
+                    users.sync(ticket)
+                    sock.send(reply.encode(encoding=ENCODING))
+                if group is None:
+                    continue
+                message = sock.recv(BUFFER_SIZE)
+                if not message:
+                    remove_connection(sock, addr, connections)
+                    print('{} logged off.'.format(src_username))
+                    return
+                with inputs.time(GROUP_MESSAGE):
+                    text = '[{}] <{}> {}'.format(group, src_username, message.decode(encoding=ENCODING))
+                    message = text.encode(encoding=ENCODING)
+                    refusal = limits.admit(src_username)
+                    if refusal is not None:
+                        sock.send('\n{}\n'.format(refusal).encode(encoding=ENCODING))
+                        continue
+                    # One shared message: into the outbound queues of online members, the mailboxes of the others
+                    try:
+                        result = deliver_group(users, group, src_username, message)
+                        if result is not None:
+                            users.sync(result[0]) # durable before we confirm
+                    finally:
+                        limits.leave()
+                    if result is None:
+                        sock.send('You are not in group {}!\n'.format(group).encode(encoding=ENCODING))
+                        continue
+                    ticket, queued, mailed = result
+                    sock.send('\nMessage delivered to {} active and {} offline member(s).\n'.format(queued, mailed).encode(encoding=ENCODING))
+                    print('(DELIVERED TO GROUP) <to {}> {}'.format(group, text))
 
             else:
-                sock.send('\n{} is not a valid option. Please enter either 1, 2, or 3.'.format(choice).encode(encoding=ENCODING))
+                sock.send('\n{} is not a valid option. Please enter either 1, 2, 3, 4, or 5.'.format(choice).encode(encoding=ENCODING))
 
         # If we're unable to send a message, close connection.  
         except:
-            remove_connection(sock, addr, active_sockets)
+            remove_connection(sock, addr, connections)
             print('{} logged off.'.format(src_username))
             return
 
+# Parse command line options
+def parse_args():
+    parser = ArgumentParser(description='Chat application server (part 1).')
+    parser.add_argument('--mode', choices=['threaded', 'selectors'], default='threaded',
+                        help='threaded: one thread per client; selectors: single-threaded event loop')
+    parser.add_argument('--host', default=SERVER_IP, help='IP address to bind')
+    parser.add_argument('--port', type=int, default=PORT, help='port to bind')
+    parser.add_argument('--handshake-workers', type=int, default=HANDSHAKE_WORKERS,
+                        help='threads running account creation/login concurrently (threaded mode)')
+    parser.add_argument('--handshake-backlog', type=int, default=HANDSHAKE_BACKLOG,
+                        help='connections allowed to wait for a handshake worker before new ones are refused')
+    parser.add_argument('--handshake-timeout', type=float, default=HANDSHAKE_TIMEOUT,
+                        help='seconds a client may take to answer each login/creation prompt')
+    parser.add_argument('--stats-interval', type=float, default=STATS_INTERVAL,
+                        help='seconds between handshake and outbound stats lines (0 disables)')
+    parser.add_argument('--outbound-queue', type=int, default=OUTBOUND_QUEUE,
+                        help='messages queued for an online recipient before --outbound-policy applies (threaded mode)')
+    parser.add_argument('--outbound-policy', choices=POLICIES, default=POLICY,
+                        help='what to do with a message for a recipient whose queue is full: drop it, spill it '
+                             'to the mailbox, or disconnect the recipient (threaded mode)')
+    parser.add_argument('--send-timeout', type=float, default=SEND_TIMEOUT,
+                        help='seconds a message may take to write before its recipient is disconnected (threaded mode)')
+    parser.add_argument('--heartbeat', type=float, default=HEARTBEAT,
+                        help='seconds without input before a client is pinged; also the TCP keepalive idle time '
+                             '(0 disables both)')
+    parser.add_argument('--idle-timeout', type=float, default=IDLE_TIMEOUT,
+                        help='seconds without input before a client that answers pings (or, in selectors mode, '
+                             'one that has not logged in) is disconnected')
+    parser.add_argument('--send-rate', type=float, default=SEND_RATE,
+                        help='messages per second each user may keep sending (0: unlimited)')
+    parser.add_argument('--send-burst', type=int, default=SEND_BURST,
+                        help='messages a user may send at once before --send-rate applies')
+    parser.add_argument('--receive-rate', type=float, default=RECEIVE_RATE,
+                        help='messages per second each user may be sent (0: unlimited)')
+    parser.add_argument('--receive-burst', type=int, default=RECEIVE_BURST,
+                        help='messages a user may be sent at once before --receive-rate applies')
+    parser.add_argument('--max-in-flight', type=int, default=MAX_IN_FLIGHT,
+                        help='sends handled at once before new ones are refused (0: no cap; threaded mode)')
+    parser.add_argument('--hash-workers', type=int, default=HASH_WORKERS,
+                        help='processes hashing and checking passwords (0: on the thread serving the client)')
+    parser.add_argument('--kdf-cost', type=int, default=LOG_N,
+                        help='scrypt cost of new password hashes, as log2 of its iterations')
+    parser.add_argument('--wal', metavar='PATH',
+                        help='write-ahead log for accounts and mailboxes (replayed on start; in-memory only if omitted)')
+    parser.add_argument('--fsync-window', type=float, default=FSYNC_WINDOW,
+                        help='seconds the log waits to group concurrent writes into one fsync')
+    parser.add_argument('--segment-size', type=int, default=SEGMENT_SIZE,
+                        help='bytes after which the log starts a new segment and compacts the full one')
+    parser.add_argument('--snapshot-interval', type=float, default=SNAPSHOT_INTERVAL,
+                        help='seconds between snapshots of the log (0 disables compaction)')
+    parser.add_argument('--max-payload', type=int, default=MAX_PAYLOAD,
+                        help='largest message (bytes) accepted from framed-protocol clients')
+    parser.add_argument('--mailbox-chunk', type=int, default=MAILBOX_CHUNK,
+                        help='bytes of queued messages sent per write when a user logs in')
+    parser.add_argument('--spill-dir', metavar='PATH',
+                        help='directory large mailboxes spill their older messages to (a temporary one if omitted)')
+    parser.add_argument('--mailbox-cap', type=int, default=USER_CAP,
+                        help='estimated bytes of one user\'s queued messages kept in memory before they spill to disk')
+    parser.add_argument('--mailbox-budget', type=int, default=MEMORY_BUDGET,
+                        help='estimated bytes of queued messages kept in memory over all users before mailboxes spill')
+    parser.add_argument('--metrics-port', type=int,
+                        help='serve input timings and connection/mailbox gauges on http://127.0.0.1:PORT/metrics '
+                             '(Prometheus text)')
+    parser.add_argument('--metrics-json', metavar='PATH', help='write the metrics as JSON to PATH periodically')
+    parser.add_argument('--metrics-interval', type=float, default=METRICS_INTERVAL,
+                        help='seconds between JSON metrics dumps')
+    return parser.parse_args()
+
 def main():
+    args = parse_args()
+
     # Creates server socket with IPv4 and TCP
     server = socket(AF_INET, SOCK_STREAM)
     server.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1) # allow for multiple clients
 
     # Remember to run 'ipconfig getifaddr en0' and update SERVER_IP
-    server.bind((SERVER_IP, PORT))
-    server.listen(MAX_CLIENTS) # accept up to MAX_CLIENTS active connections
-    
-    active_sockets = [] # running list of active client sockets
+    server.bind((args.host, args.port))
+
     '''
-    'users' is a hashmap to store all client data
+    'users' is a sharded, lock-striped store of all client data (common/user_store.py)
         - key: username
-        - values: 'password', 'socket', 'mailbox'
+        - values: 'password', 'sessions' (the user's logged in connections; threaded mode: their
+          OutboundQueues), 'mailbox'
+    Passwords are hashed in --hash-workers processes, so a login storm never holds up other clients.
+    Accounts and undelivered mail survive restarts when a write-ahead log is configured. Past
+    --mailbox-cap (per user) or --mailbox-budget (in total), older undelivered mail spills to disk.
     '''
-    users = defaultdict(dict)
+    wal = WriteAheadLog(args.wal, args.fsync_window, args.segment_size, args.snapshot_interval) if args.wal else NullLog()
+    passwords = Passwords(args.hash_workers, args.kdf_cost)
+    users = UserStore(wal, spill=Spill(args.spill_dir, args.mailbox_cap, args.mailbox_budget), passwords=passwords,
+                      sessions=())
+    metrics = Metrics()
+    store_gauges(metrics, users)
+    limits = limits_from_args(args)
+    limit_gauges(metrics, limits)
+    heartbeat = Heartbeat(args.heartbeat, args.idle_timeout) if args.heartbeat > 0 else None
+    if heartbeat is not None:
+        metrics.gauge('chat_heartbeat_watched', 'Connections watched by the heartbeat', lambda: len(heartbeat))
+        metrics.gauge('chat_heartbeat_reaped', 'Connections dropped for not answering heartbeats',
+                      lambda: heartbeat.reaped)
+
+    # Event-driven mode: one thread multiplexes every connection
+    if args.mode == 'selectors':
+        raise_fd_limit()
+        server.listen(SOMAXCONN)
+        selector_server = SelectorServer(server, users, args.max_payload, args.mailbox_chunk, metrics, heartbeat, limits)
+        export_metrics(metrics, args.metrics_port, args.metrics_json, args.metrics_interval)
+        selector_server.serve_forever()
+        return
+
+    server.listen(MAX_CLIENTS) # accept up to MAX_CLIENTS active connections
+    connections = ConnectionRegistry(users) # active client sockets, by fd and by username
+
+    # Handshakes run on a bounded worker pool so the accept loop never waits on a human typing
+    stats = HandshakeStats()
+    handshakes = ThreadPoolExecutor(max_workers=args.handshake_workers, thread_name_prefix='handshake')
+    outbound = (OutboundStats(), args.outbound_queue, args.outbound_policy, args.send_timeout)
+    inputs = metrics.timer(INPUT_TIMER, 'Client inputs handled by the part 1 server', 'state')
+    metrics.gauge('chat_connections', 'Connected client sockets', lambda: len(connections))
+    metrics.gauge('chat_outbound_messages', 'Messages waiting in outbound queues', lambda: outbound[0].depth)
+    metrics.gauge('chat_handshakes_queued', 'Accepted connections waiting for a handshake worker', lambda: stats.queued)
+    export_metrics(metrics, args.metrics_port, args.metrics_json, args.metrics_interval)
+    if args.stats_interval > 0:
+        Thread(target=stats_thread, args=(stats, outbound[0], args.stats_interval), daemon=True).start()
+    if heartbeat is not None:
+        Thread(target=heartbeat_thread, args=(heartbeat, connections), daemon=True).start()
 
     while True:
         sock, client_addr = server.accept()
-        active_sockets.append(sock) # update active sockets list
+        stats.on_accept()
+
+        # Too many connections already waiting for a worker -- refuse instead of queueing forever
+        if stats.queued > args.handshake_backlog:
+            stats.on_reject()
+            try:
+                sock.send('\nServer is busy. Please try again later.\n'.encode(encoding=ENCODING))
+            except OSError:
+                pass
+            sock.close()
+            continue
+
+        if heartbeat is not None:
+            keepalive(sock, heartbeat.interval, heartbeat.idle_timeout)
+        connections.add(sock) # update active sockets
         print ('{}:{} connected'.format(client_addr[0], client_addr[1]))
 
         # Handle 1) user creation and 2) login
-        username = welcome(sock, client_addr, users, active_sockets)
-        if not username:
-            continue
-        # Start new thread for each client user
-        Thread(target=client_thread, args=(sock, client_addr, username, users, active_sockets)).start()
+        handshakes.submit(handshake, sock, client_addr, users, connections, stats, time.monotonic(),
+                          args.handshake_timeout, args.max_payload, args.mailbox_chunk, outbound, inputs, heartbeat,
+                          limits)
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
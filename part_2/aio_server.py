@@ -0,0 +1,339 @@
+'''
+This file implements the asyncio (grpc.aio) server mode of chat application.
+
+Every RPC is a coroutine on one event loop and MessageStream is an async generator, so an
+open message stream costs a suspended coroutine instead of a worker thread. Connected-user
+capacity is therefore bounded by memory rather than by MAX_CLIENTS. Password hashing runs in the
+store's worker processes and is awaited (asyncio.wrap_future), so a login never stalls the loop.
+
+Usage: python3 server.py --mode aio
+'''
+# Import relevant python packages
+import asyncio
+import os
+import sys
+
+import grpc
+from protos import chat_pb2
+from protos import chat_pb2_grpc
+
+from batch import apply_batch, async_chunks, format_group_message, format_message
+from interceptor import AioAdmissionInterceptor, AioMetricsInterceptor
+from tokens import TokenCache
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.limits import Limits
+from common.metrics import Metrics, store_gauges
+from common.user_store import MAILBOX_CHUNK, UserStore
+
+class AioChatAppService(chat_pb2_grpc.ChatAppServicer):
+    '''
+    'users' is the same UserStore as the threaded server (key: username, values: 'password', 'mailbox').
+    All handlers run on one event loop, so its shard locks are never contended here.
+    'wakeups' maps a username to an asyncio.Event: SendMessage and DeleteAccount set it,
+    MessageStream awaits it and then reads the mailbox. 'streams' counts the open streams of each
+    user; the last one to end (grpc.aio cancels it when the client goes away) removes both entries.
+    Changes are recorded in the store's log; waiting for an fsync happens on a worker thread so the loop keeps running.
+    FetchMailbox replays queued mail in chunks of up to 'mailbox_chunk' bytes.
+    Large mailboxes spill their older messages to 'spill', if given (see ChatAppService).
+    Passwords go through 'passwords' and sessions through 'tokens', with 'require_auth' as in ChatAppService;
+    so do the rate limits of 'limits'.
+    '''
+    def __init__(self, wal, mailbox_chunk=MAILBOX_CHUNK, spill=None, passwords=None, tokens=None,
+                 require_auth=False, limits=None) -> None:
+        super().__init__()
+        self.users = UserStore(wal, spill=spill, passwords=passwords)
+        self.tokens = tokens or TokenCache()
+        self.require_auth = require_auth
+        self.limits = limits or Limits()
+        self.wakeups = {}
+        self.streams = {}
+        self.mailbox_chunk = mailbox_chunk
+
+    # Wait for a log ticket to become durable without blocking the event loop
+    async def sync(self, ticket):
+        if ticket:
+            await asyncio.get_running_loop().run_in_executor(None, self.users.sync, ticket)
+
+    # Wake the user's message streams, if any are open
+    def wake(self, username):
+        if username in self.wakeups:
+            self.wakeups[username].set()
+
+    # Whether the caller is username (see ChatAppService.authenticate); the loop runs on meanwhile
+    async def authenticate(self, username, password, token):
+        if token and self.tokens.check(token, username):
+            return True
+        if token and not password: # a stale token alone: not worth a hash
+            return False
+        return await asyncio.wrap_future(self.users.check_password(username, password))
+
+    # Whether a send from username carrying token is allowed (see ChatAppService.authorized)
+    def authorized(self, username, token):
+        if not token:
+            return not self.require_auth
+        return self.tokens.check(token, username)
+
+    # Refuse a call that must be authenticated and is not
+    async def require(self, allowed, context):
+        if not allowed:
+            await context.abort(grpc.StatusCode.UNAUTHENTICATED, 'Incorrect username, password or token')
+
+    # Refuse a message over a rate limit (see ChatAppService.throttle)
+    async def throttle(self, sender, recipient, context):
+        refusal = self.limits.check(sender, recipient)
+        if refusal is not None:
+            await context.abort(grpc.StatusCode.RESOURCE_EXHAUSTED, refusal)
+
+    # Handles user creation for new users
+    async def CreateAccount(self, request, context):
+        token = ''
+        # New username (hashed in the pool first, unless it is already taken)
+        ticket = None
+        if request.username not in self.users:
+            password = await asyncio.wrap_future(self.users.hash_password(request.password))
+            ticket = self.users.create(request.username, password)
+        if ticket is not None:
+            success = True
+            await self.sync(ticket) # durable before we confirm
+            token = self.tokens.issue(request.username)
+            print('Successfully created account with username: {}'.format(request.username))
+            message = '\nSuccessfully created account with username: {}\n'.format(request.username)
+        # Username has already been taken (re-enter)
+        else:
+            success = False
+            message = '\n{} is already taken. Please enter a unique username!\n'.format(request.username)
+        return chat_pb2.Response(status=success, msg=message, token=token)
+
+    # Handles login for existing user, by password or token (see ChatAppService.LoginAccount)
+    async def LoginAccount(self, request, context):
+        success = False
+        token = ''
+        # Username exists
+        if request.username in self.users:
+            if request.token and self.tokens.check(request.token, request.username):
+                token = request.token
+            # Entered correct password (not checked for a stale token sent alone)
+            elif ((request.password or not request.token)
+                  and await asyncio.wrap_future(self.users.check_password(request.username, request.password))):
+                token = self.tokens.issue(request.username)
+            if token:
+                success = True
+                print('{} successfully logged in'.format(request.username))
+                message = '\nSuccessfully logged in'
+
+                # Only say how much mail is queued: the client replays it with FetchMailbox (or
+                # MessageStream delivers it), so a large backlog never has to fit in one response
+                pending = self.users.pending(request.username) or 0
+                if pending == 0:
+                    message += '\nYou do not have any queued messages.' # no mail to send
+                else:
+                    message += '\nWelcome back, {}. You have {} unread message(s).'.format(request.username, pending)
+            # Entered incorrect password
+            else:
+                message = '\nIncorrect password. Returning to the welcome page.'
+
+        # Username does not exist
+        else:
+            message = '\n{} is not a valid username. Returning to the welcome page.'.format(request.username)
+
+        return chat_pb2.Response(status=success, msg=message, token=token)
+
+    # List all user accounts
+    async def ListAccounts(self, request, context):
+        message = '\nAll users:\n' + ''.join('{}. {}\n'.format(index, username) for index, username in enumerate(self.users.usernames()))
+        return chat_pb2.Response(status=True, msg=message)
+
+    # List one page of user accounts matching a prefix/glob, from the sorted username index
+    async def ListAccountsPage(self, request, context):
+        usernames, next_cursor = self.users.page(request.prefix, request.pattern, request.cursor, request.page_size)
+        return chat_pb2.AccountPage(usernames=usernames, next_cursor=next_cursor)
+
+    # Delete client user account and its tokens (see ChatAppService.DeleteAccount)
+    async def DeleteAccount(self, request, context):
+        if request.token or self.require_auth:
+            await self.require(await self.authenticate(request.username, request.password, request.token), context)
+        self.tokens.revoke(request.username)
+        ticket, _ = self.users.delete(request.username)
+        # Wake the user's message stream so it notices the deletion and ends
+        self.wake(request.username)
+        await self.sync(ticket)
+        print('{} deleted account.'.format(request.username))
+        return chat_pb2.Response(status=True, msg='')
+
+    # Replay the queued mail in chunks of up to mailbox_chunk bytes (see ChatAppService.FetchMailbox)
+    async def FetchMailbox(self, request, context):
+        await self.require(await self.authenticate(request.username, request.password, request.token), context)
+        acked = request.HasField('cursor')
+        after = request.cursor
+        self.users.ack(request.username, after)
+        while True:
+            result = self.users.read(request.username, after, self.mailbox_chunk)
+            if not result or not result[1]:
+                return
+            first_seq, msgs = result
+            after = first_seq + len(msgs) - 1
+            if not acked:
+                self.users.ack(request.username, after)
+            yield chat_pb2.MailboxChunk(msgs=msgs, first_seq=first_seq)
+
+    # The client received every message numbered up to request.seq (see ChatAppService.Ack)
+    async def Ack(self, request, context):
+        await self.require(self.authorized(request.username, request.token), context)
+        if not self.users.ack(request.username, request.seq):
+            return chat_pb2.Response(status=False, msg='User {} does not exist!'.format(request.username))
+        return chat_pb2.Response(status=True, msg='')
+
+    # Opens message (i.e., response) stream so server can keep sending messages to client(s)
+    # (resumable with a cursor, see ChatAppService.MessageStream)
+    async def MessageStream(self, request, context):
+        if request.token or self.require_auth:
+            await self.require(await self.authenticate(request.username, request.password, request.token), context)
+        # Let user know all other users available for messaging
+        message = '\nWelcome to chatroom!\nAll users:'
+        yield chat_pb2.Msg(src_username = '', dst_username = request.username, msg = message)
+        for index, username in enumerate(self.users.usernames()):
+            message = '{}. {}'.format(index, username)
+            yield chat_pb2.Msg(src_username = '', dst_username = request.username, msg = message)
+
+        acked = request.HasField('cursor')
+        sent = request.cursor
+        self.users.ack(request.username, sent)
+        # Suspend until SendMessage queues mail; grpc.aio cancels this generator when the client goes away
+        wakeup = self.wakeups.setdefault(request.username, asyncio.Event())
+        self.streams[request.username] = self.streams.get(request.username, 0) + 1
+        try:
+            while True:
+                # Clear before reading, so mail queued after the read sets it again
+                wakeup.clear()
+                result = self.users.read(request.username, sent, self.mailbox_chunk)
+                # Account deleted
+                if result is None:
+                    return
+                first_seq, mailbox = result
+                # Nothing new: wait for SendMessage (a full chunk may have more behind it, so read again first)
+                if not mailbox:
+                    await wakeup.wait()
+                    continue
+                sent = first_seq + len(mailbox) - 1
+                if not acked:
+                    self.users.ack(request.username, sent)
+                for offset, message in enumerate(mailbox):
+                    yield chat_pb2.Msg(src_username = '', dst_username = request.username, msg = message, seq = first_seq + offset)
+        finally:
+            self.streams[request.username] -= 1
+            if not self.streams[request.username]:
+                del self.streams[request.username]
+                del self.wakeups[request.username]
+
+    # Takes incoming message from client, adds it to destination mailbox, and then acknowledges success.
+    async def SendMessage(self, request, context):
+        await self.require(self.authorized(request.src_username, request.token), context)
+        await self.throttle(request.src_username, request.dst_username, context)
+        message = format_message(request) # formatted and encoded once
+        ticket, _ = self.users.append(request.dst_username, message) # append message to target user's mailbox
+        if ticket is None:
+            return chat_pb2.Response(status=False, msg='Target user {} does not exist!'.format(request.dst_username))
+        self.wake(request.dst_username)
+        await self.sync(ticket) # durable before we acknowledge
+        return chat_pb2.Response(status=True, msg='Message delivered to user')
+
+    # Queue a batch and wake the recipients' streams; returns (per-message Responses, log ticket)
+    def queue_batch(self, msgs):
+        responses, ticket = apply_batch(self.users, msgs, lambda msg: self.authorized(msg.src_username, msg.token),
+                                        lambda msg: self.limits.check(msg.src_username, msg.dst_username))
+        for username in {msg.dst_username for msg in msgs}:
+            self.wake(username)
+        return responses, ticket
+
+    # Takes a batch of messages, adds them to destination mailboxes with one store call and one fsync,
+    # and acknowledges each message.
+    async def SendMessages(self, request, context):
+        responses, ticket = self.queue_batch(request.msgs)
+        await self.sync(ticket)
+        return chat_pb2.BatchResponse(statuses=responses)
+
+    # Client-streaming SendMessages: messages are applied in chunks as they arrive, and acknowledged
+    # (after one fsync) once the client closes the stream.
+    async def SendMessageStream(self, request_iterator, context):
+        statuses = []
+        ticket = 0
+        async for chunk in async_chunks(request_iterator):
+            responses, chunk_ticket = self.queue_batch(chunk)
+            statuses += responses
+            ticket = max(ticket, chunk_ticket)
+        await self.sync(ticket)
+        return chat_pb2.BatchResponse(statuses=statuses)
+
+    # Group RPCs (see ChatAppService.CreateGroup and the following ones)
+    async def CreateGroup(self, request, context):
+        await self.require(self.authorized(request.username, request.token), context)
+        if request.username not in self.users:
+            return chat_pb2.Response(status=False, msg='User {} does not exist!'.format(request.username))
+        ticket = self.users.create_group(request.group, request.username)
+        if ticket is None:
+            return chat_pb2.Response(status=False, msg='Group {} already exists!'.format(request.group))
+        await self.sync(ticket)
+        return chat_pb2.Response(status=True, msg='Created group {}'.format(request.group))
+
+    async def JoinGroup(self, request, context):
+        await self.require(self.authorized(request.username, request.token), context)
+        if request.username not in self.users:
+            return chat_pb2.Response(status=False, msg='User {} does not exist!'.format(request.username))
+        ticket = self.users.join_group(request.group, request.username)
+        if ticket is None:
+            return chat_pb2.Response(status=False, msg='Group {} does not exist!'.format(request.group))
+        await self.sync(ticket)
+        return chat_pb2.Response(status=True, msg='Joined group {}'.format(request.group))
+
+    async def LeaveGroup(self, request, context):
+        await self.require(self.authorized(request.username, request.token), context)
+        ticket = self.users.leave_group(request.group, request.username)
+        if ticket is None:
+            return chat_pb2.Response(status=False, msg='{} is not in group {}!'.format(request.username, request.group))
+        await self.sync(ticket)
+        return chat_pb2.Response(status=True, msg='Left group {}'.format(request.group))
+
+    async def ListGroups(self, request, context):
+        message = '\nAll groups:\n' + ''.join('{} ({} members)\n'.format(group, count) for group, count in self.users.group_names())
+        return chat_pb2.Response(status=True, msg=message)
+
+    # One shared message for every other member, then a wakeup per member whose mailbox got it
+    async def SendGroupMessage(self, request, context):
+        await self.require(self.authorized(request.src_username, request.token), context)
+        await self.throttle(request.src_username, None, context)
+        message = format_group_message(request)
+        result = self.users.append_group(request.group, request.src_username, message)
+        if result is None:
+            return chat_pb2.Response(status=False, msg='{} is not in group {}!'.format(request.src_username, request.group))
+        ticket, queued, _ = result
+        for username in queued:
+            self.wake(username)
+        await self.sync(ticket)
+        return chat_pb2.Response(status=True, msg='Message delivered to {} member(s)'.format(len(queued)))
+
+    # ChatAppService.DeliverShared is only for cluster workers, and there are none in aio mode
+    async def DeliverShared(self, request, context):
+        await context.abort(grpc.StatusCode.PERMISSION_DENIED, 'DeliverShared is only for cluster workers')
+
+    # Likewise ChatAppService.VerifyToken
+    async def VerifyToken(self, request, context):
+        await context.abort(grpc.StatusCode.PERMISSION_DENIED, 'VerifyToken is only for cluster workers')
+
+# Start the grpc.aio server and serve until terminated
+# metrics: registry the RPC timings and store gauges are recorded in (a private one by default)
+# options: grpc server options (the keepalive settings of heartbeat.py)
+# limits: rate limits and in-flight cap (common/limits.py; none by default)
+async def serve(host, port, wal, mailbox_chunk=MAILBOX_CHUNK, metrics=None, spill=None, passwords=None, tokens=None,
+                require_auth=False, options=None, limits=None):
+    metrics = metrics or Metrics()
+    limits = limits or Limits()
+    service = AioChatAppService(wal, mailbox_chunk, spill, passwords, tokens, require_auth, limits)
+    store_gauges(metrics, service.users)
+    metrics.gauge('chat_streams', 'Open MessageStreams', lambda: sum(list(service.streams.values())))
+    interceptors = [AioMetricsInterceptor(metrics)] + ([AioAdmissionInterceptor(limits)] if limits.capped else [])
+    server = grpc.aio.server(interceptors=interceptors, options=options)
+    chat_pb2_grpc.add_ChatAppServicer_to_server(service, server)
+    server.add_insecure_port('{}:{}'.format(host, port))
+    await server.start()
+    await server.wait_for_termination()
@@ -0,0 +1,70 @@
+'''
+This file implements the helpers shared by the send RPCs of the threaded and asyncio servers:
+message formatting, and the batched SendMessages and SendMessageStream.
+
+A batch is formatted into (recipient, message) pairs and queued with UserStore.append_many, which
+takes each shard lock once for the whole batch and logs it as one group; the RPC then waits for a
+single fsync covering every message. SendMessageStream applies its messages in chunks of
+STREAM_CHUNK as they arrive, so an unbounded stream never has to be held in memory.
+'''
+# Import relevant python packages
+from protos import chat_pb2
+
+# Constants/configurations
+STREAM_CHUNK = 100 # messages of a SendMessageStream applied per store call
+ENCODING     = 'utf-8'
+
+# The queued form of a Msg: formatted for display and utf-8 encoded, once (see common/user_store.py)
+def format_message(msg):
+    return "<{}> {}".format(msg.src_username, msg.msg).encode(ENCODING)
+
+# The queued form of a GroupMsg
+def format_group_message(msg):
+    return '[{}] <{}> {}'.format(msg.group, msg.src_username, msg.msg).encode(ENCODING)
+
+# Why msg may not be sent, or None if it may: allowed(msg), if given, says whether the message's
+# sender may send it (see ChatAppService.authorized); limit(msg), if given, returns the rate limit
+# it is over, if any (see common/limits.py)
+def refusal(msg, allowed=None, limit=None):
+    if allowed is not None and not allowed(msg):
+        return 'Not signed in as {}!'.format(msg.src_username)
+    return limit(msg) if limit is not None else None
+
+# Queue msgs in the store, except those refused (see refusal()); returns (per-message Responses,
+# log ticket covering them)
+def apply_batch(users, msgs, allowed=None, limit=None):
+    refusals = [refusal(msg, allowed, limit) for msg in msgs]
+    statuses, ticket = users.append_many([(msg.dst_username, format_message(msg))
+                                          for msg, refused in zip(msgs, refusals) if refused is None])
+    statuses = iter(statuses)
+    responses = []
+    for msg, refused in zip(msgs, refusals):
+        if refused is not None:
+            responses.append(chat_pb2.Response(status=False, msg=refused))
+        elif next(statuses):
+            responses.append(chat_pb2.Response(status=True, msg='Message delivered to user'))
+        else:
+            responses.append(chat_pb2.Response(status=False, msg='Target user {} does not exist!'.format(msg.dst_username)))
+    return responses, ticket
+
+# Split an iterator into lists of up to size items
+def chunks(iterator, size=STREAM_CHUNK):
+    chunk = []
+    for item in iterator:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+# Same as chunks() for an async iterator
+async def async_chunks(iterator, size=STREAM_CHUNK):
+    chunk = []
+    async for item in iterator:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
@@ -1,22 +1,47 @@
 '''
 This file implements client functionality of chat application.
 
+The prompts are read here; every request goes through the client library (sdk.py).
+
 Usage: python3 client.py IP_ADDRESS
 '''
 # Import relevant python packages
-import grpc
-from protos import chat_pb2, chat_pb2_grpc
 import sys
 from threading import Thread
 
+from sdk import ChatError, Client
+
 # Constants/configurations
-PORT = 1234 # fixed application port
+PORT         = 1234 # fixed application port
+PAGE_SIZE    = 50 # usernames listed per page
+GROUP_PROMPT = '\nGroup command -- create NAME, join NAME, leave NAME, send NAME, or list:\n'
 
-# Thread function to establish message stream with server
-# We use 'account_info' for server to identify which mailbox to check
-def msgstream_thread(account_info, client):
-    for message in client.MessageStream(account_info):
-        print(message.msg) # print incoming messages from message stream
+# Thread function printing incoming messages (the chatroom notices first); the library acknowledges
+# each message and reopens a broken stream after the last message received
+def msgstream_thread(client):
+    try:
+        for message in client.subscribe(notices=True):
+            print(message)
+    except ChatError as error:
+        print('Message stream closed: {}'.format(error))
+
+# Run one group command typed at the GROUP_PROMPT
+def group_command(client, command):
+    action, _, group = command.strip().partition(' ')
+    group = group.strip()
+    try:
+        if action == 'list':
+            groups = client.list_groups()
+            print('\nAll groups:\n' + ''.join('{} ({} members)\n'.format(name, count) for name, count in groups))
+        elif action in ('create', 'join', 'leave') and group:
+            request = {'create': client.create_group, 'join': client.join_group, 'leave': client.leave_group}[action]
+            print(request(group))
+        elif action == 'send' and group:
+            print(client.send_group(group, input("Message: ")))
+        else:
+            print('{} is not a valid group command.'.format(command))
+    except ChatError as error:
+        print(error)
 
 # Main function for client functionality
 def main():
@@ -27,49 +52,70 @@ def main():
     ip_address = str(sys.argv[1])
 
     # connect to server
-    with grpc.insecure_channel('{}:{}'.format(ip_address, PORT)) as channel:
-        client = chat_pb2_grpc.ChatAppStub(channel)
+    with Client('{}:{}'.format(ip_address, PORT), timeout=None) as client:
         print('Successfully connected to server @ {}:{}'.format(ip_address, PORT))
 
         # Account creation and login -- only exit loop if successful.
         while True:
             rpc_call = input("\nPlease enter 1 or 2 :\n1. Create account.\n2. Login\n\n")
-            if rpc_call == "1":
-                account_info = chat_pb2.AccountInfo(username = input("Username: "), password = input('Password: '))
-                account_response = client.CreateAccount(account_info)
-            elif rpc_call == "2":
-                account_info = chat_pb2.AccountInfo(username = input("Username: "), password = input('Password: '))
-                account_response = client.LoginAccount(account_info)
-            else:
+            if rpc_call not in ("1", "2"):
                 print('{} is not a valid option. Please enter either 1 or 2!'.format(rpc_call))
                 continue
-            print(account_response.msg)
-            if account_response.status:
+            request = client.create if rpc_call == "1" else client.login
+            try:
+                print(request(input("Username: "), input('Password: ')))
                 break # account creation/login successful
+            except ChatError as error:
+                print(error)
+
+        # Replay queued mail in chunks before the live message stream starts, acknowledging each chunk
+        if rpc_call == "2":
+            for message in client.fetch_mailbox():
+                print(message)
 
         # create new listening thread for when new message streams come in
-        Thread(target=msgstream_thread, args=(account_info, client), daemon=True).start()
+        Thread(target=msgstream_thread, args=(client,), daemon=True).start()
 
         while True:
-            rpc_call = input('\nPlease enter 1, 2, or 3:\n1. Send message.\n2. List all users.\n3. Delete your account.\n\n')
+            rpc_call = input('\nPlease enter 1, 2, 3, or 4:\n1. Send message.\n2. List all users.\n3. Delete your account.\n4. Groups.\n\n')
             if rpc_call == "1":
-                message = chat_pb2.Msg(src_username = account_info.username, dst_username = input("Target user: "), msg = input("Message: "))
-                client.SendMessage(message)
+                dst_usernames = [username.strip() for username in input("Target user(s), comma separated: ").split(',')]
+                text = input("Message: ")
+                # Several recipients go out as one batch with a status per message
+                for delivered, message in client.send_many([(dst_username, text) for dst_username in dst_usernames]):
+                    if not delivered:
+                        print(message)
             elif rpc_call == "2":
-                message = chat_pb2.Empty()
-                list_accounts_response = client.ListAccounts(message)
-                print(list_accounts_response.msg)
+                # One page at a time, optionally filtered by a prefix or glob pattern (e.g. bo*)
+                search = input("Username prefix or pattern (blank for all): ").strip()
+                if any(wildcard in search for wildcard in '*?['):
+                    pages = client.pages(pattern = search, page_size = PAGE_SIZE)
+                else:
+                    pages = client.pages(prefix = search, page_size = PAGE_SIZE)
+                # Pages may come back short, or empty, before the end (a pattern search stops after a
+                # bounded scan), so only an empty cursor ends the list: the next page is fetched before
+                # asking, and the prompt only comes between pages that showed something
+                print('\nUsers:')
+                found = 0
+                page = next(pages)
+                while page is not None:
+                    for username in page:
+                        print(username)
+                    found += len(page)
+                    shown, page = page, next(pages, None)
+                    if shown and page is not None and input("Press enter for more, or q to stop: ").strip() == 'q':
+                        break
+                if not found:
+                    print('No matching users.')
             elif rpc_call == "3":
-                message = chat_pb2.Empty()
-                delete_account_response = client.DeleteAccount(account_info)
-                if delete_account_response.status:
-                    print('\nAccount deletion successful. Server @ {}:{} disconnected!'.format(ip_address, PORT))
-                    sys.exit('Closing application.')
+                client.delete()
+                print('\nAccount deletion successful. Server @ {}:{} disconnected!'.format(ip_address, PORT))
+                sys.exit('Closing application.')
+            elif rpc_call == "4":
+                group_command(client, input(GROUP_PROMPT))
             else:
-                print('{} is not a valid option. Please enter either 1, 2, or 3!'.format(rpc_call))
+                print('{} is not a valid option. Please enter either 1, 2, 3, or 4!'.format(rpc_call))
                 continue
-    print('Server @ {}:{} disconnected!'.format(ip_address, PORT))
-    sys.exit('Closing application.')
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,482 @@
+'''
+This file implements the multi-process (cluster) mode of the part 2 server.
+
+One launcher starts --workers worker processes. Usernames are hash-partitioned: worker i owns
+every account with crc32(username) % workers == i (a stable hash, unlike Python's per-process
+hash()), keeps them in its own UserStore and, with --wal PATH, in its own log (PATH.w<i>; likewise
+--spill-dir). A group belongs to the worker owning crc32 of its name. Restart with the same
+--workers, or accounts are looked up on workers that do not own them.
+
+Every worker binds the same --host:--port with SO_REUSEPORT, so the kernel spreads client
+connections over the workers and clients keep using the one address. A worker answers RPCs about
+the users (or groups) it owns from its own store and forwards the others to the owner over a Unix
+domain socket (IPC_DIR/worker<i>.sock), one channel per peer:
+    - account, login, mailbox and ack RPCs go to the worker owning the username; so do
+      MessageStream and FetchMailbox, proxied for as long as the client reads them
+    - SendMessage, and every message of a SendMessages/SendMessageStream batch, goes to the worker
+      owning the recipient. Forwarded messages are queued per peer and one sender thread sends
+      whatever has gathered as a single SendMessages call, so concurrent senders share each IPC
+      round trip (and the peer's fsync) instead of paying one each
+    - group RPCs go to the worker owning the group, which queues a group message for the members
+      it owns and sends it once to every other worker owning members (DeliverShared)
+    - listings (ListAccounts, ListAccountsPage, ListGroups, the MessageStream welcome list) ask
+      every peer for its part with SCOPE metadata, so the peer answers from its own store only,
+      and merge the sorted results
+A deleted user stays a member of the groups other workers own; messages for it are dropped there,
+like messages for any user that does not exist.
+
+Session tokens live on the worker owning the user, which issues them (login RPCs go there). A
+send arriving at another worker checks its sender's token by asking the owner (VerifyToken, a
+check rather than a login) and remembers the answer for VERIFIED_TTL seconds, so a user's tokens
+are revoked everywhere at most that long after the account is deleted. Calls between workers
+(over the Unix sockets) are trusted: their senders were checked by the worker the client called.
+The same goes for admission control: the worker a client calls counts its messages against the
+rate limits and its calls against the in-flight cap, and calls from peers skip both. Each worker
+keeps its own buckets, so a client whose calls the kernel spreads over N workers may send up to N
+times its rate.
+
+A call to a peer waits at most PEER_TIMEOUT seconds (forwarded streams do not wait for a peer that
+is not up), so a worker that died or hangs cannot hold the other workers' threads: a client whose
+call needed it gets UNAVAILABLE, or a failed status for that message of a batch.
+
+Only the threaded server runs as a cluster worker.
+
+Usage: python3 cluster.py --workers N [any server.py option except --mode]
+'''
+# Import relevant python packages
+from collections import defaultdict
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+import heapq
+import multiprocessing
+from multiprocessing.connection import wait
+import os
+import shutil
+import signal
+import sys
+import tempfile
+from threading import Condition, Lock, Thread
+import zlib
+
+import grpc
+from protos import chat_pb2
+from protos import chat_pb2_grpc
+
+from batch import apply_batch, chunks, format_group_message, refusal
+from interceptor import AdmissionInterceptor, MetricsInterceptor
+from server import ChatAppService, grpc_options, make_parser
+from tokens import TokenCache
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.limits import limit_gauges, limits_from_args
+from common.mailbox import Spill
+from common.metrics import Metrics, export_metrics, store_gauges
+from common.passwords import Passwords
+from common.user_store import MAX_PAGE, PAGE_SIZE
+from common.wal import NullLog, WriteAheadLog
+
+# Constants/configurations
+WORKERS       = 4
+FORWARD_BATCH = 1000 # forwarded messages sent to a peer per SendMessages call
+SCOPE         = (('chat-scope', 'local'),) # metadata: answer from this worker's store only
+VERIFIED_TTL  = 60.0 # seconds a worker trusts a token another worker confirmed
+PEER_TIMEOUT  = 10.0 # seconds a call to another worker may take before it counts as unavailable
+ENCODING      = 'utf-8'
+
+# Worker owning a username or group name
+def owner(name, workers):
+    return zlib.crc32(name.encode(encoding=ENCODING)) % workers
+
+# Unix socket address worker index listens on for its peers
+def worker_address(ipc_dir, index):
+    return 'unix:{}'.format(os.path.join(ipc_dir, 'worker{}.sock'.format(index)))
+
+# Whether the call asked for this worker's store only
+def local_scope(context):
+    return ('chat-scope', 'local') in context.invocation_metadata()
+
+# Answer UNAVAILABLE when a call to a peer worker fails in the block (it would reach the client as UNKNOWN)
+@contextmanager
+def peer_errors(context):
+    try:
+        yield
+    except grpc.RpcError as error:
+        context.abort(grpc.StatusCode.UNAVAILABLE, 'Worker unavailable: {}'.format(error.details()))
+
+class Forwarder:
+    '''
+    Forwards SendMessage calls to one peer worker in batches
+        - pending: (Msg, Future) pairs not yet sent; guarded by lock
+    send() queues a message and returns a Future for the peer's Response. A sender thread takes
+    up to FORWARD_BATCH pending messages at a time and sends them as one SendMessages call, so the
+    batch grows with the load and each IPC round trip is shared by every message waiting for it.
+    A batch the peer does not answer within PEER_TIMEOUT fails, with every message queued behind it.
+    '''
+    def __init__(self, stub) -> None:
+        self.stub    = stub
+        self.lock    = Lock()
+        self.work    = Condition(self.lock)
+        self.pending = []
+        Thread(target=self.run, daemon=True).start()
+
+    def send(self, msg):
+        future = Future()
+        with self.lock:
+            self.pending.append((msg, future))
+            self.work.notify()
+        return future
+
+    def run(self):
+        while True:
+            with self.lock:
+                while not self.pending:
+                    self.work.wait()
+                batch = self.pending[:FORWARD_BATCH]
+                del self.pending[:FORWARD_BATCH]
+            try:
+                response = self.stub.SendMessages(chat_pb2.MsgBatch(msgs=[msg for msg, _ in batch]),
+                                                  timeout=PEER_TIMEOUT, wait_for_ready=True)
+            except grpc.RpcError as error:
+                # The peer did not answer: fail what queued meanwhile too, rather than have every
+                # batch behind this one wait out its own PEER_TIMEOUT
+                with self.lock:
+                    batch += self.pending
+                    self.pending = []
+                for _, future in batch:
+                    future.set_exception(error)
+                continue
+            for (_, future), status in zip(batch, response.statuses):
+                future.set_result(status)
+
+class ClusterChatAppService(ChatAppService):
+    '''
+    ChatAppService of worker 'index' out of 'workers': 'users' only holds the accounts (and
+    groups) this worker owns; the others are reached through 'peers' (worker index -> stub)
+    and, for SendMessage, through one Forwarder per peer. 'verified' holds the tokens of other
+    workers' users that their worker confirmed.
+    '''
+    def __init__(self, index, workers, ipc_dir, keepalive, wal, mailbox_chunk, spill, passwords=None, tokens=None,
+                 require_auth=False, limits=None) -> None:
+        super().__init__(keepalive, wal, mailbox_chunk, spill, passwords, tokens, require_auth, limits)
+        self.index = index
+        self.workers = workers
+        self.verified = TokenCache(VERIFIED_TTL, sliding=False)
+        self.peers = {}
+        self.forwarders = {}
+        for peer in range(workers):
+            if peer != index:
+                self.peers[peer] = chat_pb2_grpc.ChatAppStub(grpc.insecure_channel(worker_address(ipc_dir, peer)))
+                self.forwarders[peer] = Forwarder(self.peers[peer])
+
+    def owns(self, name):
+        return owner(name, self.workers) == self.index
+
+    # Stub of the worker owning name
+    def peer(self, name):
+        return self.peers[owner(name, self.workers)]
+
+    # Call a peer's unary RPC, passing its error on to our client (UNAVAILABLE if it did not answer)
+    def forward(self, call, request, context):
+        try:
+            return call(request, timeout=PEER_TIMEOUT, wait_for_ready=True)
+        except grpc.RpcError as error:
+            code = error.code()
+            if code == grpc.StatusCode.DEADLINE_EXCEEDED:
+                code = grpc.StatusCode.UNAVAILABLE
+            context.abort(code, error.details())
+
+    # Relay a peer's response stream; the peer's call is cancelled when our client goes away. It
+    # cannot carry a deadline, so it fails at once (UNAVAILABLE) if the peer is not up
+    def forward_stream(self, call, request, context):
+        responses = call(request)
+        context.add_callback(responses.cancel)
+        try:
+            yield from responses
+        except grpc.RpcError as error:
+            if context.is_active():
+                context.abort(error.code(), error.details())
+
+    # Response of a forwarded SendMessage (a failed status if the peer could not be reached)
+    def forwarded_status(self, future):
+        try:
+            return future.result()
+        except grpc.RpcError as error:
+            return chat_pb2.Response(status=False, msg='Worker unavailable: {}'.format(error.details()))
+
+    # Peer workers connect over their Unix sockets; clients over TCP
+    def trusted(self, context):
+        return context.peer().startswith('unix:')
+
+    # A token of another worker's user is checked by that worker (and the answer cached); raises
+    # grpc.RpcError if that worker does not answer
+    def authorized(self, username, token):
+        if not token or self.owns(username):
+            return super().authorized(username, token)
+        if self.verified.check(token, username):
+            return True
+        response = self.peer(username).VerifyToken(chat_pb2.AccountInfo(username=username, token=token),
+                                                   timeout=PEER_TIMEOUT, wait_for_ready=True)
+        if response.status:
+            self.verified.add(token, username)
+        return response.status
+
+    # Raises grpc.RpcError if the worker owning username does not answer
+    def exists(self, username):
+        if self.owns(username):
+            return username in self.users
+        page = self.peer(username).ListAccountsPage(chat_pb2.ListAccountsRequest(prefix=username, page_size=1),
+                                                    metadata=SCOPE, timeout=PEER_TIMEOUT, wait_for_ready=True)
+        return list(page.usernames[:1]) == [username]
+
+    # Every username of every worker, merged in order; raises grpc.RpcError if one does not answer
+    def usernames(self):
+        lists = [self.users.usernames()]
+        for stub in self.peers.values():
+            names = []
+            request = chat_pb2.ListAccountsRequest(page_size=MAX_PAGE)
+            while True:
+                page = stub.ListAccountsPage(request, metadata=SCOPE, timeout=PEER_TIMEOUT, wait_for_ready=True)
+                names += page.usernames
+                if not page.next_cursor:
+                    break
+                request.cursor = page.next_cursor
+            lists.append(names)
+        return list(heapq.merge(*lists))
+
+    def CreateAccount(self, request, context):
+        if self.owns(request.username):
+            return super().CreateAccount(request, context)
+        return self.forward(self.peer(request.username).CreateAccount, request, context)
+
+    def LoginAccount(self, request, context):
+        if self.owns(request.username):
+            return super().LoginAccount(request, context)
+        return self.forward(self.peer(request.username).LoginAccount, request, context)
+
+    def ListAccounts(self, request, context):
+        with peer_errors(context):
+            return super().ListAccounts(request, context)
+
+    # One page of every worker's matches from the cursor, merged. A worker may return a short page
+    # (a glob search scanned MAX_SCAN entries) and resume from its own cursor, so the merged page
+    # stops at the smallest such cursor: nothing before it is left out of this page or the next.
+    def ListAccountsPage(self, request, context):
+        if local_scope(context):
+            return super().ListAccountsPage(request, context)
+        futures = [stub.ListAccountsPage.future(request, metadata=SCOPE, timeout=PEER_TIMEOUT, wait_for_ready=True)
+                   for stub in self.peers.values()]
+        pages = [self.users.page(request.prefix, request.pattern, request.cursor, request.page_size)]
+        with peer_errors(context):
+            pages += [(list(page.usernames), page.next_cursor) for page in (future.result() for future in futures)]
+        limit = min(max(1, request.page_size or PAGE_SIZE), MAX_PAGE)
+        bound = min((cursor for _, cursor in pages if cursor), default='')
+        usernames = [username for username in heapq.merge(*(names for names, _ in pages)) if not bound or username <= bound]
+        if len(usernames) > limit:
+            return chat_pb2.AccountPage(usernames=usernames[:limit], next_cursor=usernames[limit - 1])
+        return chat_pb2.AccountPage(usernames=usernames, next_cursor=bound)
+
+    def DeleteAccount(self, request, context):
+        if self.owns(request.username):
+            return super().DeleteAccount(request, context)
+        return self.forward(self.peer(request.username).DeleteAccount, request, context)
+
+    def FetchMailbox(self, request, context):
+        if self.owns(request.username):
+            return super().FetchMailbox(request, context)
+        return self.forward_stream(self.peer(request.username).FetchMailbox, request, context)
+
+    def Ack(self, request, context):
+        if self.owns(request.username):
+            return super().Ack(request, context)
+        if not self.trusted(context):
+            with peer_errors(context):
+                self.require(self.authorized(request.username, request.token), context)
+        return self.forward(self.peer(request.username).Ack, request, context)
+
+    def MessageStream(self, request, context):
+        if self.owns(request.username):
+            with peer_errors(context): # the welcome list asks every worker
+                yield from super().MessageStream(request, context)
+            return
+        yield from self.forward_stream(self.peer(request.username).MessageStream, request, context)
+
+    def SendMessage(self, request, context):
+        if self.owns(request.dst_username):
+            return super().SendMessage(request, context)
+        if not self.trusted(context):
+            with peer_errors(context):
+                self.require(self.authorized(request.src_username, request.token), context)
+            self.throttle(request.src_username, request.dst_username, context)
+        return self.forwarded_status(self.forwarders[owner(request.dst_username, self.workers)].send(request))
+
+    # Queue the messages this worker owns and forward the others (all in flight at once), except
+    # those refused (see batch.refusal, and those whose sender's worker did not answer); returns (per-message Responses in request order, log ticket of the local ones)
+    def route_batch(self, msgs, allowed=None, limit=None):
+        local = []
+        forwarded = []
+        responses = [None] * len(msgs)
+        for position, msg in enumerate(msgs):
+            try:
+                refused = refusal(msg, allowed, limit)
+            except grpc.RpcError as error:
+                refused = 'Worker unavailable: {}'.format(error.details())
+            if refused is not None:
+                responses[position] = chat_pb2.Response(status=False, msg=refused)
+            elif self.owns(msg.dst_username):
+                local.append(position)
+            else:
+                forwarded.append((position, self.forwarders[owner(msg.dst_username, self.workers)].send(msg)))
+        local_responses, ticket = apply_batch(self.users, [msgs[position] for position in local])
+        for position, response in zip(local, local_responses):
+            responses[position] = response
+        for position, future in forwarded:
+            responses[position] = self.forwarded_status(future)
+        return responses, ticket
+
+    def SendMessages(self, request, context):
+        responses, ticket = self.route_batch(request.msgs, self.sender_check(context), self.sender_limit(context))
+        self.users.sync(ticket)
+        return chat_pb2.BatchResponse(statuses=responses)
+
+    def SendMessageStream(self, request_iterator, context):
+        statuses = []
+        ticket = 0
+        allowed, limit = self.sender_check(context), self.sender_limit(context)
+        for chunk in chunks(request_iterator):
+            responses, chunk_ticket = self.route_batch(chunk, allowed, limit)
+            statuses += responses
+            ticket = max(ticket, chunk_ticket)
+        self.users.sync(ticket)
+        return chat_pb2.BatchResponse(statuses=statuses)
+
+    def CreateGroup(self, request, context):
+        with peer_errors(context):
+            if self.owns(request.group):
+                return super().CreateGroup(request, context) # the user may be another worker's
+            if not self.trusted(context):
+                self.require(self.authorized(request.username, request.token), context)
+        return self.forward(self.peer(request.group).CreateGroup, request, context)
+
+    def JoinGroup(self, request, context):
+        with peer_errors(context):
+            if self.owns(request.group):
+                return super().JoinGroup(request, context) # the user may be another worker's
+            if not self.trusted(context):
+                self.require(self.authorized(request.username, request.token), context)
+        return self.forward(self.peer(request.group).JoinGroup, request, context)
+
+    def LeaveGroup(self, request, context):
+        with peer_errors(context):
+            if self.owns(request.group):
+                return super().LeaveGroup(request, context) # the user may be another worker's
+            if not self.trusted(context):
+                self.require(self.authorized(request.username, request.token), context)
+        return self.forward(self.peer(request.group).LeaveGroup, request, context)
+
+    # Every worker's groups (each group lives on one worker), one line per group, sorted
+    def ListGroups(self, request, context):
+        response = super().ListGroups(request, context)
+        if local_scope(context):
+            return response
+        header, _, lines = response.msg.partition(':\n')
+        lines = lines.splitlines()
+        futures = [stub.ListGroups.future(request, metadata=SCOPE, timeout=PEER_TIMEOUT, wait_for_ready=True)
+                   for stub in self.peers.values()]
+        with peer_errors(context):
+            for future in futures:
+                lines += future.result().msg.partition(':\n')[2].splitlines()
+        return chat_pb2.Response(status=True, msg=header + ':\n' + ''.join(line + '\n' for line in sorted(lines)))
+
+    # The group's worker queues the message for its own members, then sends it once to every
+    # other worker owning members
+    def SendGroupMessage(self, request, context):
+        if not self.trusted(context):
+            with peer_errors(context):
+                self.require(self.authorized(request.src_username, request.token), context)
+            self.throttle(request.src_username, None, context)
+        if not self.owns(request.group):
+            return self.forward(self.peer(request.group).SendGroupMessage, request, context)
+        message = format_group_message(request)
+        result = self.users.append_group(request.group, request.src_username, message)
+        if result is None:
+            return chat_pb2.Response(status=False, msg='{} is not in group {}!'.format(request.src_username, request.group))
+        ticket, queued, _ = result
+        remote = defaultdict(list)
+        for username in self.users.group_members(request.group) or []:
+            if username != request.src_username and not self.owns(username):
+                remote[owner(username, self.workers)].append(username)
+        futures = [(len(usernames), self.peers[peer].DeliverShared.future(
+                        chat_pb2.SharedMsg(msg=message, dst_usernames=usernames), timeout=PEER_TIMEOUT,
+                        wait_for_ready=True))
+                   for peer, usernames in remote.items()]
+        self.users.sync(ticket)
+        delivered = len(queued)
+        for count, future in futures:
+            try:
+                future.result()
+                delivered += count
+            except grpc.RpcError:
+                pass
+        return chat_pb2.Response(status=True, msg='Message delivered to {} member(s)'.format(delivered))
+
+# Parse command line options: server.py's plus the number of workers
+def parse_args():
+    parser = make_parser()
+    parser.description = 'Chat application server (part 2), as several worker processes.'
+    parser.add_argument('--workers', type=int, default=WORKERS, help='worker processes, each owning a share of the users')
+    args = parser.parse_args()
+    if args.mode != 'threaded':
+        parser.error('cluster workers only run in threaded mode')
+    return args
+
+# Body of worker process index: serve the public address (shared with every worker) and the IPC socket
+def run_worker(args, index, ipc_dir):
+    suffix = '.w{}'.format(index)
+    wal = (WriteAheadLog(args.wal + suffix, args.fsync_window, args.segment_size, args.snapshot_interval)
+           if args.wal else NullLog())
+    spill = Spill(args.spill_dir and args.spill_dir + suffix, args.mailbox_cap, args.mailbox_budget)
+    metrics = Metrics()
+    export_metrics(metrics, args.metrics_port and args.metrics_port + index,
+                   args.metrics_json and args.metrics_json + suffix, args.metrics_interval)
+
+    passwords = Passwords(args.hash_workers, args.kdf_cost)
+    limits = limits_from_args(args)
+    service = ClusterChatAppService(index, args.workers, ipc_dir, args.keepalive, wal, args.mailbox_chunk, spill,
+                                    passwords, TokenCache(args.token_ttl), args.require_auth, limits)
+    store_gauges(metrics, service.users)
+    limit_gauges(metrics, limits)
+    metrics.gauge('chat_streams', 'Open MessageStreams', lambda: service.streams)
+    interceptors = [MetricsInterceptor(metrics)] + ([AdmissionInterceptor(limits, service.trusted)] if limits.capped else [])
+    server = grpc.server(ThreadPoolExecutor(max_workers=args.max_clients), interceptors=interceptors,
+                         options=[('grpc.so_reuseport', 1)] + grpc_options(args))
+    chat_pb2_grpc.add_ChatAppServicer_to_server(service, server)
+    server.add_insecure_port('{}:{}'.format(args.host, args.port))
+    server.add_insecure_port(worker_address(ipc_dir, index))
+    server.start()
+    server.wait_for_termination()
+
+# Start the workers and wait; when one exits (or the launcher is terminated) stop the others,
+# since the users they own would be unreachable
+def main():
+    args = parse_args()
+    ipc_dir = tempfile.mkdtemp(prefix='chat-cluster-')
+    # Spawned (not forked) workers: gRPC does not support forking a process that may use it
+    context = multiprocessing.get_context('spawn')
+    workers = [context.Process(target=run_worker, args=(args, index, ipc_dir)) for index in range(args.workers)]
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        for worker in workers:
+            worker.start()
+        print('Started {} workers on {}:{}'.format(args.workers, args.host, args.port))
+        wait([worker.sentinel for worker in workers])
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for worker in workers:
+            worker.terminate()
+        for worker in workers:
+            worker.join()
+        shutil.rmtree(ipc_dir, ignore_errors=True)
+
+if __name__ == "__main__":
+    main()
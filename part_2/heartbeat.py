@@ -0,0 +1,43 @@
+'''
+This file implements the connection keepalive settings of the part 2 servers and client library.
+
+gRPC only learns that a client is gone when its TCP connection closes. A client whose process
+hung or whose machine dropped off the network leaves the connection open, so its MessageStream
+kept a worker thread (threaded mode) or a coroutine and its wakeup entry (aio mode) until the
+server restarted. The servers now send an HTTP/2 PING on every connection silent for `heartbeat`
+seconds and close the connection if the PING is not acknowledged within the rest of
+`idle_timeout`; closing it cancels its calls, and a cancelled MessageStream returns at once. A dead
+client is so let go at most idle_timeout seconds after it last sent anything. PINGs are answered by
+the client's gRPC core even while the application is busy, so a slow client is not mistaken for a
+dead one.
+
+Clients ping the server too (CLIENT_HEARTBEAT, only while a call is open), so a stream notices a
+dead server; the servers accept their PINGs down to MIN_CLIENT_PING apart.
+'''
+# Constants/configurations
+HEARTBEAT        = 30.0 # seconds without traffic before the server pings a connection
+IDLE_TIMEOUT     = 90.0 # seconds without traffic before a connection that does not answer is closed
+CLIENT_HEARTBEAT = 30.0 # seconds between the PINGs of a client with an open call
+CLIENT_TIMEOUT   = 20.0 # seconds a client waits for the server to acknowledge its PING
+MIN_CLIENT_PING  = 10.0 # closest client PINGs the servers accept without data in between
+
+# grpc.server()/grpc.aio.server() options for heartbeat and idle_timeout
+def server_options(heartbeat=HEARTBEAT, idle_timeout=IDLE_TIMEOUT):
+    return [
+        ('grpc.keepalive_time_ms', int(heartbeat * 1000)),
+        ('grpc.keepalive_timeout_ms', int(max(1.0, idle_timeout - heartbeat) * 1000)),
+        ('grpc.http2.ping_timeout_ms', int(max(1.0, idle_timeout - heartbeat) * 1000)), # (newer gRPC cores)
+        ('grpc.keepalive_permit_without_calls', 1), # probe connections without calls too
+        ('grpc.http2.max_pings_without_data', 0), # keep probing a connection that sends nothing
+        ('grpc.http2.min_sent_ping_interval_without_data_ms', int(heartbeat * 1000)), # (5 minutes by default)
+        ('grpc.http2.min_recv_ping_interval_without_data_ms', int(MIN_CLIENT_PING * 1000)),
+    ]
+
+# Channel options of the client library
+CLIENT_OPTIONS = [
+    ('grpc.keepalive_time_ms', int(CLIENT_HEARTBEAT * 1000)),
+    ('grpc.keepalive_timeout_ms', int(CLIENT_TIMEOUT * 1000)),
+    ('grpc.http2.ping_timeout_ms', int(CLIENT_TIMEOUT * 1000)),
+    ('grpc.keepalive_permit_without_calls', 0),
+    ('grpc.http2.max_pings_without_data', 0),
+]
@@ -0,0 +1,214 @@
+'''
+This file implements the server interceptors of the threaded and asyncio servers: the ones that
+time every RPC, and the ones that cap the RPCs handled at once.
+
+Each call is recorded in the 'chat_rpc' timer of a Metrics registry (common/metrics.py),
+labelled with the method name: call count, calls in flight, calls that raised (including
+context.abort) and a latency histogram. Streaming responses are timed until the stream ends,
+so an open MessageStream shows up as in flight for as long as its client is connected; a
+client cancelling a stream does not count as an error.
+
+The admission interceptors hold one in-flight slot of the server's Limits (common/limits.py) for
+every call but the server-streaming ones (MessageStream stays open for as long as its client is
+connected, FetchMailbox is the client reading its own mail), and answer RESOURCE_EXHAUSTED at once
+when none is left. In the threaded server a call takes its slot once a worker thread runs it, so
+the cap bounds the workers unary calls can hold and leaves the others to the message streams.
+'''
+# Import relevant python packages
+import asyncio
+import os
+import sys
+
+import grpc
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.limits import BUSY
+
+# Constants/configurations
+RPC_TIMER = 'chat_rpc'
+
+# Method name without the service, e.g. 'SendMessage' for '/ChatApp/SendMessage'
+def method_name(method):
+    return method.rsplit('/', 1)[-1]
+
+# Same handler, with its behavior timed into series (asynchronous: the behavior is a coroutine/async generator)
+def timed_handler(handler, series, asynchronous=False):
+    call, stream = (time_call_async, time_stream_async) if asynchronous else (time_call, time_stream)
+    if handler.unary_unary:
+        behavior, factory = call(handler.unary_unary, series), grpc.unary_unary_rpc_method_handler
+    elif handler.unary_stream:
+        behavior, factory = stream(handler.unary_stream, series), grpc.unary_stream_rpc_method_handler
+    elif handler.stream_unary:
+        behavior, factory = call(handler.stream_unary, series), grpc.stream_unary_rpc_method_handler
+    else:
+        behavior, factory = stream(handler.stream_stream, series), grpc.stream_stream_rpc_method_handler
+    return factory(behavior, request_deserializer=handler.request_deserializer,
+                   response_serializer=handler.response_serializer)
+
+def time_call(behavior, series):
+    def timed(request, context):
+        started = series.start()
+        failed = True
+        try:
+            response = behavior(request, context)
+            failed = False
+            return response
+        finally:
+            series.finish(started, failed)
+    return timed
+
+def time_stream(behavior, series):
+    def timed(request, context):
+        started = series.start()
+        failed = True
+        try:
+            yield from behavior(request, context)
+            failed = False
+        # The client went away: the stream is closed, not failed
+        except GeneratorExit:
+            failed = False
+            raise
+        finally:
+            series.finish(started, failed)
+    return timed
+
+def time_call_async(behavior, series):
+    async def timed(request, context):
+        started = series.start()
+        failed = True
+        try:
+            response = await behavior(request, context)
+            failed = False
+            return response
+        finally:
+            series.finish(started, failed)
+    return timed
+
+def time_stream_async(behavior, series):
+    async def timed(request, context):
+        started = series.start()
+        failed = True
+        try:
+            async for response in behavior(request, context):
+                yield response
+            failed = False
+        except (GeneratorExit, asyncio.CancelledError):
+            failed = False
+            raise
+        finally:
+            series.finish(started, failed)
+    return timed
+
+class MetricsInterceptor(grpc.ServerInterceptor):
+    '''
+    Times every RPC of the threaded server
+        - rpcs: the 'chat_rpc' timer (label: method)
+        - handlers: key: method, value: (service handler, timed handler), so a method's handler is
+          only wrapped once instead of on every call
+    '''
+    def __init__(self, metrics) -> None:
+        self.rpcs     = metrics.timer(RPC_TIMER, 'gRPC calls handled by the chat service', 'method')
+        self.handlers = {}
+
+    # Timed version of handler (cached per method)
+    def wrap(self, handler, method, asynchronous=False):
+        cached = self.handlers.get(method)
+        if cached is None or cached[0] is not handler:
+            cached = handler, timed_handler(handler, self.rpcs.labels(method_name(method)), asynchronous)
+            self.handlers[method] = cached
+        return cached[1]
+
+    def intercept_service(self, continuation, handler_call_details):
+        handler = continuation(handler_call_details)
+        if handler is None:
+            return None
+        return self.wrap(handler, handler_call_details.method)
+
+class AioMetricsInterceptor(grpc.aio.ServerInterceptor):
+    '''
+    Times every RPC of the asyncio server (see MetricsInterceptor)
+    '''
+    def __init__(self, metrics) -> None:
+        self.timing = MetricsInterceptor(metrics)
+
+    async def intercept_service(self, continuation, handler_call_details):
+        handler = await continuation(handler_call_details)
+        if handler is None:
+            return None
+        return self.timing.wrap(handler, handler_call_details.method, asynchronous=True)
+
+# Same handler, admitted through limits first (server-streaming handlers are returned as they are).
+# trusted(context), if given, says whether a call may skip admission (cluster workers calling each other)
+def admitted_handler(handler, limits, trusted=None, asynchronous=False):
+    admit = admit_async if asynchronous else admit_call
+    if handler.unary_unary:
+        behavior, factory = admit(handler.unary_unary, limits, trusted), grpc.unary_unary_rpc_method_handler
+    elif handler.stream_unary:
+        behavior, factory = admit(handler.stream_unary, limits, trusted), grpc.stream_unary_rpc_method_handler
+    else:
+        return handler
+    return factory(behavior, request_deserializer=handler.request_deserializer,
+                   response_serializer=handler.response_serializer)
+
+def admit_call(behavior, limits, trusted):
+    def admitted(request, context):
+        if trusted is not None and trusted(context):
+            return behavior(request, context)
+        if not limits.enter():
+            context.abort(grpc.StatusCode.RESOURCE_EXHAUSTED, BUSY)
+        try:
+            return behavior(request, context)
+        finally:
+            limits.leave()
+    return admitted
+
+def admit_async(behavior, limits, trusted):
+    async def admitted(request, context):
+        if trusted is not None and trusted(context):
+            return await behavior(request, context)
+        if not limits.enter():
+            await context.abort(grpc.StatusCode.RESOURCE_EXHAUSTED, BUSY)
+        try:
+            return await behavior(request, context)
+        finally:
+            limits.leave()
+    return admitted
+
+class AdmissionInterceptor(grpc.ServerInterceptor):
+    '''
+    Caps the calls the threaded server handles at once
+        - limits: Limits holding the in-flight slots
+        - trusted: function(context) telling calls that skip admission, or None
+        - handlers: key: method, value: (service handler, admitted handler), as in MetricsInterceptor
+    '''
+    def __init__(self, limits, trusted=None) -> None:
+        self.limits   = limits
+        self.trusted  = trusted
+        self.handlers = {}
+
+    # Admitted version of handler (cached per method)
+    def wrap(self, handler, method, asynchronous=False):
+        cached = self.handlers.get(method)
+        if cached is None or cached[0] is not handler:
+            cached = handler, admitted_handler(handler, self.limits, self.trusted, asynchronous)
+            self.handlers[method] = cached
+        return cached[1]
+
+    def intercept_service(self, continuation, handler_call_details):
+        handler = continuation(handler_call_details)
+        if handler is None:
+            return None
+        return self.wrap(handler, handler_call_details.method)
+
+class AioAdmissionInterceptor(grpc.aio.ServerInterceptor):
+    '''
+    Caps the calls the asyncio server handles at once (see AdmissionInterceptor)
+    '''
+    def __init__(self, limits) -> None:
+        self.admission = AdmissionInterceptor(limits)
+
+    async def intercept_service(self, continuation, handler_call_details):
+        handler = await continuation(handler_call_details)
+        if handler is None:
+            return None
+        return self.admission.wrap(handler, handler_call_details.method, asynchronous=True)
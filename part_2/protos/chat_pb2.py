@@ -13,7 +13,7 @@ _sym_db = _symbol_database.Default()
 
 
 
-DESCRIPTOR = _descriptor_pool.Default().AddSerializedFile(b'\n\nchat.proto\x12\x04\x63hat\"\x07\n\x05\x45mpty\"1\n\x0b\x41\x63\x63ountInfo\x12\x10\n\x08username\x18\x01 \x01(\t\x12\x10\n\x08password\x18\x02 \x01(\t\"\'\n\x08Response\x12\x0e\n\x06status\x18\x01 \x01(\x08\x12\x0b\n\x03msg\x18\x02 \x01(\t\">\n\x03Msg\x12\x14\n\x0csrc_username\x18\x01 \x01(\t\x12\x14\n\x0c\x64st_username\x18\x02 \x01(\t\x12\x0b\n\x03msg\x18\x03 \x01(\t2\xa9\x02\n\x07\x43hatApp\x12\x32\n\rCreateAccount\x12\x11.chat.AccountInfo\x1a\x0e.chat.Response\x12\x31\n\x0cLoginAccount\x12\x11.chat.AccountInfo\x1a\x0e.chat.Response\x12+\n\x0cListAccounts\x12\x0b.chat.Empty\x1a\x0e.chat.Response\x12\x32\n\rDeleteAccount\x12\x11.chat.AccountInfo\x1a\x0e.chat.Response\x12%\n\x0bSendMessage\x12\t.chat.Msg\x1a\x0b.chat.Empty\x12/\n\rMessageStream\x12\x11.chat.AccountInfo\x1a\t.chat.Msg0\x01\x62\x06proto3')
+DESCRIPTOR = _descriptor_pool.Default().AddSerializedFile(b'\n\nchat.proto\x12\x04\x63hat\"\x07\n\x05\x45mpty\"@\n\x0b\x41\x63\x63ountInfo\x12\x10\n\x08username\x18\x01 \x01(\t\x12\x10\n\x08password\x18\x02 \x01(\t\x12\r\n\x05token\x18\x03 \x01(\t\"6\n\x08Response\x12\x0e\n\x06status\x18\x01 \x01(\x08\x12\x0b\n\x03msg\x18\x02 \x01(\t\x12\r\n\x05token\x18\x03 \x01(\t\"Z\n\x03Msg\x12\x14\n\x0csrc_username\x18\x01 \x01(\t\x12\x14\n\x0c\x64st_username\x18\x02 \x01(\t\x12\x0b\n\x03msg\x18\x03 \x01(\t\x12\x0b\n\x03seq\x18\x04 \x01(\x04\x12\r\n\x05token\x18\x05 \x01(\t\"b\n\rStreamRequest\x12\x10\n\x08username\x18\x01 \x01(\t\x12\x10\n\x08password\x18\x02 \x01(\t\x12\x13\n\x06\x63ursor\x18\x03 \x01(\x04H\x00\x88\x01\x01\x12\r\n\x05token\x18\x04 \x01(\tB\t\n\x07_cursor\":\n\nAckRequest\x12\x10\n\x08username\x18\x01 \x01(\t\x12\x0b\n\x03seq\x18\x02 \x01(\x04\x12\r\n\x05token\x18\x03 \x01(\t\"#\n\x08MsgBatch\x12\x17\n\x04msgs\x18\x01 \x03(\x0b\x32\t.chat.Msg\"1\n\rBatchResponse\x12 \n\x08statuses\x18\x01 \x03(\x0b\x32\x0e.chat.Response\"/\n\x0cMailboxChunk\x12\x0c\n\x04msgs\x18\x01 \x03(\t\x12\x11\n\tfirst_seq\x18\x02 \x01(\x04\"Y\n\x13ListAccountsRequest\x12\x0e\n\x06prefix\x18\x01 \x01(\t\x12\x0f\n\x07pattern\x18\x02 \x01(\t\x12\x11\n\tpage_size\x18\x03 \x01(\r\x12\x0e\n\x06\x63ursor\x18\x04 \x01(\t\"5\n\x0b\x41\x63\x63ountPage\x12\x11\n\tusernames\x18\x01 \x03(\t\x12\x13\n\x0bnext_cursor\x18\x02 \x01(\t\">\n\x0cGroupRequest\x12\r\n\x05group\x18\x01 \x01(\t\x12\x10\n\x08username\x18\x02 \x01(\t\x12\r\n\x05token\x18\x03 \x01(\t\"K\n\x08GroupMsg\x12\r\n\x05group\x18\x01 \x01(\t\x12\x14\n\x0csrc_username\x18\x02 \x01(\t\x12\x0b\n\x03msg\x18\x03 \x01(\t\x12\r\n\x05token\x18\x04 \x01(\t\"/\n\tSharedMsg\x12\x0b\n\x03msg\x18\x01 \x01(\t\x12\x15\n\rdst_usernames\x18\x02 \x03(\t2\x96\x07\n\x07\x43hatApp\x12\x32\n\rCreateAccount\x12\x11.chat.AccountInfo\x1a\x0e.chat.Response\x12\x31\n\x0cLoginAccount\x12\x11.chat.AccountInfo\x1a\x0e.chat.Response\x12+\n\x0cListAccounts\x12\x0b.chat.Empty\x1a\x0e.chat.Response\x12@\n\x10ListAccountsPage\x12\x19.chat.ListAccountsRequest\x1a\x11.chat.AccountPage\x12\x32\n\rDeleteAccount\x12\x11.chat.AccountInfo\x1a\x0e.chat.Response\x12%\n\x0bSendMessage\x12\t.chat.Msg\x1a\x0b.chat.Empty\x12\x31\n\rMessageStream\x12\x13.chat.StreamRequest\x1a\t.chat.Msg0\x01\x12\x33\n\x0cSendMessages\x12\x0e.chat.MsgBatch\x1a\x13.chat.BatchResponse\x12\x35\n\x11SendMessageStream\x12\t.chat.Msg\x1a\x13.chat.BatchResponse(\x01\x12\x39\n\x0c\x46\x65tchMailbox\x12\x13.chat.StreamRequest\x1a\x12.chat.MailboxChunk0\x01\x12\'\n\x03\x41\x63k\x12\x10.chat.AckRequest\x1a\x0e.chat.Response\x12\x31\n\x0b\x43reateGroup\x12\x12.chat.GroupRequest\x1a\x0e.chat.Response\x12/\n\tJoinGroup\x12\x12.chat.GroupRequest\x1a\x0e.chat.Response\x12\x30\n\nLeaveGroup\x12\x12.chat.GroupRequest\x1a\x0e.chat.Response\x12)\n\nListGroups\x12\x0b.chat.Empty\x1a\x0e.chat.Response\x12\x32\n\x10SendGroupMessage\x12\x0e.chat.GroupMsg\x1a\x0e.chat.Response\x12\x30\n\rDeliverShared\x12\x0f.chat.SharedMsg\x1a\x0e.chat.Response\x12\x30\n\x0bVerifyToken\x12\x11.chat.AccountInfo\x1a\x0e.chat.Responseb\x06proto3')
 
 _builder.BuildMessageAndEnumDescriptors(DESCRIPTOR, globals())
 _builder.BuildTopDescriptorsAndMessages(DESCRIPTOR, 'chat_pb2', globals())
@@ -23,11 +23,31 @@ if _descriptor._USE_C_DESCRIPTORS == False:
   _EMPTY._serialized_start=20
   _EMPTY._serialized_end=27
   _ACCOUNTINFO._serialized_start=29
-  _ACCOUNTINFO._serialized_end=78
-  _RESPONSE._serialized_start=80
-  _RESPONSE._serialized_end=119
-  _MSG._serialized_start=121
-  _MSG._serialized_end=183
-  _CHATAPP._serialized_start=186
-  _CHATAPP._serialized_end=483
+  _ACCOUNTINFO._serialized_end=93
+  _RESPONSE._serialized_start=95
+  _RESPONSE._serialized_end=149
+  _MSG._serialized_start=151
+  _MSG._serialized_end=241
+  _STREAMREQUEST._serialized_start=243
+  _STREAMREQUEST._serialized_end=341
+  _ACKREQUEST._serialized_start=343
+  _ACKREQUEST._serialized_end=401
+  _MSGBATCH._serialized_start=403
+  _MSGBATCH._serialized_end=438
+  _BATCHRESPONSE._serialized_start=440
+  _BATCHRESPONSE._serialized_end=489
+  _MAILBOXCHUNK._serialized_start=491
+  _MAILBOXCHUNK._serialized_end=538
+  _LISTACCOUNTSREQUEST._serialized_start=540
+  _LISTACCOUNTSREQUEST._serialized_end=629
+  _ACCOUNTPAGE._serialized_start=631
+  _ACCOUNTPAGE._serialized_end=684
+  _GROUPREQUEST._serialized_start=686
+  _GROUPREQUEST._serialized_end=748
+  _GROUPMSG._serialized_start=750
+  _GROUPMSG._serialized_end=825
+  _SHAREDMSG._serialized_start=827
+  _SHAREDMSG._serialized_end=874
+  _CHATAPP._serialized_start=877
+  _CHATAPP._serialized_end=1795
 # @@protoc_insertion_point(module_scope)
@@ -29,6 +29,11 @@ class ChatAppStub(object):
                 request_serializer=chat__pb2.Empty.SerializeToString,
                 response_deserializer=chat__pb2.Response.FromString,
                 )
+        self.ListAccountsPage = channel.unary_unary(
+                '/chat.ChatApp/ListAccountsPage',
+                request_serializer=chat__pb2.ListAccountsRequest.SerializeToString,
+                response_deserializer=chat__pb2.AccountPage.FromString,
+                )
         self.DeleteAccount = channel.unary_unary(
                 '/chat.ChatApp/DeleteAccount',
                 request_serializer=chat__pb2.AccountInfo.SerializeToString,
@@ -41,9 +46,64 @@ class ChatAppStub(object):
                 )
         self.MessageStream = channel.unary_stream(
                 '/chat.ChatApp/MessageStream',
-                request_serializer=chat__pb2.AccountInfo.SerializeToString,
+                request_serializer=chat__pb2.StreamRequest.SerializeToString,
                 response_deserializer=chat__pb2.Msg.FromString,
                 )
+        self.SendMessages = channel.unary_unary(
+                '/chat.ChatApp/SendMessages',
+                request_serializer=chat__pb2.MsgBatch.SerializeToString,
+                response_deserializer=chat__pb2.BatchResponse.FromString,
+                )
+        self.SendMessageStream = channel.stream_unary(
+                '/chat.ChatApp/SendMessageStream',
+                request_serializer=chat__pb2.Msg.SerializeToString,
+                response_deserializer=chat__pb2.BatchResponse.FromString,
+                )
+        self.FetchMailbox = channel.unary_stream(
+                '/chat.ChatApp/FetchMailbox',
+                request_serializer=chat__pb2.StreamRequest.SerializeToString,
+                response_deserializer=chat__pb2.MailboxChunk.FromString,
+                )
+        self.Ack = channel.unary_unary(
+                '/chat.ChatApp/Ack',
+                request_serializer=chat__pb2.AckRequest.SerializeToString,
+                response_deserializer=chat__pb2.Response.FromString,
+                )
+        self.CreateGroup = channel.unary_unary(
+                '/chat.ChatApp/CreateGroup',
+                request_serializer=chat__pb2.GroupRequest.SerializeToString,
+                response_deserializer=chat__pb2.Response.FromString,
+                )
+        self.JoinGroup = channel.unary_unary(
+                '/chat.ChatApp/JoinGroup',
+                request_serializer=chat__pb2.GroupRequest.SerializeToString,
+                response_deserializer=chat__pb2.Response.FromString,
+                )
+        self.LeaveGroup = channel.unary_unary(
+                '/chat.ChatApp/LeaveGroup',
+                request_serializer=chat__pb2.GroupRequest.SerializeToString,
+                response_deserializer=chat__pb2.Response.FromString,
+                )
+        self.ListGroups = channel.unary_unary(
+                '/chat.ChatApp/ListGroups',
+                request_serializer=chat__pb2.Empty.SerializeToString,
+                response_deserializer=chat__pb2.Response.FromString,
+                )
+        self.SendGroupMessage = channel.unary_unary(
+                '/chat.ChatApp/SendGroupMessage',
+                request_serializer=chat__pb2.GroupMsg.SerializeToString,
+                response_deserializer=chat__pb2.Response.FromString,
+                )
+        self.DeliverShared = channel.unary_unary(
+                '/chat.ChatApp/DeliverShared',
+                request_serializer=chat__pb2.SharedMsg.SerializeToString,
+                response_deserializer=chat__pb2.Response.FromString,
+                )
+        self.VerifyToken = channel.unary_unary(
+                '/chat.ChatApp/VerifyToken',
+                request_serializer=chat__pb2.AccountInfo.SerializeToString,
+                response_deserializer=chat__pb2.Response.FromString,
+                )
 
 
 class ChatAppServicer(object):
@@ -67,6 +127,12 @@ class ChatAppServicer(object):
         context.set_details('Method not implemented!')
         raise NotImplementedError('Method not implemented!')
 
+    def ListAccountsPage(self, request, context):
+        """Missing associated documentation comment in .proto file."""
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
     def DeleteAccount(self, request, context):
         """Missing associated documentation comment in .proto file."""
         context.set_code(grpc.StatusCode.UNIMPLEMENTED)
@@ -85,6 +151,74 @@ class ChatAppServicer(object):
         context.set_details('Method not implemented!')
         raise NotImplementedError('Method not implemented!')
 
+    def SendMessages(self, request, context):
+        """Missing associated documentation comment in .proto file."""
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
+    def SendMessageStream(self, request_iterator, context):
+        """Missing associated documentation comment in .proto file."""
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
+    def FetchMailbox(self, request, context):
+        """Missing associated documentation comment in .proto file."""
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
+    def Ack(self, request, context):
+        """Missing associated documentation comment in .proto file."""
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
+    def CreateGroup(self, request, context):
+        """Missing associated documentation comment in .proto file."""
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
+    def JoinGroup(self, request, context):
+        """Missing associated documentation comment in .proto file."""
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
+    def LeaveGroup(self, request, context):
+        """Missing associated documentation comment in .proto file."""
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
+    def ListGroups(self, request, context):
+        """Missing associated documentation comment in .proto file."""
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
+    def SendGroupMessage(self, request, context):
+        """Missing associated documentation comment in .proto file."""
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
+    def DeliverShared(self, request, context):
+        """Missing associated documentation comment in .proto file."""
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
+    def VerifyToken(self, request, context):
+        """Between cluster workers: whether AccountInfo.token is a live token of the username (a check,
+        not a login; refused with PERMISSION_DENIED unless it comes over a worker's Unix socket)
+        """
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
 
 def add_ChatAppServicer_to_server(servicer, server):
     rpc_method_handlers = {
@@ -103,6 +237,11 @@ def add_ChatAppServicer_to_server(servicer, server):
                     request_deserializer=chat__pb2.Empty.FromString,
                     response_serializer=chat__pb2.Response.SerializeToString,
             ),
+            'ListAccountsPage': grpc.unary_unary_rpc_method_handler(
+                    servicer.ListAccountsPage,
+                    request_deserializer=chat__pb2.ListAccountsRequest.FromString,
+                    response_serializer=chat__pb2.AccountPage.SerializeToString,
+            ),
             'DeleteAccount': grpc.unary_unary_rpc_method_handler(
                     servicer.DeleteAccount,
                     request_deserializer=chat__pb2.AccountInfo.FromString,
@@ -115,9 +254,64 @@ def add_ChatAppServicer_to_server(servicer, server):
             ),
             'MessageStream': grpc.unary_stream_rpc_method_handler(
                     servicer.MessageStream,
-                    request_deserializer=chat__pb2.AccountInfo.FromString,
+                    request_deserializer=chat__pb2.StreamRequest.FromString,
                     response_serializer=chat__pb2.Msg.SerializeToString,
             ),
+            'SendMessages': grpc.unary_unary_rpc_method_handler(
+                    servicer.SendMessages,
+                    request_deserializer=chat__pb2.MsgBatch.FromString,
+                    response_serializer=chat__pb2.BatchResponse.SerializeToString,
+            ),
+            'SendMessageStream': grpc.stream_unary_rpc_method_handler(
+                    servicer.SendMessageStream,
+                    request_deserializer=chat__pb2.Msg.FromString,
+                    response_serializer=chat__pb2.BatchResponse.SerializeToString,
+            ),
+            'FetchMailbox': grpc.unary_stream_rpc_method_handler(
+                    servicer.FetchMailbox,
+                    request_deserializer=chat__pb2.StreamRequest.FromString,
+                    response_serializer=chat__pb2.MailboxChunk.SerializeToString,
+            ),
+            'Ack': grpc.unary_unary_rpc_method_handler(
+                    servicer.Ack,
+                    request_deserializer=chat__pb2.AckRequest.FromString,
+                    response_serializer=chat__pb2.Response.SerializeToString,
+            ),
+            'CreateGroup': grpc.unary_unary_rpc_method_handler(
+                    servicer.CreateGroup,
+                    request_deserializer=chat__pb2.GroupRequest.FromString,
+                    response_serializer=chat__pb2.Response.SerializeToString,
+            ),
+            'JoinGroup': grpc.unary_unary_rpc_method_handler(
+                    servicer.JoinGroup,
+                    request_deserializer=chat__pb2.GroupRequest.FromString,
+                    response_serializer=chat__pb2.Response.SerializeToString,
+            ),
+            'LeaveGroup': grpc.unary_unary_rpc_method_handler(
+                    servicer.LeaveGroup,
+                    request_deserializer=chat__pb2.GroupRequest.FromString,
+                    response_serializer=chat__pb2.Response.SerializeToString,
+            ),
+            'ListGroups': grpc.unary_unary_rpc_method_handler(
+                    servicer.ListGroups,
+                    request_deserializer=chat__pb2.Empty.FromString,
+                    response_serializer=chat__pb2.Response.SerializeToString,
+            ),
+            'SendGroupMessage': grpc.unary_unary_rpc_method_handler(
+                    servicer.SendGroupMessage,
+                    request_deserializer=chat__pb2.GroupMsg.FromString,
+                    response_serializer=chat__pb2.Response.SerializeToString,
+            ),
+            'DeliverShared': grpc.unary_unary_rpc_method_handler(
+                    servicer.DeliverShared,
+                    request_deserializer=chat__pb2.SharedMsg.FromString,
+                    response_serializer=chat__pb2.Response.SerializeToString,
+            ),
+            'VerifyToken': grpc.unary_unary_rpc_method_handler(
+                    servicer.VerifyToken,
+                    request_deserializer=chat__pb2.AccountInfo.FromString,
+                    response_serializer=chat__pb2.Response.SerializeToString,
+            ),
     }
     generic_handler = grpc.method_handlers_generic_handler(
             'chat.ChatApp', rpc_method_handlers)
@@ -179,6 +373,23 @@ class ChatApp(object):
             options, channel_credentials,
             insecure, call_credentials, compression, wait_for_ready, timeout, metadata)
 
+    @staticmethod
+    def ListAccountsPage(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_unary(request, target, '/chat.ChatApp/ListAccountsPage',
+            chat__pb2.ListAccountsRequest.SerializeToString,
+            chat__pb2.AccountPage.FromString,
+            options, channel_credentials,
+            insecure, call_credentials, compression, wait_for_ready, timeout, metadata)
+
     @staticmethod
     def DeleteAccount(request,
             target,
@@ -225,7 +436,194 @@ class ChatApp(object):
             timeout=None,
             metadata=None):
         return grpc.experimental.unary_stream(request, target, '/chat.ChatApp/MessageStream',
-            chat__pb2.AccountInfo.SerializeToString,
+            chat__pb2.StreamRequest.SerializeToString,
             chat__pb2.Msg.FromString,
             options, channel_credentials,
             insecure, call_credentials, compression, wait_for_ready, timeout, metadata)
+
+    @staticmethod
+    def SendMessages(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_unary(request, target, '/chat.ChatApp/SendMessages',
+            chat__pb2.MsgBatch.SerializeToString,
+            chat__pb2.BatchResponse.FromString,
+            options, channel_credentials,
+            insecure, call_credentials, compression, wait_for_ready, timeout, metadata)
+
+    @staticmethod
+    def SendMessageStream(request_iterator,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.stream_unary(request_iterator, target, '/chat.ChatApp/SendMessageStream',
+            chat__pb2.Msg.SerializeToString,
+            chat__pb2.BatchResponse.FromString,
+            options, channel_credentials,
+            insecure, call_credentials, compression, wait_for_ready, timeout, metadata)
+
+    @staticmethod
+    def FetchMailbox(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_stream(request, target, '/chat.ChatApp/FetchMailbox',
+            chat__pb2.StreamRequest.SerializeToString,
+            chat__pb2.MailboxChunk.FromString,
+            options, channel_credentials,
+            insecure, call_credentials, compression, wait_for_ready, timeout, metadata)
+
+    @staticmethod
+    def Ack(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_unary(request, target, '/chat.ChatApp/Ack',
+            chat__pb2.AckRequest.SerializeToString,
+            chat__pb2.Response.FromString,
+            options, channel_credentials,
+            insecure, call_credentials, compression, wait_for_ready, timeout, metadata)
+
+    @staticmethod
+    def CreateGroup(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_unary(request, target, '/chat.ChatApp/CreateGroup',
+            chat__pb2.GroupRequest.SerializeToString,
+            chat__pb2.Response.FromString,
+            options, channel_credentials,
+            insecure, call_credentials, compression, wait_for_ready, timeout, metadata)
+
+    @staticmethod
+    def JoinGroup(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_unary(request, target, '/chat.ChatApp/JoinGroup',
+            chat__pb2.GroupRequest.SerializeToString,
+            chat__pb2.Response.FromString,
+            options, channel_credentials,
+            insecure, call_credentials, compression, wait_for_ready, timeout, metadata)
+
+    @staticmethod
+    def LeaveGroup(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_unary(request, target, '/chat.ChatApp/LeaveGroup',
+            chat__pb2.GroupRequest.SerializeToString,
+            chat__pb2.Response.FromString,
+            options, channel_credentials,
+            insecure, call_credentials, compression, wait_for_ready, timeout, metadata)
+
+    @staticmethod
+    def ListGroups(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_unary(request, target, '/chat.ChatApp/ListGroups',
+            chat__pb2.Empty.SerializeToString,
+            chat__pb2.Response.FromString,
+            options, channel_credentials,
+            insecure, call_credentials, compression, wait_for_ready, timeout, metadata)
+
+    @staticmethod
+    def SendGroupMessage(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_unary(request, target, '/chat.ChatApp/SendGroupMessage',
+            chat__pb2.GroupMsg.SerializeToString,
+            chat__pb2.Response.FromString,
+            options, channel_credentials,
+            insecure, call_credentials, compression, wait_for_ready, timeout, metadata)
+
+    @staticmethod
+    def DeliverShared(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_unary(request, target, '/chat.ChatApp/DeliverShared',
+            chat__pb2.SharedMsg.SerializeToString,
+            chat__pb2.Response.FromString,
+            options, channel_credentials,
+            insecure, call_credentials, compression, wait_for_ready, timeout, metadata)
+
+    @staticmethod
+    def VerifyToken(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_unary(request, target, '/chat.ChatApp/VerifyToken',
+            chat__pb2.AccountInfo.SerializeToString,
+            chat__pb2.Response.FromString,
+            options, channel_credentials,
+            insecure, call_credentials, compression, wait_for_ready, timeout, metadata)
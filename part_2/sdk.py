@@ -0,0 +1,405 @@
+'''
+This file implements a client library for the part 2 (gRPC) server, for programs that drive
+accounts without a terminal (bots, load generators, integrations).
+
+gRPC already pipelines: every call is an HTTP/2 stream of its own, so one channel carries any
+number of outstanding requests and each response is matched to its call by stream id. The
+library adds on top of the generated stubs:
+    - ChannelPool / AsyncChannelPool: a few channels (one TCP connection each) shared
+      round-robin by any number of users, so thousands of bots need a handful of sockets
+    - Client (blocking; send/send_group return a concurrent.futures.Future with wait=False) and
+      AsyncClient (grpc.aio coroutines): one user each, with create/login/send/list/delete,
+      group commands, fetch_mailbox (the queued backlog) and subscribe (MessageStream, resumed
+      after the last message received if the stream breaks -- with a new token if the restarted
+      server forgot the old one -- every message acknowledged; a stream the server refuses, e.g.
+      for a wrong password, raises ChatError)
+Requests the server refuses raise ChatError with its message. Sends go through SendMessages:
+SendMessage answers with an Empty, so it cannot report an unknown recipient.
+create and login keep the session token the server answers with; the client then sends it with
+its messages, acks, group calls, streams and mailbox fetches instead of the password (no password
+hash on the server), and login(username, token=client.token) resumes a session without the password.
+
+Usage:
+    pool = ChannelPool('127.0.0.1:1234', size=4)
+    bots = [Client(pool=pool) for _ in range(1000)]
+    bots[0].login('alice', 'password')
+    futures = [bots[0].send('bob', str(index), wait=False) for index in range(100)]
+    for message in bots[0].subscribe():
+        print(message)
+
+    client = AsyncClient('127.0.0.1:1234')
+    await client.create('bot1', 'password')
+    await asyncio.gather(*(client.send('bob', str(index)) for index in range(100)))
+'''
+# Import relevant python packages
+import asyncio
+from concurrent.futures import Future
+from itertools import count
+import re
+from threading import BoundedSemaphore
+import time
+
+import grpc
+from protos import chat_pb2
+from protos import chat_pb2_grpc
+
+from heartbeat import CLIENT_OPTIONS
+
+# Constants/configurations
+CHANNELS        = 1 # channels of a pool created for a single client
+REQUEST_TIMEOUT = 30.0 # seconds a unary call may take
+RECONNECT_DELAY = 1.0 # seconds between attempts to reopen a broken message stream
+PAGE_SIZE       = 1000 # usernames per ListAccountsPage call
+IN_FLIGHT       = 500 # outstanding calls per pool (gRPC servers reset calls beyond ~1000 pending)
+
+# Errors a message stream is reopened after (the server went away, or ended the call); any other
+# means the server refused the stream, which retrying would not change
+RECONNECT_CODES = (grpc.StatusCode.UNAVAILABLE, grpc.StatusCode.DEADLINE_EXCEEDED, grpc.StatusCode.CANCELLED)
+
+# Without a local subchannel pool, channels to the same target share one TCP connection; the
+# keepalive PINGs (heartbeat.py) let a stream notice a server that went away without closing it
+CHANNEL_OPTIONS = [('grpc.use_local_subchannel_pool', 1)] + CLIENT_OPTIONS
+
+GROUP_LINE = re.compile(r'^(.*) \((\d+) members\)$') # one group of ListGroups ('team (4 members)')
+
+class ChatError(Exception):
+    pass
+
+# The message of a Response, or ChatError if the server refused the request
+def checked(response):
+    if not response.status:
+        raise ChatError(response.msg.strip())
+    return response.msg.strip()
+
+# The message of the only status of a one-message SendMessages
+def checked_batch(response):
+    return checked(response.statuses[0])
+
+# ListGroups text as (name, number of members) pairs
+def parse_groups(text):
+    return [(match.group(1), int(match.group(2))) for match in map(GROUP_LINE.match, text.split('\n')) if match]
+
+class ChannelPool:
+    '''
+    Channels to one server, handed out round-robin
+        - channels: grpc channels, each its own TCP connection
+        - stubs: a ChatAppStub per channel
+        - next: counter picking the channel of the next stub()
+        - slots: bounds the calls started without waiting (send(wait=False)) to IN_FLIGHT;
+          starting one more blocks until one finishes
+    '''
+    def __init__(self, target, size=CHANNELS) -> None:
+        self.channels = [grpc.insecure_channel(target, options=CHANNEL_OPTIONS) for _ in range(size)]
+        self.stubs    = [chat_pb2_grpc.ChatAppStub(channel) for channel in self.channels]
+        self.next     = count()
+        self.slots    = BoundedSemaphore(IN_FLIGHT)
+
+    def stub(self):
+        return self.stubs[next(self.next) % len(self.stubs)]
+
+    def close(self):
+        for channel in self.channels:
+            channel.close()
+
+class AsyncChannelPool(ChannelPool):
+    '''
+    ChannelPool of grpc.aio channels (create it on the event loop that uses it); its slots bound
+    every unary call, so callers may gather as many as they like
+    '''
+    def __init__(self, target, size=CHANNELS) -> None:
+        self.channels = [grpc.aio.insecure_channel(target, options=CHANNEL_OPTIONS) for _ in range(size)]
+        self.stubs    = [chat_pb2_grpc.ChatAppStub(channel) for channel in self.channels]
+        self.next     = count()
+        self.slots    = asyncio.Semaphore(IN_FLIGHT)
+
+    async def close(self):
+        for channel in self.channels:
+            await channel.close()
+
+class Client:
+    '''
+    Blocking client for one user
+        - pool: ChannelPool its calls go through (its own unless one is given)
+        - stub: ChatAppStub of the pool channel this user was given
+        - username, password: the account, once create() or login() succeeded
+        - token: session token the server issued at create() or login() ('' before)
+        - cursor: sequence number of the last queued message received (and acknowledged)
+        - timeout: seconds a unary call may take
+        - acks: Ack calls in flight (gRPC cancels a call once nothing references it)
+    '''
+    def __init__(self, target=None, pool=None, timeout=REQUEST_TIMEOUT) -> None:
+        self.own_pool = pool is None
+        self.pool     = pool or ChannelPool(target)
+        self.stub     = self.pool.stub()
+        self.username = None
+        self.password = None
+        self.token    = ''
+        self.cursor   = 0
+        self.timeout  = timeout
+        self.acks     = set()
+
+    def account(self):
+        return chat_pb2.AccountInfo(username=self.username, password=self.password, token=self.token)
+
+    # Keep the account and session token of a successful create/login; returns the server's message
+    def signed_in(self, username, password, response):
+        message = checked(response)
+        self.username, self.password, self.token = username, password, response.token
+        return message
+
+    def create(self, username, password):
+        return self.signed_in(username, password, self.stub.CreateAccount(
+            chat_pb2.AccountInfo(username=username, password=password), timeout=self.timeout))
+
+    # Log in with the password or the token of an earlier session; returns the server's greeting
+    # (how many messages are queued)
+    def login(self, username, password='', token=''):
+        return self.signed_in(username, password, self.stub.LoginAccount(
+            chat_pb2.AccountInfo(username=username, password=password, token=token), timeout=self.timeout))
+
+    # A message from this user
+    def message(self, dst_username, text):
+        return chat_pb2.Msg(src_username=self.username, dst_username=dst_username, msg=text, token=self.token)
+
+    # Start method(request) without waiting (once the pool has a free slot) and return a
+    # concurrent.futures.Future resolved with convert(its result)
+    def chain(self, method, request, convert):
+        self.pool.slots.acquire()
+        call = method.future(request, timeout=self.timeout)
+        future = Future()
+        future.call = call # keeps the call alive
+        def done(call):
+            self.pool.slots.release()
+            try:
+                future.set_result(convert(call.result()))
+            except (ChatError, grpc.RpcError) as error:
+                future.set_exception(error)
+        call.add_done_callback(done)
+        return future
+
+    def send(self, dst_username, text, wait=True):
+        batch = chat_pb2.MsgBatch(msgs=[self.message(dst_username, text)])
+        if wait:
+            return checked_batch(self.stub.SendMessages(batch, timeout=self.timeout))
+        return self.chain(self.stub.SendMessages, batch, checked_batch)
+
+    # Send several (dst_username, text) in one call; returns a (delivered, message) pair per message
+    def send_many(self, messages):
+        batch = chat_pb2.MsgBatch(msgs=[self.message(dst_username, text) for dst_username, text in messages])
+        return [(status.status, status.msg) for status in self.stub.SendMessages(batch, timeout=self.timeout).statuses]
+
+    # Pages of the usernames starting with prefix and matching a glob pattern (e.g. bo*), in order
+    def pages(self, prefix='', pattern='', page_size=PAGE_SIZE):
+        request = chat_pb2.ListAccountsRequest(prefix=prefix, pattern=pattern, page_size=page_size)
+        while True:
+            page = self.stub.ListAccountsPage(request, timeout=self.timeout)
+            yield list(page.usernames)
+            if not page.next_cursor:
+                return
+            request.cursor = page.next_cursor
+
+    def list(self, prefix='', pattern=''):
+        return [username for page in self.pages(prefix, pattern) for username in page]
+
+    def delete(self):
+        return checked(self.stub.DeleteAccount(self.account(), timeout=self.timeout))
+
+    def group_request(self, group):
+        return chat_pb2.GroupRequest(group=group, username=self.username, token=self.token)
+
+    def create_group(self, group):
+        return checked(self.stub.CreateGroup(self.group_request(group), timeout=self.timeout))
+
+    def join_group(self, group):
+        return checked(self.stub.JoinGroup(self.group_request(group), timeout=self.timeout))
+
+    def leave_group(self, group):
+        return checked(self.stub.LeaveGroup(self.group_request(group), timeout=self.timeout))
+
+    def list_groups(self):
+        return parse_groups(self.stub.ListGroups(chat_pb2.Empty(), timeout=self.timeout).msg)
+
+    def send_group(self, group, text, wait=True):
+        request = chat_pb2.GroupMsg(group=group, src_username=self.username, msg=text, token=self.token)
+        if wait:
+            return checked(self.stub.SendGroupMessage(request, timeout=self.timeout))
+        return self.chain(self.stub.SendGroupMessage, request, checked)
+
+    # With a token the password is left out: the server then checks only the token
+    def stream_request(self):
+        if self.token:
+            return chat_pb2.StreamRequest(username=self.username, token=self.token, cursor=self.cursor)
+        return chat_pb2.StreamRequest(username=self.username, password=self.password, cursor=self.cursor)
+
+    def ack_request(self):
+        return chat_pb2.AckRequest(username=self.username, seq=self.cursor, token=self.token)
+
+    # Acknowledge everything up to the cursor without waiting for the answer
+    def ack(self):
+        call = self.stub.Ack.future(self.ack_request(), timeout=self.timeout)
+        self.acks.add(call)
+        call.add_done_callback(self.acks.discard)
+
+    # The messages queued while the user was away, chunk by chunk (each chunk acknowledged)
+    def fetch_mailbox(self):
+        for chunk in self.stub.FetchMailbox(self.stream_request()):
+            yield from chunk.msgs
+            self.cursor = chunk.first_seq + len(chunk.msgs) - 1
+            self.ack()
+
+    # Messages as they arrive (with notices -- the user list sent first -- if notices is set), until
+    # the account is deleted; a broken stream is reopened after the last message received (signing
+    # in again if the server forgot the token), and a refused one (see RECONNECT_CODES) raises ChatError
+    def subscribe(self, notices=False):
+        renew = renewed = False
+        while True:
+            try:
+                if renew:
+                    self.login(self.username, self.password)
+                    renew, renewed = False, True
+                for message in self.stub.MessageStream(self.stream_request()):
+                    renewed = False
+                    if message.seq:
+                        self.cursor = message.seq
+                        self.ack()
+                    if message.seq or notices:
+                        yield message.msg
+                return
+            except grpc.RpcError as error:
+                if self.renews(error, renewed):
+                    renew = True
+                    continue
+                if error.code() not in RECONNECT_CODES:
+                    raise ChatError(error.details()) from error
+                time.sleep(RECONNECT_DELAY)
+
+    # Whether subscribe should log in again with the password and reopen a stream its token was refused
+    # for: the server restarted (or evicted the token). Only once until a message arrives, so a password
+    # that no longer works raises ChatError instead of looping
+    def renews(self, error, renewed):
+        return (error.code() == grpc.StatusCode.UNAUTHENTICATED and bool(self.token) and bool(self.password)
+                and not renewed)
+
+    def close(self):
+        if self.own_pool:
+            self.pool.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        self.close()
+        return False
+
+class AsyncClient(Client):
+    '''
+    asyncio client for one user (grpc.aio); same fields as Client, its pool an AsyncChannelPool
+    '''
+    def __init__(self, target=None, pool=None, timeout=REQUEST_TIMEOUT) -> None:
+        super().__init__(target, pool or AsyncChannelPool(target), timeout)
+        self.own_pool = pool is None
+
+    # Await one unary call once the pool has a free slot
+    async def unary(self, method, request):
+        async with self.pool.slots:
+            return await method(request, timeout=self.timeout)
+
+    async def create(self, username, password):
+        return self.signed_in(username, password, await self.unary(
+            self.stub.CreateAccount, chat_pb2.AccountInfo(username=username, password=password)))
+
+    async def login(self, username, password='', token=''):
+        return self.signed_in(username, password, await self.unary(
+            self.stub.LoginAccount, chat_pb2.AccountInfo(username=username, password=password, token=token)))
+
+    async def send(self, dst_username, text):
+        batch = chat_pb2.MsgBatch(msgs=[self.message(dst_username, text)])
+        return checked_batch(await self.unary(self.stub.SendMessages, batch))
+
+    async def send_many(self, messages):
+        batch = chat_pb2.MsgBatch(msgs=[self.message(dst_username, text) for dst_username, text in messages])
+        response = await self.unary(self.stub.SendMessages, batch)
+        return [(status.status, status.msg) for status in response.statuses]
+
+    async def pages(self, prefix='', pattern='', page_size=PAGE_SIZE):
+        request = chat_pb2.ListAccountsRequest(prefix=prefix, pattern=pattern, page_size=page_size)
+        while True:
+            page = await self.unary(self.stub.ListAccountsPage, request)
+            yield list(page.usernames)
+            if not page.next_cursor:
+                return
+            request.cursor = page.next_cursor
+
+    async def list(self, prefix='', pattern=''):
+        return [username async for page in self.pages(prefix, pattern) for username in page]
+
+    async def delete(self):
+        return checked(await self.unary(self.stub.DeleteAccount, self.account()))
+
+    async def create_group(self, group):
+        return checked(await self.unary(self.stub.CreateGroup, self.group_request(group)))
+
+    async def join_group(self, group):
+        return checked(await self.unary(self.stub.JoinGroup, self.group_request(group)))
+
+    async def leave_group(self, group):
+        return checked(await self.unary(self.stub.LeaveGroup, self.group_request(group)))
+
+    async def list_groups(self):
+        return parse_groups((await self.unary(self.stub.ListGroups, chat_pb2.Empty())).msg)
+
+    async def send_group(self, group, text):
+        request = chat_pb2.GroupMsg(group=group, src_username=self.username, msg=text, token=self.token)
+        return checked(await self.unary(self.stub.SendGroupMessage, request))
+
+    # Acknowledge everything up to the cursor in the background (a lost ack only means a redelivery)
+    def ack(self):
+        async def ack(request):
+            try:
+                await self.unary(self.stub.Ack, request)
+            except grpc.RpcError:
+                pass
+        task = asyncio.get_running_loop().create_task(ack(self.ack_request()))
+        self.acks.add(task)
+        task.add_done_callback(self.acks.discard)
+
+    async def fetch_mailbox(self):
+        async for chunk in self.stub.FetchMailbox(self.stream_request()):
+            for message in chunk.msgs:
+                yield message
+            self.cursor = chunk.first_seq + len(chunk.msgs) - 1
+            self.ack()
+
+    async def subscribe(self, notices=False):
+        renew = renewed = False
+        while True:
+            try:
+                if renew:
+                    await self.login(self.username, self.password)
+                    renew, renewed = False, True
+                async for message in self.stub.MessageStream(self.stream_request()):
+                    renewed = False
+                    if message.seq:
+                        self.cursor = message.seq
+                        self.ack()
+                    if message.seq or notices:
+                        yield message.msg
+                return
+            except grpc.RpcError as error:
+                if self.renews(error, renewed):
+                    renew = True
+                    continue
+                if error.code() not in RECONNECT_CODES:
+                    raise ChatError(error.details()) from error
+                await asyncio.sleep(RECONNECT_DELAY)
+
+    async def close(self):
+        if self.own_pool:
+            await self.pool.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, traceback):
+        await self.close()
+        return False
@@ -1,67 +1,176 @@
 '''
 This file implements server functionality of chat application.
 
-Usage: python3 server.py
+Usage: python3 server.py [--mode threaded|aio] [--host IP_ADDRESS] [--port PORT] [--max-clients N] [--keepalive SECONDS]
+                         [--wal PATH] [--fsync-window SECONDS] [--segment-size BYTES] [--snapshot-interval SECONDS]
+                         [--mailbox-chunk BYTES] [--spill-dir PATH] [--mailbox-cap BYTES] [--mailbox-budget BYTES]
+                         [--metrics-port PORT] [--metrics-json PATH]
+                         [--hash-workers N] [--kdf-cost LOG_N] [--token-ttl SECONDS] [--require-auth]
+                         [--heartbeat SECONDS] [--idle-timeout SECONDS] [--send-rate N] [--send-burst N]
+                         [--receive-rate N] [--receive-burst N] [--max-in-flight N] [--max-streams N]
 '''
 # Import relevant python packages
-from collections import defaultdict
+from argparse import ArgumentParser
+import asyncio
 from concurrent.futures import ThreadPoolExecutor
+import os
+import sys
+from threading import Lock
 
 import grpc
 from protos import chat_pb2
 from protos import chat_pb2_grpc
 
+from aio_server import serve as serve_aio
+from batch import ENCODING, apply_batch, chunks, format_group_message, format_message
+from heartbeat import HEARTBEAT, IDLE_TIMEOUT, server_options
+from interceptor import AdmissionInterceptor, MetricsInterceptor
+from tokens import TTL, TokenCache
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.limits import (MAX_IN_FLIGHT, RECEIVE_BURST, RECEIVE_RATE, SEND_BURST, SEND_RATE, Limits, limit_gauges,
+                           limits_from_args)
+from common.mailbox import MEMORY_BUDGET, USER_CAP, Spill
+from common.metrics import METRICS_INTERVAL, Metrics, export_metrics, store_gauges
+from common.passwords import HASH_WORKERS, LOG_N, Passwords
+from common.user_store import MAILBOX_CHUNK, UserStore
+from common.wal import FSYNC_WINDOW, SEGMENT_SIZE, SNAPSHOT_INTERVAL, NullLog, WriteAheadLog
+
 # Constants/configurations
 MAX_CLIENTS = 100
+MAX_STREAMS = 0 # calls one connection may have open at once (0: gRPC's default, unlimited)
 PORT        = 1234 # fixed application port
 SERVER_IP   = '100.90.130.16' # REPLACE ME with output of ipconfig getifaddr en0
+KEEPALIVE   = 5.0 # seconds an idle MessageStream sleeps before checking its client is still connected
 
 class ChatAppService(chat_pb2_grpc.ChatAppServicer):
     '''
-    'users' is a hashmap to store all client data
+    'users' is a sharded, lock-striped store of all client data (common/user_store.py)
         - key: username
         - values: 'password', 'mailbox'
+    SendMessage appends and signals the user's condition; MessageStream sleeps on it instead
+    of polling, then reads what is queued by sequence number.
+    Every change is also recorded in 'wal' (a NullLog unless a write-ahead log is configured),
+    and the store starts from the state the log replays.
+    FetchMailbox replays queued mail in chunks of up to 'mailbox_chunk' bytes.
+    Large mailboxes spill their older messages to 'spill' (common/mailbox.py), if given.
+    Passwords are hashed and checked by 'passwords' (common/passwords.py) in worker processes;
+    the RPC thread waits for the result without holding the interpreter lock. A successful
+    CreateAccount or LoginAccount issues a session token ('tokens', tokens.py) that later logins,
+    streams and mailbox fetches present instead of the password, and that sends, acks and group
+    calls carry: one with a wrong token is refused, and with 'require_auth' so is one without.
+    'streams' counts the open MessageStreams (guarded by 'lock'); a stream whose call ends wakes
+    itself up and returns, so the worker thread it holds is back in the pool at once.
+    Every message a client sends counts against the rate limits of its sender and recipient in
+    'limits' (common/limits.py; a group message against its sender only); one over a limit is
+    refused with RESOURCE_EXHAUSTED, or a failed status within a batch.
     '''
-    def __init__(self) -> None:
+    def __init__(self, keepalive=KEEPALIVE, wal=None, mailbox_chunk=MAILBOX_CHUNK, spill=None, passwords=None,
+                 tokens=None, require_auth=False, limits=None) -> None:
         super().__init__()
-        self.users = defaultdict(dict)
+        self.users = UserStore(wal, spill=spill, passwords=passwords)
+        self.tokens = tokens or TokenCache()
+        self.require_auth = require_auth
+        self.limits = limits or Limits()
+        self.keepalive = keepalive
+        self.mailbox_chunk = mailbox_chunk
+        self.lock = Lock()
+        self.streams = 0
+
+    # Whether username has an account (a cluster worker asks the worker owning it)
+    def exists(self, username):
+        return username in self.users
+
+    # Every username, sorted (a cluster worker merges those of every worker)
+    def usernames(self):
+        return self.users.usernames()
+
+    # Whether the caller is username: a live token, or else the password (hashed in the pool)
+    def authenticate(self, username, password, token):
+        if token and self.tokens.check(token, username):
+            return True
+        if token and not password: # a stale token alone: not worth a hash
+            return False
+        return self.users.check_password(username, password).result()
+
+    # Whether a send from username carrying token is allowed (a cluster worker asks the sender's worker)
+    def authorized(self, username, token):
+        if not token:
+            return not self.require_auth
+        return self.tokens.check(token, username)
+
+    # Whether the call comes from another cluster worker, which checked its senders already
+    def trusted(self, context):
+        return False
+
+    # The sender check of a batch for apply_batch (None if the caller is trusted)
+    def sender_check(self, context):
+        if self.trusted(context):
+            return None
+        return lambda msg: self.authorized(msg.src_username, msg.token)
+
+    # The rate limit check of a batch for apply_batch (None if the caller is trusted)
+    def sender_limit(self, context):
+        if self.trusted(context):
+            return None
+        return lambda msg: self.limits.check(msg.src_username, msg.dst_username)
+
+    # Refuse a call that must be authenticated and is not
+    def require(self, allowed, context):
+        if not allowed:
+            context.abort(grpc.StatusCode.UNAUTHENTICATED, 'Incorrect username, password or token')
+
+    # Refuse a message over its sender's or recipient's rate limit (recipient None: a group message)
+    def throttle(self, sender, recipient, context):
+        refusal = self.limits.check(sender, recipient)
+        if refusal is not None:
+            context.abort(grpc.StatusCode.RESOURCE_EXHAUSTED, refusal)
      
     # Handles user creation for new users
     def CreateAccount(self, request, context):
-        # New username
+        token = ''
+        # New username (the password is hashed first, in the pool; not for a name already taken)
+        ticket = None
         if request.username not in self.users:
+            ticket = self.users.create(request.username, self.users.hash_password(request.password).result())
+        if ticket is not None:
             success = True
-            self.users[request.username]['password'] = request.password
+            self.users.sync(ticket) # durable before we confirm
+            token = self.tokens.issue(request.username)
             print('Successfully created account with username: {}'.format(request.username))
             message = '\nSuccessfully created account with username: {}\n'.format(request.username)
-            self.users[request.username]['mailbox'] = []
         # Username has already been taken (re-enter)
         else:
             success = False
             message = '\n{} is already taken. Please enter a unique username!\n'.format(request.username)
-        response = chat_pb2.Response(status=success, msg=message)
+        response = chat_pb2.Response(status=success, msg=message, token=token)
         return response
     
-    # Handles login for existing user
+    # Handles login for existing user; a token of an earlier login is accepted instead of the
+    # password (and stays the session's token)
     def LoginAccount(self, request, context):
         success = False
+        token = ''
         # Username exists
         if request.username in self.users:
-            # Entered correct password
-            if request.password == self.users[request.username]['password']:
+            if request.token and self.tokens.check(request.token, request.username):
+                token = request.token
+            # Entered correct password (not checked for a stale token sent alone)
+            elif ((request.password or not request.token)
+                  and self.users.check_password(request.username, request.password).result()):
+                token = self.tokens.issue(request.username)
+            if token:
                 success = True
                 print('{} successfully logged in'.format(request.username))
                 message = '\nSuccessfully logged in'
 
-                # No mail to send
-                if len(self.users[request.username]['mailbox']) == 0:
+                # Only say how much mail is queued: the client replays it with FetchMailbox (or
+                # MessageStream delivers it), so a large backlog never has to fit in one response
+                pending = self.users.pending(request.username) or 0
+                if pending == 0:
                     message += '\nYou do not have any queued messages.' # no mail to send
-                # Send mail and clear mailbox
                 else:
-                    message += '\nWelcome back, {}. Unread messages:\n'.format(request.username)
-                    for mailbox_message in self.users[request.username]['mailbox']:
-                        message += str(mailbox_message+'\n')
-                    self.users[request.username]['mailbox'] = []
+                    message += '\nWelcome back, {}. You have {} unread message(s).'.format(request.username, pending)
             # Entered incorrect password
             else:
                 message = '\nIncorrect password. Returning to the welcome page.'
@@ -70,57 +179,300 @@ class ChatAppService(chat_pb2_grpc.ChatAppServicer):
         else:
             message = '\n{} is not a valid username. Returning to the welcome page.'.format(request.username)
 
-        response = chat_pb2.Response(status=success, msg=message)
+        response = chat_pb2.Response(status=success, msg=message, token=token)
         return response
     
     # List all user accounts
     def ListAccounts(self, request, context):
-        message = '\nAll users:\n'
-        for index, username in enumerate(self.users):
-            message += '{}. {}\n'.format(index, username)
+        message = '\nAll users:\n' + ''.join('{}. {}\n'.format(index, username) for index, username in enumerate(self.usernames()))
         response = chat_pb2.Response(status=True, msg = message)
         return response
+
+    # List one page of user accounts matching a prefix/glob, from the sorted username index
+    def ListAccountsPage(self, request, context):
+        usernames, next_cursor = self.users.page(request.prefix, request.pattern, request.cursor, request.page_size)
+        return chat_pb2.AccountPage(usernames=usernames, next_cursor=next_cursor)
     
-    # Delete client user account
+    # Delete client user account (and its tokens); a token or password is required if one is sent,
+    # or with require_auth
     def DeleteAccount(self, request, context):
-        del self.users[request.username]
+        if request.token or self.require_auth:
+            self.require(self.authenticate(request.username, request.password, request.token), context)
+        self.tokens.revoke(request.username)
+        # Also wakes the user's message stream so it notices the deletion and ends
+        self.users.sync(self.users.delete(request.username)[0])
         print('{} deleted account.'. format(request.username))
         response = chat_pb2.Response(status=True, msg='')
         return response
     
-    # Opens message (i.e., response) stream so server can keep sending messages to client(s)
+    # Replay the queued mail in chunks of up to mailbox_chunk bytes: memory stays bounded by one
+    # chunk and the first messages go out at once however long the backlog is. With a cursor, only
+    # messages after it are sent and they stay queued until acknowledged (the cursor acknowledges
+    # everything up to it); without one, each chunk leaves the mailbox as it is sent.
+    def FetchMailbox(self, request, context):
+        self.require(self.authenticate(request.username, request.password, request.token), context)
+        acked = request.HasField('cursor')
+        after = request.cursor
+        self.users.ack(request.username, after)
+        while True:
+            result = self.users.read(request.username, after, self.mailbox_chunk)
+            if not result or not result[1]:
+                return
+            first_seq, msgs = result
+            after = first_seq + len(msgs) - 1
+            if not acked:
+                self.users.ack(request.username, after)
+            yield chat_pb2.MailboxChunk(msgs=msgs, first_seq=first_seq)
+
+    # The client received every message numbered up to request.seq, so they can leave its mailbox.
+    # Not waited on: if the server crashes first, the client gets those messages again and drops them by seq.
+    def Ack(self, request, context):
+        if not self.trusted(context):
+            self.require(self.authorized(request.username, request.token), context)
+        if not self.users.ack(request.username, request.seq):
+            return chat_pb2.Response(status=False, msg='User {} does not exist!'.format(request.username))
+        return chat_pb2.Response(status=True, msg='')
+
+    # Opens message (i.e., response) stream so server can keep sending messages to client(s).
+    # With a cursor (see FetchMailbox) a reconnecting client resumes after the last message it
+    # acknowledged, and nothing it has not acknowledged is lost if the stream breaks.
+    # The token (or password) is checked if one is sent, or with require_auth.
     def MessageStream(self, request, context):
+        if request.token or self.require_auth:
+            self.require(self.authenticate(request.username, request.password, request.token), context)
         # Let user know all other users available for messaging
         message = '\nWelcome to chatroom!\nAll users:'
         yield chat_pb2.Msg(src_username = '', dst_username = request.username, msg = message)
-        for index, username in enumerate(self.users):
+        for index, username in enumerate(self.usernames()):
             message = '{}. {}'.format(index, username)
             yield chat_pb2.Msg(src_username = '', dst_username = request.username, msg = message)
 
-        # Continuously listen to new messages
-        while True:
-            try:
-                if len(self.users[request.username]['mailbox']) > 0:
-                    for message in self.users[request.username]['mailbox']:
-                        yield chat_pb2.Msg(src_username = '', dst_username = request.username, msg = message)
-                    self.users[request.username]['mailbox'] = []
-            except:
-                # Only delete user information when DeleteAccount is called
-                if not self.users[request.username]:
-                    del self.users[request.username]
-                break
+        acked = request.HasField('cursor')
+        sent = request.cursor
+        self.users.ack(request.username, sent)
+        # The call ends (client gone, cancelled, or dropped by the heartbeat): wake the wait below
+        context.add_callback(lambda: self.users.wake(request.username))
+        with self.lock:
+            self.streams += 1
+        try:
+            # Sleep until SendMessage signals new mail; wake every keepalive seconds to check the client is still there
+            while context.is_active():
+                result = self.users.wait_read(request.username, sent, timeout=self.keepalive,
+                                              chunk_size=self.mailbox_chunk, cancelled=lambda: not context.is_active())
+                # Only stop for good when DeleteAccount removed the user
+                if result is None:
+                    break
+                first_seq, mailbox = result
+                if not mailbox:
+                    continue
+                sent = first_seq + len(mailbox) - 1
+                if not acked:
+                    self.users.ack(request.username, sent)
+                for offset, message in enumerate(mailbox):
+                    yield chat_pb2.Msg(src_username = '', dst_username = request.username, msg = message, seq = first_seq + offset)
+        finally:
+            with self.lock:
+                self.streams -= 1
 
     # Takes incoming message from client, adds it to destination mailbox, and then acknowledges success.
     def SendMessage(self, request, context):
-        message = "<{}> {}".format(request.src_username, request.msg) # message formatting
-        self.users[request.dst_username]['mailbox'].append(message) # append message to target user's mailbox
+        if not self.trusted(context):
+            self.require(self.authorized(request.src_username, request.token), context)
+            self.throttle(request.src_username, request.dst_username, context)
+        message = format_message(request) # formatted and encoded once
+        # append message to target user's mailbox (logged and signalled under the user's lock)
+        ticket, _ = self.users.append(request.dst_username, message)
+        if ticket is None:
+            return chat_pb2.Response(status=False, msg='Target user {} does not exist!'.format(request.dst_username))
+        self.users.sync(ticket) # durable before we acknowledge (fsync shared with concurrent senders)
         response = chat_pb2.Response(status=True, msg='Message delivered to user')
         return response
+
+    # Takes a batch of messages, adds them to destination mailboxes (one lock acquisition per shard
+    # and one fsync for the whole batch), and acknowledges each message.
+    def SendMessages(self, request, context):
+        responses, ticket = apply_batch(self.users, request.msgs, self.sender_check(context), self.sender_limit(context))
+        self.users.sync(ticket)
+        return chat_pb2.BatchResponse(statuses=responses)
+
+    # Client-streaming SendMessages: messages are applied in chunks as they arrive, and acknowledged
+    # (after one fsync) once the client closes the stream.
+    def SendMessageStream(self, request_iterator, context):
+        statuses = []
+        ticket = 0
+        allowed, limit = self.sender_check(context), self.sender_limit(context)
+        for chunk in chunks(request_iterator):
+            responses, chunk_ticket = apply_batch(self.users, chunk, allowed, limit)
+            statuses += responses
+            ticket = max(ticket, chunk_ticket)
+        self.users.sync(ticket)
+        return chat_pb2.BatchResponse(statuses=statuses)
+
+    # Create a group with the requesting user as its first member
+    def CreateGroup(self, request, context):
+        if not self.trusted(context):
+            self.require(self.authorized(request.username, request.token), context)
+        if not self.exists(request.username):
+            return chat_pb2.Response(status=False, msg='User {} does not exist!'.format(request.username))
+        ticket = self.users.create_group(request.group, request.username)
+        if ticket is None:
+            return chat_pb2.Response(status=False, msg='Group {} already exists!'.format(request.group))
+        self.users.sync(ticket)
+        return chat_pb2.Response(status=True, msg='Created group {}'.format(request.group))
+
+    def JoinGroup(self, request, context):
+        if not self.trusted(context):
+            self.require(self.authorized(request.username, request.token), context)
+        if not self.exists(request.username):
+            return chat_pb2.Response(status=False, msg='User {} does not exist!'.format(request.username))
+        ticket = self.users.join_group(request.group, request.username)
+        if ticket is None:
+            return chat_pb2.Response(status=False, msg='Group {} does not exist!'.format(request.group))
+        self.users.sync(ticket)
+        return chat_pb2.Response(status=True, msg='Joined group {}'.format(request.group))
+
+    def LeaveGroup(self, request, context):
+        if not self.trusted(context):
+            self.require(self.authorized(request.username, request.token), context)
+        ticket = self.users.leave_group(request.group, request.username)
+        if ticket is None:
+            return chat_pb2.Response(status=False, msg='{} is not in group {}!'.format(request.username, request.group))
+        self.users.sync(ticket)
+        return chat_pb2.Response(status=True, msg='Left group {}'.format(request.group))
+
+    # List every group with its number of members
+    def ListGroups(self, request, context):
+        message = '\nAll groups:\n' + ''.join('{} ({} members)\n'.format(group, count) for group, count in self.users.group_names())
+        return chat_pb2.Response(status=True, msg=message)
+
+    # Takes a message for a group: formatted once, the same message is queued for every other member
+    # (one lock acquisition per shard, one log record, one fsync), then acknowledged.
+    def SendGroupMessage(self, request, context):
+        if not self.trusted(context):
+            self.require(self.authorized(request.src_username, request.token), context)
+            self.throttle(request.src_username, None, context)
+        message = format_group_message(request)
+        result = self.users.append_group(request.group, request.src_username, message)
+        if result is None:
+            return chat_pb2.Response(status=False, msg='{} is not in group {}!'.format(request.src_username, request.group))
+        ticket, queued, _ = result
+        self.users.sync(ticket)
+        return chat_pb2.Response(status=True, msg='Message delivered to {} member(s)'.format(len(queued)))
+
+    # Queue one already formatted message for several users (the same bytes for all, one log record);
+    # cluster workers use it to hand a group message to the members another worker owns. The text is
+    # taken as is, so only another worker may call it (always refused outside cluster mode)
+    def DeliverShared(self, request, context):
+        if not self.trusted(context):
+            context.abort(grpc.StatusCode.PERMISSION_DENIED, 'DeliverShared is only for cluster workers')
+        ticket, queued, _ = self.users.append_shared(request.msg.encode(encoding=ENCODING), request.dst_usernames)
+        self.users.sync(ticket)
+        return chat_pb2.Response(status=True, msg='Message delivered to {} member(s)'.format(len(queued)))
+
+    # Whether request.token is a live token of request.username, without logging in (nothing is
+    # printed or counted as a login); cluster workers use it to check the token of another worker's
+    # user (always refused outside cluster mode)
+    def VerifyToken(self, request, context):
+        if not self.trusted(context):
+            context.abort(grpc.StatusCode.PERMISSION_DENIED, 'VerifyToken is only for cluster workers')
+        return chat_pb2.Response(status=bool(request.token) and self.tokens.check(request.token, request.username))
     
+# Command line options (cluster.py adds its own to the same parser)
+def make_parser():
+    parser = ArgumentParser(description='Chat application server (part 2).')
+    parser.add_argument('--mode', choices=['threaded', 'aio'], default='threaded',
+                        help='threaded: ThreadPoolExecutor server; aio: grpc.aio asyncio server')
+    parser.add_argument('--host', default=SERVER_IP, help='IP address to bind')
+    parser.add_argument('--port', type=int, default=PORT, help='port to bind')
+    parser.add_argument('--max-clients', type=int, default=MAX_CLIENTS,
+                        help='worker threads (each open MessageStream holds one; threaded mode)')
+    parser.add_argument('--keepalive', type=float, default=KEEPALIVE,
+                        help='seconds an idle MessageStream waits before checking its client (threaded mode)')
+    parser.add_argument('--wal', metavar='PATH',
+                        help='write-ahead log for accounts and mailboxes (replayed on start; in-memory only if omitted)')
+    parser.add_argument('--fsync-window', type=float, default=FSYNC_WINDOW,
+                        help='seconds the log waits to group concurrent writes into one fsync')
+    parser.add_argument('--segment-size', type=int, default=SEGMENT_SIZE,
+                        help='bytes after which the log starts a new segment and compacts the full one')
+    parser.add_argument('--snapshot-interval', type=float, default=SNAPSHOT_INTERVAL,
+                        help='seconds between snapshots of the log (0 disables compaction)')
+    parser.add_argument('--mailbox-chunk', type=int, default=MAILBOX_CHUNK,
+                        help='bytes of queued messages per FetchMailbox chunk')
+    parser.add_argument('--spill-dir', metavar='PATH',
+                        help='directory large mailboxes spill their older messages to (a temporary one if omitted)')
+    parser.add_argument('--mailbox-cap', type=int, default=USER_CAP,
+                        help='estimated bytes of one user\'s queued messages kept in memory before they spill to disk')
+    parser.add_argument('--mailbox-budget', type=int, default=MEMORY_BUDGET,
+                        help='estimated bytes of queued messages kept in memory over all users before mailboxes spill')
+    parser.add_argument('--metrics-port', type=int,
+                        help='serve RPC latency and mailbox metrics on http://127.0.0.1:PORT/metrics (Prometheus text)')
+    parser.add_argument('--metrics-json', metavar='PATH', help='write the metrics as JSON to PATH periodically')
+    parser.add_argument('--metrics-interval', type=float, default=METRICS_INTERVAL,
+                        help='seconds between JSON metrics dumps')
+    parser.add_argument('--hash-workers', type=int, default=HASH_WORKERS,
+                        help='processes hashing and checking passwords (0: on the thread serving the call)')
+    parser.add_argument('--kdf-cost', type=int, default=LOG_N,
+                        help='scrypt cost of new password hashes, as log2 of its iterations')
+    parser.add_argument('--token-ttl', type=float, default=TTL,
+                        help='seconds a session token stays valid after it was last used')
+    parser.add_argument('--require-auth', action='store_true',
+                        help='refuse sends without a session token, and streams without a token or password')
+    parser.add_argument('--heartbeat', type=float, default=HEARTBEAT,
+                        help='seconds without traffic before the server pings a client connection')
+    parser.add_argument('--idle-timeout', type=float, default=IDLE_TIMEOUT,
+                        help='seconds without traffic before a connection that does not answer pings is closed')
+    parser.add_argument('--send-rate', type=float, default=SEND_RATE,
+                        help='messages per second each sender may keep up (0: unlimited)')
+    parser.add_argument('--send-burst', type=int, default=SEND_BURST,
+                        help='messages a sender may send at once before --send-rate applies')
+    parser.add_argument('--receive-rate', type=float, default=RECEIVE_RATE,
+                        help='messages per second each recipient may be sent (0: unlimited)')
+    parser.add_argument('--receive-burst', type=int, default=RECEIVE_BURST,
+                        help='messages a recipient may be sent at once before --receive-rate applies')
+    parser.add_argument('--max-in-flight', type=int, default=MAX_IN_FLIGHT,
+                        help='calls (other than message streams and mailbox fetches) handled at once before new '
+                             'ones are refused with RESOURCE_EXHAUSTED (0: no cap)')
+    parser.add_argument('--max-streams', type=int, default=MAX_STREAMS,
+                        help='calls one client connection may have open at once; more wait in the client (0: no cap)')
+    return parser
+
+# grpc server options: the keepalive settings of heartbeat.py and the per-connection call cap
+def grpc_options(args):
+    streams = [('grpc.max_concurrent_streams', args.max_streams)] if args.max_streams > 0 else []
+    return server_options(args.heartbeat, args.idle_timeout) + streams
+
+# Parse command line options
+def parse_args():
+    return make_parser().parse_args()
+
+
 def main():
-    server = grpc.server(ThreadPoolExecutor(max_workers=MAX_CLIENTS))
-    chat_pb2_grpc.add_ChatAppServicer_to_server(ChatAppService(), server)
-    server.add_insecure_port('{}:{}'.format(SERVER_IP, PORT))
+    args = parse_args()
+    wal = WriteAheadLog(args.wal, args.fsync_window, args.segment_size, args.snapshot_interval) if args.wal else NullLog()
+    spill = Spill(args.spill_dir, args.mailbox_cap, args.mailbox_budget)
+    passwords = Passwords(args.hash_workers, args.kdf_cost)
+    tokens = TokenCache(args.token_ttl)
+    limits = limits_from_args(args)
+    metrics = Metrics()
+    limit_gauges(metrics, limits)
+    export_metrics(metrics, args.metrics_port, args.metrics_json, args.metrics_interval)
+
+    # Asyncio mode: streams are coroutines, so there is no worker thread cap
+    if args.mode == 'aio':
+        asyncio.run(serve_aio(args.host, args.port, wal, args.mailbox_chunk, metrics, spill, passwords, tokens,
+                              args.require_auth, grpc_options(args), limits))
+        return
+
+    # Every RPC is timed by the interceptor (method, in flight, errors, latency histogram), then
+    # admitted if a cap is set (a refused call is timed as an error)
+    service = ChatAppService(args.keepalive, wal, args.mailbox_chunk, spill, passwords, tokens, args.require_auth, limits)
+    store_gauges(metrics, service.users)
+    metrics.gauge('chat_streams', 'Open MessageStreams', lambda: service.streams)
+    interceptors = [MetricsInterceptor(metrics)] + ([AdmissionInterceptor(limits)] if limits.capped else [])
+    server = grpc.server(ThreadPoolExecutor(max_workers=args.max_clients), interceptors=interceptors,
+                         options=grpc_options(args))
+    chat_pb2_grpc.add_ChatAppServicer_to_server(service, server)
+    server.add_insecure_port('{}:{}'.format(args.host, args.port))
     server.start()
     server.wait_for_termination()
 
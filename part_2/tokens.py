@@ -0,0 +1,85 @@
+'''
+This file implements the session tokens of the part 2 servers.
+
+CreateAccount and LoginAccount answer with a token, which the client then sends instead of its
+password: a LoginAccount, MessageStream or FetchMailbox with a valid token skips the password hash
+(about 60 ms of a hashing process each), and sends carry the token of their sender. A token is a
+random string from the secrets module, only kept in memory: it stays valid for TTL seconds after
+it was last used, and once CAPACITY tokens are held the least recently used one is dropped. After
+a server restart (or an eviction) clients log in with their password again.
+'''
+# Import relevant python packages
+from collections import OrderedDict
+import secrets
+from threading import Lock
+import time
+
+# Constants/configurations
+TTL         = 3600.0 # seconds a token stays valid after it was last used
+CAPACITY    = 100000 # tokens held before the least recently used is dropped
+TOKEN_BYTES = 24
+
+class TokenCache:
+    '''
+    Session tokens, least recently used first
+        - tokens: token -> (username, expiry time); moved to the end whenever it is used
+        - sliding: whether using a token extends its life (cluster workers cache the tokens other
+          workers checked with a fixed expiry, so a revoked one is forgotten at the latest ttl later)
+        - users: username -> its tokens (so that deleting an account revokes them)
+        - lock: guards both (the asyncio server never contends for it)
+    '''
+    def __init__(self, ttl=TTL, capacity=CAPACITY, sliding=True) -> None:
+        self.ttl      = ttl
+        self.capacity = capacity
+        self.sliding  = sliding
+        self.tokens   = OrderedDict()
+        self.users    = {}
+        self.lock     = Lock()
+
+    # New token for username
+    def issue(self, username):
+        token = secrets.token_urlsafe(TOKEN_BYTES)
+        self.add(token, username)
+        return token
+
+    # Accept token for username (also used by cluster workers to remember a token another worker checked)
+    def add(self, token, username):
+        with self.lock:
+            self.tokens[token] = (username, time.monotonic() + self.ttl)
+            self.tokens.move_to_end(token)
+            self.users.setdefault(username, set()).add(token)
+            while len(self.tokens) > self.capacity:
+                self.forget(*self.tokens.popitem(last=False))
+
+    # Whether token is a live token of username (which extends its life, if sliding)
+    def check(self, token, username):
+        now = time.monotonic()
+        with self.lock:
+            entry = self.tokens.get(token)
+            if entry is None or entry[0] != username:
+                return False
+            if entry[1] < now:
+                del self.tokens[token]
+                self.forget(token, entry)
+                return False
+            if self.sliding:
+                self.tokens[token] = (username, now + self.ttl)
+            self.tokens.move_to_end(token)
+            return True
+
+    # Drop every token of username
+    def revoke(self, username):
+        with self.lock:
+            for token in self.users.pop(username, ()):
+                del self.tokens[token]
+
+    # Drop token from its user's set (lock held)
+    def forget(self, token, entry):
+        tokens = self.users.get(entry[0])
+        if tokens is not None:
+            tokens.discard(token)
+            if not tokens:
+                del self.users[entry[0]]
+
+    def __len__(self):
+        return len(self.tokens)